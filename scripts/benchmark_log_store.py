@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+###############################################################################
+##
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah. 
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without 
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice, 
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright 
+##    notice, this list of conditions and the following disclaimer in the 
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the University of Utah nor the names of its 
+##    contributors may be used to endorse or promote products derived from 
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, 
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR 
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR 
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, 
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, 
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; 
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, 
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR 
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF 
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+"""Compares the appended XML execution log with the LogStore.
+
+The same synthetic workflow executions, each with MODULES module
+executions, are appended to both. Then the executions of one workflow
+version are read back: from the XML log, which has to be parsed entirely
+with open_log_from_xml(), and from the store, which only reads the
+matching records.
+
+Usage: benchmark_log_store.py [executions ...]
+"""
+
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+MODULES = 20
+VERSIONS = 100
+
+
+def make_workflow_exec(i):
+    from vistrails.db.domain import DBMachine, DBModuleExec, DBWorkflowExec
+
+    ts = datetime.datetime(2014, 1, 1) + datetime.timedelta(seconds=i)
+    item_execs = [DBModuleExec(id=j, module_id=j, module_name='String',
+                               ts_start=ts, ts_end=ts, cached=0, completed=1,
+                               machine_id=1)
+                  for j in xrange(MODULES)]
+    return DBWorkflowExec(id=i, user='bench', ip='127.0.0.1', session=0,
+                          vt_version='2.2', ts_start=ts, ts_end=ts,
+                          parent_id=1, parent_type='vistrail',
+                          parent_version=i % VERSIONS, completed=1,
+                          item_execs=item_execs,
+                          machines=[DBMachine(id=1, name='localhost',
+                                              os='Linux', ram=0)])
+
+
+def main(sizes):
+    from vistrails.db.domain import DBLog
+    from vistrails.db.services import io
+    from vistrails.db.services.log import LogStore
+
+    print '%10s %8s %10s %10s %10s' % ('execs', 'log', 'size (MB)',
+                                       'append (s)', 'query (s)')
+    for executions in sizes:
+        directory = tempfile.mkdtemp(prefix='vt_bench_')
+        try:
+            xml_fname = os.path.join(directory, 'log.xml')
+            store_fname = os.path.join(directory, 'log.store')
+
+            start = time.time()
+            for i in xrange(executions):
+                io.save_log_to_xml(
+                        DBLog(workflow_execs=[make_workflow_exec(i)]),
+                        xml_fname, do_append=True)
+            append = time.time() - start
+            start = time.time()
+            log = io.open_log_from_xml(xml_fname, True)
+            found = [wf_exec for wf_exec in log.db_workflow_execs
+                     if wf_exec.db_parent_version == 7]
+            query = time.time() - start
+            assert len(found) == len(range(7, executions, VERSIONS))
+            print '%10d %8s %10.1f %10.2f %10.2f' % (
+                    executions, 'xml',
+                    os.path.getsize(xml_fname) / (1024.0 * 1024.0),
+                    append, query)
+            del log, found
+
+            store = LogStore(store_fname)
+            start = time.time()
+            for i in xrange(executions):
+                store.append(make_workflow_exec(i))
+            append = time.time() - start
+            store.close()
+            start = time.time()
+            store = LogStore(store_fname)
+            found = list(store.find_workflow_execs(version=7))
+            query = time.time() - start
+            assert len(found) == len(range(7, executions, VERSIONS))
+            size = (os.path.getsize(store_fname) +
+                    os.path.getsize(store.index_filename))
+            print '%10d %8s %10.1f %10.2f %10.2f' % (
+                    executions, 'store', size / (1024.0 * 1024.0),
+                    append, query)
+            store.close()
+        finally:
+            shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main([int(a) for a in sys.argv[1:]])
+    else:
+        main([1000, 10000])
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+###############################################################################
+##
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah. 
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without 
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice, 
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright 
+##    notice, this list of conditions and the following disclaimer in the 
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the University of Utah nor the names of its 
+##    contributors may be used to endorse or promote products derived from 
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, 
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR 
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR 
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, 
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, 
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; 
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, 
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR 
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF 
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+"""Measures the cost of bringing pipeline signatures up to date after
+changing a single parameter, for growing pipeline sizes.
+
+The pipelines are made of independent chains of String modules. Each edit
+changes the value of one module and then calls refresh_signatures(), as the
+cached interpreter does before every execution. The 'full' column shows
+the cost of rehashing everything, which is what used to happen.
+
+Usage: benchmark_signatures.py [size ...]
+"""
+
+import random
+import sys
+import timeit
+
+import vistrails.core.application
+import vistrails.core.db.action
+from vistrails.core.system import get_vistrails_basic_pkg_id
+from vistrails.core.vistrail.connection import Connection
+from vistrails.core.vistrail.module import Module
+from vistrails.core.vistrail.module_function import ModuleFunction
+from vistrails.core.vistrail.module_param import ModuleParam
+from vistrails.core.vistrail.pipeline import Pipeline
+from vistrails.core.vistrail.port import Port
+from vistrails.db.domain import IdScope
+
+CHAIN_LENGTH = 10
+EDITS = 50
+
+
+def build_pipeline(size, id_scope):
+    basic_pkg = get_vistrails_basic_pkg_id()
+    modules = []
+    connections = []
+    for i in xrange(size):
+        param = ModuleParam(id=id_scope.getNewId(ModuleParam.vtType),
+                            pos=0, type='String', val=str(i))
+        function = ModuleFunction(id=id_scope.getNewId(ModuleFunction.vtType),
+                                  name='value', parameters=[param])
+        modules.append(Module(id=id_scope.getNewId(Module.vtType),
+                              name='String', package=basic_pkg,
+                              functions=[function]))
+        if i % CHAIN_LENGTH:
+            ports = [Port(id=id_scope.getNewId(Port.vtType), type='source',
+                          moduleId=i - 1, name='value'),
+                     Port(id=id_scope.getNewId(Port.vtType),
+                          type='destination', moduleId=i, name='value')]
+            connections.append(Connection(
+                    id=id_scope.getNewId(Connection.vtType), ports=ports))
+    pipeline = Pipeline(modules=modules, connections=connections)
+    pipeline.build_index()
+    pipeline.refresh_signatures()
+    return pipeline
+
+
+def edit(pipeline, id_scope, module_id, value):
+    function = pipeline.modules[module_id].functions[0]
+    old_param = function.params[0]
+    new_param = ModuleParam(id=id_scope.getNewId(ModuleParam.vtType),
+                            pos=0, type='String', val=value)
+    action = vistrails.core.db.action.create_action([('change', old_param,
+                                                      new_param,
+                                                      function.vtType,
+                                                      function.real_id)])
+    pipeline.perform_action(action)
+
+
+def measure(size):
+    id_scope = IdScope()
+    pipeline = build_pipeline(size, id_scope)
+    rand = random.Random(size)
+    counter = [0]
+
+    def incremental():
+        counter[0] += 1
+        edit(pipeline, id_scope, rand.randrange(size), 'v%d' % counter[0])
+        pipeline.refresh_signatures()
+
+    def full():
+        counter[0] += 1
+        edit(pipeline, id_scope, rand.randrange(size), 'v%d' % counter[0])
+        pipeline.clear_signatures()
+        pipeline.refresh_signatures()
+
+    return (min(timeit.repeat(incremental, number=EDITS, repeat=3)) / EDITS,
+            min(timeit.repeat(full, number=EDITS, repeat=3)) / EDITS)
+
+
+def main(sizes):
+    vistrails.core.application.init({'batch': True,
+                                     'enablePackagesSilently': True,
+                                     'singleInstance': False,
+                                     'executionLog': False},
+                                    args=[])
+    print '%10s %16s %16s' % ('modules', 'per edit (ms)', 'full (ms)')
+    for size in sizes:
+        incremental, full = measure(size)
+        print '%10d %16.3f %16.3f' % (size, incremental * 1000.0,
+                                      full * 1000.0)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main([int(a) for a in sys.argv[1:]])
+    else:
+        main([100, 1000, 5000])
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+###############################################################################
+##
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah. 
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without 
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice, 
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright 
+##    notice, this list of conditions and the following disclaimer in the 
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the University of Utah nor the names of its 
+##    contributors may be used to endorse or promote products derived from 
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, 
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR 
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR 
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, 
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, 
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; 
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, 
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR 
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF 
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+"""Measures the table operations of the tabledata package on large tables.
+
+A table with a text key column (1000 distinct keys) and two numeric
+columns goes through a select -> project -> aggregate chain, and is joined
+with a table of the keys. Each operation is timed with the NumPy
+implementation and with the plain Python one that is used when NumPy is
+not installed; the latter is skipped above PYTHON_MAX_ROWS rows.
+
+Usage: benchmark_tabledata.py [rows ...]
+"""
+
+import sys
+import time
+
+import numpy
+
+from vistrails.packages.tabledata import operations
+from vistrails.packages.tabledata.common import TableObject
+
+KEYS = 1000
+PYTHON_MAX_ROWS = 1000000
+
+
+def build_tables(rows):
+    rand = numpy.random.RandomState(rows)
+    keys = ['key%d' % k for k in rand.randint(0, KEYS, rows)]
+    table = TableObject([keys,
+                         rand.uniform(-100.0, 100.0, rows).astype(
+                             numpy.float32),
+                         rand.randint(0, 1000, rows).astype(numpy.float32)],
+                        rows, ['key', 'x', 'y'])
+    other = TableObject([['KEY%d' % k for k in xrange(KEYS)],
+                         range(KEYS)],
+                        KEYS, ['key', 'id'])
+    return table, other
+
+
+def select(table):
+    column = table.get_column(1, True)
+    if operations.numpy is not None:
+        rows = numpy.nonzero(operations.SelectFromTable.make_mask(
+                column, 0.0, '>='))[0]
+    else:
+        condition = operations.SelectFromTable.make_condition(0.0, '>=')
+        rows = [i for i, v in enumerate(column) if condition(v)]
+    return operations.SelectedTable(table, rows)
+
+
+def chain(table):
+    selected = select(table)
+    projected = operations.ProjectedTable(selected, [0, 2], ['key', 'y'])
+    aggregated = operations.AggregatedTable(projected, 'average', 1, 0)
+    return aggregated.get_column(1, True)
+
+
+def join(table, other):
+    joined = operations.JoinedTables(table, other, 0, 0)
+    return joined.get_column(4, True)
+
+
+def timed(func, *args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+
+def measure(rows, use_numpy):
+    table, other = build_tables(rows)
+    saved = operations.numpy
+    if not use_numpy:
+        operations.numpy = None
+    try:
+        return [timed(select, table),
+                timed(chain, table),
+                timed(join, table, other)]
+    finally:
+        operations.numpy = saved
+
+
+def main(sizes):
+    print '%10s %8s %12s %12s %12s' % ('rows', 'impl', 'select (s)',
+                                       'chain (s)', 'join (s)')
+    for rows in sizes:
+        print '%10d %8s %12.3f %12.3f %12.3f' % (
+                (rows, 'numpy') + tuple(measure(rows, True)))
+        if rows <= PYTHON_MAX_ROWS:
+            print '%10d %8s %12.3f %12.3f %12.3f' % (
+                    (rows, 'python') + tuple(measure(rows, False)))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main([int(a) for a in sys.argv[1:]])
+    else:
+        main([1000000, 10000000])
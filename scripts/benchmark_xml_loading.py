@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+###############################################################################
+##
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah. 
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without 
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice, 
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright 
+##    notice, this list of conditions and the following disclaimer in the 
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the University of Utah nor the names of its 
+##    contributors may be used to endorse or promote products derived from 
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, 
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR 
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR 
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, 
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, 
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; 
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, 
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR 
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF 
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+"""Measures the time and memory needed to open large vistrail files.
+
+A synthetic vistrail is written at the current schema version: a chain of
+actions that each add a module with a function and a parameter, branching
+every BRANCH actions. It is then opened in a fresh process, either by
+parsing the whole tree (the previous behavior) or with
+open_vistrail_from_xml(), which streams it. The peak resident memory of
+the process is reported along with the load time.
+
+Usage: benchmark_xml_loading.py [actions ...]
+"""
+
+import datetime
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+BRANCH = 50
+
+
+def write_vistrail(filename, actions):
+    """Writes a vistrail with the given number of actions, one at a time.
+    """
+    from vistrails.core.system import get_elementtree_library
+    from vistrails.db.domain import DBAction, DBAdd, DBFunction, DBModule, \
+        DBParameter
+    from vistrails.db.versions import currentVersion, getVersionDAO
+
+    ElementTree = get_elementtree_library()
+    dao_list = getVersionDAO(currentVersion)
+    date = datetime.datetime(2014, 1, 1)
+    with open(filename, 'wb') as fp:
+        fp.write('<vistrail id="" name="" version="%s">\n' % currentVersion)
+        for i in xrange(1, actions + 1):
+            base = i * 10
+            module = DBModule(id=base, name='String', namespace='',
+                              package='org.vistrails.vistrails.basic',
+                              version='1.6', cache=1)
+            function = DBFunction(id=base + 1, pos=0, name='value')
+            parameter = DBParameter(id=base + 2, pos=0, name='<no description>',
+                                    type='org.vistrails.vistrails.basic:String',
+                                    val='value %d' % i, alias='')
+            ops = [DBAdd(id=base + 3, what='module', objectId=base,
+                         data=module),
+                   DBAdd(id=base + 4, what='function', objectId=base + 1,
+                         parentObjId=base, parentObjType='module',
+                         data=function),
+                   DBAdd(id=base + 5, what='parameter', objectId=base + 2,
+                         parentObjId=base + 1, parentObjType='function',
+                         data=parameter)]
+            parent = i - 1 if i % BRANCH else max(i - BRANCH, 0)
+            action = DBAction(id=i, prevId=parent, date=date, user='bench',
+                              session=0, operations=ops)
+            node = dao_list.write_xml_object(action,
+                                             ElementTree.Element('action'))
+            fp.write(ElementTree.tostring(node))
+            fp.write('\n')
+        fp.write('</vistrail>\n')
+
+
+def load(filename, mode):
+    """Opens the file in this process and prints time and peak memory.
+    """
+    from vistrails.core.system import get_elementtree_library
+    from vistrails.db.domain import DBVistrail
+    from vistrails.db.services import io
+    import vistrails.db.services.vistrail
+    from vistrails.db.versions import getVersionDAO, translate_vistrail
+
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    if mode == 'tree':
+        ElementTree = get_elementtree_library()
+        tree = ElementTree.parse(filename)
+        version = io.get_version_for_xml(tree.getroot())
+        vistrail = getVersionDAO(version).open_from_xml(
+                filename, DBVistrail.vtType, tree)
+        del tree
+        vistrail = translate_vistrail(vistrail, version)
+        vistrails.db.services.vistrail.update_id_scope(vistrail)
+    else:
+        vistrail = io.open_vistrail_from_xml(filename)
+    elapsed = time.time() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss
+    assert vistrail.db_actions
+    print elapsed, peak
+
+
+def measure(filename, mode):
+    output = subprocess.check_output([sys.executable, __file__,
+                                      '--load', mode, filename])
+    elapsed, peak = output.split()
+    return float(elapsed), int(peak) / 1024.0
+
+
+def main(sizes):
+    print '%10s %10s %8s %10s %12s' % ('actions', 'size (MB)', 'loader',
+                                       'time (s)', 'peak (MB)')
+    for actions in sizes:
+        fd, filename = tempfile.mkstemp(prefix='vt_bench_', suffix='.xml')
+        os.close(fd)
+        try:
+            write_vistrail(filename, actions)
+            size = os.path.getsize(filename) / (1024.0 * 1024.0)
+            for mode in ('tree', 'stream'):
+                print '%10d %10.1f %8s %10.2f %12.1f' % (
+                        (actions, size, mode) + measure(filename, mode))
+        finally:
+            os.unlink(filename)
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == '--load':
+        load(sys.argv[3], sys.argv[2])
+    elif len(sys.argv) > 1:
+        main([int(a) for a in sys.argv[1:]])
+    else:
+        main([10000, 100000])
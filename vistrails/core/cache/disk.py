@@ -0,0 +1,258 @@
+###############################################################################
+##
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah. 
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without 
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice, 
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright 
+##    notice, this list of conditions and the following disclaimer in the 
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the University of Utah nor the names of its 
+##    contributors may be used to endorse or promote products derived from 
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, 
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR 
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR 
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, 
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, 
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; 
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, 
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR 
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF 
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+"""On-disk store for module results, keyed by subpipeline signature.
+
+The signature of a module in the persistent pipeline identifies its result
+exactly, so results can be kept across processes: DiskResultCache stores the
+output values of cacheable modules in a directory, as one pickle file per
+signature. Files are written to a temporary name then renamed, so several
+processes on the same host can share a directory. The total size is capped,
+and the least recently used entries are removed first.
+
+"""
+
+import cPickle as pickle
+import errno
+import os
+import tempfile
+
+from vistrails.core import debug
+
+##############################################################################
+
+class UnserializableValue(Exception):
+    """Raised while pickling results that should not be stored."""
+
+
+class DiskResultCache(object):
+    """Content-addressed store of module outputs.
+
+    Entries are dictionaries mapping output port names to values; they are
+    addressed by the hexadecimal signature of the module. The modification
+    time of an entry is updated when it is read, and is used to evict the
+    least recently used entries once max_size (in bytes) is exceeded.
+    """
+    def __init__(self, directory, max_size=None):
+        self.directory = directory
+        self.max_size = max_size
+        self._size = None
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def _path(self, signature):
+        return os.path.join(self.directory, signature[:2], signature)
+
+    def get(self, signature):
+        """get(signature: str) -> dict or None
+
+        Returns the output values stored for this signature, or None.
+        """
+        path = self._path(signature)
+        try:
+            with open(path, 'rb') as fp:
+                outputs = pickle.load(fp)
+        except IOError:
+            self.misses += 1
+            return None
+        except Exception, e:
+            # Corrupted entry, or class that no longer exists
+            debug.warning("Discarding cached result %s" % signature, e)
+            self._remove(path)
+            self.misses += 1
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        self.hits += 1
+        return outputs
+
+    def put(self, signature, outputs, reject=None):
+        """put(signature: str, outputs: dict, reject: callable) -> bool
+
+        Stores output values for this signature. reject is called on every
+        object being pickled and can return True to prevent the entry from
+        being stored. Returns whether the values were stored.
+        """
+        path = self._path(signature)
+        if os.path.exists(path):
+            return True
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.mkdir(dirname)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp', dir=dirname)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                pickler = pickle.Pickler(fp, pickle.HIGHEST_PROTOCOL)
+                if reject is not None:
+                    def persistent_id(obj):
+                        if reject(obj):
+                            raise UnserializableValue
+                        return None
+                    pickler.persistent_id = persistent_id
+                pickler.dump(outputs)
+            size = os.path.getsize(tmp_path)
+            os.rename(tmp_path, path)
+        except Exception:
+            # Values that can't be pickled are simply not stored
+            self._remove(tmp_path)
+            return False
+        self.writes += 1
+        if self._size is not None:
+            self._size += size
+        if self.max_size is not None and self.size() > self.max_size:
+            self.collect()
+        return True
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _entries(self):
+        """Lists (mtime, size, path) for every stored entry."""
+        entries = []
+        for dirname in os.listdir(self.directory):
+            dirpath = os.path.join(self.directory, dirname)
+            if not os.path.isdir(dirpath):
+                continue
+            for filename in os.listdir(dirpath):
+                if filename.startswith('.tmp'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    # Removed by another process
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def size(self):
+        """size() -> int
+
+        Returns the total size of the stored entries, in bytes. This only
+        scans the directory the first time, and after a collection.
+        """
+        if self._size is None:
+            self._size = sum(e[1] for e in self._entries())
+        return self._size
+
+    def collect(self):
+        """collect() -> None
+
+        Removes the least recently used entries until the store is below 90%
+        of its maximum size.
+        """
+        entries = self._entries()
+        size = sum(e[1] for e in entries)
+        if self.max_size is not None and size > self.max_size:
+            target = self.max_size * 9 // 10
+            entries.sort()
+            for mtime, entry_size, path in entries:
+                if size <= target:
+                    break
+                self._remove(path)
+                size -= entry_size
+                self.evictions += 1
+        self._size = size
+
+    def clear(self):
+        """clear() -> None
+
+        Removes all the stored entries.
+        """
+        for mtime, size, path in self._entries():
+            self._remove(path)
+        self._size = 0
+
+##############################################################################
+
+import shutil
+import unittest
+
+class TestDiskResultCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='vt_results_')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_store(self):
+        cache = DiskResultCache(self.directory)
+        self.assertIsNone(cache.get('ab01'))
+        self.assertTrue(cache.put('ab01', {'value': [1, 2, 3]}))
+        self.assertEqual(cache.get('ab01'), {'value': [1, 2, 3]})
+        # Another instance sees the same entries
+        other = DiskResultCache(self.directory)
+        self.assertEqual(other.get('ab01'), {'value': [1, 2, 3]})
+        self.assertEqual((cache.hits, cache.misses, cache.writes), (1, 1, 1))
+
+    def test_unpicklable(self):
+        cache = DiskResultCache(self.directory)
+        self.assertFalse(cache.put('ab01', {'value': lambda: 42}))
+        self.assertFalse(cache.put('ab02', {'value': ['a', set([4])]},
+                                   reject=lambda o: isinstance(o, set)))
+        self.assertIsNone(cache.get('ab01'))
+        self.assertIsNone(cache.get('ab02'))
+        self.assertEqual(cache.size(), 0)
+
+    def test_collect(self):
+        cache = DiskResultCache(self.directory, 3000)
+        data = 'a' * 1000
+        cache.put('aa01', {'value': data})
+        cache.put('aa02', {'value': data})
+        os.utime(cache._path('aa01'), (0, 0))
+        os.utime(cache._path('aa02'), (1, 1))
+        cache.get('aa01')
+        cache.put('aa03', {'value': data})
+        self.assertEqual(cache.evictions, 1)
+        self.assertIsNone(cache.get('aa02'))
+        self.assertIsNotNone(cache.get('aa01'))
+        self.assertIsNotNone(cache.get('aa03'))
+        self.assertLessEqual(cache.size(), 3000)
@@ -0,0 +1,425 @@
+###############################################################################
+##
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah. 
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without 
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice, 
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright 
+##    notice, this list of conditions and the following disclaimer in the 
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the University of Utah nor the names of its 
+##    contributors may be used to endorse or promote products derived from 
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, 
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR 
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR 
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, 
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, 
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; 
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, 
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR 
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF 
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+"""Signatures of files and directories, used to detect when they change.
+
+FileSignatureIndex identifies a file by its path and (inode, size,
+modification time in nanoseconds). In the default mode, this metadata is the
+signature; in content mode, the SHA-1 digest of the contents is used, and is
+kept in an index so that a file is only read again once its metadata
+changed. Files that need hashing are read in large chunks on a thread pool.
+The signature of a directory combines the relative names and signatures of
+everything it contains.
+
+Like git's index, a digest is only kept if the file's modification time is
+before the second in which it was read: a file modified again within that
+second could keep the same metadata, so it is read again on the next call.
+The index keeps the most recently used files, up to max_entries.
+
+"""
+
+import atexit
+from collections import OrderedDict
+import cPickle as pickle
+import errno
+import hashlib
+from multiprocessing.pool import ThreadPool
+import os
+import tempfile
+import threading
+import time
+
+from vistrails.core import debug
+from vistrails.core.configuration import get_vistrails_configuration
+from vistrails.core.system import current_dot_vistrails
+
+##############################################################################
+
+INDEX_VERSION = 2
+CHUNK_SIZE = 1 << 20
+MAX_ENTRIES = 50000
+
+
+def stat_key(st):
+    """stat_key(st: stat_result) -> tuple
+
+    Returns the metadata identifying a version of a file.
+    """
+    return (st.st_ino, st.st_size, int(round(st.st_mtime * 1e9)))
+
+
+def hash_file(filename, chunk_size=CHUNK_SIZE):
+    """hash_file(filename: str) -> str
+
+    Returns the hexadecimal SHA-1 digest of a file's contents.
+    """
+    hasher = hashlib.sha1()
+    with open(filename, 'rb') as fp:
+        while True:
+            block = fp.read(chunk_size)
+            if not block:
+                break
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+class FileSignatureIndex(object):
+    """Computes file and directory signatures, remembering content digests.
+
+    If filename is given, the content digests are loaded from and saved to
+    that file. hash_function computes the digest of a file's contents,
+    threads is the number of files hashed concurrently and max_entries the
+    number of digests kept.
+    """
+    def __init__(self, filename=None, content=False, threads=4,
+                 hash_function=hash_file, max_entries=MAX_ENTRIES):
+        self.filename = filename
+        self.content = content
+        self.threads = threads
+        self.hash_function = hash_function
+        self.max_entries = max_entries
+        # path -> (stat key, hexdigest), least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._pool = None
+        self._dirty = False
+        self.hashed = 0
+        if filename is not None:
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self.filename, 'rb') as fp:
+                version, entries = pickle.load(fp)
+        except IOError:
+            return
+        except Exception, e:
+            debug.warning("Discarding file signature index %s" %
+                          self.filename, e)
+            return
+        if version == INDEX_VERSION:
+            self._entries = entries
+
+    def save(self):
+        """save() -> None
+
+        Writes the content digests to the index file, if they changed.
+        """
+        if self.filename is None or not self._dirty:
+            return
+        self.clean()
+        with self._lock:
+            entries = dict(self._entries)
+            self._dirty = False
+        dirname = os.path.dirname(self.filename)
+        try:
+            fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as fp:
+                    pickle.dump((INDEX_VERSION, entries), fp,
+                                pickle.HIGHEST_PROTOCOL)
+                if os.name == 'nt' and os.path.exists(self.filename):
+                    os.remove(self.filename)
+                os.rename(tmp, self.filename)
+            except Exception:
+                os.remove(tmp)
+                raise
+        except (IOError, OSError), e:
+            debug.warning("Couldn't save file signature index %s" %
+                          self.filename, e)
+
+    def clean(self):
+        """clean() -> None
+
+        Forgets the files that no longer exist, then the least recently used
+        ones over max_entries.
+        """
+        with self._lock:
+            paths = self._entries.keys()
+        removed = [path for path in paths if not os.path.isfile(path)]
+        with self._lock:
+            for path in removed:
+                if self._entries.pop(path, None) is not None:
+                    self._dirty = True
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._dirty = True
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _map(self, function, items):
+        if self.threads > 1 and len(items) > 1:
+            if self._pool is None:
+                self._pool = ThreadPool(self.threads)
+            return self._pool.map(function, items, chunksize=1)
+        return map(function, items)
+
+    def digests(self, files, content=None):
+        """digests(files: list of (str, tuple), content: bool) -> list
+
+        Returns the signatures of a list of (absolute path, stat key) pairs.
+        """
+        if content is None:
+            content = self.content
+        if not content:
+            return ['%d:%d:%d' % key for path, key in files]
+        digests = [None] * len(files)
+        stale = []
+        with self._lock:
+            for i, (path, key) in enumerate(files):
+                entry = self._entries.pop(path, None)
+                if entry is not None and entry[0] == key:
+                    digests[i] = entry[1]
+                    self._entries[path] = entry
+                else:
+                    stale.append(i)
+        if stale:
+            # files modified in this second could change again unnoticed
+            racy = int(time.time()) * 1000000000
+            hashed = self._map(self.hash_function,
+                               [files[i][0] for i in stale])
+            with self._lock:
+                for i, digest in zip(stale, hashed):
+                    digests[i] = digest
+                    if files[i][1][2] < racy:
+                        self._entries[files[i][0]] = (files[i][1], digest)
+                self.hashed += len(stale)
+                self._dirty = True
+        return digests
+
+    def signature(self, path, content=None):
+        """signature(path: str, content: bool) -> str
+
+        Returns the signature of a file or directory, hashing the contents
+        of files if content is True (defaults to the index's mode). Raises
+        OSError if the path doesn't exist.
+        """
+        if content is None:
+            content = self.content
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        if not os.path.isdir(path):
+            return self.digests([(path, stat_key(st))], content)[0]
+
+        names = []
+        files = []
+        for dirpath, dirnames, filenames in os.walk(path, onerror=_raise):
+            dirnames.sort()
+            reldir = os.path.relpath(dirpath, path)
+            for name in dirnames:
+                names.append((os.path.normpath(os.path.join(reldir, name)),
+                              None))
+            for name in sorted(filenames):
+                filename = os.path.join(dirpath, name)
+                try:
+                    key = stat_key(os.stat(filename))
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    continue # dangling link, or removed since listed
+                names.append((os.path.normpath(os.path.join(reldir, name)),
+                              len(files)))
+                files.append((filename, key))
+        digests = self.digests(files, content)
+
+        hasher = hashlib.sha1()
+        for name, i in sorted(names):
+            hasher.update(name)
+            hasher.update('\0')
+            if i is not None:
+                hasher.update(digests[i])
+            hasher.update('\n')
+        return hasher.hexdigest()
+
+    def forget(self, path):
+        """forget(path: str) -> None
+
+        Removes the digests of a file, or of everything in a directory.
+        """
+        path = os.path.abspath(path)
+        prefix = os.path.join(path, '')
+        with self._lock:
+            for p in [p for p in self._entries
+                      if p == path or p.startswith(prefix)]:
+                del self._entries[p]
+                self._dirty = True
+
+
+def _raise(e):
+    raise e
+
+
+_index = None
+
+def get_file_signatures():
+    """get_file_signatures() -> FileSignatureIndex
+
+    Returns the index shared by this process. Its mode follows the
+    contentSignatures setting; the digests are kept in the per-user
+    directory.
+    """
+    global _index
+    conf = get_vistrails_configuration()
+    if _index is None:
+        filename = None
+        try:
+            filename = os.path.join(current_dot_vistrails(),
+                                    'file_signatures')
+        except AttributeError:
+            pass
+        _index = FileSignatureIndex(filename)
+        atexit.register(_index.save)
+    _index.content = bool(conf is not None and
+                          conf.check('contentSignatures'))
+    return _index
+
+##############################################################################
+
+import shutil
+import unittest
+
+
+class TestFileSignatureIndex(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='vt_filesig_')
+        self.data = os.path.join(self.directory, 'data')
+        os.mkdir(self.data)
+        os.mkdir(os.path.join(self.data, 'sub'))
+        self.write('a.txt', 'first')
+        self.write('sub/b.txt', 'second')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, data, racy=False):
+        filename = os.path.join(self.data, name)
+        with open(filename, 'wb') as fp:
+            fp.write(data)
+        if not racy:
+            mtime = time.time() - 10
+            os.utime(filename, (mtime, mtime))
+        return filename
+
+    def test_file(self):
+        index = FileSignatureIndex(content=True)
+        filename = os.path.join(self.data, 'a.txt')
+        self.assertEqual(index.signature(filename),
+                         hashlib.sha1('first').hexdigest())
+        self.assertEqual(index.hashed, 1)
+        index.signature(filename)
+        self.assertEqual(index.hashed, 1)
+        st = os.stat(filename)
+        self.write('a.txt', 'third')
+        os.utime(filename, (st.st_atime, st.st_mtime + 1))
+        self.assertEqual(index.signature(filename),
+                         hashlib.sha1('third').hexdigest())
+        self.assertEqual(index.hashed, 2)
+        self.assertRaises(OSError, index.signature,
+                          os.path.join(self.data, 'missing'))
+
+    def test_directory(self):
+        index = FileSignatureIndex(content=True)
+        s1 = index.signature(self.data)
+        self.assertEqual(index.hashed, 2)
+        self.assertEqual(index.signature(self.data), s1)
+        self.assertEqual(index.hashed, 2)
+        # Only the new file is read
+        self.write('sub/c.txt', 'third')
+        s2 = index.signature(self.data)
+        self.assertNotEqual(s2, s1)
+        self.assertEqual(index.hashed, 3)
+        # Directories are part of the signature
+        os.mkdir(os.path.join(self.data, 'empty'))
+        s3 = index.signature(self.data)
+        self.assertNotEqual(s3, s2)
+        self.assertEqual(index.hashed, 3)
+        # Copies have different metadata but the same contents
+        copy = os.path.join(self.directory, 'copy')
+        shutil.copytree(self.data, copy)
+        self.assertNotEqual(index.signature(copy, content=False),
+                            index.signature(self.data, content=False))
+        self.assertEqual(index.signature(copy), s3)
+        self.assertEqual(index.hashed, 6)
+
+    def test_persistent(self):
+        filename = os.path.join(self.directory, 'index')
+        index = FileSignatureIndex(filename, content=True)
+        sig = index.signature(self.data)
+        index.save()
+        index = FileSignatureIndex(filename, content=True)
+        self.assertEqual(len(index), 2)
+        self.assertEqual(index.signature(self.data), sig)
+        self.assertEqual(index.hashed, 0)
+        index.forget(os.path.join(self.data, 'sub'))
+        self.assertEqual(len(index), 1)
+
+    def test_hash_function(self):
+        index = FileSignatureIndex(content=True, hash_function=os.path.basename)
+        files = [(os.path.join(self.data, name),
+                  stat_key(os.stat(os.path.join(self.data, name))))
+                 for name in ('a.txt', 'sub/b.txt')]
+        self.assertEqual(index.digests(files), ['a.txt', 'b.txt'])
+        self.assertEqual(index.digests(files, content=False)[0],
+                         '%d:%d:%d' % files[0][1])
+
+    def test_racy(self):
+        index = FileSignatureIndex(content=True)
+        filename = self.write('a.txt', 'first', racy=True)
+        index.signature(filename)
+        index.signature(filename)
+        self.assertEqual(index.hashed, 2)
+        self.assertEqual(len(index), 0)
+        mtime = time.time() - 10
+        os.utime(filename, (mtime, mtime))
+        index.signature(filename)
+        index.signature(filename)
+        self.assertEqual(index.hashed, 3)
+
+    def test_clean(self):
+        filename = os.path.join(self.directory, 'index')
+        index = FileSignatureIndex(filename, content=True, max_entries=2)
+        index.signature(self.data)
+        self.write('c.txt', 'third')
+        index.signature(os.path.join(self.data, 'c.txt'))
+        index.signature(os.path.join(self.data, 'a.txt'))
+        index.save()
+        # b.txt was the least recently used
+        index = FileSignatureIndex(filename, content=True)
+        self.assertEqual(len(index), 2)
+        index.signature(os.path.join(self.data, 'a.txt'))
+        self.assertEqual(index.hashed, 0)
+        os.remove(os.path.join(self.data, 'c.txt'))
+        index.clean()
+        self.assertEqual(len(index), 1)
@@ -33,19 +33,21 @@
 ##
 ###############################################################################
 """Hasher class for vistrail items."""
-from vistrails.core.cache.utils import hash_list
+from base64 import b16encode, b16decode
 
-try:
-    import hashlib
-    sha_hash = hashlib.sha1
-except ImportError:
-    import sha
-    sha_hash = sha.new
+from vistrails.core.cache.utils import hash_list, hash_backends, \
+    get_hash_backend, set_hash_backend, new_hash, DEFAULT_HASH_BACKEND
+from vistrails.core.utils import xor, long2bytes
+
+import unittest
 
 ##############################################################################
 
 class Hasher(object):
 
+    get_backend = staticmethod(get_hash_backend)
+    set_backend = staticmethod(set_hash_backend)
+
     @staticmethod
     def parameter_signature(p, constant_hasher_map={}):
         k = (p.identifier, p.type, p.namespace)
@@ -53,7 +55,7 @@ class Hasher(object):
         if custom_hasher:
             return custom_hasher(p)
         else:
-            hasher = sha_hash()
+            hasher = new_hash()
             u = hasher.update
             u(p.type)
             u(p.identifier)
@@ -65,7 +67,7 @@ class Hasher(object):
 
     @staticmethod
     def function_signature(function, constant_hasher_map={}):
-        hasher = sha_hash()
+        hasher = new_hash()
         u = hasher.update
         u(function.name)
         u(function.returnType)
@@ -76,7 +78,7 @@ class Hasher(object):
 
     @staticmethod
     def control_param_signature(control_param, constant_hasher_map={}):
-        hasher = sha_hash()
+        hasher = new_hash()
         u = hasher.update
         u(control_param.name)
         u(control_param.value)
@@ -84,7 +86,7 @@ class Hasher(object):
 
     @staticmethod
     def connection_signature(c):
-        hasher = sha_hash()
+        hasher = new_hash()
         u = hasher.update
         u(c.source.name)
         u(c.destination.name)
@@ -96,28 +98,62 @@ class Hasher(object):
         subpipelines
 
         """
-        hasher = sha_hash()
+        hasher = new_hash()
         u = hasher.update
         u(Hasher.connection_signature(c))
         u(source_sig)
         u(dest_sig)
         return hasher.digest()
 
+    @staticmethod
+    def _descriptor_hasher(descriptor):
+        hasher = new_hash()
+        u = hasher.update
+        u(descriptor.name)
+        u(descriptor.package)
+        u(descriptor.namespace or '')
+        u(descriptor.package_version or '')
+        u(descriptor.version or '')
+        return hasher
+
     @staticmethod
     def module_signature(obj, constant_hasher_map={}):
-        hasher = sha_hash()
+        hasher = Hasher._descriptor_hasher(obj.module_descriptor)
         u = hasher.update
-        u(obj.module_descriptor.name)
-        u(obj.module_descriptor.package)
-        u(obj.module_descriptor.namespace or '')
-        u(obj.module_descriptor.package_version or '')
-        u(obj.module_descriptor.version or '')
         u(hash_list(obj.functions, Hasher.function_signature,
                     constant_hasher_map))
         u(hash_list(obj.control_parameters, Hasher.control_param_signature,
                     constant_hasher_map))
         return hasher.digest()
 
+    @staticmethod
+    def module_signatures(objs, constant_hasher_map={}):
+        """module_signatures(objs: list) -> list of signatures
+
+        Batched version of module_signature(). The part of the signature
+        that only depends on the module type is hashed once per descriptor
+        and its state copied for each module.
+
+        """
+        descriptor_hashers = {}
+        result = []
+        for obj in objs:
+            descriptor = obj.module_descriptor
+            try:
+                prefix = descriptor_hashers[id(descriptor)]
+            except KeyError:
+                prefix = Hasher._descriptor_hasher(descriptor)
+                descriptor_hashers[id(descriptor)] = prefix
+            hasher = prefix.copy()
+            u = hasher.update
+            u(hash_list(obj.functions, Hasher.function_signature,
+                        constant_hasher_map))
+            u(hash_list(obj.control_parameters,
+                        Hasher.control_param_signature,
+                        constant_hasher_map))
+            result.append(hasher.digest())
+        return result
+
     @staticmethod
     def subpipeline_signature(module_sig, upstream_sigs):
         """Returns the signature for a subpipeline, given the signatures for
@@ -126,7 +162,7 @@ class Hasher(object):
         WARNING: For efficiency, upstream_sigs is mutated!
 
         """
-        hasher = sha_hash()
+        hasher = new_hash()
         hasher.update(module_sig)
         upstream_sigs.sort()
         for pipeline_connection_sig in upstream_sigs:
@@ -140,7 +176,118 @@ class Hasher(object):
         signatures, assuming the list order is irrelevant
 
         """
-        hasher = sha_hash()
+        hasher = new_hash()
         for h in sorted(sig_list):
             hasher.update(h)
         return hasher.digest()
+
+    # Signatures stored outside of the process (module annotations, job
+    # cache) are hexadecimal strings. Those not produced by the default
+    # algorithm are prefixed with its name, e.g. 'md5-0123abcd...'
+
+    @staticmethod
+    def signature_string(sig, backend=None):
+        """signature_string(sig: str, backend: str) -> str
+        Returns the printable form of a digest."""
+        return Hasher._tag(b16encode(sig).lower(), backend)
+
+    @staticmethod
+    def _tag(hex_sig, backend):
+        if backend is None:
+            backend = get_hash_backend()
+        if backend == DEFAULT_HASH_BACKEND:
+            return hex_sig
+        return '%s-%s' % (backend, hex_sig)
+
+    @staticmethod
+    def parse_signature_string(signature):
+        """parse_signature_string(signature: str) -> (str, str)
+        Returns the algorithm and the digest of a printable signature."""
+        if '-' in signature:
+            backend, hex_sig = signature.split('-', 1)
+        else:
+            backend, hex_sig = DEFAULT_HASH_BACKEND, signature
+        return backend, b16decode(hex_sig.upper())
+
+    @staticmethod
+    def iteration_signature(signature, port_name, iteration=None):
+        """iteration_signature(signature: str, port_name: str,
+                               iteration: int) -> str
+
+        Returns the fake signature given to a module run once per element
+        or iteration by a looping module: the loop's own signature XORed
+        with the hash of the port receiving the value and the iteration
+        number. It uses the same algorithm as the loop signature.
+
+        """
+        backend, sig = Hasher.parse_signature_string(signature)
+        port_hash = hash_backends[backend]()
+        port_hash.update(port_name)
+        parts = [port_hash.digest()]
+        if iteration is not None:
+            parts.append(long2bytes(iteration, len(sig)))
+        return Hasher._tag(b16encode(xor(sig, *parts)), backend)
+
+##############################################################################
+
+class TestHasher(unittest.TestCase):
+    def tearDown(self):
+        set_hash_backend(DEFAULT_HASH_BACKEND)
+
+    def test_default_backend(self):
+        """The default backend produces the historical SHA-1 signatures."""
+        import hashlib
+        self.assertEqual(Hasher.get_backend(), 'sha1')
+        self.assertEqual(Hasher.compound_signature(['b', 'a']),
+                         hashlib.sha1('ab').digest())
+
+    def test_set_backend(self):
+        import hashlib
+        Hasher.set_backend('md5')
+        self.assertEqual(Hasher.compound_signature(['b', 'a']),
+                         hashlib.md5('ab').digest())
+        self.assertRaises(ValueError, Hasher.set_backend, 'nonexistent')
+        self.assertEqual(Hasher.get_backend(), 'md5')
+
+    def test_signature_string(self):
+        sig = Hasher.compound_signature(['a'])
+        string = Hasher.signature_string(sig)
+        self.assertEqual(string, sig.encode('hex'))
+        self.assertEqual(Hasher.parse_signature_string(string), ('sha1', sig))
+
+        Hasher.set_backend('md5')
+        sig = Hasher.compound_signature(['a'])
+        string = Hasher.signature_string(sig)
+        self.assertEqual(string, 'md5-' + sig.encode('hex'))
+        self.assertEqual(Hasher.parse_signature_string(string), ('md5', sig))
+
+    def test_iteration_signature(self):
+        import hashlib
+        sig = hashlib.sha1('loop').digest()
+        port_hash = hashlib.sha1('port').digest()
+        self.assertEqual(
+                Hasher.iteration_signature(b16encode(sig), 'port', 3),
+                b16encode(xor(sig, long2bytes(3, 20), port_hash)))
+
+        sig = hashlib.md5('loop').digest()
+        new_sig = Hasher.iteration_signature(
+                Hasher.signature_string(sig, 'md5'), 'port', 3)
+        self.assertEqual(Hasher.parse_signature_string(new_sig)[0], 'md5')
+
+    def test_module_signatures(self):
+        """The batched signatures match the individual ones."""
+        from vistrails.core.system import get_vistrails_basic_pkg_id
+        from vistrails.core.vistrail.module import Module
+        from vistrails.core.vistrail.module_function import ModuleFunction
+        from vistrails.core.vistrail.module_param import ModuleParam
+        basic_pkg = get_vistrails_basic_pkg_id()
+        modules = [Module(id=i, name=name, package=basic_pkg,
+                          functions=[ModuleFunction(name='value',
+                                                    parameters=[ModuleParam(
+                                                            type='String',
+                                                            val=str(i))])])
+                   for i, name in enumerate(['String', 'String', 'Integer'])]
+        for backend in ('sha1', 'md5'):
+            Hasher.set_backend(backend)
+            self.assertEqual(Hasher.module_signatures(modules),
+                             [Hasher.module_signature(m) for m in modules])
@@ -34,18 +34,133 @@
 ###############################################################################
 """Helper functions for cache package."""
 
+import sys
+
 try:
     import hashlib
     sha_hash = hashlib.sha1
+    md5_hash = hashlib.md5
 except ImportError:
+    import md5
     import sha
     sha_hash = sha.new
+    md5_hash = md5.new
+
+##############################################################################
+# Hash backends
+
+DEFAULT_HASH_BACKEND = 'sha1'
+
+hash_backends = {'sha1': sha_hash,
+                 'md5': md5_hash}
+
+try:
+    import xxhash
+except ImportError:
+    pass
+else:
+    if hasattr(xxhash, 'xxh3_128'):
+        hash_backends['xxh3_128'] = xxhash.xxh3_128
+
+# [name, constructor]
+_hash_backend = [DEFAULT_HASH_BACKEND, sha_hash]
+
+def get_hash_backend():
+    """get_hash_backend() -> str
+    Returns the name of the algorithm used for signatures."""
+    return _hash_backend[0]
+
+def set_hash_backend(name):
+    """set_hash_backend(name: str) -> None
+    Selects the algorithm used for signatures, among hash_backends.
+
+    Signatures computed with different algorithms are never equal, so
+    anything that caches them needs to be reset after a change.
+
+    """
+    try:
+        _hash_backend[:] = [name, hash_backends[name]]
+    except KeyError:
+        raise ValueError("Unknown hash backend %r (available: %s)" % (
+                         name, ', '.join(sorted(hash_backends))))
+
+def new_hash():
+    """new_hash() -> hash object from the current backend"""
+    return _hash_backend[1]()
 
 ##############################################################################
 
 def hash_list(lst, hasher_f, constant_hasher_map={}):
-    hasher = sha_hash()
+    hasher = new_hash()
     hash_l = [hasher_f(el, constant_hasher_map) for el in lst]
     hash_l.sort()
     for hel in hash_l: hasher.update(hel)
     return hasher.digest()
+
+_SAMPLE_SIZE = 100
+
+def estimate_size(value, max_depth=4):
+    """estimate_size(value: object, max_depth: int) -> int
+
+    Returns an estimate of the memory held by value, in bytes.
+
+    Containers are followed up to max_depth levels, and only the first
+    elements of large containers are measured and extrapolated. Objects
+    exposing 'nbytes' (such as numpy arrays) report their buffer size. Each
+    object is counted once even if it is referenced several times.
+
+    """
+    seen = set()
+    def size(obj, depth):
+        if id(obj) in seen:
+            return 0
+        seen.add(id(obj))
+        nbytes = getattr(obj, 'nbytes', None)
+        if isinstance(nbytes, (int, long)):
+            return sys.getsizeof(obj, 0) + nbytes
+        total = sys.getsizeof(obj, 0)
+        if depth >= max_depth or isinstance(obj, basestring):
+            return total
+        if isinstance(obj, dict):
+            items = obj.iteritems()
+            count = len(obj)
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            items = obj
+            count = len(obj)
+        elif hasattr(obj, '__dict__') and not isinstance(obj, type):
+            return total + size(obj.__dict__, depth + 1)
+        else:
+            return total
+        measured = 0
+        nb = 0
+        for item in items:
+            if nb == _SAMPLE_SIZE:
+                break
+            measured += size(item, depth + 1)
+            nb += 1
+        if nb:
+            total += measured * count // nb
+        return total
+    return size(value, 0)
+
+##############################################################################
+
+import unittest
+
+class TestEstimateSize(unittest.TestCase):
+    def test_string(self):
+        self.assertGreaterEqual(estimate_size('a' * 10000), 10000)
+
+    def test_containers(self):
+        lst = ['%06d' % i for i in xrange(10000)]
+        self.assertGreater(estimate_size(lst), estimate_size(lst[:100]) * 50)
+        self.assertGreater(estimate_size({'a': lst}), estimate_size(lst) - 1)
+
+    def test_shared(self):
+        s = 'a' * 10000
+        self.assertLess(estimate_size([s, s]), 2 * 10000)
+
+    def test_nbytes(self):
+        class Buffer(object):
+            nbytes = 1000000
+        self.assertGreaterEqual(estimate_size(Buffer()), 1000000)
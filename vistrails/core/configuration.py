@@ -60,6 +60,8 @@ autoConnect: Automatically connect dragged in modules
 autoSave: Automatically save backup vistrails every two minutes
 batch: Run in batch mode instead of interactive mode
 cache: Cache previous results so they may be used in future computations
+cacheMemoryLimit: Memory budget for cached results (MB)
+contentSignatures: Identify files and directories by their contents
 dataDir: Default data directory
 db: The name for the database to load the vistrail from
 dbDefault: Save vistrails in a database by default
@@ -71,6 +73,8 @@ enablePackagesSilently: Automatically enable packages when needed
 errorLog: Write errors to a log file
 execute: Execute any specified workflows
 executionLog: Track execution provenance when running workflows
+executionLogStoreDir: Directory where executions are indexed as they finish
+executionThreads: Number of threads used to run independent modules
 fileDir: Default vistrail directory
 fixedSpreadsheetCells: Draw spreadsheet cells at a fixed size
 handlerDontAsk: Do not ask about extension handling at startup
@@ -91,9 +95,13 @@ multithread: Server will start a thread for each request
 packageDir: System packages directory
 parameterExploration: Run parameter exploration instead of workflow
 parameters: List of parameters to use when running workflow
+pipelineCacheSize: Memory budget for pipelines kept to switch versions (MB)
+pipelineCheckpointInterval: Depth interval of version tree checkpoints
 port: The port for the database to load the vistrail from
 repositoryHTTPURL: Remote package repository URL
 repositoryLocalPath: Local package repository directory
+resultCacheDir: Directory where results are cached across sessions
+resultCacheSize: Size of the on-disk result cache (MB)
 rootDirectory: Directory that contains the VisTrails source code
 rpcConfig: Config file for server connection options
 rpcInstances: Number of other instances that vistrails should start
@@ -110,6 +118,7 @@ showSplash: Show VisTrails splash screen during startup
 showSpreadsheetOnly: Hides the VisTrails main window
 showVariantErrors: Show error when variant input value doesn't match type during execution
 showWindow: Show the main window
+signatureHash: Algorithm used to compute module signatures
 singleInstance: Do not allow more than one instance of VisTrails to run at once
 spreadsheetDumpCells: Defines the location for generated cells
 spreadsheetDumpPDF: Whether the spreadsheet should dump images in PDF format
@@ -153,6 +162,17 @@ cache: Boolean
 
     Cache previous results so they may be used in future computations.
 
+cacheMemoryLimit: Integer
+
+    Estimated memory (in MB) that cached results may use before the least
+    recently used ones are discarded (0 means no limit).
+
+contentSignatures: Boolean
+
+    Identify File and Directory values by the digest of their contents
+    instead of their size and modification time. Digests are kept between
+    sessions, and files are only read again once they are modified.
+
 dataDir: Path
 
     The location that VisTrails uses as a default directory for data.
@@ -201,6 +221,18 @@ executionLog: Boolean
 
     Track execution provenance when running workflows.
 
+executionLogStoreDir: Path
+
+    If specified, the executions of each vistrail are also appended to an
+    indexed log store in this directory as they finish. The store is filled
+    from the vistrail's saved log when it is created, and is then used to
+    browse and export the provenance without loading the whole log.
+
+executionThreads: Integer
+
+    Number of threads used to update independent branches of a workflow
+    concurrently (0 or 1 runs modules one after the other).
+
 fileDir: Path
 
     The location that VisTrails uses as a default directory for
@@ -313,6 +345,19 @@ parameters: String
 
     List of parameters to use when running workflow.
 
+pipelineCacheSize: Integer
+
+    Estimated memory (in MB) that the pipelines kept to speed up version
+    switching may use before the least recently used ones are discarded (0
+    means no limit).
+
+pipelineCheckpointInterval: Integer
+
+    When switching versions, the pipelines of the versions whose depth in
+    the version tree is a multiple of this number are kept, so that any
+    version can be rebuilt from a close checkpoint (0 means only tagged
+    versions are kept).
+
 port: Integer
 
     The port for the database to load the vistrail from.
@@ -333,6 +378,17 @@ repositoryLocalPath: Path
 
     Path used to locate packages available to be installed.
 
+resultCacheDir: Path
+
+    If specified, the results of cacheable modules are stored in this
+    directory and reused by later sessions, or by other processes sharing
+    it.
+
+resultCacheSize: Integer
+
+    Maximum size (in MB) of the on-disk result cache. The least recently
+    used results are removed first.
+
 reviewMode: Boolean
 
     *Deprecated* Used to interactively export a pipeline.
@@ -412,6 +468,12 @@ showWindow: Boolean
 
     Show the main VisTrails window.
 
+signatureHash: String
+
+    Algorithm used to compute the signatures that identify cached results:
+    'sha1' (default), 'md5', or 'xxh3_128' if the xxhash library is
+    installed. Signatures stored by other algorithms are not reused.
+
 singleInstance: Boolean
 
     Whether or not VisTrails should only allow one instance to be
@@ -637,8 +699,19 @@ base_config = {
     [ConfigField('autoSave', True, bool, ConfigType.ON_OFF),
      ConfigField('dbDefault', False, bool, ConfigType.ON_OFF),
      ConfigField('cache', True, bool, ConfigType.ON_OFF),
+     ConfigField('cacheMemoryLimit', 0, int, depends_on="cache"),
+     ConfigField('contentSignatures', False, bool, ConfigType.ON_OFF,
+                 depends_on="cache"),
+     ConfigField('resultCacheDir', None, ConfigPath, depends_on="cache"),
+     ConfigField('resultCacheSize', 1024, int, depends_on="resultCacheDir"),
+     ConfigField('signatureHash', 'sha1', str, depends_on="cache"),
      ConfigField('stopOnError', True, bool, ConfigType.ON_OFF),
      ConfigField('executionLog', True, bool, ConfigType.ON_OFF),
+     ConfigField('executionLogStoreDir', None, ConfigPath,
+                 depends_on="executionLog"),
+     ConfigField('executionThreads', 0, int),
+     ConfigField('pipelineCacheSize', 256, int),
+     ConfigField('pipelineCheckpointInterval', 50, int),
      ConfigField('errorLog', True, bool, ConfigType.ON_OFF),
      ConfigField('defaultFileType', system.vistrails_default_file_type(), str,
                  widget_type="combo",
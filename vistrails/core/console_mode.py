@@ -34,7 +34,9 @@
 ###############################################################################
 """ Module used when running  vistrails uninteractively """
 from __future__ import absolute_import
+from collections import OrderedDict
 import os.path
+import threading
 import unittest
 
 from vistrails.core.application import is_running_gui
@@ -42,7 +44,8 @@ from vistrails.core.configuration import get_vistrails_configuration
 import vistrails.core.interpreter.default
 import vistrails.core.db.io
 from vistrails.core.db.io import load_vistrail
-from vistrails.core.db.locator import XMLFileLocator, ZIPFileLocator
+from vistrails.core.db.locator import DBLocator, XMLFileLocator, \
+    ZIPFileLocator
 from vistrails.core import debug
 from vistrails.core.vistrail.job import Workflow as JobWorkflow
 from vistrails.core.utils import VistrailsInternalError
@@ -54,15 +57,113 @@ import vistrails.db
 
 
 ################################################################################
-    
+
+class ControllerCache(object):
+    """Keeps the vistrails opened by run_and_get_results() between calls.
+
+    A long-running process (such as an application server instance) can
+    pass one of these so that running workflows from the same vistrail
+    again doesn't reload it: the controller (with its pipeline cache) is
+    reused as long as the vistrail's modification time, from the database
+    or the file, hasn't changed. The locator is kept along with it, so
+    that a database locator reuses its connection.
+
+    Controllers are checked out while they are used and released after,
+    so that concurrent requests (e.g. from several server threads) never
+    share one: a vistrail that is already checked out is loaded again.
+    A controller left with unsaved changes, or that isn't released
+    because the execution failed, is not reused.
+    """
+    def __init__(self, size=16):
+        self.size = size
+        # key -> [locator, controller, mtime]
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_key(locator):
+        if isinstance(locator, DBLocator):
+            return ('db', locator.host, locator.port, locator.db,
+                    locator.obj_id)
+        elif isinstance(locator, XMLFileLocator):
+            return ('file', os.path.abspath(locator.name))
+        return None
+
+    @staticmethod
+    def get_modification_time(locator):
+        if isinstance(locator, DBLocator):
+            return locator.get_db_modification_time()
+        else:
+            return os.path.getmtime(locator.name)
+
+    def checkout(self, locator, update_vistrail):
+        """checkout(locator, update_vistrail: bool)
+             -> (locator, VistrailController)
+        Returns a controller for the vistrail, loading it if it isn't
+        cached, is checked out or has changed, and the locator to use with
+        it. Give them back with release() once done.
+
+        """
+        key = self.get_key(locator)
+        if key is not None:
+            key += (update_vistrail,)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        if entry is not None:
+            if self.get_modification_time(entry[0]) == entry[2]:
+                with self._lock:
+                    self.hits += 1
+                return entry[0], entry[1]
+            entry[0].close()
+
+        with self._lock:
+            self.misses += 1
+        (v, abstractions , thumbnails, mashups)  = load_vistrail(locator)
+        controller = VistrailController(v, locator, abstractions, thumbnails,
+                                        mashups, auto_save=update_vistrail)
+        return locator, controller
+
+    def release(self, locator, controller):
+        """release(locator, controller: VistrailController) -> None
+        Puts back a controller obtained from checkout(), once the vistrail
+        has been saved if it was changed.
+
+        """
+        key = self.get_key(locator)
+        if key is None or controller.changed:
+            locator.close()
+            return
+        key += (controller._auto_save,)
+        # executions that weren't saved are not kept with the controller
+        controller.log.delete_all_workflow_execs()
+        entry = [locator, controller, self.get_modification_time(locator)]
+        evicted = []
+        with self._lock:
+            if key in self._entries:
+                # released by another request meanwhile
+                evicted.append(self._entries.pop(key))
+            self._entries[key] = entry
+            while len(self._entries) > self.size:
+                evicted.append(self._entries.popitem(last=False)[1])
+        for old_entry in evicted:
+            old_entry[0].close()
+
+    def __len__(self):
+        return len(self._entries)
+
 def run_and_get_results(w_list, parameters='', output_dir=None, 
                         update_vistrail=True, extra_info=None, 
-                        reason='Console Mode Execution'):
+                        reason='Console Mode Execution',
+                        controller_cache=None):
     """run_and_get_results(w_list: list of (locator, version), parameters: str,
                            output_dir:str, update_vistrail: boolean,
-                           extra_info:dict)
+                           extra_info:dict, reason: str,
+                           controller_cache: ControllerCache)
     Run all workflows in w_list, and returns an interpreter result object.
     version can be a tag name or a version id.
+    If a ControllerCache is given, the vistrails are opened through it.
     
     """
     elements = parameters.split("$&$")
@@ -70,9 +171,16 @@ def run_and_get_results(w_list, parameters='', output_dir=None,
     params = []
     result = []
     for locator, workflow in w_list:
-        (v, abstractions , thumbnails, mashups)  = load_vistrail(locator)
-        controller = VistrailController(v, locator, abstractions, thumbnails,
-                                        mashups, auto_save=update_vistrail)
+        if controller_cache is not None:
+            locator, controller = controller_cache.checkout(
+                    locator, update_vistrail)
+            v = controller.vistrail
+            mashups = controller._mashups
+        else:
+            (v, abstractions , thumbnails, mashups)  = load_vistrail(locator)
+            controller = VistrailController(v, locator, abstractions,
+                                            thumbnails, mashups,
+                                            auto_save=update_vistrail)
         if isinstance(workflow, basestring):
             version = v.get_version_number(workflow)
         elif isinstance(workflow, (int, long)):
@@ -152,6 +260,8 @@ def run_and_get_results(w_list, parameters='', output_dir=None,
 
         if update_vistrail:
             controller.write_vistrail(locator)
+        if controller_cache is not None:
+            controller_cache.release(locator, controller)
         result.append(run)
         if current_workflow.jobs:
             if current_workflow.completed():
@@ -273,37 +383,75 @@ def run(w_list, parameters='', output_dir=None, update_vistrail=True,
             all_errors.append(result.workflow_info + err)
     return all_errors
 
+def _load_parameter_exploration(locator, pe_id, controller_class,
+                                **kwargs):
+    """_load_parameter_exploration(locator, pe_id: str/int,
+                                   controller_class: class, **kwargs)
+         -> (VistrailController, ParameterExploration)
+    Loads the vistrail in a new controller_class(..., **kwargs) and
+    selects the version explored by parameter exploration pe_id, which
+    can be an id or a name.
+
+    """
+    (v, abstractions , thumbnails, mashups)  = load_vistrail(locator)
+    controller = controller_class(v, locator, abstractions, thumbnails,
+                                  mashups, **kwargs)
+    try:
+        pe_id = int(pe_id)
+        pe = controller.vistrail.get_paramexp(pe_id)
+    except ValueError:
+        pe = controller.vistrail.get_named_paramexp(pe_id)
+    controller.change_selected_version(pe.action_id)
+    return controller, pe
+
 def run_parameter_exploration(locator, pe_id, extra_info = {},
-                              reason="Console Mode Parameter Exploration Execution"):
+                              reason="Console Mode Parameter Exploration Execution",
+                              processes=None):
     """run_parameter_exploration(w_list: (locator, version),
                                  pe_id: str/int,
-                                 reason: str) -> (pe_id, [error msg])
+                                 reason: str, processes: int)
+         -> (pe_id, [error msg])
     Run parameter exploration in w, and returns an interpreter result object.
     version can be a tag name or a version id.
+    Without the GUI, the cells are split among 'processes' worker
+    processes if it is more than 1.
     
     """
     if is_running_gui():
         from vistrails.gui.vistrail_controller import VistrailController as \
              GUIVistrailController
         try:
-            (v, abstractions , thumbnails, mashups)  = load_vistrail(locator)
-            controller = GUIVistrailController(v, locator, abstractions, 
-                                               thumbnails, mashups)
-            try:
-                pe_id = int(pe_id)
-                pe = controller.vistrail.get_paramexp(pe_id)
-            except ValueError:
-                pe = controller.vistrail.get_named_paramexp(pe_id)
-            controller.change_selected_version(pe.action_id)
+            controller, pe = _load_parameter_exploration(
+                    locator, pe_id, GUIVistrailController)
             controller.executeParameterExploration(pe, extra_info=extra_info,
                                                    showProgress=False)
         except Exception, e:
             return (locator, pe_id,
                     debug.format_exception(e), debug.format_exc())
+    else:
+        from vistrails.core.param_explore import ParameterExplorationRunner
+        try:
+            controller, pe = _load_parameter_exploration(
+                    locator, pe_id, VistrailController, auto_save=False)
+            runner = ParameterExplorationRunner(controller, pe)
+            cells = runner.run(extra_info=extra_info, reason=reason,
+                               processes=processes)
+        except Exception, e:
+            return (locator, pe_id,
+                    debug.format_exception(e), debug.format_exc())
+        errors = ['cell %s_%s_%s: %s' % (cell.position + (error,))
+                  for cell in cells
+                  for error in cell.errors.itervalues()]
+        if errors:
+            return (locator, pe_id,
+                    "%d errors in parameter exploration" % len(errors),
+                    '\n'.join(errors))
 
 def run_parameter_explorations(w_list, extra_info = {},
-                       reason="Console Mode Parameter Exploration Execution"):
-    """run(w_list: list of (locator, pe_id), reason: str) -> boolean
+                       reason="Console Mode Parameter Exploration Execution",
+                       processes=None):
+    """run(w_list: list of (locator, pe_id), reason: str,
+           processes: int) -> boolean
     For each workflow in w_list, run parameter exploration pe_id
     version can be a tag name or a version id.
     Returns list of errors (empty list if there are no errors)
@@ -311,7 +459,8 @@ def run_parameter_explorations(w_list, extra_info = {},
     all_errors = []
     for locator, pe_id in w_list:
         result = run_parameter_exploration(locator, pe_id, reason=reason,
-                                           extra_info=extra_info)
+                                           extra_info=extra_info,
+                                           processes=processes)
         if result:
             all_errors.append(result)
     return all_errors
@@ -357,6 +506,55 @@ class TestConsoleMode(unittest.TestCase):
         finally:
             StandardOutput.compute = orig_compute
 
+    def test_controller_cache(self):
+        import shutil
+        import tempfile
+        from vistrails.core.modules.basic_modules import StandardOutput
+        values = []
+        def mycompute(s):
+            v = s.get_input('value')
+            values.append(v)
+        orig_compute = StandardOutput.compute
+        StandardOutput.compute = mycompute
+        directory = tempfile.mkdtemp(prefix='vt_console_')
+        try:
+            filename = os.path.join(directory, 'dummy.xml')
+            shutil.copyfile(vistrails.core.system.vistrails_root_directory() +
+                            '/tests/resources/dummy.xml', filename)
+            cache = ControllerCache()
+            def run_cached():
+                results = run_and_get_results(
+                        [(XMLFileLocator(filename), "int chain")],
+                        update_vistrail=False, controller_cache=cache)
+                self.assertFalse(results[0].errors)
+                return results[0]
+            run_cached()
+            locator, first = cache.checkout(XMLFileLocator(filename), False)
+            # executions are not carried over to the next request
+            self.assertEqual(len(first.log.workflow_execs), 0)
+            # a checked out controller is not shared
+            other = cache.checkout(XMLFileLocator(filename), False)[1]
+            self.assertIsNot(other, first)
+            self.assertEqual((cache.hits, cache.misses), (1, 2))
+            cache.release(locator, first)
+            run_cached()
+            self.assertEqual((cache.hits, cache.misses), (2, 2))
+            self.assertEqual(len(cache), 1)
+            self.assertEqual(values, [2, 2])
+
+            # a modified file is loaded again
+            mtime = os.path.getmtime(filename)
+            os.utime(filename, (mtime + 10, mtime + 10))
+            run_cached()
+            self.assertEqual((cache.hits, cache.misses), (2, 3))
+            self.assertIsNot(
+                    cache.checkout(XMLFileLocator(filename), False)[1],
+                    first)
+            self.assertEqual(values, [2, 2, 2])
+        finally:
+            StandardOutput.compute = orig_compute
+            shutil.rmtree(directory)
+
     def test_tuple(self):
         from vistrails.core.vistrail.module_param import ModuleParam
         from vistrails.core.vistrail.module_function import ModuleFunction
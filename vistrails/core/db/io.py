@@ -75,9 +75,10 @@ def load_vistrail(locator, is_abstraction=False):
         res = locator.load()
         if type(res) == type(SaveBundle(None)):
             vistrail = res.vistrail
-            abstraction_files.extend(res.abstractions)
-            thumbnail_files.extend(res.thumbnails)
-            mashups.extend(res.mashups)
+            # these can be loaded lazily from a .vt file; keep them that way
+            abstraction_files = res.abstractions
+            thumbnail_files = res.thumbnails
+            mashups = res.mashups
         else:
             vistrail = res
     vistrail.is_abstraction = is_abstraction
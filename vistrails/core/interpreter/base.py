@@ -188,7 +188,10 @@ class BaseInterpreter(object):
             try:
                 info = pipeline.aliases[alias]
                 param = pipeline.db_get_object(info[0],info[1])
+                # the value may have been changed in place since the
+                # signature was computed, so it is always invalidated
                 param.strValue = str(aliases[alias])
+                pipeline.invalidate_signatures(info[4])
             except KeyError:
                 pass
                     
@@ -203,12 +206,21 @@ class BaseInterpreter(object):
         
         """
         if customParams:
+            changed = set()
             for (vttype, oId, strval) in customParams:
                 try:
                     param = pipeline.db_get_object(vttype,oId)
                     param.strValue = str(strval)
+                    changed.add(id(param))
                 except Exception, e:
                     debug.debug("Problem when updating params", e)
+            # the signatures of the modules owning these parameters may
+            # no longer be valid, even if the values look unchanged
+            if changed:
+                for m in pipeline.module_list:
+                    if any(id(p) in changed
+                           for f in m.functions for p in f.params):
+                        pipeline.invalidate_signatures(m.id)
 
     def resolve_variables(self, vistrail_variables, pipeline):
         for m in pipeline.module_list:
@@ -220,6 +232,7 @@ class BaseInterpreter(object):
                 for func in m.functions:
                     if func.name == 'value':
                         func.params[0].strValue = strValue
+                        pipeline.invalidate_signatures(m.id)
 
     def set_done_summon_hook(self, hook):
         """ set_done_summon_hook(hook: function(pipeline, objects)) -> None
@@ -33,24 +33,30 @@
 ##
 ###############################################################################
 
-import base64
 import copy
 import gc
+import os
 import cPickle as pickle
 
+from vistrails.core.cache.disk import DiskResultCache
+from vistrails.core.cache.hasher import Hasher
+from vistrails.core.cache.utils import estimate_size, hash_backends, \
+    DEFAULT_HASH_BACKEND
 from vistrails.core.common import InstanceObject, VistrailsInternalError
+from vistrails.core.configuration import get_vistrails_configuration
 from vistrails.core.data_structures.bijectivedict import Bidict
 from vistrails.core import debug
 import vistrails.core.interpreter.base
 from vistrails.core.interpreter.base import AbortExecution
+from vistrails.core.interpreter.scheduler import DAGScheduler
 import vistrails.core.interpreter.utils
 from vistrails.core.log.controller import DummyLogController
 from vistrails.core.modules.basic_modules import identifier as basic_pkg, \
-                                                 Generator
+                                                 Generator, PathObject
 from vistrails.core.modules.module_registry import get_module_registry
-from vistrails.core.modules.vistrails_module import ModuleBreakpoint, \
-    ModuleConnector, ModuleError, ModuleErrors, ModuleHadError, \
-    ModuleSuspended, ModuleWasSuspended
+from vistrails.core.modules.vistrails_module import Module, \
+    ModuleBreakpoint, ModuleConnector, ModuleError, ModuleErrors, \
+    ModuleHadError, ModuleSuspended, ModuleWasSuspended
 from vistrails.core.utils import DummyView
 import vistrails.core.system
 import vistrails.core.vistrail.pipeline
@@ -200,6 +206,16 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
     def __init__(self):
         vistrails.core.interpreter.base.BaseInterpreter.__init__(self)
         self.debugger = None
+        # Memory budget for the persistent modules' outputs, in bytes; if
+        # None, the 'cacheMemoryLimit' configuration option is used
+        self.memory_budget = None
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_evictions = 0
+        # On-disk store of results; if None, the 'resultCacheDir'
+        # configuration option is used
+        self.result_cache = None
+        self._configured_result_cache = None
         self.create()
 
     def create(self):
@@ -208,6 +224,10 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
         self._file_pool = FilePool()
         self._persistent_pipeline = vistrails.core.vistrail.pipeline.Pipeline()
         self._objects = {}
+        self._sizes = {}        # persistent id -> estimated size of outputs
+        self._restored = set()  # persistent ids restored from the disk cache
+        self._last_used = {}    # persistent id -> execution counter
+        self._use_counter = 0
         self.filePool = self._file_pool
         self._streams = []
 
@@ -217,6 +237,9 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
         for obj in self._objects.itervalues():
             obj.clear()
         self._objects = {}
+        self._sizes = {}
+        self._restored = set()
+        self._last_used = {}
 
     def __del__(self):
         self.clear()
@@ -235,6 +258,204 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
         for v in dependencies:
             self._persistent_pipeline.delete_module(v)
             del self._objects[v]
+            self._sizes.pop(v, None)
+            self._restored.discard(v)
+            self._last_used.pop(v, None)
+
+    def get_memory_budget(self):
+        """get_memory_budget() -> int or None
+
+        Returns the maximum estimated size of the cached outputs, in bytes,
+        or None if the cache is not bounded.
+        """
+        if self.memory_budget is not None:
+            return self.memory_budget or None
+        conf = get_vistrails_configuration()
+        if conf is not None and conf.check('cacheMemoryLimit'):
+            return conf.cacheMemoryLimit * 1024 * 1024
+        return None
+
+    def cache_size(self):
+        """cache_size() -> int
+
+        Returns the estimated size of the outputs of the persistent modules,
+        in bytes.
+        """
+        return sum(self._sizes.itervalues())
+
+    def get_cache_statistics(self):
+        """get_cache_statistics() -> dict
+
+        Returns the hit, miss and eviction counters of the persistent
+        module cache, along with its current and maximum size.
+        """
+        return {'hits': self.cache_hits,
+                'misses': self.cache_misses,
+                'evictions': self.cache_evictions,
+                'modules': len(self._objects),
+                'size': self.cache_size(),
+                'budget': self.get_memory_budget()}
+
+    def update_cache_sizes(self, objs):
+        """update_cache_sizes(objs: list of persistent modules) -> None
+
+        Estimates the size of the outputs of newly computed modules.
+        """
+        for obj in objs:
+            if obj.id in self._objects and obj.id not in self._sizes:
+                self._sizes[obj.id] = estimate_size(
+                        [v for k, v in obj.outputPorts.iteritems()
+                         if k != 'self'])
+
+    def evict_modules(self):
+        """evict_modules() -> None
+
+        Removes persistent modules until the estimated size of the cached
+        outputs fits in the memory budget.
+
+        Modules are evicted by decreasing (time since last use * size), so
+        that old and large results go first. Eviction goes through
+        clean_modules(), so the modules that depend on an evicted module are
+        dropped as well.
+        """
+        budget = self.get_memory_budget()
+        if budget is None:
+            return
+        size = self.cache_size()
+        if size <= budget:
+            return
+        counter = self._use_counter + 1
+        candidates = sorted(
+                self._sizes.iteritems(),
+                key=lambda (i, s): (counter - self._last_used.get(i, 0)) * s,
+                reverse=True)
+        g = self._persistent_pipeline.graph
+        to_clean = set()
+        for i, s in candidates:
+            if size <= budget:
+                break
+            if i in to_clean:
+                continue
+            # The modules downstream of i will be dropped as well
+            for v in g.vertices_topological_sort([i]):
+                if v not in to_clean:
+                    to_clean.add(v)
+                    size -= self._sizes.get(v, 0)
+        nb_modules = len(self._objects)
+        self.clean_modules(to_clean)
+        self.cache_evictions += nb_modules - len(self._objects)
+
+    def update_hash_backend(self):
+        """update_hash_backend() -> None
+
+        Selects the signature algorithm from the 'signatureHash' option.
+        Signatures computed with different algorithms never match, so the
+        persistent pipeline is discarded when the algorithm changes.
+        """
+        backend = DEFAULT_HASH_BACKEND
+        conf = get_vistrails_configuration()
+        if conf is not None and conf.check('signatureHash'):
+            backend = conf.signatureHash
+            if backend not in hash_backends:
+                debug.warning("Unknown signature hash %r, using %s" % (
+                              backend, DEFAULT_HASH_BACKEND))
+                backend = DEFAULT_HASH_BACKEND
+        if backend != Hasher.get_backend():
+            Hasher.set_backend(backend)
+            self.clear()
+
+    def get_result_cache(self):
+        """get_result_cache() -> DiskResultCache or None
+
+        Returns the on-disk result cache, or None if it is disabled.
+        """
+        if self.result_cache is not None:
+            return self.result_cache
+        conf = get_vistrails_configuration()
+        if conf is None or not conf.check('resultCacheDir'):
+            return None
+        directory = conf.resultCacheDir
+        max_size = None
+        if conf.check('resultCacheSize'):
+            max_size = conf.resultCacheSize * 1024 * 1024
+        cache = self._configured_result_cache
+        if (cache is None or cache.directory != directory or
+                cache.max_size != max_size):
+            cache = self._configured_result_cache = DiskResultCache(
+                    directory, max_size)
+        return cache
+
+    def restore_results(self, result_cache, persistent_id, cacheable=None):
+        """restore_results(result_cache: DiskResultCache,
+                           persistent_id: int, cacheable: dict) -> bool
+
+        Sets the outputs of a new persistent module from the on-disk cache.
+        The module is only restored if it and its upstream modules are
+        cacheable, and if every output port used by the persistent pipeline
+        was stored. Restored modules are remembered so that their upstream
+        is never executed.
+        """
+        obj = self._objects[persistent_id]
+        if obj.signature is None or obj.is_breakpoint:
+            return False
+        if not self.is_cacheable_upstream(persistent_id, cacheable):
+            return False
+        outputs = result_cache.get(obj.signature)
+        if outputs is None:
+            return False
+        connections = self._persistent_pipeline.connections
+        graph = self._persistent_pipeline.graph
+        needed = set(connections[conn_id].source.name
+                     for _, conn_id in graph.edges_from(persistent_id))
+        if not needed.issubset(outputs):
+            return False
+        for port_name, value in outputs.iteritems():
+            obj.set_output(port_name, value)
+        obj.upToDate = True
+        self._restored.add(persistent_id)
+        return True
+
+    def is_cacheable_upstream(self, persistent_id, cacheable=None):
+        """is_cacheable_upstream(persistent_id: int,
+                                 cacheable: dict) -> bool
+
+        Returns whether a persistent module and all of its upstream modules
+        are cacheable. The answers are memoized in 'cacheable', if given.
+        """
+        if cacheable is None:
+            cacheable = {}
+        graph = self._persistent_pipeline.graph
+        if persistent_id not in cacheable:
+            cacheable[persistent_id] = (
+                    self._objects[persistent_id].is_cacheable() and
+                    all(self.is_cacheable_upstream(j, cacheable)
+                        for j, _ in graph.edges_to(persistent_id)))
+        return cacheable[persistent_id]
+
+    def store_results(self, result_cache, objs):
+        """store_results(result_cache: DiskResultCache,
+                         objs: list of persistent modules) -> None
+
+        Adds the outputs of computed modules to the on-disk cache. A module
+        is only stored if it and all of its upstream modules are cacheable,
+        and if its outputs can be pickled. Modules and temporary files from
+        the file pool are never stored.
+        """
+        cacheable = {}
+        pool_dir = os.path.join(self._file_pool.directory, '')
+        def reject(value):
+            if isinstance(value, Module):
+                return True
+            return (isinstance(value, PathObject) and
+                    os.path.abspath(value.name).startswith(pool_dir))
+
+        for obj in objs:
+            if (obj.id not in self._objects or obj.signature is None or
+                    not self.is_cacheable_upstream(obj.id, cacheable)):
+                continue
+            outputs = dict((k, v) for k, v in obj.outputPorts.iteritems()
+                           if k != 'self')
+            result_cache.put(obj.signature, outputs, reject)
 
     def clean_non_cacheable_modules(self):
         """clean_non_cacheable_modules() -> None
@@ -299,6 +520,8 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
         module_executed_hook = fetch('module_executed_hook', [])
         stop_on_error = fetch('stop_on_error', True)
         parent_exec = fetch('parent_exec', None)
+        execution_threads = fetch('execution_threads', 0)
+        result_cache = fetch('result_cache', None)
 
         reg = get_module_registry()
 
@@ -413,10 +636,25 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
                 if connector:
                     obj.set_input_port(f.name, connector, is_method=True)
 
+        # Read the results of new modules from the on-disk cache
+        restored = set()
+        if result_cache is not None:
+            cacheable = {}
+            for i in module_added_set:
+                persistent_id = tmp_to_persistent_module_map[i]
+                if persistent_id in to_delete:
+                    continue
+                if self.restore_results(result_cache, persistent_id,
+                                        cacheable):
+                    restored.add(persistent_id)
+
         # Create the new connections
         for i in conn_added_set:
             persistent_id = conn_map[i]
             conn = self._persistent_pipeline.connections[persistent_id]
+            if conn.destinationId in restored:
+                # Restored modules don't need their upstream
+                continue
             src = self._objects[conn.sourceId]
             dst = self._objects[conn.destinationId]
             self.make_connection(conn, src, dst)
@@ -453,6 +691,8 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
         clean_pipeline = fetch('clean_pipeline', False)
         stop_on_error = fetch('stop_on_error', True)
         parent_exec = fetch('parent_exec', None)
+        execution_threads = fetch('execution_threads', 0)
+        result_cache = fetch('result_cache', None)
 
         if len(kwargs) > 0:
             raise VistrailsInternalError('Wrong parameters passed '
@@ -511,6 +751,20 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
         Generator.generators = []
 
         # Update new sinks
+        if execution_threads > 1:
+            # Update independent modules concurrently
+            if sinks is not None:
+                sink_ids = [sink for sink in sinks
+                            if sink in tmp_id_to_module_map]
+            else:
+                sink_ids = pipeline.graph.sinks()
+            # Modules restored from the disk cache don't need their upstream
+            pruned = set(i for i, obj in tmp_id_to_module_map.iteritems()
+                         if obj.id in self._restored)
+            scheduler = DAGScheduler(execution_threads, stop_on_error)
+            scheduler.execute(pipeline.graph, sink_ids,
+                              tmp_id_to_module_map, logging_obj, pruned)
+            persistent_sinks = []
         for obj in persistent_sinks:
             abort = False
             try:
@@ -577,6 +831,14 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
 
         Generator.generators = self._streams.pop()
 
+        # modules wait for the work they left running in the background
+        for obj in tmp_id_to_module_map.itervalues():
+            try:
+                obj.cleanup()
+            except ModuleError, me:
+                me.module.logging.end_update(me.module, me, me.errorTrace)
+                logging_obj.signalError(me.module, me)
+
         if self.done_update_hook:
             self.done_update_hook(self._persistent_pipeline, self._objects)
                 
@@ -655,6 +917,9 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
           actions = fetch('actions', None)
           done_summon_hooks = fetch('done_summon_hooks', [])
           module_executed_hook = fetch('module_executed_hook', [])
+          stop_on_error = fetch('stop_on_error', True)
+          execution_threads = fetch('execution_threads', 0)
+          result_cache = fetch('result_cache', self.get_result_cache())
 
         Executes a pipeline using caching. Caching works by reusing
         pipelines directly.  This means that there exists one global
@@ -674,7 +939,15 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
         whether they were executed or not.
 
         If modules have no error associated with but were not executed, it
-        means they were cached."""
+        means they were cached.
+
+        If execution_threads is greater than 1, modules whose upstream
+        modules are all computed are updated concurrently on that many
+        threads, instead of updating each sink in turn.
+
+        If a result_cache is available, the outputs of new modules are read
+        from it when their signature was stored, and the results of
+        cacheable modules are added to it after the execution."""
 
         # Setup named arguments. We don't use named parameters so
         # that positional parameter calls fail earlier
@@ -698,10 +971,13 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
         module_executed_hook = fetch('module_executed_hook', [])
         stop_on_error = fetch('stop_on_error', True)
         parent_exec = fetch('parent_exec', None)
+        execution_threads = fetch('execution_threads', 0)
+        result_cache = fetch('result_cache', self.get_result_cache())
 
         if len(kwargs) > 0:
             raise VistrailsInternalError('Wrong parameters passed '
                                          'to execute: %s' % kwargs)
+        self.update_hash_backend()
         self.clean_non_cacheable_modules()
 
 
@@ -736,6 +1012,12 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
             for (i, error) in errors.iteritems():
                 view.set_module_error(i, error)
         self.finalize_pipeline(pipeline, *(res[:-1]), **new_kwargs)
+        if result_cache is not None:
+            self.store_results(result_cache,
+                               [obj for (i, obj) in res[1].iteritems()
+                                if res[3].get(i)])
+        self.update_cache_sizes(res[1].itervalues())
+        self.evict_modules()
 
         result = InstanceObject(objects=res[1],
                               errors=res[2],
@@ -792,7 +1074,7 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
                 persistent_module.id = persistent_id
                 self._persistent_pipeline.add_module(persistent_module)
                 self._persistent_pipeline.modules[persistent_id]._signature = \
-                    base64.b16encode(new_sig).lower()
+                    Hasher.signature_string(new_sig)
                 module_id_map[new_module_id] = persistent_id
                 modules_added.add(new_module_id)
             else:
@@ -818,7 +1100,12 @@ class CachedInterpreter(vistrails.core.interpreter.base.BaseInterpreter):
                         .connection_id_from_signature(new_sig)
                 connection_id_map[connection.id] = i
         # update persistent signatures
-        self._persistent_pipeline.compute_signatures()
+        self._persistent_pipeline.refresh_signatures()
+        self.cache_misses += len(modules_added)
+        self.cache_hits += len(verts) - len(modules_added)
+        self._use_counter += 1
+        for persistent_id in module_id_map.itervalues():
+            self._last_used[persistent_id] = self._use_counter
         return (module_id_map, connection_id_map,
                 modules_added, connections_added)
         
@@ -928,6 +1215,177 @@ class TestCachedInterpreter(unittest.TestCase):
         finally:
             StandardOutput.compute = old_compute
 
+    def test_eviction(self):
+        """Test the memory budget of the persistent pipeline."""
+        from vistrails.tests.utils import execute
+
+        def run(interpreter, value):
+            return execute([
+                    ('ConcatenateString', 'org.vistrails.vistrails.basic', [
+                        ('str1', [('String', value)]),
+                    ]),
+                    ('ConcatenateString', 'org.vistrails.vistrails.basic', [
+                        ('str2', [('String', 'b')]),
+                    ]),
+                ],
+                [
+                    (0, 'value', 1, 'str1'),
+                ],
+                full_results=True,
+                interpreter=interpreter)
+
+        interpreter = CachedInterpreter()
+        interpreter.memory_budget = 1024 * 1024
+        result = run(interpreter, 'a' * 100000)
+        self.assertEqual(len(result.modules_added), 2)
+        self.assertEqual(len(interpreter._objects), 2)
+        result = run(interpreter, 'a' * 100000)
+        self.assertEqual(len(result.modules_added), 0)
+        stats = interpreter.get_cache_statistics()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']),
+                         (2, 2, 0))
+        self.assertGreater(stats['size'], 200000)
+
+        # A different, smaller value evicts the old chain
+        interpreter.memory_budget = 150000
+        result = run(interpreter, 'c' * 50000)
+        self.assertEqual(len(result.modules_added), 2)
+        self.assertEqual(interpreter.cache_evictions, 2)
+        self.assertEqual(len(interpreter._objects), 2)
+        self.assertLessEqual(interpreter.cache_size(), 150000)
+
+        # Evicting an upstream module drops its dependents
+        interpreter.memory_budget = 1
+        interpreter.evict_modules()
+        self.assertEqual(interpreter.cache_evictions, 4)
+        self.assertFalse(interpreter._objects)
+        self.assertFalse(interpreter._persistent_pipeline.modules)
+
+    def test_aliases(self):
+        """Test that new alias values are used by the same pipeline."""
+        from vistrails.core.db.locator import XMLFileLocator
+        from vistrails.core.modules.basic_modules import ConcatenateString, \
+            version as basic_version
+        from vistrails.core.vistrail.module import Module
+        from vistrails.core.vistrail.module_function import ModuleFunction
+        from vistrails.core.vistrail.module_param import ModuleParam
+        from vistrails.core.vistrail.pipeline import Pipeline
+        from vistrails.tests.utils import intercept_result
+
+        param = ModuleParam(id=1, pos=0, type='String', val='a',
+                            alias='x')
+        module = Module(name='ConcatenateString',
+                        package='org.vistrails.vistrails.basic',
+                        version=basic_version, id=0,
+                        functions=[
+                            ModuleFunction(id=1, name='str1',
+                                           parameters=[param]),
+                            ModuleFunction(id=2, name='str2', parameters=[
+                                ModuleParam(id=2, pos=0, type='String',
+                                            val='b')])])
+        pipeline = Pipeline(modules=[module])
+        pipeline.build_index()
+        self.assertIn('x', pipeline.aliases)
+
+        interpreter = CachedInterpreter()
+        with intercept_result(ConcatenateString, 'value') as results:
+            for value in ('x', 'y'):
+                interpreter.execute(pipeline,
+                                    locator=XMLFileLocator('foo.xml'),
+                                    current_version=1,
+                                    view=DummyView(),
+                                    aliases={'x': value})
+            # values changed in place, as the mashup widgets do
+            param.strValue = 'z'
+            interpreter.execute(pipeline,
+                                locator=XMLFileLocator('foo.xml'),
+                                current_version=1,
+                                view=DummyView(),
+                                aliases={'x': 'z'})
+            pipeline.set_alias_str_value('x', 'w')
+            interpreter.execute(pipeline,
+                                locator=XMLFileLocator('foo.xml'),
+                                current_version=1,
+                                view=DummyView())
+        self.assertEqual(results, ['xb', 'yb', 'zb', 'wb'])
+
+    def test_result_cache(self):
+        """Test that results are shared through the on-disk cache."""
+        import shutil
+        import tempfile
+        from vistrails.core.modules.basic_modules import ConcatenateString
+        from vistrails.tests.utils import execute
+
+        def run(interpreter, **kwargs):
+            return execute([
+                    ('ConcatenateString', 'org.vistrails.vistrails.basic', [
+                        ('str1', [('String', 'a')]),
+                        ('str2', [('String', 'b')]),
+                    ]),
+                    ('ConcatenateString', 'org.vistrails.vistrails.basic', [
+                        ('str2', [('String', 'c')]),
+                    ]),
+                    ('StandardOutput', 'org.vistrails.vistrails.basic', []),
+                ],
+                [
+                    (0, 'value', 1, 'str1'),
+                    (1, 'value', 2, 'value'),
+                ],
+                full_results=True,
+                interpreter=interpreter,
+                **kwargs)
+
+        calls = []
+        old_compute = ConcatenateString.compute
+        def compute(module):
+            calls.append(module)
+            old_compute(module)
+        ConcatenateString.compute = compute
+        directory = tempfile.mkdtemp(prefix='vt_results_')
+        try:
+            interpreter = CachedInterpreter()
+            interpreter.result_cache = DiskResultCache(directory)
+            result = run(interpreter)
+            self.assertFalse(result.errors)
+            self.assertEqual(len(calls), 2)
+            self.assertEqual(interpreter.result_cache.writes, 2)
+
+            # A new interpreter (or process) reuses the sink's upstream
+            interpreter = CachedInterpreter()
+            interpreter.result_cache = DiskResultCache(directory)
+            result = run(interpreter)
+            self.assertFalse(result.errors)
+            self.assertEqual(len(calls), 2)
+            self.assertEqual(result.objects[1].get_output('value'), 'abc')
+            self.assertFalse(result.executed.get(0))
+            self.assertFalse(result.executed.get(1))
+            self.assertTrue(result.executed[2])
+
+            # So does the concurrent scheduler, even if the upstream of the
+            # restored module isn't in the cache
+            first = result.objects[0].signature
+            interpreter = CachedInterpreter()
+            cache = interpreter.result_cache = DiskResultCache(directory)
+            cache_get = cache.get
+            cache.get = lambda sig: None if sig == first else cache_get(sig)
+            result = run(interpreter, execution_threads=2)
+            self.assertFalse(result.errors)
+            self.assertEqual(len(calls), 2)
+            self.assertFalse(result.executed.get(0))
+
+            # Non-cacheable modules are never restored
+            ConcatenateString.is_cacheable = lambda self: False
+            interpreter = CachedInterpreter()
+            interpreter.result_cache = DiskResultCache(directory)
+            result = run(interpreter)
+            self.assertFalse(result.errors)
+            self.assertEqual(len(calls), 4)
+        finally:
+            ConcatenateString.compute = old_compute
+            if 'is_cacheable' in ConcatenateString.__dict__:
+                del ConcatenateString.is_cacheable
+            shutil.rmtree(directory)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,446 @@
+###############################################################################
+##
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah. 
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without 
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice, 
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright 
+##    notice, this list of conditions and the following disclaimer in the 
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the University of Utah nor the names of its 
+##    contributors may be used to endorse or promote products derived from 
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, 
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR 
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR 
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, 
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, 
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; 
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, 
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR 
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF 
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+"""Concurrent update of the modules of a pipeline.
+
+The DAGScheduler is used by the cached interpreter when execution threads are
+requested. Instead of updating each sink in turn, which walks upstream
+recursively on a single thread, it runs every module on a thread pool as soon
+as all of its upstream modules have been computed, so that independent
+branches of a workflow overlap.
+
+"""
+
+from collections import deque
+import inspect
+from multiprocessing.pool import ThreadPool
+import Queue
+import sys
+import threading
+
+from vistrails.core.interpreter.base import AbortExecution
+from vistrails.core.modules.vistrails_module import ModuleBreakpoint, \
+    ModuleError, ModuleErrors, ModuleHadError, ModuleSuspended, \
+    ModuleWasSuspended
+
+##############################################################################
+
+class QueuedView(object):
+    """Wraps a view so that the set_* calls made from worker threads are
+    replayed on the thread running the scheduler.
+
+    Views are usually GUI objects, which must not be touched from another
+    thread.
+    """
+    def __init__(self, view):
+        self.view = view
+        self._calls = deque()
+
+    def __getattr__(self, name):
+        attr = getattr(self.view, name)
+        if not name.startswith('set_') or not callable(attr):
+            return attr
+        def queued(*args, **kwargs):
+            self._calls.append((attr, args, kwargs))
+        return queued
+
+    def flush(self):
+        """Replays the queued calls, in order.
+
+        This may raise AbortExecution if the user cancelled the execution.
+        """
+        while self._calls:
+            method, args, kwargs = self._calls.popleft()
+            method(*args, **kwargs)
+
+
+class SynchronizedLogging(object):
+    """Wraps a module's logging object so that calls from several threads
+    are serialized.
+
+    Only methods are wrapped; other attributes, such as the log controller,
+    are returned as they are.
+    """
+    def __init__(self, logging, lock):
+        self.logging = logging
+        self.lock = lock
+
+    def __getattr__(self, name):
+        attr = getattr(self.logging, name)
+        if not inspect.ismethod(attr):
+            return attr
+        def synchronized(*args, **kwargs):
+            with self.lock:
+                result = attr(*args, **kwargs)
+            if name == 'begin_loop_execution':
+                result = SynchronizedLogging(result, self.lock)
+            return result
+        return synchronized
+
+
+class SharedLogging(object):
+    """Sets up a logging object to be used by several threads.
+
+    'logging' is the SynchronizedLogging to give to the modules run on other
+    threads, and wrap() synchronizes other logging objects, such as loops,
+    on the same lock. The view calls are queued until flush() is called on
+    this thread; close() restores the view.
+
+    If the logging object is already synchronized, for instance because the
+    module runs on the DAGScheduler's threads, its lock is used and the view
+    is flushed by whoever set it up.
+    """
+    def __init__(self, logging_obj):
+        self._logging_obj = logging_obj
+        self._view = None
+        self._queued_view = None
+        if isinstance(logging_obj, SynchronizedLogging):
+            self.lock = logging_obj.lock
+            self.logging = logging_obj
+        else:
+            self.lock = threading.RLock()
+            self.logging = SynchronizedLogging(logging_obj, self.lock)
+            self._view = getattr(logging_obj, 'view', None)
+            if self._view is not None:
+                self._queued_view = logging_obj.view = QueuedView(self._view)
+
+    def wrap(self, logging_obj):
+        """Returns logging_obj synchronized on this lock.
+        """
+        if isinstance(logging_obj, SynchronizedLogging):
+            return logging_obj
+        return SynchronizedLogging(logging_obj, self.lock)
+
+    def flush(self):
+        """Replays the queued view calls. May raise AbortExecution.
+        """
+        if self._queued_view is not None:
+            self._queued_view.flush()
+
+    def close(self):
+        if self._queued_view is not None:
+            self._logging_obj.view = self._view
+            self._queued_view = None
+
+##############################################################################
+
+class DAGScheduler(object):
+    """Updates the upstream closure of a set of sinks on a thread pool.
+
+    A module is submitted once all of its upstream modules have finished
+    successfully. Modules downstream of a failed or suspended module are
+    never run, exactly like update_upstream() would have stopped at them.
+
+    Groups and subworkflows execute a nested pipeline through the same
+    interpreter; they are run alone, once the pool is idle.
+    """
+    def __init__(self, max_workers, stop_on_error=True):
+        self.max_workers = max(1, max_workers)
+        self.stop_on_error = stop_on_error
+
+    @staticmethod
+    def is_exclusive(obj):
+        return getattr(obj, 'is_group', False)
+
+    @staticmethod
+    def _update(module_id, obj):
+        try:
+            obj.update()
+        except BaseException:
+            return module_id, sys.exc_info()
+        return module_id, None
+
+    def execute(self, graph, sinks, objects, logging_obj, pruned=()):
+        """execute(graph: Graph, sinks: list, objects: dict,
+                   logging_obj: ViewUpdatingLogController,
+                   pruned: set) -> None
+
+        Runs the modules needed to compute sinks. graph and sinks use the
+        ids of the pipeline being executed, and objects maps these ids to the
+        persistent module instances. The upstream of the modules in pruned
+        is not needed and is not run.
+        """
+        upstream = {}
+        to_visit = list(sinks)
+        while to_visit:
+            module_id = to_visit.pop()
+            if module_id in upstream:
+                continue
+            if module_id in pruned:
+                upstream[module_id] = set()
+                continue
+            upstream[module_id] = set(f for f, _ in graph.edges_to(module_id))
+            to_visit.extend(upstream[module_id])
+        downstream = {}
+        waiting = {}
+        for module_id, deps in upstream.iteritems():
+            waiting[module_id] = len(deps)
+            for dep in deps:
+                downstream.setdefault(dep, []).append(module_id)
+        ready = deque(sorted(m for m, n in waiting.iteritems() if n == 0))
+
+        shared = SharedLogging(logging_obj)
+        for module_id in upstream:
+            objects[module_id].logging = shared.logging
+
+        done = Queue.Queue()
+        pool = ThreadPool(self.max_workers)
+        running = 0
+        exclusive = False
+        stop = False
+        unexpected = None
+        try:
+            while running or (ready and not stop):
+                # Submit as many ready modules as allowed
+                while ready and not stop and not exclusive:
+                    obj = objects[ready[0]]
+                    if self.is_exclusive(obj):
+                        if running:
+                            break
+                        exclusive = True
+                    elif running >= self.max_workers:
+                        break
+                    pool.apply_async(self._update, (ready.popleft(), obj),
+                                     callback=done.put)
+                    running += 1
+
+                try:
+                    module_id, exc_info = done.get(timeout=0.05)
+                except Queue.Empty:
+                    module_id = None
+                try:
+                    shared.flush()
+                except AbortExecution:
+                    stop = True
+                if module_id is None:
+                    continue
+                running -= 1
+                exclusive = False
+
+                if exc_info is None:
+                    for next_id in downstream.get(module_id, ()):
+                        waiting[next_id] -= 1
+                        if waiting[next_id] == 0:
+                            ready.append(next_id)
+                    continue
+                try:
+                    abort = self.handle_error(exc_info[1], logging_obj)
+                except AbortExecution:
+                    abort = True
+                if abort:
+                    stop = True
+                elif unexpected is None and abort is None:
+                    unexpected = exc_info
+                    stop = True
+            shared.flush()
+        finally:
+            pool.close()
+            pool.join()
+            shared.close()
+            for module_id in upstream:
+                objects[module_id].logging = logging_obj
+        if unexpected is not None:
+            raise unexpected[0], unexpected[1], unexpected[2]
+
+    def handle_error(self, e, logging_obj):
+        """handle_error(e: Exception, logging_obj) -> bool or None
+
+        Reports an exception raised by Module.update() the same way the
+        sequential interpreter does. Returns whether the execution should
+        stop, or None if the exception is not one the interpreter handles.
+        """
+        if isinstance(e, ModuleWasSuspended):
+            return False
+        elif isinstance(e, ModuleHadError):
+            return self.stop_on_error
+        elif isinstance(e, AbortExecution):
+            return True
+        elif isinstance(e, ModuleSuspended):
+            e.module.logging.end_update(e.module, e, was_suspended=True)
+            return False
+        elif isinstance(e, ModuleErrors):
+            abort = False
+            for me in e.module_errors:
+                me.module.logging.end_update(me.module, me)
+                logging_obj.signalError(me.module, me)
+                abort = abort or me.abort
+        elif isinstance(e, ModuleError):
+            e.module.logging.end_update(e.module, e, e.errorTrace)
+            logging_obj.signalError(e.module, e)
+            abort = e.abort
+        elif isinstance(e, ModuleBreakpoint):
+            e.module.logging.end_update(e.module)
+            logging_obj.signalError(e.module, e)
+            abort = True
+        else:
+            return None
+        return bool(self.stop_on_error or abort)
+
+##############################################################################
+# Testing
+
+import time
+import unittest
+import urllib2
+
+
+class TestDAGScheduler(unittest.TestCase):
+    def run_outputs(self, nb_outputs, **kwargs):
+        """Runs independent StandardOutput modules, returns how many of them
+        were computing at the same time.
+        """
+        from vistrails.core.modules.basic_modules import StandardOutput
+        from vistrails.tests.utils import execute
+
+        cond = threading.Condition()
+        state = {'active': 0, 'max': 0}
+        def compute(module):
+            with cond:
+                state['active'] += 1
+                state['max'] = max(state['max'], state['active'])
+                cond.notify_all()
+                # Wait a little for the other branches to start
+                deadline = time.time() + 0.5
+                while state['max'] < nb_outputs and time.time() < deadline:
+                    cond.wait(deadline - time.time())
+                state['active'] -= 1
+
+        old_compute = StandardOutput.compute
+        StandardOutput.compute = compute
+        try:
+            result = execute([
+                    ('StandardOutput', 'org.vistrails.vistrails.basic', [
+                        ('value', [('String', str(i))]),
+                    ])
+                    for i in xrange(nb_outputs)
+                ],
+                full_results=True,
+                **kwargs)
+        finally:
+            StandardOutput.compute = old_compute
+        self.assertFalse(result.errors)
+        self.assertEqual(sorted(k for k, v in result.executed.iteritems()
+                                if v),
+                         range(nb_outputs))
+        return state['max']
+
+    def test_sequential(self):
+        self.assertEqual(self.run_outputs(3), 1)
+
+    def test_synchronized_logging(self):
+        from vistrails.core.interpreter.cached import \
+            ViewUpdatingLogController
+        from vistrails.core.log.controller import DummyLogController
+        from vistrails.core.utils import DummyView
+
+        logging = SynchronizedLogging(
+                ViewUpdatingLogController(DummyLogController, DummyView(),
+                                          None, []),
+                threading.RLock())
+        self.assertIs(logging.log, DummyLogController)
+        self.assertEqual(logging.add_machine(None), -1)
+
+    def test_shared_logging(self):
+        from vistrails.core.interpreter.cached import \
+            ViewUpdatingLogController
+        from vistrails.core.log.controller import DummyLogController
+
+        class View(object):
+            def __init__(self):
+                self.calls = []
+            def set_module_active(self, obj):
+                self.calls.append(obj)
+
+        view = View()
+        logging_obj = ViewUpdatingLogController(DummyLogController, view,
+                                                lambda obj: obj, [])
+        shared = SharedLogging(logging_obj)
+        self.assertIsInstance(shared.logging, SynchronizedLogging)
+        # view calls are queued until flushed on this thread
+        logging_obj.view.set_module_active(1)
+        self.assertEqual(view.calls, [])
+        shared.flush()
+        self.assertEqual(view.calls, [1])
+        # an already synchronized logging object is used as it is
+        nested = SharedLogging(shared.logging)
+        self.assertIs(nested.logging, shared.logging)
+        self.assertIs(nested.lock, shared.lock)
+        loop = nested.wrap(DummyLogController)
+        self.assertIs(loop.lock, shared.lock)
+        self.assertIs(nested.wrap(loop), loop)
+        nested.close()
+        self.assertIsNot(logging_obj.view, view)
+        shared.close()
+        self.assertIs(logging_obj.view, view)
+
+    def test_concurrent(self):
+        self.assertEqual(self.run_outputs(3, execution_threads=3), 3)
+
+    def test_dependencies(self):
+        """Checks that a chain is computed in order, and that modules
+        downstream of an error are not run.
+        """
+        from vistrails.core.modules.basic_modules import ConcatenateString
+        from vistrails.tests.utils import execute, intercept_result
+
+        with intercept_result(ConcatenateString, 'value') as results:
+            result = execute([
+                    ('ConcatenateString', 'org.vistrails.vistrails.basic', [
+                        ('str1', [('String', 'a')]),
+                        ('str2', [('String', 'b')]),
+                    ]),
+                    ('ConcatenateString', 'org.vistrails.vistrails.basic', [
+                        ('str2', [('String', 'c')]),
+                    ]),
+                    ('PythonSource', 'org.vistrails.vistrails.basic', [
+                        ('source', [('String', urllib2.quote(
+                                'raise ValueError("failed")'))]),
+                    ]),
+                    ('StandardOutput', 'org.vistrails.vistrails.basic', []),
+                ],
+                [
+                    (0, 'value', 1, 'str1'),
+                    (2, 'self', 3, 'value'),
+                ],
+                full_results=True,
+                execution_threads=4,
+                stop_on_error=False)
+        self.assertEqual(results, ['ab', 'abc'])
+        self.assertEqual(result.errors.keys(), [2])
+        self.assertTrue(result.executed[1])
+        self.assertFalse(result.executed[3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -55,6 +55,7 @@ class DummyLogController(object):
     def start_workflow_execution(self, *args, **kwargs): return self
     def recursing(self, *args, **kwargs): return self
     def finish_workflow_execution(self, *args, **kwargs): pass
+    def add_workflow_exec(self, *args, **kwargs): pass
     def add_exec(self, *args, **kwargs): pass
     def start_execution(self, *args, **kwargs): pass
     def start_loop_execution(self, *args, **kwargs): return self
@@ -72,7 +73,9 @@ class DummyLogController(object):
 class LogController(object):
     """The top-level log controller.
 
-    This holds a log.
+    This holds a log. If a store is given (see
+    vistrails.db.services.log.LogStore), each workflow execution is also
+    appended to it when it finishes.
     """
     local_machine = Machine(
             id=-1,
@@ -82,8 +85,9 @@ class LogController(object):
             processor=vistrails.core.system.current_processor(),
             ram=vistrails.core.system.guess_total_memory())
 
-    def __init__(self, log, machine=None):
+    def __init__(self, log, machine=None, store=None):
         self.log = log
+        self.store = store
         self.module_execs = {}      # vistrails_module -> *Exec
         self.parent_execs = {}      # vistrails_module -> *Exec
         self.children_execs = {}    # vistrails_module -> [*Exec]
@@ -133,7 +137,17 @@ class LogController(object):
         """Signals the start of the execution of a pipeline.
         """
         return LogWorkflowExecController(self.log, self.machine, parent_exec,
-                                         vistrail, pipeline, currentVersion)
+                                         vistrail, pipeline, currentVersion,
+                                         store=self.store)
+
+    def add_workflow_exec(self, workflow_exec):
+        """Adds a finished workflow execution that was logged elsewhere
+        (e.g. by another process), with a new id.
+        """
+        workflow_exec.db_id = self.log.id_scope.getNewId(WorkflowExec.vtType)
+        self.log.add_workflow_exec(workflow_exec)
+        if self.store is not None:
+            self.store.append(workflow_exec)
 
 
 class LogLoopController(object):
@@ -345,7 +359,7 @@ class LogWorkflowExecController(LogWorkflowController):
     obtained through recursing(), don't.
     """
     def __init__(self, log, machine, parent_exec, vistrail=None, pipeline=None,
-                 currentVersion=None):
+                 currentVersion=None, store=None):
         if vistrail is not None:
             parent_type = Vistrail.vtType
             parent_id = vistrail.id
@@ -373,6 +387,7 @@ class LogWorkflowExecController(LogWorkflowController):
         log.add_workflow_exec(workflow_exec)
 
         super(LogWorkflowExecController, self).__init__(log, machine, parent_exec, workflow_exec)
+        self.store = store
 
     def finish_workflow_execution(self, errors, suspended=False):
         """Signals the end of the execution of a pipeline.
@@ -384,3 +399,5 @@ class LogWorkflowExecController(LogWorkflowController):
             self.workflow_exec.completed = -1
         else:
             self.workflow_exec.completed = 1
+        if self.store is not None:
+            self.store.append(self.workflow_exec)
@@ -35,6 +35,7 @@
 """basic_modules defines basic VisTrails Modules that are used in most
 pipelines."""
 import vistrails.core.cache.hasher
+from vistrails.core.cache.file_signature import get_file_signatures
 from vistrails.core.debug import format_exception
 from vistrails.core.modules.module_registry import get_module_registry
 from vistrails.core.modules.vistrails_module import Module, new_module, \
@@ -382,24 +383,15 @@ class Path(Constant):
 Path.default_value = PathObject('')
 
 def path_parameter_hasher(p):
-    def get_mtime(path):
-        t = int(os.path.getmtime(path))
-        if os.path.isdir(path):
-            for subpath in os.listdir(path):
-                subpath = os.path.join(path, subpath)
-                if os.path.isdir(subpath):
-                    t = max(t, get_mtime(subpath))
-        return t
-
     h = vistrails.core.cache.hasher.Hasher.parameter_signature(p)
     try:
         # FIXME: This will break with aliases - I don't really care that much
-        t = get_mtime(p.strValue)
+        s = get_file_signatures().signature(p.strValue)
     except OSError:
         return h
     hasher = sha_hash()
     hasher.update(h)
-    hasher.update(str(t))
+    hasher.update(s)
     return hasher.digest()
 
 class File(Path):
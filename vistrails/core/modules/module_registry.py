@@ -895,6 +895,29 @@ class ModuleRegistry(DBRegistry):
         else:
             return vistrails.core.cache.hasher.Hasher.module_signature(module, chm)
 
+    def module_signatures(self, pipeline, modules):
+        """Returns the signatures of several core.vistrail.Module in the
+        given core.vistrail.Pipeline, in the same order. Modules without a
+        user-defined hasher are hashed in a single batch.
+        """
+        chm = self._constant_hasher_map
+        signatures = [None] * len(modules)
+        batch = []
+        for i, module in enumerate(modules):
+            descriptor = self.get_descriptor_by_name(module.package,
+                                                     module.name,
+                                                     module.namespace)
+            c = descriptor and descriptor.hasher_callable()
+            if c:
+                signatures[i] = c(pipeline, module, chm)
+            else:
+                batch.append(i)
+        batch_sigs = vistrails.core.cache.hasher.Hasher.module_signatures(
+                [modules[i] for i in batch], chm)
+        for i, sig in izip(batch, batch_sigs):
+            signatures[i] = sig
+        return signatures
+
     def get_module_color(self, identifier, name, namespace=None):
         return self.get_descriptor_by_name(identifier, name, namespace).module_color()
 
@@ -145,6 +145,14 @@ def group_signature(pipeline, module, chm):
             sig = Hasher.module_signature(input_module, chm)
         input_module._input_port_signature = sig
 
+    # InputPort signatures depend on the outer pipeline, so only the
+    # inner subpipelines fed by a changed InputPort need rehashing
+    for input_module in module._input_remap.itervalues():
+        if getattr(input_module, '_cached_input_port_signature', None) != \
+                input_module._input_port_signature:
+            module.pipeline.invalidate_signatures(input_module.id)
+            input_module._cached_input_port_signature = \
+                input_module._input_port_signature
     module.pipeline.refresh_signatures()
 
     sig_list = []
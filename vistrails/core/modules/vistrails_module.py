@@ -32,26 +32,23 @@
 ## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
 ##
 ###############################################################################
-from base64 import b16encode, b16decode
 import copy
 import json
+from multiprocessing.pool import ThreadPool
+import Queue
+import sys
+import threading
 import time
-from itertools import izip, product
+from itertools import izip
 import warnings
 
+from vistrails.core.cache.hasher import Hasher
 from vistrails.core.data_structures.bijectivedict import Bidict
 from vistrails.core import debug
 from vistrails.core.configuration import get_vistrails_configuration
 from vistrails.core.modules.config import ModuleSettings, IPort, OPort
 from vistrails.core.vistrail.module_control_param import ModuleControlParam
-from vistrails.core.utils import VistrailsDeprecation, deprecated, \
-                                 xor, long2bytes
-try:
-    import hashlib
-    sha1_hash = hashlib.sha1
-except ImportError:
-    import sha
-    sha1_hash = sha.new
+from vistrails.core.utils import VistrailsDeprecation, deprecated
 
 class NeedsInputPort(Exception):
     def __init__(self, obj, port):
@@ -183,6 +180,80 @@ class DummyModuleLogging(object):
 
 _dummy_logging = DummyModuleLogging()
 
+################################################################################
+# Combination
+
+class PortElements(object):
+    """The values received on an iterated port, as 1-tuples."""
+    def __init__(self, values):
+        if not hasattr(values, '__getitem__') or \
+                not hasattr(values, '__len__'):
+            values = list(values)
+        self.values = values
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, i):
+        return (self.values[i],)
+
+    def __iter__(self):
+        return ((e,) for e in self.values)
+
+class Combination(object):
+    """The tuples formed by combining several sequences of tuples, either
+    pairwise or as their cartesian product.
+
+    Tuples are only built when accessed, by index or by iterating, so the
+    size of a combination does not depend on its length. Cartesian tuples
+    are in the same order as itertools.product(), and pairwise ones stop at
+    the shortest sequence like izip().
+    """
+    def __init__(self, combine_type, sequences):
+        if combine_type not in ('pairwise', 'cartesian'):
+            raise ValueError('Unknown combine type "%s"' % combine_type)
+        self.combine_type = combine_type
+        self.sequences = sequences
+        self.sizes = [len(seq) for seq in sequences]
+        if combine_type == 'pairwise':
+            self.length = min(self.sizes) if self.sizes else 0
+        else:
+            self.length = 1
+            for size in self.sizes:
+                self.length *= size
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError('combination index out of range')
+        if self.combine_type == 'pairwise':
+            return tuple(e for seq in self.sequences for e in seq[i])
+        parts = []
+        for seq, size in reversed(zip(self.sequences, self.sizes)):
+            i, j = divmod(i, size)
+            parts.append(seq[j])
+        return tuple(e for t in reversed(parts) for e in t)
+
+    def __iter__(self):
+        if self.combine_type == 'pairwise':
+            return (tuple(e for t in t_list for e in t)
+                    for t_list in izip(*self.sequences))
+        return self._iter_cartesian(self.sequences)
+
+    @staticmethod
+    def _iter_cartesian(sequences):
+        # Unlike product(), this doesn't copy nested combinations
+        if not sequences:
+            yield ()
+            return
+        for head in sequences[0]:
+            for tail in Combination._iter_cartesian(sequences[1:]):
+                yield head + tail
+
 ################################################################################
 # Serializable
 
@@ -390,6 +461,16 @@ class Module(Serializable):
         """
         return True
 
+    def cleanup(self):
+        """cleanup() -> None.
+        Called once the execution of the pipeline is over, for each
+        module that was part of it. A Module that left work running in
+        the background should wait for it here, raising ModuleError if
+        it failed.
+
+        """
+        pass
+
     def update_upstream_port(self, port_name):
         """Updates upstream of a single port instead of all ports."""
 
@@ -451,7 +532,10 @@ class Module(Serializable):
         specs = p_module.sourcePorts()
         params = {}
         if not jm.getCache(self.signature):
-            from vistrails.core.modules.basic_modules import Constant
+            from vistrails.core.modules.basic_modules import Constant, Path
+            # the File and Directory outputs are checked when the cache is
+            # used again
+            files = []
             for spec in specs:
                 if spec.name == 'self':
                     continue
@@ -460,7 +544,9 @@ class Module(Serializable):
                 if not issubclass(module, Constant):
                     raise ModuleError(self, "Trying to cache a non-constant type: %s" % spec.name)
                 params[spec.name] = module.translate_to_string(self.get_output(spec.name))
-                jm.setCache(self.signature, params, p_module.name)
+                if issubclass(module, Path):
+                    files.append(params[spec.name])
+                jm.setCache(self.signature, params, p_module.name, files)
 
     def update_upstream(self):
         """ update_upstream() -> None
@@ -621,6 +707,10 @@ class Module(Serializable):
         self.logging.signalSuccess(self)
 
     def do_combine(self, combine_type, inputs, port_name_order):
+        """Returns the lazy Combination of the values on the given ports,
+        and the corresponding port names.
+
+        """
         values = []
         port_names = []
         for port_name in port_name_order:
@@ -634,17 +724,9 @@ class Module(Serializable):
                 values.append(sub_values)
                 port_names.extend(sub_port_names)
             else:
-                values.append((e,) for e in inputs[port_name])
+                values.append(PortElements(inputs[port_name]))
                 port_names.append(port_name)
-        if combine_type == "pairwise":
-            elements = [tuple(e for t in t_list for e in t)
-                        for t_list in izip(*values)]
-        elif combine_type == "cartesian":
-            elements = [tuple(e for t in t_list for e in t)
-                        for t_list in product(*values)]
-        else:
-            raise ValueError('Unknown combine type "%s"' % combine_type)
-        return elements, port_names
+        return Combination(combine_type, values), port_names
 
     def get_combine_type(self, default="cartesian"):
         if ModuleControlParam.LOOP_KEY in self.control_params:
@@ -683,45 +765,37 @@ class Module(Serializable):
         elements, port_names = self.do_combine(combine_type, inputs, port_names)
         num_inputs = len(elements)
         loop = self.logging.begin_loop_execution(self, num_inputs)
+        threads = self.get_loop_threads()
         ## Update everything for each value inside the list
         outputs = {}
-        for i in xrange(num_inputs):
-            self.logging.update_progress(self, float(i)/num_inputs)
-            module = copy.copy(self)
-            module.list_depth = self.list_depth - 1
-            module.had_error = False
-            module.was_suspended = False
-
-            if not self.upToDate: # pragma: no partial
-                ## Type checking if first iteration and last iteration level
-                if i == 0 and self.list_depth == 1:
-                    self.typeChecking(module, port_names, elements)
+        if threads > 1 and num_inputs > 1:
+            outputs, suspended = self.compute_all_threaded(
+                    threads, loop, port_names, elements)
+        else:
+            for i in xrange(num_inputs):
+                self.logging.update_progress(self, float(i)/num_inputs)
+                module = self.iteration_module(i, port_names, elements)
 
-                module.upToDate = False
-                module.computed = False
-                self.setInputValues(module, port_names, elements[i], i)
+                loop.begin_iteration(module, i)
 
-            loop.begin_iteration(module, i)
+                try:
+                    module.update()
+                except ModuleSuspended, e:
+                    e.loop_iteration = i
+                    module.logging.end_update(module, e, was_suspended=True)
+                    suspended.append(e)
+                    loop.end_iteration(module)
+                    continue
 
-            try:
-                module.update()
-            except ModuleSuspended, e:
-                e.loop_iteration = i
-                module.logging.end_update(module, e, was_suspended=True)
-                suspended.append(e)
                 loop.end_iteration(module)
-                continue
-
-            loop.end_iteration(module)
 
-            ## Getting the result from the output port
-            for nameOutput in module.outputPorts:
-                if nameOutput not in outputs:
-                    outputs[nameOutput] = []
-                output = module.get_output(nameOutput)
-                outputs[nameOutput].append(output)
+                ## Getting the result from the output port
+                for nameOutput in module.outputPorts:
+                    if nameOutput not in outputs:
+                        outputs[nameOutput] = [None] * num_inputs
+                    outputs[nameOutput][i] = module.get_output(nameOutput)
 
-            self.logging.update_progress(self, i * 1.0 / num_inputs)
+                self.logging.update_progress(self, i * 1.0 / num_inputs)
 
         if suspended:
             raise ModuleSuspended(
@@ -734,6 +808,132 @@ class Module(Serializable):
             self.set_output(nameOutput, outputs[nameOutput])
         loop.end_loop_execution()
 
+    def get_loop_threads(self):
+        """Returns the number of threads running the iterations of
+        compute_all(), from the loop_threads control parameter.
+
+        """
+        value = self.control_params.get(ModuleControlParam.LOOP_THREADS_KEY)
+        if not value:
+            return 1
+        try:
+            return int(value)
+        except ValueError:
+            raise ModuleError(self, "Invalid number of loop threads: %r" %
+                                    value)
+
+    def iteration_module(self, i, port_names, elements):
+        """Returns the copy of this module that computes the i-th
+        element of the combined input lists.
+
+        """
+        module = copy.copy(self)
+        module.list_depth = self.list_depth - 1
+        module.had_error = False
+        module.was_suspended = False
+
+        if not self.upToDate: # pragma: no partial
+            ## Type checking if first iteration and last iteration level
+            if i == 0 and self.list_depth == 1:
+                self.typeChecking(module, port_names, elements)
+
+            module.upToDate = False
+            module.computed = False
+            self.setInputValues(module, port_names, elements[i], i)
+        return module
+
+    def compute_all_threaded(self, threads, loop, port_names, elements):
+        """Runs the iterations of compute_all() on a pool of threads.
+
+        Returns the outputs, as lists indexed like the elements, and the
+        ModuleSuspended exceptions of the suspended iterations. Iterations are
+        created and collected on the calling thread; only update() runs on
+        the pool. The logging objects are shared with the pool through the
+        scheduler's SharedLogging. Once an iteration failed, no new one is
+        started and the errors are raised with their loop_iteration set.
+
+        """
+        from vistrails.core.interpreter.scheduler import SharedLogging
+
+        num_inputs = len(elements)
+        events = Queue.Queue()
+        shared = SharedLogging(self.logging)
+        logging = shared.logging
+        loop = shared.wrap(loop)
+        pool = ThreadPool(threads)
+
+        def run(i, module):
+            try:
+                module.update()
+            except BaseException:
+                return i, sys.exc_info()
+            return i, None
+        modules = {}
+        outputs = {}
+        suspended = []
+        errors = []
+        unexpected = None
+        next_i = 0
+        nb_done = 0
+        try:
+            while modules or (next_i < num_inputs and
+                              not errors and unexpected is None):
+                while (len(modules) < threads and next_i < num_inputs and
+                        not errors and unexpected is None):
+                    module = self.iteration_module(next_i, port_names,
+                                                   elements)
+                    module.logging = logging
+                    loop.begin_iteration(module, next_i)
+                    pool.apply_async(run, (next_i, module),
+                                     callback=events.put)
+                    modules[next_i] = module
+                    next_i += 1
+
+                try:
+                    i, exc_info = events.get(timeout=0.05)
+                except Queue.Empty:
+                    shared.flush()
+                    continue
+                module = modules.pop(i)
+                module.logging = self.logging
+                if exc_info is None:
+                    loop.end_iteration(module)
+                    for nameOutput in module.outputPorts:
+                        if nameOutput not in outputs:
+                            outputs[nameOutput] = [None] * num_inputs
+                        outputs[nameOutput][i] = module.get_output(nameOutput)
+                elif isinstance(exc_info[1], ModuleSuspended):
+                    e = exc_info[1]
+                    e.loop_iteration = i
+                    logging.end_update(module, e, was_suspended=True)
+                    suspended.append(e)
+                    loop.end_iteration(module)
+                elif isinstance(exc_info[1], ModuleError):
+                    exc_info[1].loop_iteration = i
+                    errors.append(exc_info[1])
+                elif unexpected is None:
+                    unexpected = exc_info
+                nb_done += 1
+                logging.update_progress(self, nb_done * 1.0 / num_inputs)
+            shared.flush()
+        finally:
+            pool.close()
+            pool.join()
+            for module in modules.itervalues():
+                module.logging = self.logging
+            shared.close()
+
+        if unexpected is not None:
+            raise unexpected[0], unexpected[1], unexpected[2]
+        if len(errors) == 1:
+            raise errors[0]
+        elif errors:
+            errors.sort(key=lambda e: e.loop_iteration)
+            raise ModuleErrors(errors)
+
+        suspended.sort(key=lambda e: e.loop_iteration)
+        return outputs, suspended
+
     def build_stream(self):
         """Determines and builds correct generator type.
 
@@ -1067,12 +1267,9 @@ class Module(Serializable):
             # anywhere though...
             # The fake signature is
             # XOR(signature(loop module), iteration, hash(inputPort))
-            inputPort_hash = sha1_hash()
-            inputPort_hash.update(inputPort)
-            module.signature = b16encode(xor(
-                    b16decode(self.signature.upper()),
-                    long2bytes(iteration, 20),
-                    inputPort_hash.digest()))
+            module.signature = Hasher.iteration_signature(self.signature,
+                                                          inputPort,
+                                                          iteration)
 
     Variant_desc = None
     InputPort_desc = None
@@ -1875,3 +2072,102 @@ class TestImplicitLooping(unittest.TestCase):
 
     def test_list_custom(self):
         self.run_vt("test-list-custom.vt")
+
+
+class TestThreadedLooping(unittest.TestCase):
+    def calc(self, values, threads, op='*', **kwargs):
+        """Runs 1 <op> x for each x in values using implicit looping."""
+        from vistrails.packages.pythonCalc.init import PythonCalc
+        from vistrails.tests.utils import execute, intercept_result
+        with intercept_result(PythonCalc, 'value') as results:
+            errors = execute([
+                    ('List', 'org.vistrails.vistrails.basic', [
+                        ('value', [('List', repr(values))]),
+                    ]),
+                    ('PythonCalc', 'org.vistrails.vistrails.pythoncalc', [
+                        ('value1', [('Float', '1.0')]),
+                        ('op', [('String', op)]),
+                    ], [
+                        (ModuleControlParam.LOOP_THREADS_KEY, threads),
+                    ]),
+                ],
+                [
+                    (0, 'value', 1, 'value2'),
+                ],
+                **kwargs)
+        return errors, results
+
+    def test_order(self):
+        from vistrails.packages.pythonCalc.init import PythonCalc
+        threads = set()
+        compute = PythonCalc.compute
+        def slow_compute(module):
+            threads.add(threading.current_thread())
+            time.sleep(0.01)
+            compute(module)
+        PythonCalc.compute = slow_compute
+        try:
+            values = [float(i) for i in xrange(50)]
+            errors, results = self.calc(values, '4', '+')
+        finally:
+            PythonCalc.compute = compute
+        self.assertFalse(errors)
+        self.assertEqual(results[-1], [1.0 + v for v in values])
+        self.assertGreater(len(threads), 1)
+
+    def test_scheduler(self):
+        """Threaded loops share the logging of the interpreter's threads."""
+        values = [float(i) for i in xrange(10)]
+        errors, results = self.calc(values, '4', '+', execution_threads=2)
+        self.assertFalse(errors)
+        self.assertEqual(results[-1], [1.0 + v for v in values])
+
+    def test_errors(self):
+        """Failed iterations are reported with their index."""
+        errors, results = self.calc([1.0, 0.0, 2.0, 0.0], '4', '/')
+        self.assertEqual(errors.keys(), [1])
+        self.assertIn(errors[1].loop_iteration, (1, 3))
+
+    def test_invalid(self):
+        errors, results = self.calc([1.0, 2.0], 'many')
+        self.assertEqual(errors.keys(), [1])
+
+
+class TestCombination(unittest.TestCase):
+    def check(self, combination, expected):
+        self.assertEqual(len(combination), len(expected))
+        self.assertEqual(list(combination), expected)
+        self.assertEqual([combination[i] for i in xrange(len(combination))],
+                         expected)
+
+    def test_cartesian(self):
+        from itertools import product
+        c = Combination('cartesian', [PortElements([1, 2, 3]),
+                                      PortElements(iter('ab'))])
+        self.check(c, list(product([1, 2, 3], 'ab')))
+        self.assertEqual(c[-1], (3, 'b'))
+        self.assertRaises(IndexError, c.__getitem__, 6)
+
+    def test_pairwise(self):
+        c = Combination('pairwise', [PortElements([1, 2, 3]),
+                                     PortElements('ab')])
+        self.check(c, [(1, 'a'), (2, 'b')])
+        self.check(Combination('pairwise', []), [])
+
+    def test_nested(self):
+        from itertools import izip, product
+        # ['cartesian', ['pairwise', 'a', 'b'], 'c']
+        inner = Combination('pairwise', [PortElements([1, 2]),
+                                         PortElements([3, 4])])
+        c = Combination('cartesian', [inner, PortElements([5, 6, 7])])
+        self.check(c, [a + (b,) for a, b in product(izip([1, 2], [3, 4]),
+                                                    [5, 6, 7])])
+
+    def test_lazy(self):
+        big = PortElements(xrange(10000))
+        c = Combination('cartesian', [big, big, big])
+        self.assertEqual(len(c), 10 ** 12)
+        self.assertEqual(c[10 ** 12 - 2], (9999, 9999, 9998))
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, Combination, 'diagonal', [])
@@ -36,9 +36,20 @@
 This module handles Parameter Exploration in VisTrails
 """
 from vistrails.core import debug
+from vistrails.core.configuration import get_vistrails_configuration
+from vistrails.core.db.io import serialize, unserialize
+from vistrails.core.interpreter.default import get_default_interpreter
+from vistrails.core.log.controller import DummyLogController, LogController
+from vistrails.core.log.log import Log
+from vistrails.core.log.workflow_exec import WorkflowExec
+from vistrails.core.utils import DummyView
 from vistrails.core.vistrail.module_function import ModuleFunction
 from vistrails.core.vistrail.module_param import ModuleParam
+from vistrails.core.vistrail.operation import AddOp, ChangeOp, DeleteOp
+from vistrails.core.vistrail.pipeline import Pipeline
 import copy
+import multiprocessing
+import uuid
 
 import unittest
 
@@ -206,38 +217,112 @@ class ActionBasedParameterExploration(object):
         """
         results = []
         resultActions = []
-        
-        def exploreDimension(pipeline, performedActions, dim):
-            """ exploreDimension(pipeline: Pipeline, performedActions: [actions],
-                                 dim: int) -> None
-            Start applying actions to the pipeline at dimension
-            dim. 'pipeline' will not be modified in the function
-            
-            """
-            if dim<0:
-                results.append(pipeline)
-                resultActions.append(performedActions)
-                return
-            currentActions = actions[dim]
-            if len(currentActions)==0:
-                # Ignore empty dimension
-                exploreDimension(pipeline, performedActions, dim-1)
-                return
-            for actionSet in currentActions:
-                currentPipeline = copy.copy(pipeline)
-                currentPeformedActions = copy.copy(performedActions)
-                for action in actionSet:
-                    currentPipeline.perform_action(action)
-                    currentPeformedActions.append(action)
-                exploreDimension(currentPipeline, currentPeformedActions, dim-1)
-        
-        # perform pre_actions
+        for currentPipeline, performedActions in \
+                self.explore_iter(pipeline, actions, pre_actions):
+            results.append(copy.copy(currentPipeline))
+            resultActions.append(performedActions)
+        return (results, resultActions)
+
+    def explore_iter(self, pipeline, actions, pre_actions=[]):
+        """ explore_iter(pipeline: Pipeline, actions: [action set],
+                         pre_actions: [action set])
+                         -> iter((pipeline, actions))
+        Same as explore(), but generates the (pipeline, actions) tuples one
+        at a time, in the same order.
+
+        A single copy of 'pipeline' is made, and each pipeline is derived
+        from the previous one by undoing and applying only the action sets
+        of the dimensions that changed. The same pipeline object is
+        generated every time and modified afterwards, so it should be
+        copied if it needs to be kept.
+
+        """
         currentPipeline = copy.copy(pipeline)
         for action in pre_actions:
             currentPipeline.perform_action(action)
-        
-        exploreDimension(currentPipeline, pre_actions, len(actions)-1)
-        return (results, resultActions)
+
+        # empty dimensions are ignored; the first dimension varies fastest
+        dims = [dim for dim in xrange(len(actions)) if len(actions[dim])]
+        steps = [0] * len(dims)
+        undo = [[] for dim in dims]
+
+        def select(k):
+            """ select(k: int) -> None
+            Switches dimension dims[k] to its action set at steps[k]
+
+            """
+            currentPipeline.perform_operation_chain(undo[k])
+            undo[k] = []
+            for action in actions[dims[k]][steps[k]]:
+                undo[k][:0] = _perform_undoable(currentPipeline, action)
+
+        for k in reversed(xrange(len(dims))):
+            select(k)
+        while True:
+            performedActions = list(pre_actions)
+            for k in reversed(xrange(len(dims))):
+                performedActions.extend(actions[dims[k]][steps[k]])
+            yield currentPipeline, performedActions
+
+            # move to the next point of the grid
+            k = 0
+            while k < len(dims):
+                steps[k] = (steps[k] + 1) % len(actions[dims[k]])
+                select(k)
+                if steps[k]:
+                    break
+                k += 1
+            else:
+                return
+
+def _perform_undoable(pipeline, action):
+    """ _perform_undoable(pipeline: Pipeline, action: Action) -> [operation]
+    Performs an action on the pipeline, returning the operations that
+    revert it
+
+    """
+    inverse = []
+    for op in action.operations:
+        if op.vtType == 'add':
+            inverse.append(DeleteOp(id=-1L,
+                                    what=op.what,
+                                    objectId=op.objectId,
+                                    parentObjType=op.parentObjType,
+                                    parentObjId=op.parentObjId))
+        else:
+            old_obj = copy.copy(pipeline.db_get_object(op.what,
+                                                       op.old_obj_id))
+            if op.vtType == 'delete':
+                inverse.append(AddOp(id=-1L,
+                                     what=op.what,
+                                     objectId=op.objectId,
+                                     parentObjType=op.parentObjType,
+                                     parentObjId=op.parentObjId,
+                                     data=old_obj))
+            else:
+                inverse.append(ChangeOp(id=-1L,
+                                        what=op.what,
+                                        oldObjId=op.newObjId,
+                                        newObjId=op.oldObjId,
+                                        parentObjType=op.parentObjType,
+                                        parentObjId=op.parentObjId,
+                                        data=old_obj))
+        pipeline.perform_operation(op)
+    inverse.reverse()
+    return inverse
+
+def _pipelinePosition(pId, sheetCount, rowCount, colCount):
+    """ _pipelinePosition(pId: int, sheetCount: int, rowCount: int,
+                          colCount: int) -> (row, col, sheet)
+    Returns the position of the pipeline pId in a parameter exploration
+    given that pipelines has multiple chunk of sheetCount x rowCount x
+    colCount cells
+
+    """
+    col = pId % colCount
+    row = (pId / colCount) % rowCount
+    sheet = (pId / (colCount*rowCount)) % sheetCount
+    return (row, col, sheet)
 
 def _pipelinePositions(sheetCount, rowCount, colCount,
                        pipelines):
@@ -251,14 +336,288 @@ def _pipelinePositions(sheetCount, rowCount, colCount,
 
     """
 
-    pipelinePositions = []
-    for pId in xrange(len(pipelines)):
-        col = pId % colCount
-        row = (pId / colCount) % rowCount
-        sheet = (pId / (colCount*rowCount)) % sheetCount
-        pipelinePositions.append((row, col, sheet))
-    return pipelinePositions
+    return [_pipelinePosition(pId, sheetCount, rowCount, colCount)
+            for pId in xrange(len(pipelines))]
+
+class ExplorationCell(object):
+    """One cell of a parameter exploration, and its execution results.
+
+    position is (row, column, sheet). id_map maps the ids of the modules of
+    the cell's pipeline to their ids in merged pipeline number 'chunk' of
+    the runner. errors and objects map the ids of the modules of the cell's
+    pipeline to their errors and module instances; objects is only filled
+    once the whole exploration has run, and only if it ran in this process.
+
+    """
+    def __init__(self, index, position, actions, chunk, id_map):
+        self.index = index
+        self.position = position
+        self.actions = actions
+        self.chunk = chunk
+        self.id_map = id_map
+        self.errors = {}
+        self.objects = {}
+        self.finished = False
+
+class _ExplorationView(DummyView):
+    """Tracks the modules of the merged exploration pipeline as they
+    finish, to report each cell as soon as it is done.
+
+    """
+    def __init__(self, runner, cells):
+        DummyView.__init__(self)
+        self.runner = runner
+        # cell index -> merged ids left to run
+        self.left = {}
+        # merged id -> [(cell, id in the cell's pipeline)]
+        self.owners = {}
+        for cell in cells:
+            self.left[cell.index] = set(cell.id_map.itervalues())
+            for cell_id, m_id in cell.id_map.iteritems():
+                self.owners.setdefault(m_id, []).append((cell, cell_id))
+
+    def module_done(self, i, error=None):
+        for cell, cell_id in self.owners.get(i, ()):
+            if cell.finished:
+                continue
+            left = self.left[cell.index]
+            left.discard(i)
+            if error is not None:
+                cell.errors[cell_id] = error
+                self.runner.finish_cell(cell)
+            elif not left:
+                self.runner.finish_cell(cell)
+
+    def set_module_success(self, i, *args, **kwargs):
+        self.module_done(i)
+    def set_module_not_executed(self, i, *args, **kwargs):
+        self.module_done(i)
+    def set_module_error(self, i, error, *args, **kwargs):
+        self.module_done(i, error)
+    def set_module_suspended(self, i, error, *args, **kwargs):
+        self.module_done(i, error)
+
+# The merged pipelines and the interpreter arguments of the exploration that
+# is running on worker processes, which get them when they are forked
+_exploration = None
+
+def _execute_chunk(chunk):
+    """ _execute_chunk(chunk: int) -> (int, dict, [str])
+    Executes merged pipeline number 'chunk' of the running exploration, in
+    a worker process. Returns the chunk, the error messages by module id,
+    and the serialized workflow executions to add to the log
+
+    """
+    pipelines, kwargs = _exploration
+    kwargs = dict(kwargs)
+    logger = kwargs['logger']
+    if logger is not DummyLogController:
+        logger = kwargs['logger'] = LogController(Log())
+    result = get_default_interpreter().execute(pipelines[chunk], **kwargs)
+    errors = dict((m_id, str(error))
+                  for m_id, error in result.errors.iteritems())
+    if logger is DummyLogController:
+        workflow_execs = []
+    else:
+        workflow_execs = [serialize(workflow_exec)
+                          for workflow_exec in logger.log.workflow_execs]
+    return chunk, errors, workflow_execs
+
+class ParameterExplorationRunner(object):
+    """Executes a parameter exploration without the GUI.
+
+    The pipelines of the cells are generated one at a time and merged into
+    a single pipeline, which is executed at once. The modules that do not
+    depend on the explored parameters have the same signature in every
+    cell, so they only appear once in the merged pipeline and are only
+    computed once; those that are not cacheable, or are downstream of one,
+    are kept for each cell. With several workers, independent modules run
+    on the interpreter's thread pool.
+
+    Threads only help the modules that release the GIL, so the cells can
+    also be split among worker processes: each one gets a merged pipeline
+    of its own.
+
+    """
+    def __init__(self, controller, pe):
+        self.controller = controller
+        self.pe = pe
+        self.cells = []
+        self.merged = []
+        self.cell_finished = None
+        self.vistrail_vars = []
+
+    def build_cells(self, chunks=1):
+        """build_cells(chunks: int) -> [ExplorationCell]
+
+        Creates the pipelines of the exploration, from the version it
+        explores, and merges them as they are generated. The cells are
+        split into 'chunks' runs of consecutive cells, each merged into one
+        of the pipelines of self.merged.
+
+        """
+        controller = self.controller
+        if self.pe.action_id != controller.current_version:
+            controller.change_selected_version(self.pe.action_id)
+        collected = self.pe.collectParameterActions(
+                controller.current_pipeline)
+        if not collected:
+            raise ValueError("Parameter exploration has no valid values")
+        actions, pre_actions, self.vistrail_vars = collected
+        dim = [max(1, len(a)) for a in actions]
+        count = reduce(lambda x, y: x * y, dim, 1)
+        chunks = max(1, min(chunks, count))
+        self.merged = [Pipeline() for chunk in xrange(chunks)]
+        by_signature = [{} for chunk in xrange(chunks)]
+        cacheable = {}
+        explorer = ActionBasedParameterExploration()
+        self.cells = []
+        for i, (pipeline, performedActions) in enumerate(
+                explorer.explore_iter(controller.current_pipeline, actions,
+                                      pre_actions)):
+            chunk = i * chunks // count
+            id_map = self._merge(self.merged[chunk], by_signature[chunk],
+                                 cacheable, pipeline)
+            self.cells.append(ExplorationCell(
+                    i, _pipelinePosition(i, dim[2], dim[1], dim[0]),
+                    performedActions, chunk, id_map))
+        return self.cells
+
+    def _merge(self, merged, by_signature, cacheable, pipeline):
+        """_merge(merged: Pipeline, by_signature: dict, cacheable: dict,
+                  pipeline: Pipeline) -> dict
+
+        Adds the modules of 'pipeline' to 'merged', except the cacheable
+        ones that have the same upstream signature as a module already in
+        it, and returns the mapping from the ids of 'pipeline' to the ids
+        in 'merged'. by_signature maps the signatures of the cacheable
+        modules of 'merged' to their ids; cacheable caches whether the
+        module and upstream of a signature are cacheable.
+
+        """
+        pipeline.refresh_signatures()
+        id_map = {}
+        added = set()
+        for module_id in pipeline.graph.vertices_topological_sort():
+            sig = pipeline.subpipeline_signature(module_id)
+            if sig not in cacheable:
+                cacheable[sig] = (
+                        pipeline.modules[module_id].summon().is_cacheable() and
+                        all(cacheable[pipeline.subpipeline_signature(m)]
+                            for m, _ in pipeline.graph.edges_to(module_id)))
+            if cacheable[sig] and sig in by_signature:
+                id_map[module_id] = by_signature[sig]
+                continue
+            new_module = copy.copy(pipeline.modules[module_id])
+            new_module.id = merged.fresh_module_id()
+            merged.add_module(new_module)
+            id_map[module_id] = new_module.id
+            if cacheable[sig]:
+                by_signature[sig] = new_module.id
+            added.add(module_id)
+        for connection in pipeline.connection_list:
+            if connection.destinationId not in added:
+                continue
+            new_connection = copy.copy(connection)
+            new_connection.id = merged.fresh_connection_id()
+            new_connection.sourceId = id_map[connection.sourceId]
+            new_connection.destinationId = id_map[connection.destinationId]
+            merged.add_connection(new_connection)
+        return id_map
+
+    def finish_cell(self, cell):
+        cell.finished = True
+        if self.cell_finished is not None:
+            self.cell_finished(cell)
+
+    def run(self, workers=None, cell_finished=None, extra_info=None,
+            reason='Parameter Exploration', processes=None):
+        """run(workers: int, cell_finished: callable, extra_info: dict,
+               reason: str, processes: int) -> [ExplorationCell]
+
+        Executes the exploration on 'workers' threads (the executionThreads
+        option by default). cell_finished, if given, is called with each
+        cell as soon as it is done, or one of its modules failed.
+
+        If 'processes' is more than 1, the cells are split among that many
+        worker processes, forked from this one, that each run on 'workers'
+        threads. The cells then only get the error messages, not the
+        module instances, and are reported when their process is done.
+
+        """
+        if processes is None or processes < 1:
+            processes = 1
+        if not self.cells or len(self.merged) != processes:
+            self.build_cells(processes)
+        if workers is None:
+            conf = get_vistrails_configuration()
+            workers = 0
+            if conf is not None and conf.check('executionThreads'):
+                workers = conf.executionThreads
+        self.cell_finished = cell_finished
+        controller = self.controller
 
+        pe_log_id = uuid.uuid1()
+        logger = controller.get_logger()
+        kwargs = {'locator': controller.locator,
+                  'current_version': controller.current_version,
+                  'reason': '%s %s' % (reason, pe_log_id),
+                  'logger': logger,
+                  'stop_on_error': False,
+                  'execution_threads': workers,
+                  }
+        if extra_info is not None:
+            kwargs['extra_info'] = extra_info
+        if controller.get_vistrail_variables():
+            # remove vars used in pe
+            vars = dict([(v.uuid, v)
+                         for v in controller.get_vistrail_variables()
+                         if v.uuid not in self.vistrail_vars])
+            kwargs['vistrail_variables'] = lambda x: vars.get(x, None)
+
+        if len(self.merged) > 1:
+            self._run_processes(kwargs, logger)
+            return self.cells
+
+        kwargs['view'] = _ExplorationView(self, self.cells)
+        result = get_default_interpreter().execute(self.merged[0], **kwargs)
+        for cell in self.cells:
+            for cell_id, m_id in cell.id_map.iteritems():
+                if m_id in result.objects:
+                    cell.objects[cell_id] = result.objects[m_id]
+                if m_id in result.errors and cell_id not in cell.errors:
+                    cell.errors[cell_id] = result.errors[m_id]
+            if not cell.finished:
+                self.finish_cell(cell)
+        return self.cells
+
+    def _run_processes(self, kwargs, logger):
+        """_run_processes(kwargs: dict, logger: LogController) -> None
+
+        Executes each merged pipeline on its own worker process, with the
+        given interpreter arguments.
+
+        """
+        global _exploration
+        _exploration = (self.merged, kwargs)
+        pool = multiprocessing.Pool(len(self.merged))
+        try:
+            for chunk, errors, workflow_execs in pool.imap_unordered(
+                    _execute_chunk, xrange(len(self.merged))):
+                for workflow_exec in workflow_execs:
+                    logger.add_workflow_exec(
+                            unserialize(workflow_exec, WorkflowExec))
+                for cell in self.cells:
+                    if cell.chunk != chunk:
+                        continue
+                    for cell_id, m_id in cell.id_map.iteritems():
+                        if m_id in errors:
+                            cell.errors[cell_id] = errors[m_id]
+                    self.finish_cell(cell)
+        finally:
+            pool.terminate()
+            pool.join()
+            _exploration = None
 
 ################################################################################
         
@@ -280,5 +639,127 @@ class TestParameterExploration(unittest.TestCase):
                           (5, 5.0, 'two'),
                           (10, 10.0, 'three')])
 
+    def testRunner(self):
+        import os
+        import shutil
+        import tempfile
+        from vistrails.core.modules.basic_modules import identifier
+        from vistrails.core.paramexplore.function import PEFunction
+        from vistrails.core.paramexplore.param import PEParam
+        from vistrails.core.paramexplore.paramexplore import \
+            ParameterExploration
+        from vistrails.core.vistrail.controller import VistrailController
+        from vistrails.core.vistrail.vistrail import Vistrail
+
+        # only the file for the second value exists
+        tmpdir = tempfile.mkdtemp(prefix='vt_pe_')
+        self.addCleanup(shutil.rmtree, tmpdir)
+        open(os.path.join(tmpdir, 'b'), 'w').close()
+
+        controller = VistrailController(Vistrail(), None, auto_save=False)
+        controller.change_selected_version(0)
+        source = controller.add_module(identifier, 'String')
+        controller.update_function(source, 'value', [tmpdir + os.sep])
+        concat = controller.add_module(identifier, 'ConcatenateString')
+        check = controller.add_module(identifier, 'File')
+        controller.add_connection(source.id, 'value', concat.id, 'str1')
+        controller.add_connection(concat.id, 'value', check.id, 'name')
+
+        param = PEParam(pos=0, interpolator='List',
+                        value="['a', 'b', 'c']", dimension=0)
+        function = PEFunction(module_id=concat.id, port_name='str2',
+                              parameters=[param])
+        pe = ParameterExploration(action_id=controller.current_version,
+                                  dims='[3, 1, 1, 1]', functions=[function])
+
+        finished = []
+        runner = ParameterExplorationRunner(controller, pe)
+        cells = runner.run(workers=2, cell_finished=finished.append)
+        self.assertEqual(len(cells), 3)
+        self.assertEqual(sorted(c.index for c in finished), [0, 1, 2])
+        self.assertEqual([c.position for c in cells],
+                         [(0, 0, 0), (0, 1, 0), (0, 2, 0)])
+        self.assertEqual([sorted(c.errors) for c in cells],
+                         [[check.id], [], [check.id]])
+        self.assertEqual([c.objects[concat.id].get_output('value')
+                          for c in cells],
+                         [os.path.join(tmpdir, v) for v in 'abc'])
+        # the upstream module is shared by all the cells
+        self.assertIs(cells[0].objects[source.id],
+                      cells[2].objects[source.id])
+
+        # unless it is not cacheable
+        from vistrails.core.modules.basic_modules import String
+        String.is_cacheable = lambda self: False
+        try:
+            runner = ParameterExplorationRunner(controller, pe)
+            cells = runner.run(workers=2)
+        finally:
+            del String.is_cacheable
+        self.assertEqual(len(runner.merged[0].modules), 9)
+        self.assertIsNot(cells[0].objects[source.id],
+                         cells[2].objects[source.id])
+
+        # on worker processes, only the error messages come back
+        finished = []
+        runner = ParameterExplorationRunner(controller, pe)
+        cells = runner.run(cell_finished=finished.append, processes=2)
+        self.assertEqual(len(runner.merged), 2)
+        self.assertEqual(sorted(c.index for c in finished), [0, 1, 2])
+        self.assertEqual([sorted(c.errors) for c in cells],
+                         [[check.id], [], [check.id]])
+        self.assertIsInstance(cells[0].errors[check.id], str)
+        self.assertEqual([c.objects for c in cells], [{}, {}, {}])
+
+    def testExploreIter(self):
+        from vistrails.core.modules.basic_modules import identifier
+        from vistrails.core.paramexplore.function import PEFunction
+        from vistrails.core.paramexplore.param import PEParam
+        from vistrails.core.paramexplore.paramexplore import \
+            ParameterExploration as PE
+        from vistrails.core.vistrail.controller import VistrailController
+        from vistrails.core.vistrail.vistrail import Vistrail
+
+        controller = VistrailController(Vistrail(), None, auto_save=False)
+        controller.change_selected_version(0)
+        source = controller.add_module(identifier, 'String')
+        controller.update_function(source, 'value', ['a'])
+        concat = controller.add_module(identifier, 'ConcatenateString')
+        controller.add_connection(source.id, 'value', concat.id, 'str1')
+        pipeline = controller.current_pipeline
+
+        functions = [PEFunction(module_id=concat.id, port_name='str2',
+                                parameters=[PEParam(pos=0,
+                                                    interpolator='List',
+                                                    value="['x', 'y', 'z']",
+                                                    dimension=0)]),
+                     PEFunction(module_id=source.id, port_name='value',
+                                parameters=[PEParam(pos=0,
+                                                    interpolator='List',
+                                                    value="['a', 'b']",
+                                                    dimension=2)])]
+        pe = PE(dims='[3, 1, 2, 1]', functions=functions)
+        actions, pre_actions, _ = pe.collectParameterActions(pipeline)
+
+        def values(p):
+            return (p.modules[source.id].functions[0].params[0].strValue,
+                    p.modules[concat.id].functions[0].params[0].strValue)
+
+        explorer = ActionBasedParameterExploration()
+        pipelines, performed = explorer.explore(pipeline, actions,
+                                                pre_actions)
+        expected = [(v1, v2) for v1 in 'ab' for v2 in 'xyz']
+        self.assertEqual([values(p) for p in pipelines], expected)
+
+        generated = explorer.explore_iter(pipeline, actions, pre_actions)
+        for i, (p, performedActions) in enumerate(generated):
+            self.assertEqual(values(p), expected[i])
+            self.assertEqual(performedActions, performed[i])
+            self.assertEqual(p.subpipeline_signature(concat.id),
+                             pipelines[i].subpipeline_signature(concat.id))
+        self.assertEqual(i, 5)
+        # the original pipeline is left alone
+        self.assertEqual(len(pipeline.modules[concat.id].functions), 0)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,329 @@
+###############################################################################
+##
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah. 
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without 
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice, 
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright 
+##    notice, this list of conditions and the following disclaimer in the 
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the University of Utah nor the names of its 
+##    contributors may be used to endorse or promote products derived from 
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, 
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR 
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR 
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, 
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, 
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; 
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, 
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR 
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF 
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+"""Inverted index of the versions of a vistrail, used by version search.
+
+Searching used to test every version on its own, building the pipeline of
+each version to look at its modules. The index instead records what each
+action introduces, so that a search term is tested once per distinct value
+and the matching versions are derived from the version tree.
+"""
+
+import bisect
+import time
+
+from vistrails.core.query import extract_text
+from vistrails.core.system import time_strptime
+
+################################################################################
+
+class VersionIndex(object):
+    """Index of the actions of a vistrail, updated as actions are added.
+
+    Users and dates are indexed per action. Module names, parameter values
+    and connections (as the pair of the names of the modules they connect)
+    are structural: an object added by an action is present in all the
+    versions below it, except below the actions that delete or change it.
+    Tags, notes and descriptions are read from the action annotations and
+    re-read when these change.
+
+    Use VersionIndex.get() to obtain the index of a vistrail; it is kept on
+    the vistrail and brought up to date on each call.
+    """
+
+    STRUCTURAL_TERMS = ('module', 'parameter', 'connection')
+
+    def __init__(self, vistrail):
+        self.vistrail = vistrail
+        # bumped whenever the indexed content changes, so that statements
+        # can cache their results
+        self.generation = 0
+
+        self._indexed = set()
+        self._parents = {}
+        self._users = {}
+        self._dates = []
+        self._terms = dict((kind, {}) for kind in self.STRUCTURAL_TERMS)
+        self._kills = {}
+        self._module_names = {}
+        self._tree = None
+
+        self._annotation_count = None
+        self._tags = {}
+        self._notes = {}
+        self._descriptions = {}
+
+    @staticmethod
+    def get(vistrail):
+        """get(vistrail: Vistrail) -> VersionIndex
+        Returns the up-to-date index of a vistrail, creating it if needed.
+
+        """
+        index = getattr(vistrail, 'search_index', None)
+        if index is None:
+            index = VersionIndex(vistrail)
+            vistrail.search_index = index
+        index.update()
+        return index
+
+    def annotation_changed(self, action_id):
+        """annotation_changed(action_id: long) -> None
+        Called by the vistrail when the annotations of an action change.
+
+        """
+        self._annotation_count = None
+        self._descriptions.pop(action_id, None)
+
+    def update(self):
+        """update() -> None
+        Indexes the actions added since the last update.
+
+        """
+        vistrail = self.vistrail
+        action_map = vistrail.actionMap
+        if len(action_map) != len(self._indexed):
+            new_actions = [action
+                           for version, action in action_map.iteritems()
+                           if version not in self._indexed]
+            new_actions.sort(key=lambda a: a.id)
+            for action in new_actions:
+                self._add_action(action)
+            self._tree = None
+            self.generation += 1
+        if self._annotation_count != len(vistrail.action_annotations):
+            self._index_annotations()
+            self.generation += 1
+
+    @staticmethod
+    def _what(op):
+        if op.what in ('abstraction', 'group'):
+            return 'module'
+        return op.what
+
+    def _add_action(self, action):
+        version = action.id
+        self._indexed.add(version)
+        self._parents[version] = action.prevId
+        if action.user:
+            self._users.setdefault(action.user, set()).add(version)
+        if action.date:
+            t = time.mktime(time_strptime(action.date, "%d %b %Y %H:%M:%S"))
+            bisect.insort(self._dates, (t, version))
+        # the ports of new connections are usually added by their own
+        # operations
+        connections = {}
+        for op in action.operations:
+            what = self._what(op)
+            if op.vtType in ('change', 'delete'):
+                self._kills.setdefault((what, op.old_obj_id),
+                                       []).append(version)
+            if op.vtType not in ('add', 'change') or op.data is None:
+                continue
+            if what == 'module':
+                self._module_names[op.data.id] = op.data.name
+                self._add_term('module', op.data.name, version, op)
+            elif what == 'parameter':
+                self._add_term('parameter', op.data.strValue, version, op)
+            elif what == 'connection':
+                ports = connections.setdefault(op.new_obj_id, [op, {}])[1]
+                for port in op.data.db_ports:
+                    ports[port.db_type] = port
+            elif what == 'port' and op.parentObjType == 'connection':
+                ports = connections.setdefault(op.parentObjId, [None, {}])[1]
+                ports[op.data.db_type] = op.data
+        for op, ports in connections.itervalues():
+            if op is None or len(ports) != 2:
+                continue
+            # module ids are never reused, so their names are known
+            value = tuple(self._module_names.get(port.db_moduleId,
+                                                 port.db_moduleName)
+                          for port in (ports['source'],
+                                       ports['destination']))
+            self._add_term('connection', value, version, op)
+
+    def _add_term(self, kind, value, version, op):
+        if value is not None:
+            self._terms[kind].setdefault(value, []).append(
+                    (version, kind, op.new_obj_id))
+
+    def _index_annotations(self):
+        from vistrails.core.vistrail.vistrail import Vistrail
+
+        self._tags = {}
+        self._notes = {}
+        self._descriptions = {}
+        annotations = self.vistrail.action_annotations
+        for annotation in annotations:
+            if annotation.key == Vistrail.TAG_ANNOTATION:
+                self._tags[annotation.action_id] = annotation.value
+            elif annotation.key == Vistrail.NOTES_ANNOTATION:
+                self._notes[annotation.action_id] = \
+                    extract_text(annotation.value)
+        self._annotation_count = len(annotations)
+
+    def _get_tree(self):
+        """Numbers the versions in preorder.
+
+        Returns (order, pre, end): the subtree of version v is
+        order[pre[v]:end[v]].
+        """
+        if self._tree is None:
+            children = {}
+            for version in sorted(self._parents):
+                children.setdefault(self._parents[version], []).append(version)
+            roots = [v for v in children if v not in self._parents]
+            order = []
+            pre = {}
+            end = {}
+            stack = [(v, False) for v in sorted(roots, reverse=True)]
+            while stack:
+                version, done = stack.pop()
+                if done:
+                    end[version] = len(order)
+                    continue
+                pre[version] = len(order)
+                order.append(version)
+                stack.append((version, True))
+                for child in reversed(children.get(version, ())):
+                    stack.append((child, False))
+            self._tree = order, pre, end
+        return self._tree
+
+    ##########################################################################
+    # Queries
+    #
+    # 'matches' is a function called on each distinct indexed value; the
+    # versions are returned as a set of version ids.
+
+    def versions_by_user(self, matches):
+        result = set()
+        for user, versions in self._users.iteritems():
+            if matches(user):
+                result.update(versions)
+        return result
+
+    def versions_in_time(self, start=None, stop=None):
+        """Returns the versions created between start and stop (inclusive),
+        both as timestamps.
+        """
+        dates = self._dates
+        lo = 0
+        hi = len(dates)
+        if start is not None:
+            lo = bisect.bisect_left(dates, (start,))
+        if stop is not None:
+            hi = bisect.bisect_left(dates, (stop, float('inf')))
+        return set(version for t, version in dates[lo:hi])
+
+    def versions_by_notes(self, matches):
+        return set(version for version, notes in self._notes.iteritems()
+                   if version in self._indexed and matches(notes))
+
+    def versions_by_name(self, matches):
+        """Returns the versions whose tag or description matches.
+        """
+        result = set()
+        descriptions = self._descriptions
+        for version in self._indexed:
+            tag = self._tags.get(version)
+            if tag is not None and matches(tag):
+                result.add(version)
+                continue
+            try:
+                description = descriptions[version]
+            except KeyError:
+                description = descriptions[version] = \
+                    self.vistrail.get_description(version)
+            if matches(description):
+                result.add(version)
+        return result
+
+    def versions_with(self, kind, matches):
+        """Returns the versions whose pipeline contains an object of the
+        given kind ('module', 'parameter' or 'connection') whose value
+        matches.
+        """
+        return self._live_versions(
+                occurrence
+                for value, occurrences in self._terms[kind].iteritems()
+                if matches(value)
+                for occurrence in occurrences)
+
+    def versions_with_values(self, kind, values):
+        """Like versions_with(), for values equal to one of 'values'.
+        """
+        terms = self._terms[kind]
+        return self._live_versions(occurrence
+                                   for value in values
+                                   for occurrence in terms.get(value, ()))
+
+    def preorder(self, versions):
+        """Returns the given versions, sorted in preorder of the version
+        tree; consecutive versions are then close in the tree.
+        """
+        order, pre, end = self._get_tree()
+        return sorted(versions, key=pre.__getitem__)
+
+    def _live_versions(self, occurrences):
+        """Returns the versions in which one of the occurrences is present.
+
+        An occurrence (version, what, obj_id) is an object added by an
+        action.
+        """
+        order, pre, end = self._get_tree()
+        intervals = []
+        for version, what, obj_id in occurrences:
+            start, stop = pre[version], end[version]
+            # versions below an action removing the object don't have it
+            killers = sorted((pre[k], end[k])
+                             for k in self._kills.get((what, obj_id), ())
+                             if start < pre[k] < stop)
+            for k_start, k_stop in killers:
+                if k_start < start:
+                    continue # below a previous killer
+                if start < k_start:
+                    intervals.append((start, k_start))
+                start = k_stop
+            if start < stop:
+                intervals.append((start, stop))
+
+        result = set()
+        intervals.sort()
+        last = 0
+        for start, stop in intervals:
+            start = max(start, last)
+            if start < stop:
+                result.update(order[start:stop])
+                last = stop
+        return result
@@ -39,8 +39,7 @@ import re
 import time
 import unittest
 
-from vistrails.core.query import extract_text
-from vistrails.core.system import time_strptime
+from vistrails.core.query.index import VersionIndex
 
 ################################################################################
 
@@ -62,7 +61,26 @@ class SearchStmt(object):
         """Make SearchStmt behave just like a QueryObject."""
         return self
 
-class TimeSearchStmt(SearchStmt):
+class IndexedSearchStmt(SearchStmt):
+    """A statement answered from the VersionIndex of the vistrail.
+
+    Subclasses implement matching_versions(), which is computed once for
+    all the versions and kept until the index changes.
+    """
+    _matches = None
+
+    def matching_versions(self, index):
+        return set()
+
+    def match(self, vistrail, action):
+        index = VersionIndex.get(vistrail)
+        if (self._matches is None or self._matches[0] is not index or
+                self._matches[1] != index.generation):
+            self._matches = (index, index.generation,
+                             self.matching_versions(index))
+        return action.timestep in self._matches[2]
+
+class TimeSearchStmt(IndexedSearchStmt):
     oneSecond = 1.0
     oneMinute = oneSecond * 60.0
     oneHour = oneMinute * 60.0
@@ -390,20 +408,14 @@ class TimeSearchStmt(SearchStmt):
         return time.mktime(this)
         
 class BeforeSearchStmt(TimeSearchStmt):
-    def match(self, vistrail, action):
-        if not action.date:
-            return False
-        t = time.mktime(time_strptime(action.date, "%d %b %Y %H:%M:%S"))
-        return t <= self.date
+    def matching_versions(self, index):
+        return index.versions_in_time(stop=self.date)
 
 class AfterSearchStmt(TimeSearchStmt):
-    def match(self, vistrail, action):
-        if not action.date:
-            return False
-        t = time.mktime(time_strptime(action.date, "%d %b %Y %H:%M:%S"))
-        return t >= self.date
+    def matching_versions(self, index):
+        return index.versions_in_time(start=self.date)
 
-class RegexEnabledSearchStmt(SearchStmt):
+class RegexEnabledSearchStmt(IndexedSearchStmt):
     def __init__(self, content, use_regex):
         self.content = content
         self.use_regex = use_regex
@@ -417,35 +429,24 @@ class RegexEnabledSearchStmt(SearchStmt):
             return v in self.content
 
 class UserSearchStmt(RegexEnabledSearchStmt):
-    def match(self, vistrail, action):
-        if not action.user:
-            return False
-        return self._content_matches(action.user)
+    def matching_versions(self, index):
+        return index.versions_by_user(self._content_matches)
 
 class NotesSearchStmt(RegexEnabledSearchStmt):
-    def match(self, vistrail, action):
-        if vistrail.has_notes(action.id):
-            plainNotes = extract_text(vistrail.get_notes(action.id))
-            return self._content_matches(plainNotes)
-        return False
+    def matching_versions(self, index):
+        return index.versions_by_notes(self._content_matches)
 
 class NameSearchStmt(RegexEnabledSearchStmt):
-    def match(self, vistrail, action):
-        m = 0
-        tm = vistrail.get_tagMap()
-        if action.timestep in tm:
-            m = self._content_matches(tm[action.timestep])
-        if bool(m) == False:
-            m = self._content_matches(vistrail.get_description(action.timestep))
-        return bool(m)
+    def matching_versions(self, index):
+        return index.versions_by_name(self._content_matches)
 
 class ModuleSearchStmt(RegexEnabledSearchStmt):
-    def match(self, vistrail, action):
-        pipeline = vistrail.getPipeline(action.timestep)
-        for module in pipeline.modules.itervalues():
-            if self._content_matches(module.name):
-                return True
-        return False
+    def matching_versions(self, index):
+        return index.versions_with('module', self._content_matches)
+
+class ParameterSearchStmt(RegexEnabledSearchStmt):
+    def matching_versions(self, index):
+        return index.versions_with('parameter', self._content_matches)
 
 class AndSearchStmt(SearchStmt):
     def __init__(self, lst):
@@ -469,7 +470,7 @@ class NotSearchStmt(SearchStmt):
     def __init__(self, stmt):
         self.stmt = stmt
     def match(self, vistrail, action):
-        return not self.stmt.match(action)
+        return not self.stmt.match(vistrail, action)
 
 class TrueSearch(SearchStmt):
     def __init__(self):
@@ -544,6 +545,17 @@ class SearchCompiler(object):
             lst.append(ModuleSearchStmt(tok, use_regex))
             tokStream = tokStream[1:]
         return (AndSearchStmt(lst), [])
+    def parseParameter(self, tokStream, use_regex):
+        if len(tokStream) == 0:
+            raise SearchParseError('Expected token, got end of search')
+        lst = []
+        while len(tokStream):
+            tok = tokStream[0]
+            if ':' in tok:
+                return (AndSearchStmt(lst), tokStream)
+            lst.append(ParameterSearchStmt(tok, use_regex))
+            tokStream = tokStream[1:]
+        return (AndSearchStmt(lst), [])
     def parseBefore(self, tokStream, use_regex):
         old_tokstream = tokStream
         try:
@@ -601,6 +613,7 @@ class SearchCompiler(object):
                 'after': parseAfter,
                 'name': parseName,
                 'module': parseModule,
+                'parameter': parseParameter,
                 'any': parseAny}
                 
             
@@ -700,5 +713,67 @@ class TestSearch(unittest.TestCase):
         SearchCompiler('before')
         SearchCompiler('after')
 
+    def test_index(self):
+        from vistrails.core.modules.basic_modules import identifier
+        from vistrails.core.vistrail.controller import VistrailController
+        from vistrails.core.vistrail.vistrail import Vistrail
+
+        controller = VistrailController(Vistrail(), None, auto_save=False)
+        vistrail = controller.vistrail
+        controller.change_selected_version(0)
+        string = controller.add_module(identifier, 'String')
+        controller.update_function(string, 'value', ['hello'])
+        branch = controller.current_version
+        controller.update_function(
+                controller.current_pipeline.modules[string.id],
+                'value', ['world'])
+        controller.add_module(identifier, 'Integer')
+        controller.change_selected_version(branch)
+        controller.delete_module(string.id)
+        controller.add_module(identifier, 'Float')
+        vistrail.set_tag(branch, 'greeting')
+        vistrail.set_notes(controller.current_version, 'floating')
+
+        def reference(version):
+            """The contents of a version, from its pipeline."""
+            pipeline = vistrail.getPipeline(version)
+            modules = set(m.name for m in pipeline.modules.itervalues())
+            params = set(p.strValue
+                         for m in pipeline.modules.itervalues()
+                         for f in m.functions
+                         for p in f.params)
+            return modules, params
+
+        actions = vistrail.actionMap.values()
+        def matching(search):
+            stmt = SearchCompiler(search).searchStmt
+            return set(a.id for a in vistrail.actionMap.itervalues()
+                       if stmt.match(vistrail, a))
+
+        for name in ['String', 'Integer', 'Float']:
+            self.assertEqual(
+                    matching('module:%s' % name),
+                    set(a.id for a in actions if name in reference(a.id)[0]))
+        for value in ['hello', 'world']:
+            self.assertEqual(
+                    matching('parameter:%s' % value),
+                    set(a.id for a in actions if value in reference(a.id)[1]))
+        self.assertEqual(matching('name:greeting'), set([branch]))
+        self.assertEqual(matching('notes:floating'),
+                         set([controller.current_version]))
+        self.assertEqual(matching('module:String parameter:hello'),
+                         set([branch]))
+        self.assertEqual(matching('after:yesterday'),
+                         set(a.id for a in actions))
+
+        # the index follows new actions and annotations
+        strings = matching('module:String')
+        controller.add_module(identifier, 'String')
+        self.assertEqual(matching('module:String'),
+                         strings | set([controller.current_version]))
+        vistrail.set_tag(branch, 'farewell')
+        self.assertEqual(matching('name:greeting'), set())
+        self.assertEqual(matching('name:farewell'), set([branch]))
+
 if __name__ == '__main__':
     unittest.main()
@@ -34,9 +34,11 @@
 ###############################################################################
 from vistrails.core import query
 from vistrails.core.modules.module_registry import get_module_registry
+from vistrails.core.query.index import VersionIndex
 from vistrails.core.utils import append_to_dict_of_lists
 import copy
 import re
+import unittest
 
 ################################################################################
 
@@ -84,11 +86,64 @@ class VisualQuery(query.Query):
             target_ids = nextTargetIds
             template_ids = nextTemplateIds
 
+    def candidate_versions(self, vistrail):
+        """candidate_versions(vistrail: Vistrail) -> list of versions
+        Returns the versions to check that can match the query, in preorder.
+
+        Uses the VersionIndex of the vistrail: a version can only match if
+        it has modules with all the names in the query, and, for each module
+        that is not a source of the query, a connection to a module with
+        that name from a module with a name in the query.
+
+        """
+        query = self.queryPipeline
+        if query is None or not query.modules:
+            return []
+        versions = self.versions_to_check
+        if isinstance(versions, (int, long)):
+            versions = [versions]
+        index = VersionIndex.get(vistrail)
+        names = set(m.name for m in query.modules.itervalues())
+        candidates = set(versions)
+        for name in names:
+            if not candidates:
+                break
+            candidates &= index.versions_with_values('module', [name])
+        sources = set(query.graph.sources())
+        for name in set(m.name for m_id, m in query.modules.iteritems()
+                        if m_id not in sources):
+            if not candidates:
+                break
+            candidates &= index.versions_with_values(
+                    'connection', [(n, name) for n in names])
+        return index.preorder(candidates)
+
+    @staticmethod
+    def iter_pipelines(vistrail, versions):
+        """iter_pipelines(vistrail: Vistrail, versions: list)
+               -> iterator over (version, Pipeline)
+        Materializes the pipelines of the versions in turn.
+
+        A single pipeline is updated from one version to the next, so
+        versions that are close in the version tree are cheap. The pipeline
+        is only valid until the next iteration.
+
+        """
+        pipeline = None
+        for version in versions:
+            if pipeline is None:
+                pipeline = vistrail.getPipeline(version)
+            else:
+                pipeline.perform_action(
+                        vistrail.general_action_chain(current, version))
+            current = version
+            yield version, pipeline
+
     def run(self, vistrail, name):
         result = []
         self.tupleLength = 2
-        for version in self.versions_to_check:
-            p = vistrail.getPipeline(version)
+        for version, p in self.iter_pipelines(
+                vistrail, self.candidate_versions(vistrail)):
             matches = set()
             queryModuleNameIndex = {}
             for moduleId, module in p.modules.iteritems():
@@ -96,9 +151,9 @@ class VisualQuery(query.Query):
             for querySourceId in self.queryPipeline.graph.sources():
                 querySourceName = self.queryPipeline.modules[querySourceId].name
                 if not queryModuleNameIndex.has_key(querySourceName):
-                    # need to reset matches here!
+                    # We always perform AND operation
                     matches = set()
-                    continue
+                    break
                 candidates = queryModuleNameIndex[querySourceName]
                 atLeastOneMatch = False
                 for candidateSourceId in candidates:
@@ -131,7 +186,7 @@ class VisualQuery(query.Query):
         """Returns a copy of itself. This needs to be implemented so that
         a visualquery object looks like a class that can be instantiated
         once per vistrail."""
-        return VisualQuery(self.queryPipeline)
+        return VisualQuery(self.queryPipeline, self.versions_to_check)
 
     def matchQueryModule(self, template, target):
         """ matchQueryModule(template, target: Module) -> bool        
@@ -237,3 +292,69 @@ class VisualQuery(query.Query):
         #             except:
         #                 print 'Invalid query "%s".' % template.strValue
         #                 return False
+
+################################################################################
+
+class TestVisualQuery(unittest.TestCase):
+    def test_run(self):
+        from vistrails.core.modules.basic_modules import identifier
+        from vistrails.core.vistrail.controller import VistrailController
+        from vistrails.core.vistrail.vistrail import Vistrail
+
+        controller = VistrailController(Vistrail(), None, auto_save=False)
+        vistrail = controller.vistrail
+        controller.change_selected_version(0)
+        string = controller.add_module(identifier, 'String')
+        concat = controller.add_module(identifier, 'ConcatenateString')
+        unconnected = controller.current_version
+        conn = controller.add_connection(string.id, 'value', concat.id, 'str1')
+        connected = controller.current_version
+        controller.update_function(string, 'value', ['hello'])
+        with_value = controller.current_version
+        controller.delete_connection(conn.id)
+        disconnected = controller.current_version
+        controller.change_selected_version(unconnected)
+        controller.add_module(identifier, 'String')
+        other_string = controller.current_version
+
+        query = VisualQuery(vistrail.getPipeline(connected),
+                            set(vistrail.actionMap))
+        self.assertEqual(query.candidate_versions(vistrail),
+                         [connected, with_value])
+        result = query.run(vistrail, None)
+        self.assertEqual(sorted(result),
+                         [(connected, string.id), (connected, concat.id),
+                          (with_value, string.id), (with_value, concat.id)])
+        self.assertFalse(query.match(vistrail,
+                                     vistrail.actionMap[disconnected]))
+        self.assertFalse(query.match(vistrail,
+                                     vistrail.actionMap[other_string]))
+
+        # the parameter restricts the matches
+        query = VisualQuery(vistrail.getPipeline(with_value),
+                            set(vistrail.actionMap))
+        self.assertEqual(sorted(query.run(vistrail, None)),
+                         [(with_value, string.id), (with_value, concat.id)])
+
+    def test_iter_pipelines(self):
+        from vistrails.core.modules.basic_modules import identifier
+        from vistrails.core.vistrail.controller import VistrailController
+        from vistrails.core.vistrail.vistrail import Vistrail
+
+        controller = VistrailController(Vistrail(), None, auto_save=False)
+        vistrail = controller.vistrail
+        controller.change_selected_version(0)
+        versions = []
+        for i in xrange(3):
+            controller.add_module(identifier, 'String')
+            versions.append(controller.current_version)
+        controller.change_selected_version(versions[0])
+        controller.add_module(identifier, 'Integer')
+        versions.append(controller.current_version)
+
+        for version, pipeline in VisualQuery.iter_pipelines(
+                vistrail, [versions[2], versions[3], versions[1]]):
+            expected = vistrail.getPipeline(version)
+            self.assertEqual(
+                    sorted((m.id, m.name) for m in pipeline.module_list),
+                    sorted((m.id, m.name) for m in expected.module_list))
@@ -35,8 +35,25 @@
 
 """Utilities for debugging garbage collection, leaked memory, etc."""
 
+import contextlib
 import gc
 
+@contextlib.contextmanager
+def gc_paused():
+    """Disables the cyclic garbage collector in a with block.
+
+    Building many objects that stay alive triggers collections that go
+    over all of them again and again; loading large files is much faster
+    without them.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
 def get_objects_by_typename():
     gc.collect()
     x = {}
@@ -33,6 +33,7 @@
 ##
 ###############################################################################
 import copy
+import hashlib
 from itertools import izip
 import os
 import uuid
@@ -82,6 +83,7 @@ from vistrails.core.vistrail.module_control_param import ModuleControlParam
 from vistrails.core.vistrail.module_function import ModuleFunction
 from vistrails.core.vistrail.module_param import ModuleParam
 from vistrails.core.vistrail.pipeline import Pipeline
+from vistrails.core.vistrail.pipeline_cache import PipelineCache
 from vistrails.core.vistrail.port import Port
 from vistrails.core.vistrail.port_spec import PortSpec
 from vistrails.core.vistrail.port_spec_item import PortSpecItem
@@ -91,6 +93,7 @@ from vistrails.db import VistrailsDBException
 from vistrails.db.domain import IdScope, DBWorkflowExec
 from vistrails.db.services.io import create_temp_folder, remove_temp_folder
 from vistrails.db.services.io import SaveBundle, open_vt_log_from_db
+from vistrails.db.services.log import LogStore
 from vistrails.db.services.vistrail import getSharedRoot
 from vistrails.core.utils import any
 
@@ -177,6 +180,10 @@ class VistrailController(object):
         # when writing the vistrail
         self._mashups = []
 
+        # if set, executions are also appended to this LogStore as they
+        # finish (see vistrails.db.services.log and open_log_store())
+        self.log_store = None
+
         # the redo stack stores the undone action ids 
         # (undo is automatic with us, through the version tree)
         self.redo_stack = []
@@ -208,14 +215,51 @@ class VistrailController(object):
     current_pipeline = property(_get_current_pipeline, _set_current_pipeline)
 
     def flush_pipeline_cache(self):
-        self._pipelines = {0: Pipeline()}
+        memory_limit = 0
+        checkpoint_interval = 0
+        conf = get_vistrails_configuration()
+        if conf is not None:
+            if conf.check('pipelineCacheSize'):
+                memory_limit = conf.pipelineCacheSize * 1024 * 1024
+            if conf.check('pipelineCheckpointInterval'):
+                checkpoint_interval = conf.pipelineCheckpointInterval
+        self._pipelines = PipelineCache(memory_limit, checkpoint_interval)
+
+    def materialize_pipeline(self, closest, path):
+        """materialize_pipeline(closest: int, path: list) -> Pipeline
+
+        Builds the pipeline of path[0] from the cached pipeline of its
+        ancestor 'closest', path being the versions in between (from path[0]
+        up). The pipelines of the checkpoints found along the way are cached.
+
+        """
+        version = path[0]
+        depth = self._pipelines.depth(closest)
+        start = closest
+        result = None
+        for v in reversed(path):
+            depth += 1
+            if v != version and not (self._cache_pipelines and
+                                     self._pipelines.is_checkpoint(depth)):
+                continue
+            if start == 0:
+                result = self.vistrail.getPipeline(v)
+            else:
+                if result is None:
+                    result = copy.copy(self._pipelines[start])
+                action = self.vistrail.general_action_chain(start, v)
+                result.perform_action(action)
+            start = v
+            if v != version:
+                self._pipelines.add(v, copy.copy(result), depth)
+        return result
 
     def logging_on(self):
         return get_vistrails_configuration().check('executionLog')
             
     def get_logger(self):
         if self.logging_on():
-            return LogController(self.log)
+            return LogController(self.log, store=self.log_store)
         else:
             return DummyLogController
         
@@ -258,8 +302,41 @@ class VistrailController(object):
             self.set_changed(True)
         if self.vistrail is not None:
             self.recompute_terse_graph()
+        self.open_log_store()
+
+    def open_log_store(self):
+        """open_log_store() -> None
+        Opens the LogStore of this vistrail in the 'executionLogStoreDir'
+        directory, if that option is set. A new store is filled from the
+        saved log of the vistrail.
+
+        """
+        if self.log_store is not None:
+            self.log_store.close()
+            self.log_store = None
+        conf = get_vistrails_configuration()
+        if (self.vistrail is None or not self.locator or
+                not self.locator.name or conf is None or
+                not conf.check('executionLogStoreDir')):
+            return
+        directory = conf.executionLogStoreDir
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        name = self.locator.name
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        filename = os.path.join(directory,
+                                hashlib.sha1(name).hexdigest() + '.vtlog')
+        store = LogStore(filename)
+        if not len(store):
+            for workflow_exec in self.read_log().workflow_execs:
+                store.append(workflow_exec)
+        self.log_store = store
 
     def close_vistrail(self, locator):
+        if self.log_store is not None:
+            self.log_store.close()
+            self.log_store = None
         if not self.vistrail.is_abstraction:
             self.unload_abstractions()
         if locator is not None:
@@ -2589,6 +2666,8 @@ class VistrailController(object):
 
         stop_on_error = getattr(get_vistrails_configuration(),
                                 'stopOnError')
+        execution_threads = getattr(get_vistrails_configuration(),
+                                    'executionThreads')
         interpreter = get_default_interpreter()
         changed = False
         results = []
@@ -2614,6 +2693,7 @@ class VistrailController(object):
                       'sinks': sinks,
                       'extra_info': extra_info,
                       'stop_on_error': stop_on_error,
+                      'execution_threads': execution_threads,
                       }    
             if self.get_vistrail_variables():
                 kwargs['vistrail_variables'] = \
@@ -3369,6 +3449,7 @@ class VistrailController(object):
         # the rest of the exception handling code, things look
         # stateless.
 
+        # Cost of a switch, in number of actions to replay
         def get_cost(descendant, ancestor):
             cost = 0
             am = self.vistrail.actionMap
@@ -3413,10 +3494,15 @@ class VistrailController(object):
             elif version in self._pipelines:
                 result = copy.copy(self._pipelines[version])
             else:
-                # Find the closest upstream pipeline to the current one
-                cv = self._current_full_graph.inverse_immutable().closest_vertex
-                closest = cv(version, self._pipelines)
-                cost_to_closest_version = get_cost(version, closest)
+                # Find the closest upstream pipeline in the cache
+                am = self.vistrail.actionMap
+                path = []
+                closest = version
+                while closest not in self._pipelines:
+                    path.append(closest)
+                    closest = am[closest].parent
+                cost_to_closest_version = len(path)
+                depth = self._pipelines.depth(closest) + len(path)
                 # Now we have to decide between the closest pipeline
                 # to version and the current pipeline
                 shared_parent = getSharedRoot(self.vistrail, 
@@ -3429,14 +3515,8 @@ class VistrailController(object):
                     cost_common_to_new
                 # FIXME I'm assuming copying the pipeline has zero cost.
                 # Formulate a better cost model
-                if cost_to_closest_version < cost_to_current_version:
-                    if closest == 0:
-                        result = self.vistrail.getPipeline(version)
-                    else:
-                        result = copy.copy(self._pipelines[closest])
-                        action = self.vistrail.general_action_chain(closest, 
-                                                                    version)
-                        result.perform_action(action)
+                if cost_to_closest_version <= cost_to_current_version:
+                    result = self.materialize_pipeline(closest, path)
                 else:
                     action = \
                         self.vistrail.general_action_chain(self.current_version,
@@ -3447,7 +3527,8 @@ class VistrailController(object):
                         result = copy.copy(self.current_pipeline)
                     result.perform_action(action)
                 if self._cache_pipelines and \
-                        self.vistrail.has_tag(long(version)):
+                        (self.vistrail.has_tag(long(version)) or
+                         self._pipelines.is_checkpoint(depth)):
                     # stash a copy for future use
                     if do_validate:
                         try:
@@ -3456,9 +3537,10 @@ class VistrailController(object):
                             if not allow_fail:
                                 raise
                         else:
-                            self._pipelines[version] = copy.copy(result)
+                            self._pipelines.add(version, copy.copy(result),
+                                                depth)
                     else:
-                        self._pipelines[version] = copy.copy(result)
+                        self._pipelines.add(version, copy.copy(result), depth)
             if do_validate:
                 try:
                     self.validate(result)
@@ -3796,13 +3878,26 @@ class VistrailController(object):
             save_bundle = SaveBundle(pipeline.vtType,workflow=pipeline)
             locator.save_as(save_bundle, version)
 
+    def get_log(self):
+        """get_log() -> Log or LogStore
+        Returns all the executions of this vistrail, saved or not: its
+        LogStore if it has one, else the saved log merged with the log of
+        this session.
+
+        """
+        if self.log_store is not None:
+            return self.log_store
+        if self.vistrail.db_log_filename is not None:
+            return vistrails.core.db.io.merge_logs(
+                    self.log, self.vistrail.db_log_filename)
+        return self.log
+
     def write_log(self, locator):
         if self.log:
-            if self.vistrail.db_log_filename is not None:
-                log = vistrails.core.db.io.merge_logs(self.log, 
-                                            self.vistrail.db_log_filename)
-            else:
-                log = self.log
+            log = self.get_log()
+            if isinstance(log, LogStore):
+                log = log.get_log()
+                Log.convert(log)
             #print log
             save_bundle = SaveBundle(log.vtType,log=log)
             locator.save_as(save_bundle)
@@ -37,6 +37,7 @@
 """
 
 from vistrails.core.configuration import get_vistrails_configuration
+from vistrails.core.cache.file_signature import get_file_signatures
 from vistrails.core.system import current_dot_vistrails
 from vistrails.core.modules.vistrails_module import NotCacheable, \
     ModuleError, ModuleSuspended
@@ -219,20 +220,23 @@ class Workflow(object):
 class Job(object):
     """A suspended module.
     """
-    def __init__(self, id, parameters, name='', start=None, finished=False):
+    def __init__(self, id, parameters, name='', start=None, finished=False,
+                 files=None):
         """ __init__(id: str, parameters: dict, name: str, start: str,
-                     finished: bool)
+                     finished: bool, files: dict)
 
             id - persistent identifier
             parameters - either output values or job parameters
             start - start time
             finished - is it finished or running?
+            files - signatures of the files in the output values
         """
         self.id = id
         self.parameters = parameters
         self.name = name
         self.start = start if start else datetime.datetime.now().isoformat()
         self.finished = finished
+        self.files = files if files else {}
         self.updated = True
 
     def reset(self):
@@ -255,11 +259,14 @@ class Job(object):
         m['name'] = self.name
         m['start'] = self.start
         m['finished'] = self.finished
+        if self.files:
+            m['files'] = self.files
         return m
 
     @staticmethod
     def from_dict(m):
-        return Job(m['id'], m['parameters'], m['name'], m['start'], m['finished'])
+        return Job(m['id'], m['parameters'], m['name'], m['start'],
+                   m['finished'], m.get('files'))
 
     def __eq__(self, other):
         if self.id != other.id: return False
@@ -488,8 +495,32 @@ class JobMonitor(object):
             return # ignore non-monitored jobs
         workflow.parents[id(error)] = error
 
-    def setCache(self, id, params, name=''):
+    def setCache(self, id, params, name='', files=()):
+        """ setCache(id: str, params: dict, name: str, files: list) -> None
+            Stores the output values of a completed module
+
+            The signatures of the output files and directories listed in
+            'files' are recorded, so that the cache is discarded if they
+            change.
+
+        """
         self.addJob(id, params, name, True)
+        self.getJob(id).files = self.file_signatures(files)
+
+    @staticmethod
+    def file_signatures(paths):
+        """ file_signatures(paths: list) -> dict
+            Returns the signatures of the paths that exist
+
+        """
+        signatures = get_file_signatures()
+        files = {}
+        for path in paths:
+            try:
+                files[path] = signatures.signature(path)
+            except OSError:
+                pass
+        return files
 
     def checkJob(self, module, id, monitor):
         """ checkJob(module: VistrailsModule, id: str, monitor: instance) -> None
@@ -539,7 +570,20 @@ class JobMonitor(object):
             Checks if a completed module exists using its id and returns it
         """
         job = self.jobs.get(id, None)
-        return job if job and job.finished else None
+        if not job or not job.finished:
+            return None
+        if job.files:
+            signatures = get_file_signatures()
+            for filename, signature in job.files.iteritems():
+                try:
+                    changed = signatures.signature(filename) != signature
+                except OSError:
+                    changed = True
+                if changed:
+                    # The results are gone or were modified, run it again
+                    self.deleteJob(id)
+                    return None
+        return job
 
     def hasJob(self, id):
         """ hasJob(id: str) -> bool
@@ -619,3 +663,26 @@ class TestJob(unittest.TestCase):
         self.assertIn(workflow2.id, jm.workflows)
         self.assertEqual(workflow1, jm.workflows[workflow1.id])
         self.assertEqual(workflow2, jm.workflows[workflow2.id])
+
+    def test_cache_files(self):
+        import tempfile
+        jm = JobMonitor()
+        fd, filename = tempfile.mkstemp(prefix='vt_job_')
+        os.close(fd)
+        try:
+            # only the registered outputs are checked
+            jm.setCache('other', {'output': filename})
+            self.assertFalse(jm.getJob('other').files)
+            jm.setCache('result', {'output': filename, 'count': '3'},
+                        files=[filename])
+            self.assertEqual(list(jm.getJob('result').files), [filename])
+            jm.unserialize(jm.serialize())
+            self.assertIsNotNone(jm.getCache('result'))
+            # The output file changed: the module has to run again
+            with open(filename, 'wb') as fp:
+                fp.write('modified')
+            self.assertIsNone(jm.getCache('result'))
+            self.assertFalse(jm.hasJob('result'))
+            self.assertIsNotNone(jm.getCache('other'))
+        finally:
+            os.remove(filename)
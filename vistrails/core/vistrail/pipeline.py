@@ -143,6 +143,8 @@ class Pipeline(DBWorkflow):
             self._subpipeline_signatures = Bidict()
             self._module_signatures = Bidict()
             self._connection_signatures = Bidict()
+            self._stale_signatures = set(self.modules.iterkeys())
+            self._signature_backend = Hasher.get_backend()
         else:
             self.is_valid = other.is_valid
             self.aliases = Bidict([(k,copy.copy(v))
@@ -156,6 +158,9 @@ class Pipeline(DBWorkflow):
             self._module_signatures = \
                 Bidict([(k,copy.copy(v))
                         for (k,v) in other._module_signatures.iteritems()])
+            self._stale_signatures = set(other._stale_signatures)
+            self._signature_backend = other._signature_backend
+        self._function_owners = {}
 
         self.graph = Graph()
         for module in self.module_list:
@@ -271,6 +276,9 @@ class Pipeline(DBWorkflow):
         self._subpipeline_signatures = Bidict()
         self._module_signatures = Bidict()
         self._connection_signatures = Bidict()
+        self._stale_signatures = set()
+        self._signature_backend = Hasher.get_backend()
+        self._function_owners = {}
 
     def get_tmp_id(self, type):
         """get_tmp_id(type: str) -> long
@@ -357,6 +365,14 @@ class Pipeline(DBWorkflow):
                     (op.vtType, op.what)
                 raise VistrailsInternalError(msg)
 
+        # modules and connections invalidate their own signatures;
+        # objects nested inside them are handled here
+        hashed = what not in self._unhashed_types
+        if hashed:
+            owner_id = self.signature_owner(op.parentObjType, op.parentObjId)
+            if owner_id is not None:
+                self.invalidate_signatures(owner_id)
+
         if op.vtType == 'add':
             f(op.data, op.parentObjType, op.parentObjId)
         elif op.vtType == 'delete':
@@ -364,6 +380,12 @@ class Pipeline(DBWorkflow):
         elif op.vtType == 'change':
             f(op.oldObjId, op.data, op.parentObjType, op.parentObjId)
 
+        # port changes can move a connection to a different module
+        if hashed and op.parentObjType == 'connection':
+            owner_id = self.signature_owner(op.parentObjType, op.parentObjId)
+            if owner_id is not None:
+                self.invalidate_signatures(owner_id)
+
     def add_module(self, m, *args):
         """add_module(m: Module) -> None 
         Add new module to pipeline
@@ -376,13 +398,16 @@ class Pipeline(DBWorkflow):
 #             m.abstraction = self.abstraction_map[m.abstraction_id]
         self.db_add_object(m)
         self.graph.add_vertex(m.id)
+        self.invalidate_signatures(m.id)
 
     def change_module(self, old_id, m, *args):
         if not self.has_module_with_id(old_id):
             raise VistrailsInternalError("module %s doesn't exist" % old_id)
+        self.invalidate_signatures(old_id)
         self.db_change_object(old_id, m)
         self.graph.delete_vertex(old_id)
         self.graph.add_vertex(m.id)
+        self.invalidate_signatures(m.id)
 
     def delete_module(self, id, *args):
         """delete_module(id:int) -> None 
@@ -392,6 +417,7 @@ class Pipeline(DBWorkflow):
         if not self.has_module_with_id(id):
             raise VistrailsInternalError("id missing in modules")
 
+        self.invalidate_signatures(id)
         # we're hiding the necessary operations by doing this!
         for (_, conn_id) in self.graph.adjacency_list[id][:]:
             self.delete_connection(conn_id)
@@ -401,10 +427,6 @@ class Pipeline(DBWorkflow):
         # self.modules.pop(id)
         self.db_delete_object(id, Module.vtType)
         self.graph.delete_vertex(id)
-        if id in self._module_signatures:
-            del self._module_signatures[id]
-        if id in self._subpipeline_signatures:
-            del self._subpipeline_signatures[id]
 
     def add_connection(self, c, *args):
         """add_connection(c: Connection) -> None 
@@ -418,6 +440,7 @@ class Pipeline(DBWorkflow):
         if c.source is not None and c.destination is not None:
             assert(c.sourceId != c.destinationId)        
             self.graph.add_edge(c.sourceId, c.destinationId, c.id)
+            self.invalidate_signatures(c.destinationId)
             self.ensure_connection_specs([c.id])
 
             source_name = c.source.name
@@ -442,6 +465,7 @@ class Pipeline(DBWorkflow):
 
         old_conn = self.connections[old_id]
         if old_conn.source is not None and old_conn.destination is not None:
+            self.invalidate_signatures(old_conn.destinationId)
             self.graph.delete_edge(old_conn.sourceId, old_conn.destinationId,
                                    old_conn.id)
             if self.graph.out_degree(old_conn.sourceId) < 1:
@@ -458,6 +482,7 @@ class Pipeline(DBWorkflow):
         if c.source is not None and c.destination is not None:
             assert(c.sourceId != c.destinationId)
             self.graph.add_edge(c.sourceId, c.destinationId, c.id)
+            self.invalidate_signatures(c.destinationId)
             self.ensure_connection_specs([c.id])
             self.modules[c.sourceId].connected_output_ports.add(c.source.name)
             self.modules[c.destinationId].connected_input_ports.add(
@@ -477,6 +502,7 @@ class Pipeline(DBWorkflow):
         if conn.source is not None and conn.destination is not None and \
                 (conn.destinationId, conn.id) in \
                 self.graph.edges_from(conn.sourceId):
+            self.invalidate_signatures(conn.destinationId)
             self.graph.delete_edge(conn.sourceId, conn.destinationId, conn.id)
 
             c = conn
@@ -688,6 +714,7 @@ class Pipeline(DBWorkflow):
                 #FIXME: check if a change parameter action needs to be generated
                 parameter = self.db_get_object(what, oId)
                 parameter.strValue = str(value)
+                self.invalidate_signatures(mId)
             else:
                 raise VistrailsInternalError("only parameters are supported")
         
@@ -834,15 +861,110 @@ class Pipeline(DBWorkflow):
     def has_connection_signature(self, signature):
         return signature in self._connection_signatures.inverse
 
+    # Objects that do not take part in any signature
+    _unhashed_types = set(['location', 'annotation'])
+
+    def signature_owner(self, obj_type, obj_id):
+        """signature_owner(obj_type: str, obj_id: long) -> long
+        Returns the id of the module whose signature depends on the
+        given object, or None if no module does."""
+        if obj_type in ('module', 'abstraction', 'group'):
+            if self.has_module_with_id(obj_id):
+                return obj_id
+        elif obj_type == 'connection':
+            if self.has_connection_with_id(obj_id):
+                c = self.connections[obj_id]
+                if c.destination is not None:
+                    return c.destinationId
+        elif obj_type == 'function':
+            m_id = self._function_owners.get(obj_id)
+            if m_id is None or not self.has_module_with_id(m_id) or \
+                    not self.modules[m_id].has_function_with_real_id(obj_id):
+                self._function_owners = dict((f.real_id, m.id)
+                                             for m in self.module_list
+                                             for f in m.functions)
+                m_id = self._function_owners.get(obj_id)
+            return m_id
+        return None
+
+    def invalidate_signatures(self, module_id):
+        """invalidate_signatures(module_id: long) -> None
+        Forgets the cached signatures that depend on the given module:
+        its own, and those of the subpipelines and connections
+        downstream of it. Everything else is kept."""
+        if module_id in self._module_signatures:
+            del self._module_signatures[module_id]
+        self._stale_signatures.add(module_id)
+        if module_id not in self.graph.vertices:
+            if module_id in self._subpipeline_signatures:
+                del self._subpipeline_signatures[module_id]
+            return
+        seen = set([module_id])
+        stack = [module_id]
+        while stack:
+            m_id = stack.pop()
+            if m_id in self._subpipeline_signatures:
+                del self._subpipeline_signatures[m_id]
+                self._stale_signatures.add(m_id)
+            for (_, c_id) in self.graph.edges_to(m_id):
+                if c_id in self._connection_signatures:
+                    del self._connection_signatures[c_id]
+            for (next_id, c_id) in self.graph.edges_from(m_id):
+                if c_id in self._connection_signatures:
+                    del self._connection_signatures[c_id]
+                if next_id not in seen:
+                    seen.add(next_id)
+                    stack.append(next_id)
+
+    def clear_signatures(self):
+        """clear_signatures() -> None
+        Forgets every cached signature."""
+        self._connection_signatures = Bidict()
+        self._subpipeline_signatures = Bidict()
+        self._module_signatures = Bidict()
+        self._stale_signatures = set(self.modules.iterkeys())
+        self._signature_backend = Hasher.get_backend()
+
     def refresh_signatures(self):
-        self._connection_signatures = {}
-        self._subpipeline_signatures = {}
-        self._module_signatures = {}
-        self.compute_signatures()
+        """refresh_signatures() -> None
+        Brings the signatures up to date. Only those invalidated since
+        the last call are recomputed; use clear_signatures() first if
+        modules were changed without going through this class."""
+        if self._signature_backend != Hasher.get_backend():
+            self.clear_signatures()
+        stale = self._stale_signatures
+        self._stale_signatures = set()
+        if len(self._subpipeline_signatures) + len(stale) < \
+                len(self.modules):
+            # modules were added behind our back
+            self.compute_signatures()
+            return
+        stale = [m_id for m_id in stale if m_id in self.graph.vertices]
+        self.compute_module_signatures(stale)
+        for m_id in stale:
+            self.subpipeline_signature(m_id)
+            for (_, c_id) in self.graph.edges_to(m_id):
+                self.connection_signature(c_id)
+
+    def compute_module_signatures(self, module_ids):
+        """compute_module_signatures(module_ids: list) -> None
+        Computes the missing module signatures among module_ids in a
+        single batch."""
+        missing = [i for i in module_ids if i not in self._module_signatures]
+        if not missing:
+            return
+        registry = get_module_registry()
+        sigs = registry.module_signatures(self,
+                                          [self.modules[i] for i in missing])
+        for (i, sig) in zip(missing, sigs):
+            self._module_signatures[i] = sig
 
     def compute_signatures(self):
         """compute_signatures(): compute all module and subpipeline signatures
         for this pipeline."""
+        if self._signature_backend != Hasher.get_backend():
+            self.clear_signatures()
+        self.compute_module_signatures(self.modules.keys())
         for i in self.modules.iterkeys():
             self.subpipeline_signature(i)
         for c in self.connections.iterkeys():
@@ -1461,6 +1583,43 @@ class TestPipeline(unittest.TestCase):
         self.assertNotEquals(c_sig_size_before, c_sig_size_after)
         self.assertNotEquals(p_sig_size_before, p_sig_size_after)
 
+    def test_incremental_signatures(self):
+        """Makes sure editing a module only invalidates the signatures
+        downstream of it, and that they match a full recomputation."""
+        import vistrails.core.db.action
+        p = self.create_default_pipeline()
+        p.build_index()
+        p.refresh_signatures()
+        before = dict(p._subpipeline_signatures)
+
+        function = p.modules[1].functions[0]
+        old_param = function.params[0]
+        new_param = ModuleParam(id=-1,
+                                pos=old_param.pos,
+                                name=old_param.name,
+                                val='*',
+                                type=old_param.type)
+        action = vistrails.core.db.action.create_action([('change',
+                                                          old_param,
+                                                          new_param,
+                                                          function.vtType,
+                                                          function.real_id)])
+        p.perform_action(action)
+        self.assertEqual(set(p._subpipeline_signatures.iterkeys()), set([0]))
+        self.assertEqual(p._stale_signatures, set([1, 2]))
+        self.assertEqual(len(p._connection_signatures), 0)
+
+        p.refresh_signatures()
+        after = dict(p._subpipeline_signatures)
+        self.assertEqual(before[0], after[0])
+        self.assertNotEqual(before[1], after[1])
+        self.assertNotEqual(before[2], after[2])
+        self.assertEqual(len(p._connection_signatures), 2)
+
+        p.clear_signatures()
+        p.refresh_signatures()
+        self.assertEqual(after, dict(p._subpipeline_signatures))
+
     def test_delete_connections(self):
         p = self.create_default_pipeline()
         p.delete_connection(0)
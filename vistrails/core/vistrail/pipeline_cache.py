@@ -0,0 +1,193 @@
+###############################################################################
+##
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah. 
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without 
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice, 
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright 
+##    notice, this list of conditions and the following disclaimer in the 
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the University of Utah nor the names of its 
+##    contributors may be used to endorse or promote products derived from 
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, 
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR 
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR 
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, 
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, 
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; 
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, 
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR 
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF 
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+"""Cache of materialized pipelines, used by VistrailController to switch
+between versions without replaying whole action chains.
+"""
+from collections import OrderedDict
+
+from vistrails.core.vistrail.pipeline import Pipeline
+
+################################################################################
+
+# Rough memory use of a pipeline, and of each of its modules, connections,
+# functions and parameters
+_PIPELINE_SIZE = 64 * 1024
+_ITEM_SIZE = 4 * 1024
+
+def estimate_pipeline_size(pipeline):
+    """estimate_pipeline_size(pipeline: Pipeline) -> int
+
+    Returns a rough estimate of the memory used by a pipeline, in bytes.
+
+    """
+    items = len(pipeline.modules) + len(pipeline.connections)
+    for module in pipeline.module_list:
+        items += len(module.functions)
+        for function in module.functions:
+            items += len(function.params)
+    return _PIPELINE_SIZE + _ITEM_SIZE * items
+
+class PipelineCache(object):
+    """Materialized pipelines of a vistrail, by version.
+
+    The empty pipeline of the root version is always kept. Other pipelines
+    are discarded, least recently used first, once their estimated size
+    exceeds memory_limit (in bytes, 0 means no limit). The depth of each
+    version in the version tree is kept with its pipeline, so that
+    checkpoints can be placed every checkpoint_interval actions.
+
+    """
+    def __init__(self, memory_limit=0, checkpoint_interval=0):
+        self.memory_limit = memory_limit
+        self.checkpoint_interval = checkpoint_interval
+        self.clear()
+
+    def clear(self):
+        self._root = Pipeline()
+        # version -> (pipeline, depth, size), least recently used first
+        self._entries = OrderedDict()
+        self.size = 0
+
+    def __contains__(self, version):
+        return version == 0 or version in self._entries
+
+    def __iter__(self):
+        yield 0
+        for version in self._entries:
+            yield version
+
+    def __len__(self):
+        return len(self._entries) + 1
+
+    def __getitem__(self, version):
+        if version == 0:
+            return self._root
+        entry = self._entries.pop(version)
+        self._entries[version] = entry
+        return entry[0]
+
+    def __delitem__(self, version):
+        if version == 0:
+            raise KeyError("the root pipeline is always cached")
+        pipeline, depth, size = self._entries.pop(version)
+        self.size -= size
+
+    def depth(self, version):
+        """depth(version: int) -> int
+
+        Returns the depth of a cached version in the version tree.
+
+        """
+        if version == 0:
+            return 0
+        return self._entries[version][1]
+
+    def is_checkpoint(self, depth):
+        """is_checkpoint(depth: int) -> bool
+
+        Indicates whether versions at this depth should be cached.
+
+        """
+        return (self.checkpoint_interval > 0 and
+                depth % self.checkpoint_interval == 0)
+
+    def add(self, version, pipeline, depth):
+        """add(version: int, pipeline: Pipeline, depth: int) -> None
+
+        Stores the pipeline of a version, which should not be modified
+        afterwards, and discards old pipelines if the cache is full.
+
+        """
+        if version == 0:
+            return
+        if version in self._entries:
+            del self[version]
+        size = estimate_pipeline_size(pipeline)
+        self._entries[version] = (pipeline, depth, size)
+        self.size += size
+        if self.memory_limit:
+            while self.size > self.memory_limit and len(self._entries) > 1:
+                del self[next(iter(self._entries))]
+
+################################################################################
+
+import unittest
+
+class TestPipelineCache(unittest.TestCase):
+    def test_lru(self):
+        size = estimate_pipeline_size(Pipeline())
+        cache = PipelineCache(memory_limit=3 * size)
+        for version in xrange(1, 4):
+            cache.add(version, Pipeline(), version)
+        self.assertEqual(sorted(cache), [0, 1, 2, 3])
+        cache[1]
+        cache.add(4, Pipeline(), 4)
+        self.assertEqual(sorted(cache), [0, 1, 3, 4])
+        self.assertEqual(cache.size, 3 * size)
+        self.assertEqual(cache.depth(4), 4)
+        self.assertIn(0, cache)
+        self.assertRaises(KeyError, cache.__delitem__, 0)
+
+    def test_checkpoints(self):
+        cache = PipelineCache(checkpoint_interval=10)
+        self.assertTrue(cache.is_checkpoint(20))
+        self.assertFalse(cache.is_checkpoint(21))
+        self.assertFalse(PipelineCache().is_checkpoint(20))
+
+    def test_controller(self):
+        from vistrails.core.modules.basic_modules import identifier
+        from vistrails.core.vistrail.controller import VistrailController
+        from vistrails.core.vistrail.vistrail import Vistrail
+
+        controller = VistrailController(Vistrail(), None, auto_save=False)
+        controller.change_selected_version(0)
+        versions = [0]
+        for i in xrange(25):
+            controller.add_module(identifier, 'String')
+            versions.append(controller.current_version)
+        cache = controller._pipelines
+        cache.checkpoint_interval = 10
+        cache.memory_limit = 0
+
+        controller.change_selected_version(0)
+        controller.change_selected_version(versions[25])
+        self.assertEqual(len(controller.current_pipeline.modules), 25)
+        self.assertEqual(sorted(cache), [0, versions[10], versions[20]])
+        self.assertEqual(cache.depth(versions[20]), 20)
+
+        # rebuilt from the checkpoint at depth 10
+        controller.change_selected_version(0)
+        controller.change_selected_version(versions[15])
+        self.assertEqual(len(controller.current_pipeline.modules), 15)
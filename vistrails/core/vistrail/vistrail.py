@@ -115,6 +115,8 @@ class Vistrail(DBVistrail):
             self.currentVersion = other.currentVersion
             self.savedQueries = copy.copy(other.savedQueries)
             self.is_abstraction = other.is_abstraction
+        # index used by version search, see core.query.index
+        self.search_index = None
 
         # object to keep explicit expanded 
         # version tree always updated
@@ -597,6 +599,11 @@ class Vistrail(DBVistrail):
     def delete_action_annotation(self, action_id, key):
         annotation = self.get_action_annotation(action_id, key)
         self.db_delete_actionAnnotation(annotation)
+        self.annotation_changed(action_id)
+
+    def annotation_changed(self, action_id):
+        if self.search_index is not None:
+            self.search_index.annotation_changed(action_id)
 
     def set_action_annotation(self, action_id, key, value):
         changed = False
@@ -619,6 +626,7 @@ class Vistrail(DBVistrail):
             changed = True
         if changed:
             self.changed = True
+            self.annotation_changed(action_id)
             return True
         return False
 
@@ -762,6 +770,7 @@ class Vistrail(DBVistrail):
                                )
                 action.add_annotation(annotation)
             self.changed = True
+            self.annotation_changed(version_number)
             return True
         return False
 
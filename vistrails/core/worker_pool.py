@@ -0,0 +1,220 @@
+###############################################################################
+##
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah. 
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without 
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice, 
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright 
+##    notice, this list of conditions and the following disclaimer in the 
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the University of Utah nor the names of its 
+##    contributors may be used to endorse or promote products derived from 
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, 
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR 
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR 
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, 
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, 
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; 
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, 
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR 
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF 
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+"""Routes requests to a pool of VisTrails server instances.
+
+The application server can start other instances of itself (rpcInstances)
+and forward requests to them. Each instance keeps the vistrails it opened
+(see console_mode.ControllerCache) and its interpreter's cache, so a
+request is sent to an instance that already served the same vistrail when
+possible; another instance is only used if that one is busy and another is
+idle. Since instances serve one request at a time, requests for an
+instance wait for it here, and the pool keeps track of how many are
+waiting and of how long requests take.
+"""
+
+import threading
+import time
+import unittest
+import xmlrpclib
+
+
+class Worker(object):
+    """One instance of the pool, with its statistics.
+    """
+    def __init__(self, uri, proxy):
+        self.uri = uri
+        self.proxy = proxy
+        self.lock = threading.Lock()
+        self.keys = set()
+        self.waiting = 0
+        self.busy = False
+        self.requests = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def load(self):
+        return self.waiting + (1 if self.busy else 0)
+
+    def status(self):
+        if self.requests:
+            mean_latency = self.total_latency / self.requests
+        else:
+            mean_latency = 0.0
+        return {'uri': self.uri,
+                'queued': self.waiting,
+                'busy': self.busy,
+                'requests': self.requests,
+                'errors': self.errors,
+                'mean_latency': mean_latency,
+                'max_latency': self.max_latency,
+                'vistrails': len(self.keys)}
+
+
+class WorkerPool(object):
+    """Sends requests to the instances at the given URIs.
+
+    'key' identifies what a request works on (usually the vistrail); None
+    means any instance will do.
+    """
+    def __init__(self, uris, make_proxy=xmlrpclib.ServerProxy):
+        self._lock = threading.RLock()
+        self.workers = [Worker(uri, make_proxy(uri)) for uri in uris]
+
+    def __len__(self):
+        return len(self.workers)
+
+    def choose(self, key=None):
+        """choose(key) -> Worker
+        Picks the instance for a request, and counts it as waiting there.
+
+        """
+        with self._lock:
+            holders = [w for w in self.workers
+                       if key is not None and key in w.keys]
+            if holders:
+                worker = min(holders, key=Worker.load)
+                if worker.load() > 0:
+                    idle = [w for w in self.workers if w.load() == 0]
+                    if idle:
+                        worker = idle[0]
+            else:
+                worker = min(self.workers, key=Worker.load)
+            if key is not None:
+                worker.keys.add(key)
+            return self.reserve(worker)
+
+    def reserve(self, worker):
+        """reserve(worker: Worker) -> Worker
+        Counts a request as waiting on this instance.
+
+        """
+        with self._lock:
+            worker.waiting += 1
+        return worker
+
+    def call_worker(self, worker, method, *args):
+        """Calls a method on an instance, once it is free.
+
+        The worker must have been obtained from choose() or reserve().
+        """
+        start = time.time()
+        with worker.lock:
+            with self._lock:
+                worker.waiting -= 1
+                worker.busy = True
+            try:
+                return getattr(worker.proxy, method)(*args)
+            except Exception:
+                worker.errors += 1
+                raise
+            finally:
+                latency = time.time() - start
+                with self._lock:
+                    worker.busy = False
+                    worker.requests += 1
+                    worker.total_latency += latency
+                    worker.max_latency = max(worker.max_latency, latency)
+
+    def call(self, key, method, *args):
+        """call(key, method: str, *args)
+        Calls a method on the instance chosen for 'key'.
+
+        """
+        return self.call_worker(self.choose(key), method, *args)
+
+    def call_all(self, method, *args):
+        """Calls a method on every instance, and returns the results.
+        """
+        results = []
+        for worker in self.workers:
+            results.append(self.call_worker(self.reserve(worker),
+                                            method, *args))
+        return results
+
+    def status(self):
+        """Returns the statistics of each instance, as a list of dicts.
+        """
+        with self._lock:
+            return [worker.status() for worker in self.workers]
+
+
+class TestWorkerPool(unittest.TestCase):
+    class Proxy(object):
+        def __init__(self, uri):
+            self.uri = uri
+            self.calls = []
+
+        def run(self, arg):
+            self.calls.append(arg)
+            return self.uri, arg
+
+        def fail(self):
+            raise ValueError
+
+    def test_affinity(self):
+        pool = WorkerPool(['a', 'b'], make_proxy=self.Proxy)
+        self.assertEqual(pool.call('vt1', 'run', 1), ('a', 1))
+        self.assertEqual(pool.call('vt2', 'run', 2)[0], 'a')
+        # requests for a vistrail go back to the same instance
+        workers = dict((w.uri, w) for w in pool.workers)
+        self.assertEqual(workers['a'].keys, set(['vt1', 'vt2']))
+        self.assertEqual(pool.call('vt1', 'run', 3)[0], 'a')
+        self.assertEqual(pool.call_all('run', 4), [('a', 4), ('b', 4)])
+
+    def test_busy(self):
+        pool = WorkerPool(['a', 'b'], make_proxy=self.Proxy)
+        pool.call('vt1', 'run', 1)
+        # 'a' is busy: an idle instance is used, and also gets the vistrail
+        first = pool.choose('vt1')
+        self.assertEqual(first.uri, 'a')
+        second = pool.choose('vt1')
+        self.assertEqual(second.uri, 'b')
+        self.assertEqual([s['queued'] for s in pool.status()], [1, 1])
+        pool.call_worker(first, 'run', 2)
+        pool.call_worker(second, 'run', 3)
+        self.assertEqual([s['queued'] for s in pool.status()], [0, 0])
+        self.assertIn('vt1', second.keys)
+
+    def test_status(self):
+        pool = WorkerPool(['a'], make_proxy=self.Proxy)
+        pool.call(None, 'run', 1)
+        self.assertRaises(ValueError, pool.call, None, 'fail')
+        status, = pool.status()
+        self.assertEqual((status['requests'], status['errors'],
+                          status['queued'], status['busy']),
+                         (2, 1, 0, False))
+        self.assertGreaterEqual(status['max_latency'],
+                                status['mean_latency'])
@@ -39,6 +39,7 @@ from vistrails.core import debug
 from vistrails.core.bundles import py_import
 from vistrails.core.system import get_elementtree_library, strftime
 from vistrails.core.utils import Chdir
+from vistrails.core.utils.gcutils import gc_paused
 from vistrails.core.mashup.mashup_trail import Mashuptrail
 from vistrails.core.modules.sub_module import get_cur_abs_namespace,\
     parse_abstraction_name, read_vistrail_from_db
@@ -48,6 +49,7 @@ import vistrails.core.requirements
 import os.path
 import shutil
 import tempfile
+import time
 import copy
 import zipfile
 
@@ -542,6 +544,54 @@ def setup_db_tables(db_connection, version=None, old_version=None):
 ##############################################################################
 # General I/O
 
+class StreamedXMLElement(object):
+    """Root element of an XML file whose children are parsed on demand.
+
+    getchildren() parses the children one at a time; once the caller moves
+    on to the next one, the previous one is removed from the root so that
+    it can be freed. The generated fromXML() methods only go over the
+    children of the root once, so they can build the domain objects while
+    the file is being read, without holding the whole tree in memory.
+    Other attributes are those of the underlying element.
+    """
+    def __init__(self, element, events):
+        self._element = element
+        self._events = events
+
+    def __getattr__(self, name):
+        return getattr(self._element, name)
+
+    def getchildren(self):
+        element = self._element
+        depth = 0
+        for event, elem in self._events:
+            if event == 'start':
+                depth += 1
+            elif depth == 0:
+                # end of the root element
+                return
+            else:
+                depth -= 1
+                if depth == 0:
+                    yield elem
+                    element.remove(elem)
+
+    __iter__ = getchildren
+
+class StreamedXMLTree(object):
+    """Minimal ElementTree-like object backed by iterparse.
+
+    Only the start tag of the root element is parsed on creation, so that
+    its attributes (such as the schema version) can be read right away.
+    """
+    def __init__(self, filename):
+        events = ElementTree.iterparse(filename, events=('start', 'end'))
+        event, root = next(events)
+        self._root = StreamedXMLElement(root, events)
+
+    def getroot(self):
+        return self._root
+
 def open_from_xml(filename, type):
     if type == DBVistrail.vtType:
         return open_vistrail_from_xml(filename)
@@ -653,6 +703,7 @@ def close_zip_xml(temp_dir):
     """
     if temp_dir is None:
         return
+    _bundle_archives.pop(temp_dir, None)
     if not os.path.isdir(temp_dir):
         if os.path.isfile(temp_dir):
             os.remove(temp_dir)
@@ -677,20 +728,173 @@ def unserialize(str, obj_type):
     daoList = getVersionDAO(currentVersion)
     return daoList.unserialize(str, obj_type)
  
+##############################################################################
+# Lazily extracted bundle members
+
+class BundleArchive(object):
+    """The zip file the bundle in a directory was opened from.
+
+    Opening a .vt file doesn't extract it: the archive is registered for the
+    bundle's temporary directory, and members are extracted there the first
+    time they are needed, see get_bundle_file(). A member that is on disk
+    takes precedence over the one in the archive; when the bundle is saved,
+    the members that were never extracted are copied over from the archive
+    as they are.
+    """
+    def __init__(self, filename, directory):
+        self.filename = filename
+        self.directory = directory
+        z = zipfile.ZipFile(filename)
+        try:
+            # normalized name -> name in the archive
+            self.names = dict((os.path.normpath(info.filename), info.filename)
+                              for info in z.infolist()
+                              if not info.filename.endswith('/'))
+        finally:
+            z.close()
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def pending(self):
+        """Returns the members that are not on disk."""
+        return [name for name in self.names
+                if not os.path.exists(self.path(name))]
+
+    def extract(self, names):
+        """Extracts the given members that are not on disk yet.
+        """
+        names = [name for name in names
+                 if name in self.names and not os.path.exists(self.path(name))]
+        if not names:
+            return
+        z = zipfile.ZipFile(self.filename)
+        try:
+            for name in names:
+                z.extract(self.names[name], self.directory)
+        finally:
+            z.close()
+
+    def copy_pending(self, dest):
+        """Adds the members that are not on disk to the ZipFile 'dest'.
+
+        Each member is streamed through a temporary file rather than read
+        in memory; it keeps the name, date and attributes it had in the
+        archive.
+        """
+        src = zipfile.ZipFile(self.filename)
+        (fd, tmp) = tempfile.mkstemp(prefix='vt_member_')
+        os.close(fd)
+        try:
+            for name in self.pending():
+                info = src.getinfo(self.names[name])
+                member = src.open(info)
+                try:
+                    with open(tmp, 'wb') as fp:
+                        shutil.copyfileobj(member, fp, 1 << 20)
+                finally:
+                    member.close()
+                mtime = time.mktime(info.date_time + (0, 0, -1))
+                os.utime(tmp, (mtime, mtime))
+                dest.write(tmp, info.filename, info.compress_type)
+                dest.getinfo(info.filename).external_attr = \
+                    info.external_attr
+        finally:
+            src.close()
+            os.remove(tmp)
+
+# directory -> BundleArchive
+_bundle_archives = {}
+
+def get_bundle_file(filename):
+    """get_bundle_file(filename: str) -> str
+    Makes sure that a file of an opened bundle is on disk, extracting it
+    from the bundle's archive if needed, and returns its name.
+
+    """
+    if filename is None or os.path.exists(filename):
+        return filename
+    directory = os.path.dirname(filename)
+    while True:
+        archive = _bundle_archives.get(directory)
+        if archive is not None:
+            archive.extract([os.path.relpath(filename, directory)])
+            break
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            break
+        directory = parent
+    return filename
+
+class BundleMemberList(list):
+    """A list whose items are only loaded when it is first used.
+
+    'load' is called without arguments at that point and returns the
+    items; it is used for the thumbnails, abstractions and mashups of a
+    bundle, so that opening a .vt file doesn't extract or parse them.
+    'directory' is the bundle directory the items come from.
+    """
+    def __init__(self, load, directory=None):
+        list.__init__(self)
+        self._load = load
+        self.directory = directory
+
+    def is_loaded(self):
+        return '_load' not in self.__dict__
+
+    def _ensure_loaded(self):
+        load = self.__dict__.pop('_load', None)
+        if load is not None:
+            list.extend(self, load())
+
+def _loading_method(name):
+    method = getattr(list, name)
+    def wrapper(self, *args, **kwargs):
+        self._ensure_loaded()
+        return method(self, *args, **kwargs)
+    wrapper.__name__ = name
+    return wrapper
+
+for _name in ['__contains__', '__delitem__', '__delslice__', '__eq__',
+              '__ge__', '__getitem__', '__getslice__', '__gt__', '__iadd__',
+              '__imul__', '__iter__', '__le__', '__len__', '__lt__',
+              '__ne__', '__repr__', '__reversed__', '__setitem__',
+              '__setslice__', '__add__', '__mul__', '__rmul__', 'append',
+              'count', 'extend', 'index', 'insert', 'pop', 'remove',
+              'reverse', 'sort']:
+    setattr(BundleMemberList, _name, _loading_method(_name))
+del _name
+
+def _unloaded_members(members, directory):
+    """Checks whether 'members' are still in the archive of 'directory'.
+    """
+    return (isinstance(members, BundleMemberList) and
+            not members.is_loaded() and members.directory == directory)
+
 ##############################################################################
 # Vistrail I/O
 
 def open_vistrail_from_xml(filename):
     """open_vistrail_from_xml(filename) -> Vistrail"""
-    tree = ElementTree.parse(filename)
+    return read_vistrail_from_xml_tree(filename, StreamedXMLTree(filename))
+
+def read_vistrail_from_xml_tree(filename, tree):
+    """read_vistrail_from_xml_tree(filename, tree) -> Vistrail
+    Reads a vistrail from a (streamed) XML tree. Versions older than 0.8
+    read 'filename' instead.
+
+    """
     version = get_version_for_xml(tree.getroot())
     try:
         daoList = getVersionDAO(version)
-        vistrail = daoList.open_from_xml(filename, DBVistrail.vtType, tree)
-        if vistrail is None:
-            raise VistrailsDBException("Couldn't read vistrail from XML")
-        vistrail = translate_vistrail(vistrail, version)
-        vistrails.db.services.vistrail.update_id_scope(vistrail)
+        with gc_paused():
+            vistrail = daoList.open_from_xml(filename, DBVistrail.vtType,
+                                             tree)
+            if vistrail is None:
+                raise VistrailsDBException("Couldn't read vistrail from XML")
+            if version != currentVersion:
+                vistrail = translate_vistrail(vistrail, version)
+            vistrails.db.services.vistrail.update_id_scope(vistrail)
     except VistrailsDBException, e:
         if str(e).startswith('VistrailsDBException: Cannot find DAO for'):
             raise VistrailsDBException(
@@ -708,73 +912,90 @@ def open_vistrail_bundle_from_zip_xml(filename):
     abstractions inside archive have prefix 'abstraction_',
     and thumbnails inside archive are '.png' files in 'thumbs' dir
 
+    The vistrail is read directly from the archive; the other members are
+    only extracted into the returned directory when they are first used
+    (see BundleArchive).
+
     """
     vt_save_dir = tempfile.mkdtemp(prefix='vt_save')
 
-    z = zipfile.ZipFile(filename)
     try:
-        z.extractall(vt_save_dir)
-    finally:
-        z.close()
+        archive = BundleArchive(filename, vt_save_dir)
+    except (IOError, zipfile.BadZipfile), e:
+        raise VistrailsDBException("Error when reading vt file")
 
-    vistrail = None
     log = None
     log_fname = None
     abstraction_files = []
     unknown_files = []
     thumbnail_files = []
-    mashups = []
-    try:
-        for root, dirs, files in os.walk(vt_save_dir):
-            for fname in files:
-                if fname == 'vistrail' and root == vt_save_dir:
-                    vistrail = open_vistrail_from_xml(os.path.join(root, fname))
-                elif fname == 'log' and root == vt_save_dir:
-                    # FIXME read log to get execution info
-                    # right now, just ignore the file
-                    log = None 
-                    log_fname = os.path.join(root, fname)
-                    # log = open_log_from_xml(os.path.join(root, fname))
-                    # objs.append(DBLog.vtType, log)
-                elif fname.startswith('abstraction_'):
-                    abstraction_file = os.path.join(root, fname)
-                    abstraction_files.append(abstraction_file)
-                elif (fname.endswith('.png') and
-                      root == os.path.join(vt_save_dir,'thumbs')):
-                    thumbnail_file = os.path.join(root, fname)
-                    thumbnail_files.append(thumbnail_file)
-                elif root == os.path.join(vt_save_dir,'mashups'):
-                    mashup_file = os.path.join(root, fname)
-                    mashup = open_mashuptrail_from_xml(mashup_file)
-                    mashups.append(mashup)
-                else:
-                    handled = False
-                    from vistrails.core.packagemanager import get_package_manager
-                    pm = get_package_manager()
-                    for package in pm.enabled_package_list():
-                        if package.can_handle_vt_file(fname):
-                            handled = True
-                            continue
-                    if not handled:
-                        unknown_files.append(os.path.join(root, fname))
-    except OSError, e:
-        raise VistrailsDBException("Error when reading vt file")
+    mashup_files = []
+    package_files = []
+    for name in archive.names:
+        root, fname = os.path.split(name)
+        if name == 'vistrail':
+            pass
+        elif name == 'log':
+            # FIXME read log to get execution info
+            # right now, just ignore the file
+            log_fname = archive.path(name)
+        elif fname.startswith('abstraction_'):
+            abstraction_files.append(archive.path(name))
+        elif fname.endswith('.png') and root == 'thumbs':
+            thumbnail_files.append(archive.path(name))
+        elif root == 'mashups':
+            mashup_files.append(archive.path(name))
+        else:
+            handled = False
+            from vistrails.core.packagemanager import get_package_manager
+            pm = get_package_manager()
+            for package in pm.enabled_package_list():
+                if package.can_handle_vt_file(fname):
+                    handled = True
+                    continue
+            if handled:
+                package_files.append(name)
+            else:
+                unknown_files.append(archive.path(name))
     if len(unknown_files) > 0:
         raise VistrailsDBException("Unknown files in vt file: %s" % \
                                        unknown_files)
-    if vistrail is None:
+    if 'vistrail' not in archive.names:
         raise VistrailsDBException("vt file does not contain vistrail")
+
+    z = zipfile.ZipFile(filename)
+    try:
+        tree = StreamedXMLTree(z.open(archive.names['vistrail']))
+        if get_version_for_xml(tree.getroot()) == currentVersion:
+            vistrail = read_vistrail_from_xml_tree(None, tree)
+        else:
+            # older versions might read the file again
+            archive.extract(['vistrail'])
+            vistrail = open_vistrail_from_xml(archive.path('vistrail'))
+    finally:
+        z.close()
     vistrail.db_log_filename = log_fname
+    _bundle_archives[vt_save_dir] = archive
 
     # call package hooks
+    archive.extract(package_files)
     from vistrails.core.packagemanager import get_package_manager
     pm = get_package_manager()
     for package in pm.enabled_package_list():
         package.loadVistrailFileHook(vistrail, vt_save_dir)
 
-    save_bundle = SaveBundle(DBVistrail.vtType, vistrail, log, 
-                             abstractions=abstraction_files, 
-                             thumbnails=thumbnail_files, mashups=mashups)
+    def load_files(filenames):
+        return lambda: [get_bundle_file(f) for f in filenames]
+    def load_mashups():
+        return [open_mashuptrail_from_xml(get_bundle_file(f))
+                for f in mashup_files]
+    save_bundle = SaveBundle(
+            DBVistrail.vtType, vistrail, log,
+            abstractions=BundleMemberList(load_files(abstraction_files),
+                                          vt_save_dir),
+            thumbnails=BundleMemberList(load_files(thumbnail_files),
+                                        vt_save_dir),
+            mashups=BundleMemberList(load_mashups, vt_save_dir))
     return (save_bundle, vt_save_dir)
 
 def open_vistrail_bundle_from_db(db_connection, vistrail_id, tmp_dir=None):
@@ -890,17 +1111,27 @@ def save_vistrail_bundle_to_zip_xml(save_bundle, filename, vt_save_dir=None, ver
     if save_bundle.vistrail.db_log_filename is not None:
         xml_fname = os.path.join(vt_save_dir, 'log')
         if save_bundle.vistrail.db_log_filename != xml_fname:
-            shutil.copyfile(save_bundle.vistrail.db_log_filename, xml_fname)
+            shutil.copyfile(
+                    get_bundle_file(save_bundle.vistrail.db_log_filename),
+                    xml_fname)
             save_bundle.vistrail.db_log_filename = xml_fname
 
     if save_bundle.log is not None:
         xml_fname = os.path.join(vt_save_dir, 'log')
+        # new executions are appended to the existing log
+        get_bundle_file(xml_fname)
         save_log_to_xml(save_bundle.log, xml_fname, version, True)
         save_bundle.vistrail.db_log_filename = xml_fname
 
+    # Lists that are still lazy (see BundleMemberList) are left as they are:
+    # their files are copied from the archive when zipping
+
     # Save Abstractions
     saved_abstractions = []
-    for obj in save_bundle.abstractions:
+    abstractions = save_bundle.abstractions
+    if _unloaded_members(abstractions, vt_save_dir):
+        saved_abstractions, abstractions = abstractions, []
+    for obj in abstractions:
         if isinstance(obj, basestring):
             # FIXME we should have an abstraction directory here instead
             # of the abstraction_ prefix...
@@ -918,7 +1149,7 @@ def save_vistrail_bundle_to_zip_xml(save_bundle, filename, vt_save_dir=None, ver
             if obj != xml_fname:
                 # print 'copying %s -> %s' % (obj, xml_fname)
                 try:
-                    shutil.copyfile(obj, xml_fname)
+                    shutil.copyfile(get_bundle_file(obj), xml_fname)
                 except Exception, e:
                     saved_abstractions.pop()
                     debug.critical('copying %s -> %s failed: %s' % \
@@ -928,7 +1159,10 @@ def save_vistrail_bundle_to_zip_xml(save_bundle, filename, vt_save_dir=None, ver
                                        'abstraction list entry must be a filename')
     # Save Thumbnails
     saved_thumbnails = []
-    for obj in save_bundle.thumbnails:
+    thumbnails = save_bundle.thumbnails
+    if _unloaded_members(thumbnails, vt_save_dir):
+        saved_thumbnails, thumbnails = thumbnails, []
+    for obj in thumbnails:
         if isinstance(obj, basestring):
             obj_fname = os.path.basename(obj)
             png_fname = os.path.join(thumbnail_dir, obj_fname)
@@ -937,7 +1171,7 @@ def save_vistrail_bundle_to_zip_xml(save_bundle, filename, vt_save_dir=None, ver
                 os.mkdir(thumbnail_dir)
             
             try:
-                shutil.copyfile(obj, png_fname)
+                shutil.copyfile(get_bundle_file(obj), png_fname)
             except shutil.Error, e:
                 #files are the same no need to show warning
                 saved_thumbnails.pop()
@@ -950,10 +1184,13 @@ def save_vistrail_bundle_to_zip_xml(save_bundle, filename, vt_save_dir=None, ver
                                        'thumbnail list entry must be a filename')
     # Save Mashups
     saved_mashups = []
+    mashups = save_bundle.mashups
+    if _unloaded_members(mashups, vt_save_dir):
+        saved_mashups, mashups = mashups, []
     #print " mashups:"
-    if len(save_bundle.mashups) > 0 and not os.path.exists(mashup_dir):
+    if len(mashups) > 0 and not os.path.exists(mashup_dir):
         os.mkdir(mashup_dir)
-    for obj in save_bundle.mashups:
+    for obj in mashups:
         #print "  ", obj
         try:
             xml_fname = os.path.join(mashup_dir, str(obj.id))
@@ -982,11 +1219,15 @@ def save_vistrail_bundle_to_zip_xml(save_bundle, filename, vt_save_dir=None, ver
             for root, dirs, files in os.walk('.'):
                 for f in files:
                     z.write(os.path.join(root, f))
+        archive = _bundle_archives.get(vt_save_dir)
+        if archive is not None:
+            archive.copy_pending(z)
         z.close()
         shutil.copyfile(tmp_zip_file, filename)
     finally:
         os.unlink(tmp_zip_file)
         os.rmdir(tmp_zip_dir)
+    _bundle_archives[vt_save_dir] = BundleArchive(filename, vt_save_dir)
     save_bundle = SaveBundle(save_bundle.bundle_type, save_bundle.vistrail,
                              save_bundle.log, thumbnails=saved_thumbnails,
                              abstractions=saved_abstractions,
@@ -1094,14 +1335,16 @@ def save_vistrail_to_db(vistrail, db_connection, do_copy=False, version=None):
 
 def open_workflow_from_xml(filename):
     """open_workflow_from_xml(filename) -> DBWorkflow"""
-    tree = ElementTree.parse(filename)
+    tree = StreamedXMLTree(filename)
     version = get_version_for_xml(tree.getroot())
     daoList = getVersionDAO(version)
-    workflow = daoList.open_from_xml(filename, DBWorkflow.vtType, tree)
-    if workflow is None:
-        raise VistrailsDBException("Couldn't read workflow from XML")
-    workflow = translate_workflow(workflow, version)
-    vistrails.db.services.workflow.update_id_scope(workflow)
+    with gc_paused():
+        workflow = daoList.open_from_xml(filename, DBWorkflow.vtType, tree)
+        if workflow is None:
+            raise VistrailsDBException("Couldn't read workflow from XML")
+        if version != currentVersion:
+            workflow = translate_workflow(workflow, version)
+        vistrails.db.services.workflow.update_id_scope(workflow)
     return workflow
 
 def open_workflow_from_db(db_connection, id, lock=False, version=None):
@@ -1187,6 +1430,7 @@ def get_saved_workflows(vistrail, db_connection):
 
 def open_log_from_xml(filename, was_appended=False):
     """open_log_from_xml(filename) -> DBLog"""
+    filename = get_bundle_file(filename)
     if was_appended:
         parser = ElementTree.XMLTreeBuilder()
         parser.feed("<log>\n")
@@ -1196,28 +1440,20 @@ def open_log_from_xml(filename, was_appended=False):
         root = parser.close()
         workflow_execs = []
         for node in root:
-            version = get_version_for_xml(node)
-            daoList = getVersionDAO(version)
-            workflow_exec = \
-                daoList.read_xml_object(DBWorkflowExec.vtType, node)
-            if version != currentVersion:
-                # if version is wrong, dump this into a dummy log object, 
-                # then translate, then get workflow_exec back
-                log = DBLog()
-                translate_log(log, currentVersion, version)
-                log.db_add_workflow_exec(workflow_exec)
-                log = translate_log(log, version)
-                workflow_exec = log.db_workflow_execs[0]
-            workflow_execs.append(workflow_exec)
+            workflow_execs.append(
+                    vistrails.db.services.log.read_workflow_exec_from_xml(
+                            node, get_version_for_xml(node)))
         log = DBLog(workflow_execs=workflow_execs)
         vistrails.db.services.log.update_ids(log)
     else:
-        tree = ElementTree.parse(filename)
+        tree = StreamedXMLTree(filename)
         version = get_version_for_xml(tree.getroot())
         daoList = getVersionDAO(version)
-        log = daoList.open_from_xml(filename, DBLog.vtType, tree)
-        log = translate_log(log, version)
-        vistrails.db.services.log.update_id_scope(log)
+        with gc_paused():
+            log = daoList.open_from_xml(filename, DBLog.vtType, tree)
+            if version != currentVersion:
+                log = translate_log(log, version)
+            vistrails.db.services.log.update_id_scope(log)
     return log
 
 def open_log_from_db(db_connection, id, lock=False, version=None):
@@ -1895,6 +2131,104 @@ class TestDBIO(unittest.TestCase):
                          'tests/resources/dummy_new.xml'))
         assert vistrail is not None
 
+    def test_streamed_xml(self):
+        """test that streaming gives the same objects as parsing the tree"""
+
+        vistrail = open_vistrail_from_xml(
+                os.path.join(vistrails.core.system.vistrails_root_directory(),
+                             'tests/resources/dummy_new.xml'))
+        (fd, filename) = tempfile.mkstemp(prefix='vt_', suffix='.xml')
+        os.close(fd)
+        try:
+            save_vistrail_to_xml(vistrail, filename)
+            tree = ElementTree.parse(filename)
+            self.assertEqual(get_version_for_xml(tree.getroot()),
+                             currentVersion)
+            dao_list = getVersionDAO(currentVersion)
+            expected = dao_list.open_from_xml(filename, DBVistrail.vtType,
+                                              tree)
+
+            tree = StreamedXMLTree(filename)
+            self.assertEqual(get_version_for_xml(tree.getroot()),
+                             currentVersion)
+            vistrail = dao_list.open_from_xml(filename, DBVistrail.vtType,
+                                              tree)
+            # the parsed elements were dropped as they were read
+            self.assertEqual(len(tree.getroot()._element), 0)
+        finally:
+            os.unlink(filename)
+
+        self.assertEqual(len(vistrail.db_actions), len(expected.db_actions))
+        for action in expected.db_actions:
+            other = vistrail.db_get_action_by_id(action.db_id)
+            self.assertEqual([(op.vtType, op.db_what, op.db_id)
+                              for op in other.db_operations],
+                             [(op.vtType, op.db_what, op.db_id)
+                              for op in action.db_operations])
+        self.assertEqual(
+                sorted((a.db_key, a.db_value)
+                       for a in vistrail.db_actionAnnotations),
+                sorted((a.db_key, a.db_value)
+                       for a in expected.db_actionAnnotations))
+
+    def test_lazy_bundle(self):
+        """test that bundle members are only extracted when needed"""
+
+        (save_bundle, vt_save_dir) = open_vistrail_bundle_from_zip_xml(
+                os.path.join(vistrails.core.system.vistrails_root_directory(),
+                             'tests/resources/spx_loop.vt'))
+        (fd, filename) = tempfile.mkstemp(prefix='vt_', suffix='.vt')
+        os.close(fd)
+        new_save_dir = None
+        try:
+            log_fname = save_bundle.vistrail.db_log_filename
+            self.assertEqual(log_fname, os.path.join(vt_save_dir, 'log'))
+            self.assertFalse(os.path.exists(log_fname))
+            self.assertFalse(os.path.exists(os.path.join(vt_save_dir,
+                                                         'thumbs')))
+            self.assertFalse(save_bundle.mashups.is_loaded())
+
+            thumbnails = save_bundle.thumbnails
+            self.assertEqual(len(thumbnails), 3)
+            for thumbnail in thumbnails:
+                self.assertTrue(os.path.isfile(thumbnail))
+            self.assertFalse(os.path.exists(log_fname))
+
+            # the members that were not extracted are copied from the archive
+            save_vistrail_bundle_to_zip_xml(save_bundle, filename,
+                                            vt_save_dir)
+            self.assertFalse(os.path.exists(log_fname))
+            self.assertFalse(save_bundle.mashups.is_loaded())
+            original = zipfile.ZipFile(
+                    os.path.join(
+                            vistrails.core.system.vistrails_root_directory(),
+                            'tests/resources/spx_loop.vt'))
+            saved = zipfile.ZipFile(filename)
+            try:
+                for name in ['log',
+                             'mashups/d5026457-de6c-11e2-b074-3c07543dba07']:
+                    self.assertEqual(saved.read(name), original.read(name))
+                    for attr in ('date_time', 'external_attr',
+                                 'compress_type'):
+                        self.assertEqual(
+                                getattr(saved.getinfo(name), attr),
+                                getattr(original.getinfo(name), attr))
+            finally:
+                original.close()
+                saved.close()
+            log = open_log_from_xml(log_fname, True)
+            self.assertTrue(len(log.db_workflow_execs) > 0)
+
+            (save_bundle, new_save_dir) = open_vistrail_bundle_from_zip_xml(
+                    filename)
+            self.assertEqual(len(save_bundle.thumbnails), 3)
+            self.assertEqual([mashup.id for mashup in save_bundle.mashups],
+                             ['d5026457-de6c-11e2-b074-3c07543dba07'])
+        finally:
+            close_zip_xml(vt_save_dir)
+            close_zip_xml(new_save_dir)
+            os.unlink(filename)
+
     def test3(self):
         """test importing a vt file"""
 
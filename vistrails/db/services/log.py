@@ -32,7 +32,21 @@
 ## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
 ##
 ###############################################################################
-from vistrails.db.domain import DBWorkflowExec
+from array import array
+from datetime import datetime
+import os
+import struct
+import zlib
+
+from vistrails.core.system import get_elementtree_library
+from vistrails.db import VistrailsDBException
+from vistrails.db.domain import DBLog, DBWorkflowExec
+from vistrails.db.versions import getVersionDAO, currentVersion, translate_log
+
+import unittest
+
+ElementTree = get_elementtree_library()
+
 
 def update_id_scope(log):
     if hasattr(log, 'update_id_scope'):
@@ -43,3 +57,489 @@ def update_id_scope(log):
 def update_ids(log):
     for workflow_exec in log.db_workflow_execs:
         workflow_exec.db_id = log.id_scope.getNewId(DBWorkflowExec.vtType)
+
+def read_workflow_exec_from_xml(node, version):
+    """read_workflow_exec_from_xml(node, version) -> DBWorkflowExec
+    Reads a workflow execution from an XML element, translating it to the
+    current version.
+
+    """
+    daoList = getVersionDAO(version)
+    workflow_exec = daoList.read_xml_object(DBWorkflowExec.vtType, node)
+    if version != currentVersion:
+        # if version is wrong, dump this into a dummy log object, 
+        # then translate, then get workflow_exec back
+        log = DBLog()
+        translate_log(log, currentVersion, version)
+        log.db_add_workflow_exec(workflow_exec)
+        log = translate_log(log, version)
+        workflow_exec = log.db_workflow_execs[0]
+    return workflow_exec
+
+def iter_workflow_execs(log, version=None):
+    """iter_workflow_execs(log, version: long) -> iter(DBWorkflowExec)
+    Iterates on the executions of the given workflow version (or of all
+    versions if None) from either a DBLog or a LogStore.
+
+    """
+    if isinstance(log, LogStore):
+        return log.find_workflow_execs(version=version)
+    return (workflow_exec for workflow_exec in log.db_workflow_execs
+            if version is None or workflow_exec.db_parent_version == version)
+
+_EPOCH = datetime(1970, 1, 1)
+
+def _timestamp(dt):
+    if dt is None:
+        return float('nan')
+    return (dt - _EPOCH).total_seconds()
+
+def _iter_module_ids(item_execs):
+    """_iter_module_ids(item_execs) -> iter(long)
+    Yields the module ids of the given executions and of the executions
+    nested in them, inside groups and loops.
+
+    """
+    for item_exec in item_execs:
+        if hasattr(item_exec, 'db_module_id'):
+            yield item_exec.db_module_id
+        if hasattr(item_exec, 'db_item_execs'):
+            for module_id in _iter_module_ids(item_exec.db_item_execs):
+                yield module_id
+        for loop_exec in getattr(item_exec, 'db_loop_execs', ()):
+            for loop_iteration in loop_exec.db_loop_iterations:
+                for module_id in _iter_module_ids(
+                        loop_iteration.db_item_execs):
+                    yield module_id
+
+
+class LogStore(object):
+    """An append-only file of workflow executions, with an index.
+
+    Each workflow execution is written as one record when it is added, as
+    compressed XML, and is never rewritten. A second file (filename +
+    '.idx') gets a small entry for each record: where it is in the file,
+    the workflow version, the start and end times, the completion status
+    and the ids of the executed modules. Only that index is kept in
+    memory; find() returns record numbers, and the records are read from
+    disk one at a time as they are iterated on.
+
+    If the index is missing or behind (e.g. VisTrails stopped between the
+    two writes), the missing entries are rebuilt from the records on
+    opening.
+    """
+
+    MAGIC = 'VTLOGSTORE\x01\n'
+    INDEX_MAGIC = 'VTLOGINDEX\x01\n'
+    # record: length, followed by the zlib-compressed XML
+    RECORD_HEADER = struct.Struct('<I')
+    # entry: offset, length, parent_version, ts_start, ts_end, completed,
+    # number of module ids, followed by the module ids
+    INDEX_ENTRY = struct.Struct('<QIqddbI')
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.index_filename = filename + '.idx'
+        self._offsets = []
+        self._lengths = []
+        self._versions = array('l')
+        self._ts_start = array('d')
+        self._ts_end = array('d')
+        self._completed = array('b')
+        self._by_version = {}
+        self._by_module = {}
+        self._data_file = None
+        self._index_file = None
+
+        if not os.path.exists(self.filename):
+            with open(self.filename, 'wb') as f:
+                f.write(self.MAGIC)
+            with open(self.index_filename, 'wb') as f:
+                f.write(self.INDEX_MAGIC)
+        self._load_index()
+
+    def _add_entry(self, offset, length, version, ts_start, ts_end,
+                   completed, module_ids):
+        record = len(self._offsets)
+        self._offsets.append(offset)
+        self._lengths.append(length)
+        self._versions.append(version)
+        self._ts_start.append(ts_start)
+        self._ts_end.append(ts_end)
+        self._completed.append(completed)
+        self._by_version.setdefault(version, array('l')).append(record)
+        for module_id in module_ids:
+            self._by_module.setdefault(module_id, array('l')).append(record)
+
+    def _load_index(self):
+        with open(self.filename, 'rb') as f:
+            if f.read(len(self.MAGIC)) != self.MAGIC:
+                raise VistrailsDBException("%s is not a log store" %
+                                           self.filename)
+            f.seek(0, 2)
+            data_size = f.tell()
+
+        end = len(self.INDEX_MAGIC)
+        if os.path.exists(self.index_filename):
+            with open(self.index_filename, 'rb') as f:
+                if f.read(end) != self.INDEX_MAGIC:
+                    raise VistrailsDBException("%s is not a log store index" %
+                                               self.index_filename)
+                entry_size = self.INDEX_ENTRY.size
+                while True:
+                    header = f.read(entry_size)
+                    if len(header) < entry_size:
+                        break
+                    entry = self.INDEX_ENTRY.unpack(header)
+                    nb_ids = entry[-1]
+                    ids = f.read(8 * nb_ids)
+                    if len(ids) < 8 * nb_ids:
+                        break
+                    offset, length = entry[:2]
+                    if offset + self.RECORD_HEADER.size + length > data_size:
+                        break
+                    self._add_entry(*(entry[:-1] +
+                                      (struct.unpack('<%dq' % nb_ids, ids),)))
+                    end = f.tell()
+            if end < os.path.getsize(self.index_filename):
+                # drop the entries that don't match a complete record
+                with open(self.index_filename, 'r+b') as f:
+                    f.truncate(end)
+        else:
+            with open(self.index_filename, 'wb') as f:
+                f.write(self.INDEX_MAGIC)
+
+        # index the records that have no entry
+        if self._offsets:
+            offset = (self._offsets[-1] + self.RECORD_HEADER.size +
+                      self._lengths[-1])
+        else:
+            offset = len(self.MAGIC)
+        if offset < data_size:
+            valid_size = offset
+            with open(self.filename, 'rb') as f:
+                f.seek(offset)
+                for offset, data in self._read_records(f):
+                    self._write_index_entry(
+                            offset, len(data),
+                            self._read_record(data))
+                    valid_size = f.tell()
+            if valid_size < data_size:
+                # the last record was not written completely
+                with open(self.filename, 'r+b') as f:
+                    f.truncate(valid_size)
+
+    def _read_records(self, f):
+        header_size = self.RECORD_HEADER.size
+        while True:
+            offset = f.tell()
+            header = f.read(header_size)
+            if len(header) < header_size:
+                return
+            length, = self.RECORD_HEADER.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield offset, data
+
+    def _read_record(self, data):
+        node = ElementTree.fromstring(zlib.decompress(data))
+        return read_workflow_exec_from_xml(node, node.get('version'))
+
+    def _write_index_entry(self, offset, length, workflow_exec):
+        version = workflow_exec.db_parent_version
+        if version is None:
+            version = -1
+        module_ids = sorted(set(_iter_module_ids(workflow_exec.db_item_execs)))
+        completed = workflow_exec.db_completed
+        if completed is None:
+            completed = 0
+        entry = (offset, length, version,
+                 _timestamp(workflow_exec.db_ts_start),
+                 _timestamp(workflow_exec.db_ts_end),
+                 completed)
+        if self._index_file is None:
+            self._index_file = open(self.index_filename, 'ab')
+        self._index_file.write(
+                self.INDEX_ENTRY.pack(*(entry + (len(module_ids),))) +
+                struct.pack('<%dq' % len(module_ids), *module_ids))
+        self._index_file.flush()
+        self._add_entry(*(entry + (module_ids,)))
+
+    def append(self, workflow_exec):
+        """append(workflow_exec: DBWorkflowExec) -> int
+        Writes a workflow execution at the end of the store, and returns
+        its record number. Its id in the store is that number plus one.
+
+        """
+        record = len(self._offsets)
+        dao_list = getVersionDAO(currentVersion)
+        wf_exec_id = workflow_exec.db_id
+        workflow_exec.db_id = record + 1
+        try:
+            node = dao_list.write_xml_object(workflow_exec)
+        finally:
+            workflow_exec.db_id = wf_exec_id
+        node.set('version', currentVersion)
+        data = zlib.compress(ElementTree.tostring(node))
+
+        if self._data_file is None:
+            self._data_file = open(self.filename, 'ab')
+        self._data_file.seek(0, 2)
+        offset = self._data_file.tell()
+        self._data_file.write(self.RECORD_HEADER.pack(len(data)) + data)
+        self._data_file.flush()
+        self._write_index_entry(offset, len(data), workflow_exec)
+        return record
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def find(self, version=None, module_id=None, start=None, end=None,
+             completed=None):
+        """find(version: long, module_id: long, start: datetime,
+                end: datetime, completed: int) -> list(int)
+        Returns the numbers of the records that match all the given
+        criteria, in order: executions of the given workflow version, that
+        executed the given module, that started between start (included)
+        and end (excluded), that have the given completion status.
+
+        """
+        records = None
+        for index, key in ((self._by_version, version),
+                           (self._by_module, module_id)):
+            if key is not None:
+                matches = index.get(key, ())
+                if records is None:
+                    records = matches
+                else:
+                    matches = set(matches)
+                    records = [r for r in records if r in matches]
+        if records is None:
+            records = xrange(len(self._offsets))
+        if start is not None:
+            start = _timestamp(start)
+            records = [r for r in records if self._ts_start[r] >= start]
+        if end is not None:
+            end = _timestamp(end)
+            records = [r for r in records if self._ts_start[r] < end]
+        if completed is not None:
+            records = [r for r in records if self._completed[r] == completed]
+        return list(records)
+
+    def iter_workflow_execs(self, records=None):
+        """iter_workflow_execs(records: list(int)) -> iter(DBWorkflowExec)
+        Reads the given records (or all of them) from the store, one at a
+        time.
+
+        """
+        if records is None:
+            records = xrange(len(self._offsets))
+        if self._data_file is not None:
+            self._data_file.flush()
+        header_size = self.RECORD_HEADER.size
+        with open(self.filename, 'rb') as f:
+            for record in records:
+                f.seek(self._offsets[record] + header_size)
+                yield self._read_record(f.read(self._lengths[record]))
+
+    __iter__ = iter_workflow_execs
+
+    def find_workflow_execs(self, **kwargs):
+        """find_workflow_execs(**kwargs) -> iter(DBWorkflowExec)
+        Reads the workflow executions matching find(**kwargs).
+
+        """
+        return self.iter_workflow_execs(self.find(**kwargs))
+
+    def get_workflow_exec(self, record):
+        return next(self.iter_workflow_execs([record]))
+
+    def get_log(self, records=None):
+        """get_log(records: list(int)) -> DBLog
+        Loads the given records (or all of them) in a DBLog.
+
+        """
+        log = DBLog(workflow_execs=list(self.iter_workflow_execs(records)))
+        update_id_scope(log)
+        return log
+
+    def close(self):
+        for f in (self._data_file, self._index_file):
+            if f is not None:
+                f.close()
+        self._data_file = self._index_file = None
+
+
+class TestLogStore(unittest.TestCase):
+    def make_workflow_exec(self, version, module_ids, ts_start, completed):
+        from vistrails.db.domain import DBMachine, DBModuleExec
+        ts_end = datetime(2014, 1, 1, 12, 30)
+        item_execs = [DBModuleExec(id=i, module_id=module_id,
+                                   module_name='String', ts_start=ts_start,
+                                   ts_end=ts_end, cached=0, completed=1,
+                                   machine_id=1)
+                      for i, module_id in enumerate(module_ids)]
+        return DBWorkflowExec(id=12, user='tester', ip='127.0.0.1',
+                              session=0, vt_version='2.2',
+                              ts_start=ts_start, ts_end=ts_end,
+                              parent_id=1, parent_type='vistrail',
+                              parent_version=version, completed=completed,
+                              item_execs=item_execs,
+                              machines=[DBMachine(id=1, name='localhost',
+                                                  os='Linux', ram=0)])
+
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp(prefix='vt_logstore_')
+        self.filename = os.path.join(self.directory, 'log')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def fill(self, store):
+        store.append(self.make_workflow_exec(
+                3, [1, 2], datetime(2014, 1, 1, 10), 1))
+        store.append(self.make_workflow_exec(
+                5, [1, 4], datetime(2014, 1, 1, 11), -1))
+        store.append(self.make_workflow_exec(
+                3, [2], datetime(2014, 1, 1, 12), 1))
+
+    def check(self, store):
+        self.assertEqual(len(store), 3)
+        self.assertEqual(store.find(), [0, 1, 2])
+        self.assertEqual(store.find(version=3), [0, 2])
+        self.assertEqual(store.find(module_id=1), [0, 1])
+        self.assertEqual(store.find(version=3, module_id=1), [0])
+        self.assertEqual(store.find(module_id=7), [])
+        self.assertEqual(store.find(completed=-1), [1])
+        self.assertEqual(store.find(start=datetime(2014, 1, 1, 11)), [1, 2])
+        self.assertEqual(store.find(start=datetime(2014, 1, 1, 10, 30),
+                                    end=datetime(2014, 1, 1, 12)), [1])
+
+        workflow_execs = list(store.find_workflow_execs(version=3))
+        self.assertEqual([wf_exec.db_id for wf_exec in workflow_execs],
+                         [1, 3])
+        self.assertEqual([item_exec.db_module_id
+                          for item_exec in workflow_execs[0].db_item_execs],
+                         [1, 2])
+        self.assertEqual(workflow_execs[1].db_ts_start,
+                         datetime(2014, 1, 1, 12))
+        self.assertEqual([wf_exec.db_parent_version for wf_exec in store],
+                         [3, 5, 3])
+        log = store.get_log([1])
+        self.assertEqual([wf_exec.db_completed
+                          for wf_exec in log.db_workflow_execs], [-1])
+
+    def test_append(self):
+        store = LogStore(self.filename)
+        workflow_exec = self.make_workflow_exec(3, [1], datetime.now(), 1)
+        self.assertEqual(store.append(workflow_exec), 0)
+        # the execution itself is not renumbered
+        self.assertEqual(workflow_exec.db_id, 12)
+        self.assertEqual(store.get_workflow_exec(0).db_id, 1)
+        store.close()
+
+    def test_find(self):
+        store = LogStore(self.filename)
+        self.fill(store)
+        self.check(store)
+        store.close()
+
+        store = LogStore(self.filename)
+        self.check(store)
+        store.close()
+
+    def test_iter_workflow_execs(self):
+        store = LogStore(self.filename)
+        self.fill(store)
+        log = store.get_log()
+        self.assertEqual([wf_exec.db_id
+                          for wf_exec in iter_workflow_execs(log, 3)],
+                         [1, 3])
+        self.assertEqual([wf_exec.db_id
+                          for wf_exec in iter_workflow_execs(store, 3)],
+                         [1, 3])
+        store.close()
+
+    def test_recover(self):
+        """the index is rebuilt if it is behind the records"""
+        store = LogStore(self.filename)
+        self.fill(store)
+        store.close()
+
+        # lose the last index entry, write half a record
+        with open(self.filename + '.idx', 'r+b') as f:
+            f.truncate(os.path.getsize(self.filename + '.idx') - 4)
+        size = os.path.getsize(self.filename)
+        with open(self.filename, 'ab') as f:
+            f.write(LogStore.RECORD_HEADER.pack(100) + 'partial')
+
+        store = LogStore(self.filename)
+        self.assertEqual(os.path.getsize(self.filename), size)
+        self.check(store)
+        store.close()
+
+        os.remove(self.filename + '.idx')
+        store = LogStore(self.filename)
+        self.check(store)
+        store.append(self.make_workflow_exec(
+                5, [4], datetime(2014, 1, 1, 13), 1))
+        self.assertEqual(store.find(module_id=4), [1, 3])
+        store.close()
+
+    def test_nested(self):
+        """executions inside groups and loops are indexed"""
+        from vistrails.db.domain import DBGroupExec, DBLoopExec, \
+            DBLoopIteration, DBModuleExec
+        workflow_exec = self.make_workflow_exec(
+                3, [1], datetime(2014, 1, 1, 10), 1)
+        loop_exec = DBLoopExec(id=2, loop_iterations=[
+                DBLoopIteration(id=3, iteration=0, completed=1, item_execs=[
+                        DBModuleExec(id=4, module_id=6, module_name='String',
+                                     cached=0, completed=1, machine_id=1)])])
+        workflow_exec.db_item_execs[0].db_add_loop_exec(loop_exec)
+        workflow_exec.db_add_item_exec(DBGroupExec(
+                id=5, module_id=7, group_name='Group', cached=0, completed=1,
+                machine_id=1, item_execs=[
+                        DBModuleExec(id=6, module_id=8, module_name='String',
+                                     cached=0, completed=1, machine_id=1)]))
+        store = LogStore(self.filename)
+        store.append(workflow_exec)
+        for module_id in (1, 6, 7, 8):
+            self.assertEqual(store.find(module_id=module_id), [0])
+        store.close()
+
+        os.remove(self.filename + '.idx')
+        store = LogStore(self.filename)
+        self.assertEqual(store.find(module_id=8), [0])
+        store.close()
+
+    def test_log_controller(self):
+        """finished executions are appended to the store"""
+        from vistrails.core.interpreter.cached import CachedInterpreter
+        from vistrails.core.log.controller import LogController
+        from vistrails.core.log.log import Log
+        from vistrails.tests.utils import execute
+
+        store = LogStore(self.filename)
+        logger = LogController(Log(), store=store)
+        for i in xrange(2):
+            result = execute([
+                    ('ConcatenateString', 'org.vistrails.vistrails.basic', [
+                        ('str1', [('String', 'a')]),
+                    ]),
+                ],
+                full_results=True,
+                interpreter=CachedInterpreter(),
+                logger=logger)
+            self.assertFalse(result.errors)
+        self.assertEqual(len(logger.log.workflow_execs), 2)
+        self.assertEqual(store.find(completed=1), [0, 1])
+        self.assertEqual(len(store.find(module_id=0)), 2)
+        workflow_exec = store.get_workflow_exec(1)
+        self.assertEqual([item_exec.db_module_name
+                          for item_exec in workflow_exec.db_item_execs],
+                         ['ConcatenateString'])
+        store.close()
@@ -46,6 +46,7 @@ from vistrails.db.domain import DBOpmProcess, DBOpmArtifact, DBOpmUsed, \
     IdScope, DBGroupExec, DBLoopExec, DBModuleExec, DBOpmOverlaps, DBPort, \
     DBConnection, DBGroup, DBPortSpec, DBOpmWasTriggeredBy, DBFunction, \
     DBParameter
+from vistrails.db.services.log import iter_workflow_execs
 from vistrails.db.services.vistrail import materializeWorkflow
 
 def create_process(item_exec, account, id_scope):
@@ -628,9 +629,8 @@ def create_opm(workflow, version, log, reg):
         # print '  upstream_lookup:', upstream_lookup
         # print '  downstream_lookup:', downstream_lookup
         if top_version:
-            for workflow_exec in parent_exec.db_workflow_execs:
-                if workflow_exec.db_parent_version != version:
-                    continue
+            # parent_exec is the log, possibly a LogStore
+            for workflow_exec in iter_workflow_execs(parent_exec, version):
                 conn_artifacts = {}
                 function_artifacts = {}
                 module_processes = {}
@@ -41,6 +41,7 @@ from vistrails.db.domain import DBProvDocument, DBProvEntity, DBProvActivity, \
     DBVtConnection, DBRefProvEntity, DBRefProvPlan, DBRefProvActivity, \
     DBRefProvAgent, DBIsPartOf, IdScope, DBGroupExec, DBLoopExec, DBModuleExec, \
     DBWorkflowExec, DBFunction, DBParameter, DBGroup, DBAbstraction
+from vistrails.db.services.log import iter_workflow_execs
 from vistrails.db.services.vistrail import materializeWorkflow
 
 def create_prov_document(entities, activities, agents, connections, usages,
@@ -486,14 +487,13 @@ def create_prov(workflow, version, log):
     for id in prov_functions:
         entities.append(prov_functions[id])
     
-    # machines
-    for machine in log._db_machines:
-        machines[machine.db_id] = (create_prov_agent_from_machine(id_scope, machine), False)
-    
-    # executions
-    for exec_ in log._db_workflow_execs:
-        if exec_._db_parent_version != version:
-            continue
+    # executions, read one at a time if the log is a LogStore
+    for exec_ in iter_workflow_execs(log, version):
+        # machines
+        for machine in exec_._db_machines:
+            if machine.db_id not in machines:
+                machines[machine.db_id] = (create_prov_agent_from_machine(id_scope, machine), False)
+
         prov_agent = None
         if exec_._db_user not in agents_map:
             prov_agent = create_prov_agent_from_user(id_scope, exec_._db_user)
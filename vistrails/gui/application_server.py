@@ -33,7 +33,6 @@
 ##
 ###############################################################################
 """ This is the application for vistrails when running as a server. """
-import Queue
 import base64
 import hashlib
 import inspect
@@ -75,6 +74,7 @@ import gc
 
 import vistrails.core.requirements
 import vistrails.core.console_mode
+from vistrails.core.worker_pool import WorkerPool
 
 from vistrails.db.versions import currentVersion
 
@@ -121,25 +121,49 @@ class RequestHandler(object):
     def __init__(self, logger, instances):
         self.server_logger = logger
         self.instances = instances
-        self.proxies_queue = None
+        self.pool = None
+        # vistrails kept open between requests, when running workflows here
+        self.controller_cache = vistrails.core.console_mode.ControllerCache()
         self.instantiate_proxies()
 
     #proxies
     def instantiate_proxies(self):
         """instantiate_proxies() -> None
         If this server started other instances of VisTrails, this will create
-        the client proxies to connect to them.
+        the pool of client proxies to connect to them.
         """
         if len(self.instances) > 0:
-            self.proxies_queue = Queue.Queue()
-            for uri in self.instances:
-                try:
-                    proxy = xmlrpclib.ServerProxy(uri)
-                    self.proxies_queue.put(proxy)
+            try:
+                self.pool = WorkerPool(self.instances)
+                for uri in self.instances:
                     self.server_logger.info("Instantiated client for %s" % uri)
-                except Exception, e:
-                    self.server_logger.error("Error when instantiating proxy %s" % uri)
-                    self.server_logger.error(str(e))
+            except Exception, e:
+                self.server_logger.error("Error when instantiating proxies %s" %
+                                         self.instances)
+                self.server_logger.error(str(e))
+
+    def _vistrail_key(self, host, port, db_name, vt_id):
+        """Identifies a vistrail, for routing requests to the instances.
+        """
+        return (host, int(port), db_name, int(vt_id))
+
+    def get_pool_status(self):
+        """get_pool_status() -> dict
+        Returns statistics about this server: for each instance it forwards
+        requests to, the number of queued requests, whether it is busy, the
+        number of requests and errors, the mean and maximum latency in
+        seconds and the number of vistrails it was sent; and the number of
+        vistrails this server keeps open.
+        """
+        self.server_logger.info("Request: get_pool_status()")
+        cache = self.controller_cache
+        status = {'vistrails': len(cache),
+                  'cache_hits': cache.hits,
+                  'cache_misses': cache.misses,
+                  'instances': []}
+        if self.pool is not None:
+            status['instances'] = self.pool.status()
+        return (status, 1)
     #utils
     def memory_usage(self):
         """memory_usage() -> dict
@@ -328,24 +352,17 @@ class RequestHandler(object):
         self.server_logger.info("Request: get_server_packages()")
 
         messages = []
-        if self.proxies_queue is not None:
-            # collect all proxies:
-            proxies = []
-            while len(proxies) < len(self.instances):
-                self.server_logger.info("Proxies: %s Instances: %s" % (len(proxies), len(self.instances)))
-                if self.proxies_queue.empty():
-                    for p in  proxies:
-                        self.proxies_queue.put(p)
-                    return [[[],
-                        "Not all vistrail instances are free, please try again."], 1]
-                proxies.append(self.proxies_queue.get())
-            for proxy in proxies:
+        if self.pool is not None:
+            if codepath and status is not None:
+                args = (codepath, status)
+            else:
+                args = ()
+            for worker in self.pool.workers:
                 result, s = 'Please contact the server admin', 0
                 try:
-                    if codepath and status is not None:
-                        result, s = proxy.get_server_packages(codepath, status)
-                    else:
-                        result, s = proxy.get_server_packages()
+                    result, s = self.pool.call_worker(
+                            self.pool.reserve(worker),
+                            'get_server_packages', *args)
                 except xmlrpclib.ProtocolError, err:
                     err_msg = ("A protocol error occurred\n"
                            "URL: %s\n"
@@ -354,8 +371,6 @@ class RequestHandler(object):
                            "Error message: %s\n") % (err.url, err.headers,
                                                  err.errcode, err.errmsg)
                     self.server_logger.error(err_msg)
-                finally:
-                    self.proxies_queue.put(proxy)
                 if s == 0:
                     messages.append('An error occurred: %s' % result)
                 else:
@@ -721,16 +736,20 @@ class RequestHandler(object):
             path_to_images = \
                os.path.join(media_dir, 'medleys/images', subdir)
             if (not self.path_exists_and_not_empty(path_to_images) and
-                self.proxies_queue is not None):
+                self.pool is not None):
                 #this server can send requests to other instances
-                proxy = self.proxies_queue.get()
+                key = None
+                if medley is not None and medley._type == 'vistrail':
+                    key = self._vistrail_key(db_host, 3306, 'vistrails',
+                                             medley._vtid)
                 try:
-                    self.server_logger.info("Sending request to %s" % proxy)
+                    self.server_logger.info("Sending request to the instance pool")
                     if extra_info is not None:
-                        result = proxy.executeMedley(xml_medley, extra_info)
+                        result = self.pool.call(key, 'executeMedley',
+                                                xml_medley, extra_info)
                     else:
-                        result = proxy.executeMedley(xml_medley)
-                    self.proxies_queue.put(proxy)
+                        result = self.pool.call(key, 'executeMedley',
+                                                xml_medley)
                     self.server_logger.info("returning %s"% result)
                     return result
                 except Exception, e:
@@ -910,7 +929,6 @@ class RequestHandler(object):
 
         self.server_logger.info("path_exists_and_not_empty? %s" % self.path_exists_and_not_empty(path_to_figures))
         self.server_logger.info("build_always? %s" % build_always)
-        self.server_logger.info(str(self.proxies_queue))
 
         if not is_local:
             # use same hashing as on crowdlabs webserver
@@ -919,16 +937,16 @@ class RequestHandler(object):
             path_to_figures = os.path.join(media_dir, "photos", "wf_execution", dest_version)
 
         if ((not self.path_exists_and_not_empty(path_to_figures) or 
-             build_always) and self.proxies_queue is not None):
+             build_always) and self.pool is not None):
             self.server_logger.info("will forward request")
             #this server can send requests to other instances
-            proxy = self.proxies_queue.get()
             try:
-                self.server_logger.info("Sending request to %s" % proxy)
-                result = proxy.run_from_db(host, port, db_name, vt_id,
-                                           path_to_figures, version, pdf, vt_tag,
-                                           build_always, parameters, is_local)
-                self.proxies_queue.put(proxy)
+                self.server_logger.info("Sending request to the instance pool")
+                result = self.pool.call(
+                        self._vistrail_key(host, port, db_name, vt_id),
+                        'run_from_db', host, port, db_name, vt_id,
+                        path_to_figures, version, pdf, vt_tag,
+                        build_always, parameters, is_local)
                 self.server_logger.info("returning %s" % result)
                 return result
             except xmlrpclib.ProtocolError, err:
@@ -980,7 +998,8 @@ class RequestHandler(object):
                             parameters,
                             update_vistrail=True,
                             extra_info=extra_info,
-                            reason="Server Pipeline Execution")
+                            reason="Server Pipeline Execution",
+                            controller_cache=self.controller_cache)
                 except Exception, e:
                     self.server_logger.error("workflow execution failed:")
                     self.server_logger.error(str(e))
@@ -1198,12 +1217,12 @@ class RequestHandler(object):
             filename = os.path.join(filepath,base_fname)
             if ((not os.path.exists(filepath) or
                 os.path.exists(filepath) and not os.path.exists(filename))
-                and self.proxies_queue is not None):
+                and self.pool is not None):
                 #this server can send requests to other instances
-                proxy = self.proxies_queue.get()
                 try:
-                    result = proxy.get_wf_graph_pdf(host,port,db_name, vt_id, version, is_local)
-                    self.proxies_queue.put(proxy)
+                    result = self.pool.call(
+                            self._vistrail_key(host, port, db_name, vt_id),
+                            'get_wf_graph_pdf', host, port, db_name, vt_id, version, is_local)
                     self.server_logger.info("get_wf_graph_pdf returning %s"% result)
                     return result
                 except xmlrpclib.ProtocolError, err:
@@ -1282,13 +1301,13 @@ class RequestHandler(object):
             filename = os.path.join(filepath,base_fname)
             if ((not os.path.exists(filepath) or
                 os.path.exists(filepath) and not os.path.exists(filename))
-                and self.proxies_queue is not None):
+                and self.pool is not None):
                 #this server can send requests to other instances
-                proxy = self.proxies_queue.get()
                 try:
-                    self.server_logger.info("Sending request to %s" % proxy)
-                    result = proxy.get_wf_graph_png(host, port, db_name, vt_id, version, is_local)
-                    self.proxies_queue.put(proxy)
+                    self.server_logger.info("Sending request to the instance pool")
+                    result = self.pool.call(
+                            self._vistrail_key(host, port, db_name, vt_id),
+                            'get_wf_graph_png', host, port, db_name, vt_id, version, is_local)
                     self.server_logger.info("returning %s" % result)
                     return result
                 except xmlrpclib.ProtocolError, err:
@@ -1382,13 +1401,13 @@ class RequestHandler(object):
             if ((not os.path.exists(filepath) or
                 (os.path.exists(filepath) and not os.path.exists(filename)) or
                  self._is_image_stale(filename, host, port, db_name, vt_id)) and 
-                self.proxies_queue is not None):
+                self.pool is not None):
                 #this server can send requests to other instances
-                proxy = self.proxies_queue.get()
                 try:
-                    self.server_logger.info("Sending request to %s" % proxy)
-                    result = proxy.get_vt_graph_png(host, port, db_name, vt_id, is_local)
-                    self.proxies_queue.put(proxy)
+                    self.server_logger.info("Sending request to the instance pool")
+                    result = self.pool.call(
+                            self._vistrail_key(host, port, db_name, vt_id),
+                            'get_vt_graph_png', host, port, db_name, vt_id, is_local)
                     self.server_logger.info("returning %s" % result)
                     return result
                 except xmlrpclib.ProtocolError, err:
@@ -1471,13 +1490,13 @@ class RequestHandler(object):
             if ((not os.path.exists(filepath) or
                 (os.path.exists(filepath) and not os.path.exists(filename)) or
                  self._is_image_stale(filename, host, port, db_name, vt_id)) and 
-                self.proxies_queue is not None):
+                self.pool is not None):
                 #this server can send requests to other instances
-                proxy = self.proxies_queue.get()
                 try:
-                    self.server_logger.info("Sending request to %s" % proxy)
-                    result = proxy.get_vt_graph_pdf(host, port, db_name, vt_id, is_local)
-                    self.proxies_queue.put(proxy)
+                    self.server_logger.info("Sending request to the instance pool")
+                    result = self.pool.call(
+                            self._vistrail_key(host, port, db_name, vt_id),
+                            'get_vt_graph_pdf', host, port, db_name, vt_id, is_local)
                     self.server_logger.info("returning %s" % result)
                     return result
                 except xmlrpclib.ProtocolError, err:
@@ -102,6 +102,17 @@ class QModuleOptions(QtGui.QDialog, QVistrailsPaletteInterface):
         self.portCombiner = QPortCombineTreeWidget()
         self.layout().addWidget(self.portCombiner)
         self.portCombiner.setVisible(False)
+
+        layout = QtGui.QHBoxLayout()
+        layout.addWidget(QtGui.QLabel("Port list threads:"))
+        layout.setStretch(0, 0)
+        self.threadsEdit = QtGui.QLineEdit()
+        self.threadsEdit.setValidator(QtGui.QIntValidator(self))
+        self.threadsEdit.setToolTip('Number of list elements computed '
+                                    'concurrently (default=1)')
+        layout.addWidget(self.threadsEdit)
+        layout.setStretch(1, 1)
+        self.layout().addLayout(layout)
         
         whileLayout = QtGui.QVBoxLayout()
 
@@ -198,6 +209,7 @@ class QModuleOptions(QtGui.QDialog, QVistrailsPaletteInterface):
         self.customButton.toggled.connect(self.stateChanged)
         self.customButton.toggled.connect(self.customToggled)
         self.portCombiner.itemChanged.connect(self.stateChanged)
+        self.threadsEdit.textChanged.connect(self.stateChanged)
         self.whileButton.toggled.connect(self.stateChanged)
         self.whileButton.toggled.connect(self.whileToggled)
         self.condEdit.textChanged.connect(self.stateChanged)
@@ -289,6 +301,7 @@ class QModuleOptions(QtGui.QDialog, QVistrailsPaletteInterface):
             self.pairwiseButton.setEnabled(False)
             self.cartesianButton.setEnabled(False)
             self.customButton.setEnabled(False)
+            self.threadsEdit.setEnabled(False)
             self.whileButton.setEnabled(False)
             self.condEdit.setVisible(False)
             self.maxEdit.setVisible(False)
@@ -311,6 +324,8 @@ class QModuleOptions(QtGui.QDialog, QVistrailsPaletteInterface):
         self.cartesianButton.setEnabled(True)
         self.cartesianButton.setChecked(True)
         self.customButton.setEnabled(True)
+        self.threadsEdit.setEnabled(True)
+        self.threadsEdit.setText('')
 
         self.whileButton.setEnabled(True)
         self.whileButton.setChecked(False)
@@ -336,6 +351,9 @@ class QModuleOptions(QtGui.QDialog, QVistrailsPaletteInterface):
             self.portCombiner.setVisible(type not in ['pairwise', 'cartesian'])
             if type not in ['pairwise', 'cartesian']:
                 self.portCombiner.setValue(type)
+        if module.has_control_parameter_with_name(ModuleControlParam.LOOP_THREADS_KEY):
+            threads = module.get_control_parameter_by_name(ModuleControlParam.LOOP_THREADS_KEY).value
+            self.threadsEdit.setText(threads)
         if module.has_control_parameter_with_name(ModuleControlParam.WHILE_COND_KEY) or \
            module.has_control_parameter_with_name(ModuleControlParam.WHILE_MAX_KEY):
             self.whileButton.setChecked(True)
@@ -370,6 +388,8 @@ class QModuleOptions(QtGui.QDialog, QVistrailsPaletteInterface):
         else:
             value = self.portCombiner.getValue()
         values.append((ModuleControlParam.LOOP_KEY, value))
+        values.append((ModuleControlParam.LOOP_THREADS_KEY,
+                       self.threadsEdit.text()))
         _while = self.whileButton.isChecked()
         values.append((ModuleControlParam.WHILE_COND_KEY,
                        _while and self.condEdit.text()))
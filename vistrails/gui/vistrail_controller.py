@@ -1340,11 +1340,7 @@ class VistrailController(QtCore.QObject, BaseController):
 
     def write_opm(self, locator):
         if self.log:
-            if self.vistrail.db_log_filename is not None:
-                log = vistrails.core.db.io.merge_logs(self.log, 
-                                            self.vistrail.db_log_filename)
-            else:
-                log = self.log
+            log = self.get_log()
             opm_graph = OpmGraph(log=log, 
                                  version=self.current_version,
                                  workflow=self.current_pipeline,
@@ -1353,11 +1349,7 @@ class VistrailController(QtCore.QObject, BaseController):
             
     def write_prov(self, locator):
         if self.log:
-            if self.vistrail.db_log_filename is not None:
-                log = vistrails.core.db.io.merge_logs(self.log, 
-                                            self.vistrail.db_log_filename)
-            else:
-                log = self.log
+            log = self.get_log()
             prov_document = ProvDocument(log=log, 
                                          version=self.current_version,
                                          workflow=self.current_pipeline,
@@ -1462,33 +1454,25 @@ class VistrailController(QtCore.QObject, BaseController):
         if self.current_pipeline and actions:
             pe_log_id = uuid.uuid1()
             explorer = ActionBasedParameterExploration()
-            (pipelines, performedActions) = explorer.explore(
-                self.current_pipeline, actions, pre_actions)
+            # the pipelines are generated one at a time
+            explored = explorer.explore_iter(self.current_pipeline, actions,
+                                             pre_actions)
             
             dim = [max(1, len(a)) for a in actions]
+            pipelineCount = reduce(lambda x, y: x * y, dim, 1)
             if use_spreadsheet:
-                from vistrails.gui.paramexplore.virtual_cell import positionPipelines, assembleThumbnails
+                from vistrails.gui.paramexplore.virtual_cell import positionPipeline, assembleThumbnails
                 from vistrails.gui.paramexplore.pe_view import QParamExploreView
-                modifiedPipelines, pipelinePositions = positionPipelines(
-                    'PE#%d %s' % (QParamExploreView.explorationId, self.name),
-                    dim[2], dim[1], dim[0], pipelines, pe.layout, self)
+                sheetPrefix = 'PE#%d %s' % (QParamExploreView.explorationId,
+                                            self.name)
                 QParamExploreView.explorationId += 1
             else:
-                from vistrails.core.param_explore import _pipelinePositions
-                modifiedPipelines = pipelines
-                pipelinePositions = _pipelinePositions(
-                    dim[2], dim[1], dim[0], pipelines)
-
-            mCount = []
-            for p in modifiedPipelines:
-                if len(mCount)==0:
-                    mCount.append(0)
-                else:
-                    mCount.append(len(p.modules)+mCount[len(mCount)-1])
-                
+                from vistrails.core.param_explore import _pipelinePosition
+
             # Now execute the pipelines
             if showProgress:
-                totalProgress = sum([len(p.modules) for p in modifiedPipelines])
+                # the maximum is set once the size of a pipeline is known
+                totalProgress = pipelineCount
                 progress = QtGui.QProgressDialog('Performing Parameter '
                                                  'Exploration...',
                                                  '&Cancel',
@@ -1501,9 +1485,21 @@ class VistrailController(QtCore.QObject, BaseController):
             
             images = {}
             errors = []
-            for pi in xrange(len(modifiedPipelines)):
+            mCount = 0
+            for pi, (pipeline, performedActions) in enumerate(explored):
+                if use_spreadsheet:
+                    pipeline, pipelinePosition = positionPipeline(
+                        sheetPrefix, dim[2], dim[1], dim[0], pi, pipeline,
+                        pe.layout)
+                else:
+                    pipeline = copy.copy(pipeline)
+                    pipelinePosition = _pipelinePosition(
+                        pi, dim[2], dim[1], dim[0])
                 if showProgress:
-                    progress.setValue(mCount[pi])
+                    if pi == 0:
+                        totalProgress = pipelineCount * len(pipeline.modules)
+                        progress.setMaximum(totalProgress)
+                    progress.setValue(mCount)
                     QtCore.QCoreApplication.processEvents()
                     if progress.wasCanceled():
                         break
@@ -1511,19 +1507,20 @@ class VistrailController(QtCore.QObject, BaseController):
                         if not progress.wasCanceled():
                             progress.setValue(progress.value()+1)
                             QtCore.QCoreApplication.processEvents()
+                mCount += len(pipeline.modules)
                 if use_spreadsheet:
                     name = os.path.splitext(self.name)[0] + \
-                                         ("_%s_%s_%s" % pipelinePositions[pi])
+                                         ("_%s_%s_%s" % pipelinePosition)
                     extra_info['nameDumpCells'] = name
                     if 'pathDumpCells' in extra_info:
-                        images[pipelinePositions[pi]] = \
+                        images[pipelinePosition] = \
                                    os.path.join(extra_info['pathDumpCells'], name)
-                pe_cell_id = (pe_log_id,) + pipelinePositions[pi]
+                pe_cell_id = (pe_log_id,) + pipelinePosition
                 kwargs = {'locator': self.locator,
                           'current_version': self.current_version,
                           'reason': 'Parameter Exploration %s %s_%s_%s' % pe_cell_id,
                           'logger': self.get_logger(),
-                          'actions': performedActions[pi],
+                          'actions': performedActions,
                           'extra_info': extra_info
                           }
                 if view:
@@ -1535,10 +1532,10 @@ class VistrailController(QtCore.QObject, BaseController):
                     vars = dict([(v.uuid, v) for v in self.get_vistrail_variables()
                             if v.uuid not in vistrail_vars])
                     kwargs['vistrail_variables'] = lambda x: vars.get(x, None)
-                result = interpreter.execute(modifiedPipelines[pi], **kwargs)
+                result = interpreter.execute(pipeline, **kwargs)
                 for error in result.errors.itervalues():
                     if use_spreadsheet:
-                        pp = pipelinePositions[pi]
+                        pp = pipelinePosition
                         errors.append(((pp[1], pp[0], pp[2]), error))
                     else:
                         errors.append(((0,0,0), error))
@@ -38,4 +38,4 @@ from vistrails.core.configuration import ConfigurationObject
 
 from identifiers import *
 
-configuration = ConfigurationObject(env=(None, str))
+configuration = ConfigurationObject(env=(None, str), loopThreads=1)
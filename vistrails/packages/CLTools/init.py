@@ -39,13 +39,16 @@ import os
 import shutil
 import subprocess
 import sys
+import threading
 
+from vistrails.core.modules.basic_modules import PathObject
 from vistrails.core.modules.vistrails_module import Module, ModuleError, IncompleteImplementation, new_module
 import vistrails.core.modules.module_registry
 from vistrails.core import debug
 from vistrails.core.packagemanager import get_package_manager
 import vistrails.core.system
 from vistrails.core.system import packages_directory, vistrails_root_directory
+from vistrails.core.vistrail.module_control_param import ModuleControlParam
 
 import identifiers
 
@@ -59,9 +62,131 @@ class CLTools(Module):
      the web service.
 
     """
+    def __init__(self):
+        Module.__init__(self)
+        # The copies computing list iterations share this list
+        self._pipes = []
+
     def compute(self):
         raise IncompleteImplementation # pragma: no cover
 
+    def is_cacheable(self):
+        # A pipe can only be read once
+        return not pipes_stdout(self.conf)
+
+    def get_loop_threads(self):
+        # The package's loopThreads setting runs independent invocations
+        # concurrently unless the module sets its own value
+        if self.control_params.get(ModuleControlParam.LOOP_THREADS_KEY):
+            return Module.get_loop_threads(self)
+        return configuration.loopThreads or 1
+
+    def cleanup(self):
+        """Waits for the commands whose output pipe wasn't fully read.
+        """
+        pipes, self._pipes[:] = self._pipes[:], []
+        for pipe in pipes:
+            pipe.close()
+
+
+def pipes_stdout(conf):
+    """Whether the standard output is left streaming from the process.
+
+    This is enabled by the 'pipe_stdout' option, and only applies if stdout
+    is a file and it is the only output of the tool: the other outputs are
+    only complete once the command has finished. Such tools have no
+    return_code output; the module reading the pipe checks it instead.
+    """
+    if 'pipe_stdout' not in conf.get('options', {}):
+        return False
+    if 'stdout' not in conf or conf['stdout'][1].lower() != 'file':
+        return False
+    if 'stderr' in conf:
+        return False
+    return not any(arg[0].lower() in ('output', 'inputoutput')
+                   for arg in conf['args'])
+
+
+class CLToolsPipe(PathObject):
+    """The standard output of a running command, as a File value.
+
+    A CLTools module reading its stdin from this value gets the pipe
+    itself, so the two processes are connected directly. Any other use of
+    the file name copies the rest of the output to a temporary file first;
+    this also happens at the end of the execution if nothing read it.
+
+    'upstream' is the CLToolsPipe the command reads its stdin from, if any.
+    """
+    def __init__(self, module, process, return_code=None, upstream=None):
+        self.module = module
+        self.process = process
+        self.return_code = return_code
+        self.upstream = upstream
+        self._file = None
+        self._taken = False
+        self._returncode = None
+        self._lock = threading.Lock()
+
+    @property
+    def name(self):
+        with self._lock:
+            if self._taken:
+                raise ModuleError(self.module,
+                                  "Output of command '%s' was already read "
+                                  "through a pipe" % self.module.conf['command'])
+            if self._file is None:
+                self._file = self.module.interpreter.filePool.create_file(
+                        suffix=DEFAULTFILESUFFIX)
+                with open(self._file.name, 'wb') as f:
+                    shutil.copyfileobj(self.process.stdout, f)
+                self.process.stdout.close()
+                self.check(self.module)
+        return self._file.name
+
+    def open(self):
+        """Returns a file object to read the output from.
+
+        The first reader gets the pipe and becomes responsible for closing
+        it; it reads from the temporary file if the output was already
+        copied there.
+        """
+        with self._lock:
+            if self._file is None and not self._taken:
+                self._taken = True
+                return self.process.stdout
+        return open(self.name, 'rb')
+
+    def close(self):
+        """Makes sure the command is over and checks its return code.
+
+        If the pipe was never read, the output is copied to a file.
+        """
+        with self._lock:
+            taken = self._taken
+        if taken:
+            self.check(self.module)
+        else:
+            self.name
+
+    def check(self, module):
+        """Waits for the command and checks its return code.
+
+        The commands piped into this one are checked first. A failure is
+        only reported once.
+        """
+        if self.upstream is not None:
+            self.upstream.check(module)
+        if self._returncode is not None:
+            return self._returncode
+        returncode = self._returncode = _eintr_retry_call(self.process.wait)
+        if (self.return_code is not None and
+                returncode != self.return_code):
+            raise ModuleError(module, "Piped command '%s' returned %d "
+                                      "(!= %d)" % (
+                                      self.module.conf['command'],
+                                      returncode, self.return_code))
+        return returncode
+
 
 SUFFIX = '.clt'
 DEFAULTFILESUFFIX = '.cld'
@@ -180,20 +305,22 @@ def _add_tool(path):
                     args.append(options['flag'])
                 args.append(value)
                 self.set_output(name, outfile)
+        pipe_out = pipes_stdout(self.conf)
+        pipe_in = None
         if "stdin" in self.conf:
             name, type, options = self.conf["stdin"]
             type = type.lower()
             if self.has_input(name):
                 value = self.get_input(name)
                 if "file" == type:
-                    if file_std:
-                        f = open(value.name, 'rb')
+                    # the process reads the file or pipe directly
+                    if isinstance(value, CLToolsPipe):
+                        pipe_in = value
+                        f = value.open()
                     else:
                         f = open(value.name, 'rb')
-                        stdin = f.read()
-                        f.close()
                 elif "string" == type:
-                    if file_std:
+                    if file_std or pipe_out:
                         file = self.interpreter.filePool.create_file()
                         f = open(file.name, 'wb')
                         f.write(value)
@@ -201,17 +328,20 @@ def _add_tool(path):
                         f = open(file.name, 'rb')
                     else:
                         stdin = value
+                        f = None
                 else: # pragma: no cover
                     raise ValueError
-                if file_std:
+                if f is not None:
                     open_files.append(f)
                     kwargs['stdin'] = f.fileno()
                 else:
                     kwargs['stdin'] = subprocess.PIPE
         if "stdout" in self.conf:
-            if file_std:
-                name, type, options = self.conf["stdout"]
-                type = type.lower()
+            name, type, options = self.conf["stdout"]
+            type = type.lower()
+            if pipe_out:
+                kwargs['stdout'] = subprocess.PIPE
+            elif file_std or "file" == type:
                 file = self.interpreter.filePool.create_file(
                         suffix=DEFAULTFILESUFFIX)
                 if "file" == type:
@@ -226,9 +356,9 @@ def _add_tool(path):
             else:
                 kwargs['stdout'] = subprocess.PIPE
         if "stderr" in self.conf:
-            if file_std:
-                name, type, options = self.conf["stderr"]
-                type = type.lower()
+            name, type, options = self.conf["stderr"]
+            type = type.lower()
+            if file_std or "file" == type:
                 file = self.interpreter.filePool.create_file(
                         suffix=DEFAULTFILESUFFIX)
                 if "file" == type:
@@ -302,18 +432,27 @@ def _add_tool(path):
         if 'dir' in self.conf:
             kwargs['cwd'] = self.conf['dir']
 
-        process = subprocess.Popen(args, **kwargs)
-        if file_std:
-            process.wait()
-        else:
-            #if stdin:
-            #    print "stdin:", len(stdin), stdin[:30]
-            stdout, stderr = _eintr_retry_call(process.communicate, stdin)
-            #stdout, stderr = process.communicate(stdin)
-            #if stdout:
-            #    print "stdout:", len(stdout), stdout[:30]
-            #if stderr:
-            #    print "stderr:", len(stderr), stderr[:30]
+        # Don't leak the pipes of concurrent invocations into the children
+        kwargs['close_fds'] = os.name == 'posix'
+
+        try:
+            process = subprocess.Popen(args, **kwargs)
+        finally:
+            # the child has its own copies now
+            for f in open_files:
+                f.close()
+
+        if pipe_out:
+            name, type, options = self.conf["stdout"]
+            # the input pipe is checked once this process has finished too
+            pipe = CLToolsPipe(self, process, return_code, pipe_in)
+            self._pipes.append(pipe)
+            self.set_output(name, pipe)
+            return
+
+        stdout, stderr = _eintr_retry_call(process.communicate, stdin)
+        if pipe_in is not None:
+            pipe_in.check(self)
 
         if return_code is not None:
             if process.returncode != return_code:
@@ -321,43 +460,17 @@ def _add_tool(path):
                                   process.returncode, return_code))
         self.set_output('return_code', process.returncode)
 
-        for f in open_files:
-            f.close()
-
         for name, file in setOutput:
             f = open(file.name, 'rb')
             self.set_output(name, f.read())
             f.close()
 
-        if not file_std:
-            if "stdout" in self.conf:
-                name, type, options = self.conf["stdout"]
-                type = type.lower()
-                if "file" == type:
-                    file = self.interpreter.filePool.create_file(
-                            suffix=DEFAULTFILESUFFIX)
-                    f = open(file.name, 'wb')
-                    f.write(stdout)
-                    f.close()
-                    self.set_output(name, file)
-                elif "string" == type:
-                    self.set_output(name, stdout)
-                else: # pragma: no cover
-                    raise ValueError
-            if "stderr" in self.conf:
-                name, type, options = self.conf["stderr"]
-                type = type.lower()
-                if "file" == type:
-                    file = self.interpreter.filePool.create_file(
-                            suffix=DEFAULTFILESUFFIX)
-                    f = open(file.name, 'wb')
-                    f.write(stderr)
-                    f.close()
-                    self.set_output(name, file)
-                elif "string" == type:
-                    self.set_output(name, stderr)
-                else: # pragma: no cover
-                    raise ValueError
+        if stdout is not None:
+            name, type, options = self.conf["stdout"]
+            self.set_output(name, stdout)
+        if stderr is not None:
+            name, type, options = self.conf["stderr"]
+            self.set_output(name, stderr)
 
 
     # create docstring
@@ -403,7 +516,8 @@ def _add_tool(path):
         elif 'inputoutput' == type.lower():
             reg.add_input_port(M, name, to_vt_type('file'), optional=optional)
             reg.add_output_port(M, name, to_vt_type('file'), optional=optional)
-    reg.add_output_port(M, 'return_code', to_vt_type('integer'))
+    if not pipes_stdout(conf):
+        reg.add_output_port(M, 'return_code', to_vt_type('integer'))
     cl_tools[tool_name] = M
 
 
@@ -522,7 +636,7 @@ def callContextMenu(name):
 ###############################################################################
 
 import unittest
-from vistrails.tests.utils import execute, intercept_results
+from vistrails.tests.utils import execute, intercept_result, intercept_results
 
 
 class TestCLTools(unittest.TestCase):
@@ -576,3 +690,159 @@ class TestCLTools(unittest.TestCase):
         """With std_using_files: use files instead of pipes.
         """
         self.do_the_test('intern_cltools_2')
+
+
+class TestCLToolsPipes(unittest.TestCase):
+    PRODUCER = ("import sys\n"
+                "for i in xrange(int(sys.argv[1])):\n"
+                "    sys.stdout.write('line %d\\n' % i)\n"
+                "sys.exit(int(sys.argv[2]))\n")
+    COUNTER = ("import sys\n"
+               "f = open(sys.argv[1], 'rb') if len(sys.argv) > 1 "
+               "else sys.stdin\n"
+               "sys.stdout.write(str(sum(1 for l in f)))\n")
+    FILTER = ("import sys\n"
+              "for l in sys.stdin:\n"
+              "    if l.endswith('0\\n'):\n"
+              "        sys.stdout.write(l)\n")
+
+    @classmethod
+    def setUpClass(cls):
+        import tempfile
+
+        pm = get_package_manager()
+        if 'CLTools' not in pm._package_list: # pragma: no cover # pragma: no branch
+            pm.late_enable_package('CLTools')
+        cls.testdir = tempfile.mkdtemp(prefix='vt_cltools_')
+        def tool(name, script, args, **conf):
+            conf['command'] = sys.executable
+            conf['args'] = ([['constant', script, 'string', {'flag': '-c'}]] +
+                            args)
+            path = os.path.join(cls.testdir, name + SUFFIX)
+            with open(path, 'w') as fp:
+                json.dump(conf, fp)
+            _add_tool(path)
+        lines = [['input', 'lines', 'integer', {}],
+                 ['input', 'exit', 'integer', {}]]
+        tool('intern_pipe_producer', cls.PRODUCER, lines,
+             stdout=['stdout', 'file', {}],
+             options={'pipe_stdout': ''}, return_code=0)
+        tool('intern_pipe_filter', cls.FILTER, [],
+             stdin=['stdin', 'file', {}], stdout=['stdout', 'file', {}],
+             options={'pipe_stdout': ''}, return_code=0)
+        tool('intern_pipe_counter', cls.COUNTER, [],
+             stdin=['stdin', 'file', {}], stdout=['count', 'string', {}])
+        tool('intern_pipe_file_counter', cls.COUNTER,
+             [['input', 'file', 'file', {}]],
+             stdout=['count', 'string', {}])
+
+    @classmethod
+    def tearDownClass(cls):
+        reg = vistrails.core.modules.module_registry.get_module_registry()
+        for name in os.listdir(cls.testdir):
+            name = os.path.splitext(name)[0]
+            if name in cl_tools:
+                del cl_tools[name]
+                reg.delete_module(identifiers.identifier, name)
+        shutil.rmtree(cls.testdir)
+
+    def producer(self, lines, exit=0):
+        return ('intern_pipe_producer', identifiers.identifier, [
+                    ('lines', [('Integer', str(lines))]),
+                    ('exit', [('Integer', str(exit))]),
+                ])
+
+    def test_pipe(self):
+        """The output of a command is streamed into the next one.
+        """
+        from vistrails.core.interpreter.default import get_default_interpreter
+
+        interpreter = get_default_interpreter()
+        with intercept_results(cl_tools['intern_pipe_counter'], 'count',
+                               cl_tools['intern_pipe_producer'], 'stdout') \
+                as (count, stdout):
+            self.assertFalse(execute([
+                    self.producer(100000),
+                    ('intern_pipe_counter', identifiers.identifier, []),
+                ],
+                [
+                    (0, 'stdout', 1, 'stdin'),
+                ]))
+        self.assertEqual(count, ['100000'])
+        self.assertIsInstance(stdout[0], CLToolsPipe)
+        self.assertEqual(stdout[0].process.returncode, 0)
+        # The producer can't be reused
+        self.assertFalse(any(isinstance(obj, cl_tools['intern_pipe_producer'])
+                             for obj in interpreter._objects.itervalues()))
+
+    def test_chain(self):
+        """Three commands are connected by two pipes.
+        """
+        with intercept_results(cl_tools['intern_pipe_counter'], 'count') \
+                as (count,):
+            self.assertFalse(execute([
+                    self.producer(1000),
+                    ('intern_pipe_filter', identifiers.identifier, []),
+                    ('intern_pipe_counter', identifiers.identifier, []),
+                ],
+                [
+                    (0, 'stdout', 1, 'stdin'),
+                    (1, 'stdout', 2, 'stdin'),
+                ]))
+        self.assertEqual(count, ['100'])
+
+    def test_pipe_as_file(self):
+        """A pipe used as a file name is copied to a file first.
+        """
+        with intercept_results(cl_tools['intern_pipe_file_counter'],
+                               'count') as (count,):
+            self.assertFalse(execute([
+                    self.producer(50),
+                    ('intern_pipe_file_counter', identifiers.identifier, []),
+                ],
+                [
+                    (0, 'stdout', 1, 'file'),
+                ]))
+        self.assertEqual(count, ['50'])
+
+    def test_pipe_error(self):
+        """The return code of a piped command is checked by its reader.
+        """
+        self.assertTrue(execute([
+                self.producer(10, exit=3),
+                ('intern_pipe_counter', identifiers.identifier, []),
+            ],
+            [
+                (0, 'stdout', 1, 'stdin'),
+            ]))
+
+    def test_unread_pipe(self):
+        """A pipe nothing reads is waited for at the end of the execution.
+        """
+        with intercept_result(cl_tools['intern_pipe_producer'], 'stdout') \
+                as stdout:
+            self.assertFalse(execute([self.producer(100000)]))
+        pipe, = stdout
+        self.assertEqual(pipe.process.returncode, 0)
+        with open(pipe.name, 'rb') as fp:
+            self.assertEqual(sum(1 for l in fp), 100000)
+
+        errors = execute([self.producer(10, exit=3)])
+        self.assertEqual(len(errors), 1)
+        self.assertIn("returned 3", str(errors.values()[0]))
+
+    def test_pipe_ports(self):
+        """Tools piping stdout have no return_code port.
+        """
+        reg = vistrails.core.modules.module_registry.get_module_registry()
+        producer = reg.get_descriptor(cl_tools['intern_pipe_producer'])
+        counter = reg.get_descriptor(cl_tools['intern_pipe_counter'])
+        self.assertFalse(reg.has_port_spec_from_descriptor(
+                producer, 'return_code', 'output'))
+        self.assertTrue(reg.has_port_spec_from_descriptor(
+                counter, 'return_code', 'output'))
+        self.assertFalse(pipes_stdout({
+                'command': 'cat',
+                'args': [['output', 'out', 'file', {}]],
+                'stdout': ['stdout', 'file', {}],
+                'options': {'pipe_stdout': ''}}))
@@ -215,6 +215,10 @@ class QCLToolsWizard(QtGui.QWidget):
         self.stdAsFiles.setToolTip('Check to make pipes communicate using files instead of strings\nOnly useful when processing large files')
         self.stdAsFiles.setCheckable(True)
         self.toolBar.addAction(self.stdAsFiles)
+        self.pipeStdout = QtGui.QAction('pipe stdout', self)
+        self.pipeStdout.setToolTip('Check to stream a file stdout directly into the stdin of the next CLTools module\nOnly if stdout is a file and the only output; the module is then not cached and has no return code')
+        self.pipeStdout.setCheckable(True)
+        self.toolBar.addAction(self.pipeStdout)
 
         self.toolBar.addSeparator()
 
@@ -360,6 +364,7 @@ class QCLToolsWizard(QtGui.QWidget):
         self.argList = QtGui.QListWidget()
         self.layout().addWidget(self.argList)
         self.stdAsFiles.setChecked(False)
+        self.pipeStdout.setChecked(False)
         self.setTitle()
         self.generate_preview()
     
@@ -403,6 +408,8 @@ class QCLToolsWizard(QtGui.QWidget):
                                 'env_port' in conf['options'])
         self.stdAsFiles.setChecked('options' in conf and
                                    'std_using_files' in conf['options'])
+        self.pipeStdout.setChecked('options' in conf and
+                                   'pipe_stdout' in conf['options'])
         self.envOption = conf['options']['env'] \
                  if ('options' in conf and 'env' in conf['options']) else None
         self.conf = conf
@@ -430,6 +437,8 @@ class QCLToolsWizard(QtGui.QWidget):
         options = {}
         if self.stdAsFiles.isChecked():
             options['std_using_files'] = ''
+        if self.pipeStdout.isChecked():
+            options['pipe_stdout'] = ''
         if self.envPort.isChecked():
             options['env_port'] = ''
         if self.envOption:
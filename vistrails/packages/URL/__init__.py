@@ -43,4 +43,11 @@ way, files that haven't been changed do not need to be downloaded again. The
 check is performed efficiently using HTTP headers.
 """
 
+from vistrails.core.configuration import ConfigurationObject
+
 from identifiers import *
+
+# cacheSize is in MB, 0 for no limit
+configuration = ConfigurationObject(cacheSize=0,
+                                    maxDownloads=8,
+                                    maxDownloadsPerHost=4)
@@ -0,0 +1,783 @@
+###############################################################################
+##
+## Copyright (C) 2011-2014, NYU-Poly.
+## Copyright (C) 2006-2011, University of Utah. 
+## All rights reserved.
+## Contact: contact@vistrails.org
+##
+## This file is part of VisTrails.
+##
+## "Redistribution and use in source and binary forms, with or without 
+## modification, are permitted provided that the following conditions are met:
+##
+##  - Redistributions of source code must retain the above copyright notice, 
+##    this list of conditions and the following disclaimer.
+##  - Redistributions in binary form must reproduce the above copyright 
+##    notice, this list of conditions and the following disclaimer in the 
+##    documentation and/or other materials provided with the distribution.
+##  - Neither the name of the University of Utah nor the names of its 
+##    contributors may be used to endorse or promote products derived from 
+##    this software without specific prior written permission.
+##
+## THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+## AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, 
+## THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR 
+## PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR 
+## CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, 
+## EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, 
+## PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; 
+## OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, 
+## WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR 
+## OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF 
+## ADVISED OF THE POSSIBILITY OF SUCH DAMAGE."
+##
+###############################################################################
+"""Download manager shared by the modules of the URL package.
+
+DownloadManager keeps HTTP/1.1 connections open between requests, one pool
+per host, and limits the number of concurrent requests to the same host.
+Files are written to a '.part' file which is renamed once complete; if a
+download is interrupted, the next attempt resumes it with a Range request.
+
+Downloaded files are kept in the cache directory, named after their URL,
+with their ETag. Cached files are revalidated with conditional requests, and
+the least recently used ones are removed once the cache exceeds its size.
+"""
+
+import email.utils
+import errno
+import httplib
+from multiprocessing.pool import ThreadPool
+import os
+import socket
+import ssl
+import threading
+import time
+import urllib
+import urlparse
+
+from vistrails.core import debug
+
+
+BUFFER_SIZE = 1 << 20
+MAX_REDIRECTS = 10
+
+SIDECAR_SUFFIXES = ('.etag', '.part', '.part.validator')
+
+
+class DownloadError(Exception):
+    """Raised when a URL can't be retrieved.
+    """
+    def __init__(self, url, msg, status=None):
+        Exception.__init__(self, msg)
+        self.url = url
+        self.status = status
+
+
+class Response(object):
+    """A response from a pooled connection.
+
+    Closing the response returns its connection to the pool if the body was
+    read entirely and the server allows it, and frees the host's slot.
+    """
+    def __init__(self, manager, key, conn, response, url):
+        self._manager = manager
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self.url = url
+        self.status = response.status
+        self.msg = response.msg
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def read(self, amt=None):
+        return self._response.read(amt)
+
+    def discard(self):
+        """Closes the response without using its body.
+
+        The body is only read if that allows the connection to be reused.
+        """
+        if not self._response.will_close:
+            self._response.read()
+        self.close()
+
+    def close(self):
+        if self._conn is None:
+            return
+        response, conn = self._response, self._conn
+        self._conn = None
+        if response.isclosed() and not response.will_close:
+            self._manager._release(self._key, conn)
+        else:
+            response.close()
+            conn.close()
+            self._manager._release(self._key, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class DownloadManager(object):
+    """Downloads files over HTTP(S) with pooled connections.
+
+    directory is where fetch() keeps downloaded files, and max_size the size
+    of that cache in bytes (None for no limit). Files returned by fetch() are
+    never evicted by this manager, since modules and cached results may
+    still refer to them. per_host is the maximum
+    number of simultaneous requests to a host, and threads the number of
+    downloads run at once by map().
+    """
+    def __init__(self, directory=None, max_size=None, per_host=4,
+                 threads=8, timeout=60):
+        self.directory = directory
+        self.max_size = max_size
+        self.per_host = per_host
+        self.threads = threads
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._slots = {}
+        self._file_locks = {}
+        self._handed_out = set()
+        self._pool = None
+        self.connections = 0
+
+    # Connections
+
+    def _connection_key(self, url, insecure):
+        scheme, netloc = urlparse.urlsplit(url)[:2]
+        if scheme not in ('http', 'https'):
+            raise DownloadError(url, "Unsupported URL scheme %r" % scheme)
+        host, port = urllib.splitport(netloc.rsplit('@', 1)[-1])
+        if port:
+            port = int(port)
+        else:
+            port = (httplib.HTTPS_PORT if scheme == 'https'
+                    else httplib.HTTP_PORT)
+        return (scheme, host, port, bool(insecure) and scheme == 'https')
+
+    def _slot(self, key):
+        with self._lock:
+            try:
+                return self._slots[key]
+            except KeyError:
+                slot = self._slots[key] = threading.BoundedSemaphore(
+                        self.per_host)
+                return slot
+
+    def _proxy(self, scheme, host):
+        proxy = urllib.getproxies().get(scheme)
+        if not proxy or urllib.proxy_bypass(host):
+            return None
+        netloc = urlparse.urlsplit(proxy).netloc or proxy
+        host, port = urllib.splitport(netloc.rsplit('@', 1)[-1])
+        return host, int(port) if port else 8080
+
+    def _connect(self, key):
+        scheme, host, port, insecure = key
+        proxy = self._proxy(scheme, host)
+        if proxy is not None:
+            address = proxy
+        else:
+            address = (host, port)
+        if scheme == 'https':
+            conn = _https_connection(address, insecure, self.timeout)
+            if proxy is not None:
+                conn.set_tunnel(host, port)
+        else:
+            conn = httplib.HTTPConnection(address[0], address[1],
+                                          timeout=self.timeout)
+        # Plain HTTP through a proxy uses absolute URLs
+        conn.absolute_urls = proxy is not None and scheme == 'http'
+        with self._lock:
+            self.connections += 1
+        return conn
+
+    def _release(self, key, conn):
+        if conn is not None:
+            with self._lock:
+                self._idle.setdefault(key, []).append(conn)
+        self._slot(key).release()
+
+    def _request(self, key, url, headers):
+        """Sends a request, reusing an idle connection if possible.
+        """
+        with self._lock:
+            idle = self._idle.get(key)
+            conn = idle.pop() if idle else None
+        reused = conn is not None
+        if conn is None:
+            conn = self._connect(key)
+        if conn.absolute_urls:
+            path = url
+        else:
+            scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+            path = urlparse.urlunsplit(('', '', path or '/', query, ''))
+        try:
+            conn.request('GET', path, headers=headers)
+            return conn, conn.getresponse()
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            if not reused:
+                raise
+        # The server closed the kept-alive connection, try a new one
+        conn = self._connect(key)
+        try:
+            conn.request('GET', path, headers=headers)
+            return conn, conn.getresponse()
+        except:
+            conn.close()
+            raise
+
+    def open(self, url, headers=None, insecure=False):
+        """open(url: str, headers: dict, insecure: bool) -> Response
+
+        Sends a GET request, following redirections. Raises DownloadError
+        if the server returns an error. The response should be closed once
+        its body has been read.
+        """
+        headers = dict(headers or {})
+        headers.setdefault('User-Agent', 'VisTrails')
+        for i in xrange(MAX_REDIRECTS + 1):
+            key = self._connection_key(url, insecure)
+            slot = self._slot(key)
+            slot.acquire()
+            try:
+                conn, response = self._request(key, url, headers)
+            except (httplib.HTTPException, socket.error), e:
+                slot.release()
+                raise DownloadError(url, "Error retrieving URL: %s" %
+                                    debug.format_exception(e))
+            except:
+                slot.release()
+                raise
+            result = Response(self, key, conn, response, url)
+            if (response.status in (301, 302, 303, 307, 308) and
+                    response.getheader('Location')):
+                url = urlparse.urljoin(url, response.getheader('Location'))
+                headers.pop('Range', None)
+                headers.pop('If-Range', None)
+                result.discard()
+                continue
+            if response.status >= 400:
+                result.discard()
+                raise DownloadError(url, "HTTP error %d: %s" % (
+                                        response.status, response.reason),
+                                    response.status)
+            return result
+        raise DownloadError(url, "Too many redirections")
+
+    # Downloads
+
+    def _file_lock(self, filename):
+        with self._lock:
+            try:
+                return self._file_locks[filename]
+            except KeyError:
+                lock = self._file_locks[filename] = threading.Lock()
+                return lock
+
+    def download(self, url, target, headers=None, insecure=False,
+                 progress=None):
+        """download(url: str, target: str, headers: dict, insecure: bool,
+                    progress: callable) -> Response or None
+
+        Downloads a URL to a file. The response is returned, already closed,
+        or None if the server answered 304 Not Modified to a conditional
+        request in headers. A previous partial download of the same target
+        is resumed if the server still has the same version. progress is
+        called with the fraction downloaded, when the size is known.
+        """
+        with self._file_lock(target):
+            return self._download(url, target, headers, insecure, progress)
+
+    def _download(self, url, target, headers, insecure, progress):
+        headers = dict(headers or {})
+        partial = target + '.part'
+        validator_file = partial + '.validator'
+        offset = 0
+        try:
+            with open(validator_file, 'rb') as fp:
+                validator = fp.read()
+            offset = os.path.getsize(partial)
+        except (IOError, OSError):
+            validator = None
+        if validator and offset > 0:
+            headers['Range'] = 'bytes=%d-' % offset
+            headers['If-Range'] = validator
+        else:
+            offset = 0
+
+        try:
+            response = self.open(url, headers, insecure)
+        except DownloadError, e:
+            if e.status != 416 or not offset:
+                raise
+            # Range not satisfiable: start over
+            _remove(partial, validator_file)
+            del headers['Range'], headers['If-Range']
+            offset = 0
+            response = self.open(url, headers, insecure)
+        try:
+            if response.status == 304:
+                response.read()
+                _remove(partial, validator_file)
+                return None
+            if response.status == 206 and offset > 0:
+                start = _content_range_start(
+                        response.getheader('Content-Range'))
+                if start != offset:
+                    raise DownloadError(url, "Invalid Content-Range")
+                mode = 'ab'
+            else:
+                offset = 0
+                mode = 'wb'
+            validator = (response.getheader('ETag') or
+                         response.getheader('Last-Modified'))
+            if validator and not validator.startswith('W/'):
+                with open(validator_file, 'wb') as fp:
+                    fp.write(validator)
+            else:
+                _remove(validator_file)
+
+            with open(partial, mode) as fp:
+                _copy_body(response, fp, offset, progress)
+        finally:
+            response.close()
+        _rename(partial, target)
+        _remove(validator_file)
+        return response
+
+    def save(self, response, target, progress=None):
+        """save(response: Response, target: str, progress: callable) -> None
+
+        Writes the body of a response to a file, and closes the response.
+        """
+        partial = target + '.part'
+        try:
+            with open(partial, 'wb') as fp:
+                _copy_body(response, fp, 0, progress)
+        finally:
+            response.close()
+        _rename(partial, target)
+
+    def map(self, function, items):
+        """Calls function on each of the items using the download threads.
+        """
+        if self.threads <= 1 or len(items) <= 1:
+            return map(function, items)
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.threads)
+        return self._pool.map(function, items, chunksize=1)
+
+    # Cache
+
+    def cache_filename(self, url):
+        return os.path.join(self.directory, urllib.quote_plus(url))
+
+    def fetch(self, url, insecure=False, progress=None):
+        """fetch(url: str, insecure: bool, progress: callable) -> str
+
+        Returns the path of the cached copy of a URL, downloading it if it
+        is missing or if the server has a newer version.
+        """
+        filename = self.cache_filename(url)
+        etag_file = filename + '.etag'
+        headers = {}
+        if os.path.isfile(filename):
+            try:
+                with open(etag_file, 'rb') as fp:
+                    headers['If-None-Match'] = fp.read()
+            except IOError:
+                pass
+            headers['If-Modified-Since'] = email.utils.formatdate(
+                    os.path.getmtime(filename), usegmt=True)
+        response = self.download(url, filename, headers, insecure, progress)
+        if response is not None:
+            etag = response.getheader('ETag')
+            if etag:
+                with open(etag_file, 'wb') as fp:
+                    fp.write(etag)
+            else:
+                _remove(etag_file)
+        self.touch(filename)
+        with self._lock:
+            self._handed_out.add(filename)
+        if response is not None:
+            self.collect()
+        return filename
+
+    def fetch_many(self, urls, insecure=False):
+        """Fetches several URLs concurrently, returning their cached paths.
+        """
+        return self.map(lambda url: self.fetch(url, insecure), urls)
+
+    def touch(self, filename):
+        """Marks a cached file as used, keeping its modification time.
+        """
+        try:
+            os.utime(filename, (time.time(), os.path.getmtime(filename)))
+        except OSError:
+            pass
+
+    def _entries(self):
+        """Lists the cached files as (last use, size, filename) tuples.
+        """
+        entries = {}
+        for name in os.listdir(self.directory):
+            filename = os.path.join(self.directory, name)
+            for suffix in SIDECAR_SUFFIXES:
+                if name.endswith(suffix):
+                    filename = filename[:-len(suffix)]
+                    break
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            atime, size = entries.get(filename, (0, 0))
+            if name == os.path.basename(filename):
+                atime = st.st_atime
+            entries[filename] = (atime, size + st.st_size)
+        return [(atime, size, filename)
+                for filename, (atime, size) in entries.iteritems()]
+
+    def size(self):
+        """Returns the total size of the cache in bytes.
+        """
+        return sum(size for atime, size, filename in self._entries())
+
+    def collect(self):
+        """collect() -> int
+
+        Removes the least recently used files until the cache fits in
+        max_size, except for those fetch() returned during this session.
+        Returns the number of files removed.
+        """
+        if self.max_size is None or self.directory is None:
+            return 0
+        entries = self._entries()
+        total = sum(size for atime, size, filename in entries)
+        with self._lock:
+            handed_out = set(self._handed_out)
+        removed = 0
+        for atime, size, filename in sorted(entries):
+            if total <= self.max_size:
+                break
+            if filename in handed_out:
+                continue
+            lock = self._file_lock(filename)
+            if not lock.acquire(False):
+                continue # being downloaded
+            try:
+                _remove(filename, *[filename + suffix
+                                    for suffix in SIDECAR_SUFFIXES])
+            finally:
+                lock.release()
+            total -= size
+            removed += 1
+        return removed
+
+    def close(self):
+        """Closes the idle connections and stops the download threads.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+            pool, self._pool = self._pool, None
+        for conns in idle.itervalues():
+            for conn in conns:
+                conn.close()
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def _copy_body(response, fp, offset, progress):
+    """Writes the body of a response to a file opened at offset.
+    """
+    total = response.getheader('Content-Length')
+    try:
+        total = int(total) + offset
+    except (TypeError, ValueError):
+        total = None
+    size = offset
+    try:
+        while True:
+            if progress is not None and total:
+                progress(size * 1.0 / total)
+            chunk = response.read(BUFFER_SIZE)
+            if not chunk:
+                break
+            fp.write(chunk)
+            size += len(chunk)
+    except (httplib.HTTPException, socket.error), e:
+        raise DownloadError(response.url, "Error retrieving URL: %s" %
+                            debug.format_exception(e))
+    if total is not None and size < total:
+        raise DownloadError(response.url, "Connection closed after %d of %d "
+                                          "bytes" % (size, total))
+
+
+def _rename(source, target):
+    if os.name == 'nt' and os.path.exists(target):
+        os.remove(target)
+    os.rename(source, target)
+
+
+def _remove(*filenames):
+    for filename in filenames:
+        try:
+            os.remove(filename)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+def _content_range_start(content_range):
+    # Content-Range: bytes 100-199/200
+    try:
+        unit, rng = content_range.split(' ', 1)
+        return int(rng.split('-', 1)[0])
+    except (AttributeError, ValueError):
+        return None
+
+
+_secure_connection_warned = False
+
+def _https_connection(address, insecure, timeout):
+    global _secure_connection_warned
+    kwargs = {}
+    if not insecure:
+        try:
+            import certifi
+            from .https import CertValidatingHTTPSConnection
+        except ImportError:
+            if not _secure_connection_warned:
+                debug.warning("Unable to use secure SSL requests -- please "
+                              "install certifi and ssl_match_hostname")
+                _secure_connection_warned = True
+        else:
+            return CertValidatingHTTPSConnection(address[0], address[1],
+                                                 ca_certs=certifi.where(),
+                                                 timeout=timeout)
+    if insecure and hasattr(ssl, '_create_unverified_context'):
+        kwargs['context'] = ssl._create_unverified_context()
+    return httplib.HTTPSConnection(address[0], address[1], timeout=timeout,
+                                   **kwargs)
+
+
+_manager = None
+
+def get_download_manager():
+    """get_download_manager() -> DownloadManager
+
+    Returns the manager shared by the URL package, set by initialize().
+    """
+    global _manager
+    if _manager is None:
+        _manager = DownloadManager()
+    return _manager
+
+def set_download_manager(manager):
+    global _manager
+    if _manager is not None and _manager is not manager:
+        _manager.close()
+    _manager = manager
+
+
+###############################################################################
+
+import shutil
+import tempfile
+import unittest
+
+
+class TestDownloadManager(unittest.TestCase):
+    """Tests the manager against a local HTTP server.
+    """
+    @classmethod
+    def setUpClass(cls):
+        import BaseHTTPServer
+        import hashlib
+        import SimpleHTTPServer
+        import SocketServer
+
+        cls.root = tempfile.mkdtemp(prefix='vt_http_root_')
+        root = cls.root
+        cls.requests = requests = []
+        cls.server_connections = connections = []
+
+        class Handler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                SimpleHTTPServer.SimpleHTTPRequestHandler.setup(self)
+                connections.append(self.client_address)
+
+            def translate_path(self, path):
+                path = urllib.unquote(path.split('?', 1)[0])
+                return os.path.join(root, *path.strip('/').split('/'))
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                requests.append((self.path, dict(self.headers)))
+                path = self.translate_path(self.path)
+                if os.path.isdir(path):
+                    f = self.send_head()
+                    if f:
+                        self.copyfile(f, self.wfile)
+                        f.close()
+                    return
+                if not os.path.isfile(path):
+                    self.send_error(404)
+                    return
+                with open(path, 'rb') as fp:
+                    data = fp.read()
+                etag = '"%s"' % hashlib.md5(data).hexdigest()
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                start = 0
+                rng = self.headers.get('Range')
+                if rng and self.headers.get('If-Range') in (None, etag):
+                    start = int(rng[len('bytes='):].split('-')[0])
+                    self.send_response(206)
+                    self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                                     start, len(data) - 1, len(data)))
+                else:
+                    self.send_response(200)
+                self.send_header('Content-Type', self.guess_type(path))
+                self.send_header('Content-Length', str(len(data) - start))
+                self.send_header('ETag', etag)
+                self.end_headers()
+                self.wfile.write(data[start:])
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        cls.server = Server(('127.0.0.1', 0), Handler)
+        cls.url = 'http://127.0.0.1:%d' % cls.server.server_address[1]
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.setDaemon(True)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        shutil.rmtree(cls.root)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='vt_http_cache_')
+        self.manager = DownloadManager(self.directory)
+        del self.requests[:]
+        del self.server_connections[:]
+
+    def tearDown(self):
+        self.manager.close()
+        shutil.rmtree(self.directory)
+
+    def publish(self, name, data):
+        filename = os.path.join(self.root, *name.split('/'))
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename, 'wb') as fp:
+            fp.write(data)
+
+    def read(self, filename):
+        with open(filename, 'rb') as fp:
+            return fp.read()
+
+    def test_fetch(self):
+        self.publish('a.txt', 'first version')
+        url = self.url + '/a.txt'
+        filename = self.manager.fetch(url)
+        self.assertEqual(self.read(filename), 'first version')
+        self.assertEqual(self.manager.fetch(url), filename)
+        self.assertEqual(self.requests[-1][1]['if-none-match'],
+                         self.read(filename + '.etag'))
+        self.publish('a.txt', 'second version')
+        self.assertEqual(self.read(self.manager.fetch(url)),
+                         'second version')
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         [os.path.basename(filename),
+                          os.path.basename(filename) + '.etag'])
+        # All three requests used the same connection
+        self.assertEqual(len(self.server_connections), 1)
+        self.assertEqual(self.manager.connections, 1)
+        self.assertRaises(DownloadError, self.manager.fetch,
+                          self.url + '/missing')
+
+    def test_resume(self):
+        import hashlib
+        data = ''.join(chr(i % 256) for i in xrange(100000))
+        self.publish('b.bin', data)
+        url = self.url + '/b.bin'
+        filename = self.manager.cache_filename(url)
+        with open(filename + '.part', 'wb') as fp:
+            fp.write(data[:30000])
+        with open(filename + '.part.validator', 'wb') as fp:
+            fp.write('"%s"' % hashlib.md5(data).hexdigest())
+        self.assertEqual(self.read(self.manager.fetch(url)), data)
+        self.assertEqual(self.requests[-1][1]['range'], 'bytes=30000-')
+        self.assertFalse(os.path.exists(filename + '.part'))
+
+        # Outdated partial download: the whole file is sent again
+        with open(filename + '.part', 'wb') as fp:
+            fp.write('garbage')
+        with open(filename + '.part.validator', 'wb') as fp:
+            fp.write('"outdated"')
+        os.remove(filename)
+        self.assertEqual(self.read(self.manager.fetch(url)), data)
+
+    def test_concurrent(self):
+        for i in xrange(12):
+            self.publish('c/%d' % i, str(i) * 1000)
+        self.manager.per_host = 2
+        urls = ['%s/c/%d' % (self.url, i) for i in xrange(12)]
+        filenames = self.manager.fetch_many(urls)
+        self.assertEqual([self.read(f) for f in filenames],
+                         [str(i) * 1000 for i in xrange(12)])
+        self.assertLessEqual(len(self.server_connections), 2)
+
+    def test_collect(self):
+        for name in 'def':
+            self.publish(name, name * 1000)
+        self.manager.max_size = 2500
+        urls = ['%s/%s' % (self.url, name) for name in 'def']
+        d, e = self.manager.fetch_many(urls[:2])
+        os.utime(d, (time.time() - 100, os.path.getmtime(d)))
+        # Files returned in this session are kept
+        f = self.manager.fetch(urls[2])
+        self.assertTrue(all(os.path.exists(n) for n in (d, e, f)))
+        # Another session evicts the least recently used ones
+        os.remove(f)
+        self.manager.close()
+        self.manager = DownloadManager(self.directory, 2500)
+        f = self.manager.fetch(urls[2])
+        self.assertFalse(os.path.exists(d))
+        self.assertTrue(os.path.exists(e) and os.path.exists(f))
+        self.assertLessEqual(self.manager.size(), 2500)
+
+    def test_directory(self):
+        from .http_directory import download_directory
+
+        self.publish('dir/a', 'aa\n')
+        self.publish('dir/bb', 'bb\n')
+        self.publish('dir/cc/d', 'dd\n')
+        target = os.path.join(self.directory, 'dir')
+        download_directory(self.url + '/dir/', target, manager=self.manager)
+        self.assertEqual(self.read(os.path.join(target, 'a')), 'aa\n')
+        self.assertEqual(self.read(os.path.join(target, 'bb')), 'bb\n')
+        self.assertEqual(self.read(os.path.join(target, 'cc', 'd')), 'dd\n')
+        self.assertEqual(sorted(os.listdir(target)), ['a', 'bb', 'cc'])
@@ -4,7 +4,7 @@ from HTMLParser import HTMLParser
 import os
 import re
 
-from .https_if_available import build_opener
+from .downloads import get_download_manager
 
 
 re_url = re.compile(r'^(([a-zA-Z_-]+)://([^/]+))(/.*)?$')
@@ -54,51 +54,62 @@ class ListingParser(HTMLParser):
                     break
 
 
-def download_directory(url, target, insecure=False):
-    def mkdir():
-        if not mkdir.done:
-            try:
-                os.mkdir(target)
-            except OSError:
-                pass
-            mkdir.done = True
-    mkdir.done = False
+def download_directory(url, target, insecure=False, manager=None):
+    """Downloads the files listed in an HTML index, recursively.
 
-    opener = build_opener(insecure=insecure)
-    response = opener.open(url)
+    The pages are requested one level at a time; the files and listings of
+    a level are downloaded concurrently by the manager.
+    """
+    if manager is None:
+        manager = get_download_manager()
 
-    if response.info().type == 'text/html':
-        contents = response.read()
+    def download(entry):
+        return _download_entry(manager, entry[0], entry[1], insecure)
 
-        parser = ListingParser(url)
-        parser.feed(contents)
-        for link in parser.links:
-            link = resolve_link(link, url)
-            if link[-1] == '/':
-                link = link[:-1]
-            if not link.startswith(url):
-                continue
-            name = link.rsplit('/', 1)[1]
-            if '?' in name:
-                continue
-            mkdir()
-            download_directory(link, os.path.join(target, name), insecure)
-        if not mkdir.done:
-            # We didn't find anything to write inside this directory
-            # Maybe it's a HTML file?
-            if url[-1] != '/':
-                end = target[-5:].lower()
-                if not (end.endswith('.htm') or end.endswith('.html')):
-                    target = target + '.html'
-                with open(target, 'wb') as fp:
-                    fp.write(contents)
-    else:
-        buffer_size = 4096
+    level = [(url, target)]
+    while level:
+        level = [child
+                 for children in manager.map(download, level)
+                 for child in children]
+
+
+def _download_entry(manager, url, target, insecure):
+    """Downloads a file, or reads a listing and returns its entries.
+    """
+    response = manager.open(url, insecure=insecure)
+    if response.msg.type != 'text/html':
+        manager.save(response, target)
+        return []
+
+    with response:
+        contents = response.read()
+    parser = ListingParser(url)
+    parser.feed(contents)
+    children = []
+    for link in parser.links:
+        link = resolve_link(link, url)
+        if link[-1] == '/':
+            link = link[:-1]
+        if not link.startswith(url):
+            continue
+        name = link.rsplit('/', 1)[1]
+        if '?' in name:
+            continue
+        children.append((link, os.path.join(target, name)))
+    if children:
+        try:
+            os.mkdir(target)
+        except OSError:
+            pass
+    elif url[-1] != '/':
+        # We didn't find anything to write inside this directory
+        # Maybe it's a HTML file?
+        end = target[-5:].lower()
+        if not (end.endswith('.htm') or end.endswith('.html')):
+            target = target + '.html'
         with open(target, 'wb') as fp:
-            chunk = response.read(buffer_size)
-            while chunk:
-                fp.write(chunk)
-                chunk = response.read(buffer_size)
+            fp.write(contents)
+    return children
 
 
 ###############################################################################
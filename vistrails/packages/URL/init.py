@@ -43,8 +43,6 @@ way, files that haven't been changed do not need to be downloaded again. The
 check is performed efficiently using HTTP headers.
 """
 
-from datetime import datetime
-import email.utils
 import hashlib
 import os
 import re
@@ -58,7 +56,7 @@ import vistrails.core.modules.basic_modules
 from vistrails.core.modules.basic_modules import PathObject
 import vistrails.core.modules.module_registry
 from vistrails.core.modules.vistrails_module import Module, ModuleError
-from vistrails.core.system import current_dot_vistrails, strptime
+from vistrails.core.system import current_dot_vistrails
 from vistrails.core.upgradeworkflow import UpgradeWorkflowHandler
 import vistrails.gui.repository
 from vistrails.gui.utils import show_warning
@@ -67,6 +65,8 @@ from vistrails.core.repository.poster.encode import multipart_encode
 from vistrails.core.repository.poster.streaminghttp import register_openers
 
 from .identifiers import identifier
+from .downloads import DownloadError, DownloadManager, \
+    get_download_manager, set_download_manager
 from .http_directory import download_directory
 from .https_if_available import build_opener
 
@@ -80,6 +80,7 @@ class Downloader(object):
     def __init__(self, url, module, insecure):
         self.url = url
         self.module = module
+        self.insecure = insecure
         self.opener = build_opener(insecure=insecure)
 
     def execute(self):
@@ -90,12 +91,9 @@ class Downloader(object):
         self.local_filename = os.path.join(package_directory,
                                            urllib.quote_plus(self.url))
 
-        # Before download
-        self.pre_download()
-
         # Send request
         try:
-            response = self.send_request()
+            response = self.opener.open(self.url)
         except urllib2.URLError, e:
             if self.is_in_local_cache:
                 debug.warning("A network error occurred. DownloadFile will "
@@ -105,142 +103,74 @@ class Downloader(object):
                 raise ModuleError(
                         self.module,
                         "Network error: %s" % debug.format_exception(e))
-        if response is None:
-            return self.local_filename
-
-        # Read response headers
-        self.size_header = None
-        if not self.read_headers(response):
-            return self.local_filename
 
         # Download
         self.download(response)
 
-        # Post download
-        self.post_download(response)
-
         return self.local_filename
 
-    def pre_download(self):
-        pass
-
-    def send_request(self):
-        return self.opener.open(self.url)
-
-    def read_headers(self, response):
-        return True
-
     def download(self, response):
+        partial = self.local_filename + '.part'
         try:
+            try:
+                size = int(response.headers['content-length'])
+            except (KeyError, ValueError):
+                size = None
             dl_size = 0
-            CHUNKSIZE = 4096
-            f2 = open(self.local_filename, 'wb')
-            while True:
-                if self.size_header is not None:
-                    self.module.logging.update_progress(
-                            self.module,
-                            dl_size*1.0/self.size_header)
-                chunk = response.read(CHUNKSIZE)
-                if not chunk:
-                    break
-                dl_size += len(chunk)
-                f2.write(chunk)
-            f2.close()
+            with open(partial, 'wb') as f2:
+                while True:
+                    if size:
+                        self.module.logging.update_progress(
+                                self.module,
+                                dl_size*1.0/size)
+                    chunk = response.read(1 << 20)
+                    if not chunk:
+                        break
+                    dl_size += len(chunk)
+                    f2.write(chunk)
             response.close()
+            if os.name == 'nt' and self.is_in_local_cache:
+                os.unlink(self.local_filename)
+            os.rename(partial, self.local_filename)
 
         except Exception, e:
             try:
-                os.unlink(self.local_filename)
+                os.unlink(partial)
             except OSError:
                 pass
             raise ModuleError(
                     self.module,
                     "Error retrieving URL: %s" % debug.format_exception(e))
 
-    def post_download(self, response):
-        pass
-
     @property
     def is_in_local_cache(self):
         return os.path.isfile(self.local_filename)
 
 
 class HTTPDownloader(Downloader):
-    def pre_download(self):
-        # Get ETag from disk
-        try:
-            with open(self.local_filename + '.etag') as etag_file:
-                self.etag = etag_file.read()
-        except IOError:
-            self.etag = None
+    """ HTTP downloader: uses the package's download manager.
 
-    def send_request(self):
-        try:
-            request = urllib2.Request(self.url)
-            if self.etag is not None:
-                request.add_header(
-                    'If-None-Match',
-                    self.etag)
-            try:
-                mtime = email.utils.formatdate(
-                        os.path.getmtime(self.local_filename),
-                        usegmt=True)
-                request.add_header(
-                    'If-Modified-Since',
-                    mtime)
-            except OSError:
-                pass
-            return self.opener.open(request)
-        except urllib2.HTTPError, e:
-            if e.code == 304:
-                # Not modified
-                return None
-            raise
-
-    def read_headers(self, response):
-        try:
-            self.mod_header = response.headers['last-modified']
-        except KeyError:
-            self.mod_header = None
-        try:
-            size_header = response.headers['content-length']
-            if not size_header:
-                raise ValueError
-            self.size_header = int(size_header)
-        except (KeyError, ValueError):
-            self.size_header = None
-        return True
+    The cached file is revalidated using its ETag and modification time;
+    interrupted downloads are resumed.
+    """
+    def execute(self):
+        manager = get_download_manager()
+        self.local_filename = manager.cache_filename(self.url)
 
-    def _is_outdated(self):
-        local_time = datetime.utcfromtimestamp(
-                os.path.getmtime(self.local_filename))
-        try:
-            remote_time = strptime(self.mod_header,
-                                   "%a, %d %b %Y %H:%M:%S %Z")
-        except ValueError:
-            try:
-                remote_time = strptime(self.mod_header,
-                                       "%a, %d %B %Y %H:%M:%S %Z")
-            except ValueError:
-                # unable to parse last-modified header, download file again
-                debug.warning("Unable to parse Last-Modified header, "
-                              "downloading file")
-                return True
-        return remote_time > local_time
+        def progress(fraction):
+            self.module.logging.update_progress(self.module, fraction)
 
-    def download(self, response):
-        if (not self.is_in_local_cache or
-                not self.mod_header or self._is_outdated()):
-            Downloader.download(self, response)
-
-    def post_download(self, response):
         try:
-            etag = response.headers['ETag']
-        except KeyError:
-            pass
-        else:
-            with open(self.local_filename + '.etag', 'w') as etag_file:
-                etag = etag_file.write(etag)
+            return manager.fetch(self.url, self.insecure, progress)
+        except (DownloadError, EnvironmentError), e:
+            if self.is_in_local_cache:
+                debug.warning("A network error occurred. DownloadFile will "
+                              "use a cached version of the file")
+                return self.local_filename
+            else:
+                raise ModuleError(
+                        self.module,
+                        "Network error: %s" % debug.format_exception(e))
 
 
 class SSHDownloader(object):
@@ -524,8 +454,9 @@ class RepoSync(Module):
                 if not self._file_is_in_local_cache(local_filename):
                     # file not in cache, download.
                     try:
-                        urllib.urlretrieve(self.url, local_filename)
-                    except IOError, e:
+                        get_download_manager().download(self.url,
+                                                        local_filename)
+                    except (DownloadError, IOError), e:
                         raise ModuleError(self, ("Invalid URL: %s" % e))
                 out_file = PathObject(local_filename)
                 debug.warning('RepoSync is using repository data')
@@ -648,6 +579,18 @@ def initialize(*args, **keywords):
             raise RuntimeError("Failed to create cache directory: %s" %
                                package_directory, e)
 
+    cache_size = None
+    if configuration.check('cacheSize'):
+        cache_size = configuration.cacheSize * 1024 * 1024
+    set_download_manager(DownloadManager(
+            package_directory, cache_size,
+            per_host=configuration.maxDownloadsPerHost,
+            threads=configuration.maxDownloads))
+
+
+def finalize():
+    set_download_manager(None)
+
 
 def handle_module_upgrade_request(controller, module_id, pipeline):
     module_remap = {
@@ -35,14 +35,19 @@
 from vistrails.core import debug
 from vistrails.core.modules.basic_modules import create_constant, get_module
 from vistrails.core.modules.vistrails_module import Module, ModuleError, \
-    ModuleConnector, InvalidOutput, ModuleSuspended, ModuleWasSuspended
+    ModuleErrors, ModuleConnector, InvalidOutput, ModuleSuspended, \
+    ModuleWasSuspended
 from vistrails.core.modules.basic_modules import Boolean, String, Integer, \
     Float, Constant, List
+from vistrails.core.interpreter.scheduler import SharedLogging
 from vistrails.core.modules.module_registry import get_module_registry
 from vistrails.core.vistrail.port_spec import PortSpec
 
 import copy
 from itertools import izip
+from multiprocessing.pool import ThreadPool
+import Queue
+import sys
 
 ###############################################################################
 ## Fold Operator
@@ -144,6 +149,9 @@ class FoldWithModule(Fold):
         nameInput = self.get_input('InputPort')
         nameOutput = self.get_input('OutputPort')
         rawInputList = self.get_input('InputList')
+        maxWorkers = self.get_input('MaxWorkers')
+        if maxWorkers < 1:
+            raise ModuleError(self, "MaxWorkers should be at least 1")
 
         # Create inputList to always have iterable elements
         # to simplify code
@@ -153,8 +161,30 @@ class FoldWithModule(Fold):
         else:
             element_is_iter = True
             inputList = rawInputList
-        suspended = []
         loop = self.logging.begin_loop_execution(self, len(inputList))
+        if maxWorkers > 1 and len(inputList) > 1:
+            suspended = self.updateFunctionPortThreaded(
+                    maxWorkers, loop, nameInput, nameOutput, inputList,
+                    element_is_iter)
+        else:
+            suspended = self.updateFunctionPortSerial(
+                    loop, nameInput, nameOutput, inputList, element_is_iter)
+
+        if suspended:
+            raise ModuleSuspended(
+                    self,
+                    "function module suspended in %d/%d iterations" % (
+                            len(suspended), len(inputList)),
+                    children=suspended)
+        loop.end_loop_execution()
+
+    def updateFunctionPortSerial(self, loop, nameInput, nameOutput,
+                                 inputList, element_is_iter):
+        """Runs the function modules for each element in turn.
+
+        Returns the ModuleSuspended exceptions of the suspended elements.
+        """
+        suspended = []
         ## Update everything for each value inside the list
         for i, element in enumerate(inputList):
             self.logging.update_progress(self, float(i)/len(inputList))
@@ -163,19 +193,7 @@ class FoldWithModule(Fold):
             else:
                 self.element = element[0]
             do_operation = True
-            for connector in self.inputPorts.get('FunctionPort'):
-                module = copy.copy(connector.obj)
-
-                if not self.upToDate: # pragma: no branch
-                    ## Type checking
-                    if i == 0:
-                        self.typeChecking(module, nameInput, inputList)
-
-                    module.upToDate = False
-                    module.computed = False
-
-                    self.setInputValues(module, nameInput, element, i)
-
+            for module in self.functionModules(i, nameInput, inputList):
                 loop.begin_iteration(module, i)
 
                 try:
@@ -188,23 +206,153 @@ class FoldWithModule(Fold):
 
                 loop.end_iteration(module)
 
-                ## Getting the result from the output port
-                if nameOutput not in module.outputPorts:
-                    raise ModuleError(module,
-                                      'Invalid output port: %s' % nameOutput)
-                self.elementResult = module.get_output(nameOutput)
+                self.elementResult = self.functionOutput(module, nameOutput)
             if do_operation:
                 self.operation()
 
             self.logging.update_progress(self, i * 1.0 / len(inputList))
+        return suspended
 
-        if suspended:
-            raise ModuleSuspended(
-                    self,
-                    "function module suspended in %d/%d iterations" % (
-                            len(suspended), len(inputList)),
-                    children=suspended)
-        loop.end_loop_execution()
+    def updateFunctionPortThreaded(self, maxWorkers, loop, nameInput,
+                                   nameOutput, inputList, element_is_iter):
+        """Runs the function modules on a pool of threads.
+
+        At most maxWorkers elements are computed at the same time. The
+        modules are created on this thread, and operation() is applied here
+        in the order of the input list, as soon as the results of all the
+        previous elements are in. Returns the ModuleSuspended exceptions of
+        the suspended elements.
+        """
+        num_inputs = len(inputList)
+        events = Queue.Queue()
+        shared = SharedLogging(self.logging)
+        logging = shared.logging
+        worker_loop = shared.wrap(loop)
+        pool = ThreadPool(maxWorkers)
+
+        def run(i, modules):
+            results = []
+            for module in modules:
+                worker_loop.begin_iteration(module, i)
+                try:
+                    module.update()
+                except ModuleSuspended:
+                    results.append(sys.exc_info())
+                    worker_loop.end_iteration(module)
+                    continue
+                except BaseException:
+                    results.append(sys.exc_info())
+                    break
+                worker_loop.end_iteration(module)
+                results.append(None)
+            return i, results
+
+        running = {}
+        done = {}
+        suspended = []
+        errors = []
+        unexpected = None
+        next_i = 0
+        next_operation = 0
+        try:
+            while running or (next_i < num_inputs and
+                              not errors and unexpected is None):
+                while (len(running) < maxWorkers and next_i < num_inputs and
+                        not errors and unexpected is None):
+                    modules = self.functionModules(next_i, nameInput,
+                                                   inputList)
+                    for module in modules:
+                        module.logging = logging
+                    pool.apply_async(run, (next_i, modules),
+                                     callback=events.put)
+                    running[next_i] = modules
+                    next_i += 1
+
+                try:
+                    i, results = events.get(timeout=0.05)
+                except Queue.Empty:
+                    shared.flush()
+                    continue
+                modules = running.pop(i)
+                for module in modules:
+                    module.logging = self.logging
+                for exc_info in results:
+                    if exc_info is None:
+                        continue
+                    elif isinstance(exc_info[1], ModuleSuspended):
+                        suspended.append(exc_info[1])
+                    elif isinstance(exc_info[1], ModuleError):
+                        exc_info[1].loop_iteration = i
+                        errors.append(exc_info[1])
+                    elif unexpected is None:
+                        unexpected = exc_info
+                done[i] = modules, results
+
+                # Fold the elements that are ready, in order
+                while (next_operation in done and
+                        not errors and unexpected is None):
+                    modules, results = done.pop(next_operation)
+                    element = inputList[next_operation]
+                    if element_is_iter:
+                        self.element = element
+                    else:
+                        self.element = element[0]
+                    if any(exc_info is not None for exc_info in results):
+                        next_operation += 1
+                        continue
+                    for module in modules:
+                        self.elementResult = self.functionOutput(module,
+                                                                 nameOutput)
+                    self.operation()
+                    next_operation += 1
+                    logging.update_progress(
+                            self, next_operation * 1.0 / num_inputs)
+            shared.flush()
+        finally:
+            pool.close()
+            pool.join()
+            for modules in running.itervalues():
+                for module in modules:
+                    module.logging = self.logging
+            shared.close()
+
+        if unexpected is not None:
+            raise unexpected[0], unexpected[1], unexpected[2]
+        if len(errors) == 1:
+            raise errors[0]
+        elif errors:
+            errors.sort(key=lambda e: e.loop_iteration)
+            raise ModuleErrors(errors)
+        return suspended
+
+    def functionModules(self, i, nameInput, inputList):
+        """Returns the copies of the modules connected to the FunctionPort
+        port that compute the i-th element of inputList.
+        """
+        modules = []
+        for connector in self.inputPorts.get('FunctionPort'):
+            module = copy.copy(connector.obj)
+
+            if not self.upToDate: # pragma: no branch
+                ## Type checking
+                if i == 0:
+                    self.typeChecking(module, nameInput, inputList)
+
+                module.upToDate = False
+                module.computed = False
+
+                self.setInputValues(module, nameInput, inputList[i], i)
+            modules.append(module)
+        return modules
+
+    def functionOutput(self, module, nameOutput):
+        """Returns the value of a function module on the OutputPort port.
+        """
+        ## Getting the result from the output port
+        if nameOutput not in module.outputPorts:
+            raise ModuleError(module,
+                              'Invalid output port: %s' % nameOutput)
+        return module.get_output(nameOutput)
 
     def compute(self):
         """The compute method for the Fold."""
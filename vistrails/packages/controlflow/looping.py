@@ -1,21 +1,13 @@
-from base64 import b16encode, b16decode
 import copy
 from itertools import izip
 import time
 
+from vistrails.core.cache.hasher import Hasher
 from vistrails.core.modules.vistrails_module import Module, InvalidOutput, \
     ModuleError, ModuleConnector, ModuleSuspended, ModuleWasSuspended
-from vistrails.core.utils import xor, long2bytes
 
 from fold import create_constant
 
-try:
-    import hashlib
-    sha1_hash = hashlib.sha1
-except ImportError:
-    import sha
-    sha1_hash = sha.new
-
 
 class While(Module):
     """
@@ -114,11 +106,8 @@ class While(Module):
                                            module.output_specs.get(output_port, None))
                         module.set_input_port(input_port, new_connector)
                         # Affix a fake signature on the module
-                        inputPort_hash = sha1_hash()
-                        inputPort_hash.update(input_port)
-                        module.signature = b16encode(xor(
-                                b16decode(self.signature.upper()),
-                                inputPort_hash.digest()))
+                        module.signature = Hasher.iteration_signature(
+                                self.signature, input_port)
 
             loop.begin_iteration(module, i)
 
@@ -227,12 +216,8 @@ class For(Module):
                                                     'value')
                     module.set_input_port(name_input, new_connector)
                     # Affix a fake signature on the module
-                    inputPort_hash = sha1_hash()
-                    inputPort_hash.update(name_input)
-                    module.signature = b16encode(xor(
-                            b16decode(self.signature.upper()),
-                            long2bytes(i, 20),
-                            inputPort_hash.digest()))
+                    module.signature = Hasher.iteration_signature(
+                            self.signature, name_input, i)
 
             loop.begin_iteration(module, i)
 
@@ -201,6 +201,57 @@ class TestMap(unittest.TestCase):
                 ]))
         self.assertEqual(results, [[3, 11, 1]])
 
+    def test_parallel(self):
+        # Later elements finish first, the results are still in order
+        src = urllib2.quote('import time\n'
+                            'time.sleep(0.02 * (5 - i))\n'
+                            'o = i + 1')
+        with intercept_result(Map, 'Result') as results:
+            self.assertFalse(execute([
+                    ('PythonSource', 'org.vistrails.vistrails.basic', [
+                        ('source', [('String', src)]),
+                    ]),
+                    ('Map', 'org.vistrails.vistrails.control_flow', [
+                        ('InputPort', [('List', "['i']")]),
+                        ('OutputPort', [('String', 'o')]),
+                        ('InputList', [('List', '[0, 1, 2, 3, 4]')]),
+                        ('MaxWorkers', [('Integer', '3')]),
+                    ]),
+                ],
+                [
+                    (0, 'self', 1, 'FunctionPort'),
+                ],
+                add_port_specs=[
+                    (0, 'input', 'i',
+                     'org.vistrails.vistrails.basic:Integer'),
+                    (0, 'output', 'o',
+                     'org.vistrails.vistrails.basic:Integer'),
+                ]))
+        self.assertEqual(results, [[1, 2, 3, 4, 5]])
+
+    def test_parallel_error(self):
+        src = urllib2.quote('o = 10 / i')
+        self.assertEqual(execute([
+                ('PythonSource', 'org.vistrails.vistrails.basic', [
+                    ('source', [('String', src)]),
+                ]),
+                ('Map', 'org.vistrails.vistrails.control_flow', [
+                    ('InputPort', [('List', "['i']")]),
+                    ('OutputPort', [('String', 'o')]),
+                    ('InputList', [('List', '[1, 2, 0, 5]')]),
+                    ('MaxWorkers', [('Integer', '2')]),
+                ]),
+            ],
+            [
+                (0, 'self', 1, 'FunctionPort'),
+            ],
+            add_port_specs=[
+                (0, 'input', 'i',
+                 'org.vistrails.vistrails.basic:Integer'),
+                (0, 'output', 'o',
+                 'org.vistrails.vistrails.basic:Integer'),
+            ]).keys(), [0])
+
 
 class TestUtils(unittest.TestCase):
     def test_filter(self):
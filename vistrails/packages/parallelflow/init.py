@@ -1,8 +1,12 @@
 from vistrails.core.modules.vistrails_module import Module
 from vistrails.core.modules.module_registry import get_module_registry
-from vistrails.core.modules.basic_modules import List, String
+from vistrails.core.modules.basic_modules import Integer, List, String
 
-from engine_manager import EngineManager
+try:
+    from engine_manager import EngineManager
+except ImportError:
+    EngineManager = None
+from local import LocalEngine
 from map import Map
 
 
@@ -14,14 +18,24 @@ def initialize(*args,**keywords):
     reg.add_input_port(Map, 'InputList', (List, ''))
     reg.add_input_port(Map, 'InputPort', (List, ''))
     reg.add_input_port(Map, 'OutputPort', (String, ''))
+    reg.add_input_port(Map, 'Engine', (String, ''),
+                       optional=True, defaults="['auto']")
+    reg.add_input_port(Map, 'Processes', (Integer, ''), optional=True)
     reg.add_output_port(Map, 'Result', (List, ''))
 
 
 def finalize():
-    EngineManager.cleanup()
+    LocalEngine.cleanup()
+    if EngineManager is not None:
+        EngineManager.cleanup()
 
 
 def menu_items():
+    if EngineManager is None:
+        return (
+                ("Stop local worker processes",
+                 lambda: LocalEngine.cleanup()),
+        )
     return (
             ("Start new engine processes",
              lambda: EngineManager.start_engines()),
@@ -33,4 +47,6 @@ def menu_items():
              lambda: EngineManager.cleanup()),
             ("Request cluster shutdown",
              lambda: EngineManager.shutdown_cluster()),
+            ("Stop local worker processes",
+             lambda: LocalEngine.cleanup()),
     )
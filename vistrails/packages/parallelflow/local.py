@@ -0,0 +1,123 @@
+"""Local engine for the Map module, based on a multiprocessing pool.
+
+Unlike the IPython engines, this needs no external controller: the worker
+processes are forked from VisTrails and stay around between executions.
+Each worker keeps the subworkflows it already loaded and its own
+CachedInterpreter. A subworkflow is written once to the engine's directory,
+where each worker reads it the first time it sees it; the tasks only carry
+its key and the values of the elements.
+"""
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+from vistrails.core import debug
+from vistrails.core.configuration import get_vistrails_configuration
+from vistrails.core.db.io import unserialize
+from vistrails.core.interpreter.default import get_default_interpreter
+from vistrails.core.vistrail.pipeline import Pipeline
+
+
+###############################################################################
+# This runs in the worker processes
+
+_workflows = {}
+_directory = None
+
+def init_worker(directory):
+    """Initializes a worker process.
+
+    The process is a copy of VisTrails at the time the pool was created; the
+    interpreter's cache is cleared so that it only holds what this worker
+    computes. The execution log is always recorded, since it is sent back
+    with the results. The serialized subworkflows are read from 'directory'.
+    """
+    global _directory
+    _directory = directory
+    _workflows.clear()
+    setattr(get_vistrails_configuration(), 'executionLog', True)
+    get_default_interpreter().flush()
+
+def execute_element(key, functions, output_port):
+    """Executes a subworkflow on the values of one element.
+
+    The serialized workflow registered as 'key' is only loaded the first
+    time this worker sees it. 'functions' are the functions to add to its
+    module, as built by add_element_functions().
+    """
+    from .map import add_element_functions, execute_pipeline
+
+    try:
+        workflow = _workflows[key]
+    except KeyError:
+        with open(os.path.join(_directory, key), 'rb') as fp:
+            wf = fp.read()
+        workflow = _workflows[key] = unserialize(wf, Pipeline)
+    workflow = workflow.do_copy()
+    module, = workflow.module_list
+    add_element_functions(module, functions)
+    return execute_pipeline(workflow, output_port)
+
+def _execute_element(args):
+    return execute_element(*args)
+
+###############################################################################
+
+class LocalEngine(object):
+    """Manages the pool of local worker processes.
+    """
+    def __init__(self):
+        self._pool = None
+        self._processes = None
+        self._directory = None
+
+    def pool(self, processes=None):
+        """Returns the pool, starting it with 'processes' workers if needed.
+
+        If processes is None, one worker is started per CPU.
+        """
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        if self._pool is not None and self._processes != processes:
+            self.cleanup()
+        if self._pool is None:
+            debug.log("parallelflow: starting %d local workers" % processes)
+            self._directory = tempfile.mkdtemp(prefix='vt_parallelflow_')
+            self._pool = multiprocessing.Pool(processes,
+                                              initializer=init_worker,
+                                              initargs=(self._directory,))
+            self._processes = processes
+        return self._pool
+
+    def map(self, key, wf, elements, output_port, processes=None):
+        """Executes the workflow for each element's functions, in order.
+
+        The serialized workflow 'wf' is only written the first time 'key' is
+        used with this pool.
+        """
+        pool = self.pool(processes)
+        filename = os.path.join(self._directory, key)
+        if not os.path.exists(filename):
+            with open(filename, 'wb') as fp:
+                fp.write(wf)
+        return pool.map(_execute_element,
+                        [(key, functions, output_port)
+                         for functions in elements],
+                        chunksize=1)
+
+    def cleanup(self):
+        """Terminates the worker processes.
+        """
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            shutil.rmtree(self._directory, ignore_errors=True)
+            debug.log("parallelflow: %d local workers terminated" %
+                      self._processes)
+            self._pool = None
+            self._processes = None
+            self._directory = None
+
+LocalEngine = LocalEngine()
@@ -11,13 +11,13 @@ from vistrails.core.vistrail.group import Group
 from vistrails.core.vistrail.module_function import ModuleFunction
 from vistrails.core.vistrail.module_param import ModuleParam
 from vistrails.core.vistrail.vistrail import Vistrail
-from vistrails.core.db.locator import XMLFileLocator
 from vistrails.core.vistrail.controller import VistrailController
 from vistrails.core.interpreter.default import get_default_interpreter
 from vistrails.core.db.io import serialize, unserialize
 from vistrails.core.log.module_exec import ModuleExec
 from vistrails.core.log.group_exec import GroupExec
 from vistrails.core.log.machine import Machine
+from vistrails.core.log.controller import DummyLogController
 from vistrails.core.utils import xor, long2bytes
 from vistrails.db.domain import IdScope
 
@@ -25,14 +25,17 @@ from base64 import b16encode, b16decode
 import copy
 import inspect
 from itertools import izip
-import os
 import re
 import sys
-import tempfile
 
-from IPython.parallel.error import CompositeError
+try:
+    from IPython.parallel.error import CompositeError
+except ImportError:
+    class CompositeError(Exception):
+        """Never raised, IPython is not available."""
 
 from .api import get_client
+from .local import LocalEngine
 
 try:
     import hashlib
@@ -50,94 +53,117 @@ except ImportError:
 # It returns the corresponding computed outputs and the execution log
 #
 def execute_wf(wf, output_port):
-    # Save the workflow in a temporary file
-    temp_wf_fd, temp_wf = tempfile.mkstemp()
+    # Clean the cache
+    interpreter = get_default_interpreter()
+    interpreter.flush()
 
-    try:
-        f = open(temp_wf, 'w')
-        f.write(wf)
-        f.close()
-        os.close(temp_wf_fd)
-
-        # Clean the cache
-        interpreter = get_default_interpreter()
-        interpreter.flush()
-
-        # Load the Pipeline from the temporary file
-        vistrail = Vistrail()
-        locator = XMLFileLocator(temp_wf)
-        workflow = locator.load(Pipeline)
-
-        # Build a Vistrail from this single Pipeline
-        action_list = []
-        for module in workflow.module_list:
-            action_list.append(('add', module))
-        for connection in workflow.connection_list:
-            action_list.append(('add', connection))
-        action = vistrails.core.db.action.create_action(action_list)
-
-        vistrail.add_action(action, 0L)
-        vistrail.update_id_scope()
-        tag = 'parallel flow'
-        vistrail.addTag(tag, action.id)
-
-        # Build a controller and execute
-        controller = VistrailController()
-        controller.set_vistrail(vistrail, None)
-        controller.change_selected_version(vistrail.get_version_number(tag))
-        execution = controller.execute_current_workflow(
-                custom_aliases=None,
-                custom_params=None,
-                extra_info=None,
-                reason='API Pipeline Execution')
-
-        # Build a list of errors
-        errors = []
-        pipeline = vistrail.getPipeline(tag)
-        execution_errors = execution[0][0].errors
-        if execution_errors:
-            for key in execution_errors:
-                module = pipeline.modules[key]
-                msg = '%s: %s' %(module.name, execution_errors[key])
-                errors.append(msg)
+    # Load the Pipeline from its serialization
+    workflow = unserialize(wf, Pipeline)
+
+    return execute_pipeline(workflow, output_port)
 
-        # Get the execution log from the controller
+###############################################################################
+# Executes a single-module Pipeline, in an IPython engine or a local worker
+#
+def execute_pipeline(workflow, output_port):
+    # Build a Vistrail from this single Pipeline
+    vistrail = Vistrail()
+    action_list = []
+    for module in workflow.module_list:
+        action_list.append(('add', module))
+    for connection in workflow.connection_list:
+        action_list.append(('add', connection))
+    action = vistrails.core.db.action.create_action(action_list)
+
+    vistrail.add_action(action, 0L)
+    vistrail.update_id_scope()
+    tag = 'parallel flow'
+    vistrail.addTag(tag, action.id)
+
+    # Build a controller and execute
+    controller = VistrailController()
+    controller.set_vistrail(vistrail, None)
+    controller.change_selected_version(vistrail.get_version_number(tag))
+    execution = controller.execute_current_workflow(
+            custom_aliases=None,
+            custom_params=None,
+            extra_info=None,
+            reason='API Pipeline Execution')
+
+    # Build a list of errors
+    errors = []
+    pipeline = vistrail.getPipeline(tag)
+    execution_errors = execution[0][0].errors
+    if execution_errors:
+        for key in execution_errors:
+            module = pipeline.modules[key]
+            msg = '%s: %s' %(module.name, execution_errors[key])
+            errors.append(msg)
+
+    # Get the execution log from the controller
+    try:
+        module_log = controller.log.workflow_execs[0].item_execs[0]
+    except IndexError:
+        errors.append("Module log not found")
+        return dict(errors=errors)
+    else:
+        machine = controller.log.workflow_execs[0].machines[
+                module_log.machine_id]
+        xml_log = serialize(module_log)
+        machine_log = serialize(machine)
+
+    # Get the output value
+    output = None
+    serializable = None
+    if not execution_errors:
+        executed_module, = execution[0][0].executed
+        executed_module = execution[0][0].objects[executed_module]
         try:
-            module_log = controller.log.workflow_execs[0].item_execs[0]
-        except IndexError:
-            errors.append("Module log not found")
+            output = executed_module.get_output(output_port)
+        except ModuleError:
+            errors.append("Output port not found: %s" % output_port)
             return dict(errors=errors)
-        else:
-            machine = controller.log.workflow_execs[0].machines[
-                    module_log.machine_id]
-            xml_log = serialize(module_log)
-            machine_log = serialize(machine)
-
-        # Get the output value
-        output = None
-        serializable = None
-        if not execution_errors:
-            executed_module, = execution[0][0].executed
-            executed_module = execution[0][0].objects[executed_module]
-            try:
-                output = executed_module.get_output(output_port)
-            except ModuleError:
-                errors.append("Output port not found: %s" % output_port)
-                return dict(errors=errors)
-            reg = vistrails.core.modules.module_registry.get_module_registry()
-            base_classes = inspect.getmro(type(output))
-            if Module in base_classes:
-                serializable = reg.get_descriptor(type(output)).sigstring
-                output = output.serialize()
-
-        # Return the dictionary, that will be sent back to the client
-        return dict(errors=errors,
-                    output=output,
-                    serializable=serializable,
-                    xml_log=xml_log,
-                    machine_log=machine_log)
-    finally:
-        os.unlink(temp_wf)
+        reg = vistrails.core.modules.module_registry.get_module_registry()
+        base_classes = inspect.getmro(type(output))
+        if Module in base_classes:
+            serializable = reg.get_descriptor(type(output)).sigstring
+            output = output.serialize()
+
+    # Return the dictionary, that will be sent back to the client
+    return dict(errors=errors,
+                output=output,
+                serializable=serializable,
+                xml_log=xml_log,
+                machine_log=machine_log)
+
+###############################################################################
+# Adds the functions setting the values of an element to a module
+#
+# 'functions' is a list of (port name, type, value) tuples
+#
+def add_element_functions(module, functions):
+    # getting highest id between functions to guarantee unique ids
+    # TODO: can get current IdScope here?
+    if module.functions:
+        high_id = max(function.db_id for function in module.functions)
+    else:
+        high_id = 0
+
+    # adding function and parameter to module in pipeline
+    # TODO: 'pos' should not be always 0 here
+    id_scope = IdScope(beginId=long(high_id+1))
+    for inputPort, type, elementValue in functions:
+        mod_function = ModuleFunction(
+                id=id_scope.getNewId(ModuleFunction.vtType),
+                pos=0,
+                name=inputPort)
+        mod_param = ModuleParam(id=0L,
+                                pos=0,
+                                type=type,
+                                val=elementValue)
+
+        mod_function.add_parameter(mod_param)
+        module.add_function(mod_function)
 
 ###############################################################################
 
@@ -150,11 +176,15 @@ def strip_ansi_codes(s):
 # Map Operator
 #
 class Map(Module):
-    """The Map Module executes a map operator in parallel on IPython engines.
+    """The Map Module executes a map operator in parallel on IPython engines
+    or on local worker processes.
 
     The FunctionPort should be connected to the 'self' output of the module you
     want to execute.
     The InputList is the list of values to be scattered on the engines.
+    Engine selects 'ipython', 'local', or 'auto' which uses IPython if a
+    cluster is already running. Processes is the number of local workers, one
+    per CPU by default.
     """
     def __init__(self):
         Module.__init__(self)
@@ -204,6 +234,9 @@ class Map(Module):
         nameInput = self.get_input('InputPort')
         nameOutput = self.get_input('OutputPort')
         rawInputList = self.get_input('InputList')
+        engine = self.get_input('Engine')
+        if engine not in ('auto', 'ipython', 'local'):
+            raise ModuleError(self, "Unknown engine: %r" % engine)
 
         # Create inputList to always have iterable elements
         # to simplify code
@@ -214,7 +247,8 @@ class Map(Module):
             element_is_iter = True
             inputList = rawInputList
 
-        workflows = []
+        elements = []
+        pipeline_db_module = None
         module = None
         vtType = None
 
@@ -229,151 +263,64 @@ class Map(Module):
             module_id = connector.obj.moduleInfo['moduleId']
             vtType = original_pipeline.modules[module_id].vtType
 
-            # serialize the module for each value in the list
+            pipeline_db_module = original_pipeline.modules[module_id].do_copy()
+
+            # transforming a subworkflow in a group
+            # TODO: should we also transform inner subworkflows?
+            if pipeline_db_module.is_abstraction():
+                group = Group(id=pipeline_db_module.id,
+                              cache=pipeline_db_module.cache,
+                              location=pipeline_db_module.location,
+                              functions=pipeline_db_module.functions,
+                              annotations=pipeline_db_module.annotations)
+
+                source_port_specs = pipeline_db_module.sourcePorts()
+                dest_port_specs = pipeline_db_module.destinationPorts()
+                for source_port_spec in source_port_specs:
+                    group.add_port_spec(source_port_spec)
+                for dest_port_spec in dest_port_specs:
+                    group.add_port_spec(dest_port_spec)
+
+                group.pipeline = pipeline_db_module.pipeline
+                pipeline_db_module = group
+
+            # checking types
+            self.typeChecking(connector.obj, nameInput, inputList)
+
+            # build the functions of the module for each value in the list
             for i, element in enumerate(inputList):
                 if element_is_iter:
                     self.element = element
                 else:
                     self.element = element[0]
 
-                # checking type and setting input in the module
-                self.typeChecking(connector.obj, nameInput, inputList)
                 self.setInputValues(connector.obj, nameInput, element, i)
 
-                pipeline_db_module = original_pipeline.modules[module_id].do_copy()
-
-                # transforming a subworkflow in a group
-                # TODO: should we also transform inner subworkflows?
-                if pipeline_db_module.is_abstraction():
-                    group = Group(id=pipeline_db_module.id,
-                                  cache=pipeline_db_module.cache,
-                                  location=pipeline_db_module.location,
-                                  functions=pipeline_db_module.functions,
-                                  annotations=pipeline_db_module.annotations)
-
-                    source_port_specs = pipeline_db_module.sourcePorts()
-                    dest_port_specs = pipeline_db_module.destinationPorts()
-                    for source_port_spec in source_port_specs:
-                        group.add_port_spec(source_port_spec)
-                    for dest_port_spec in dest_port_specs:
-                        group.add_port_spec(dest_port_spec)
-
-                    group.pipeline = pipeline_db_module.pipeline
-                    pipeline_db_module = group
-
-                # getting highest id between functions to guarantee unique ids
-                # TODO: can get current IdScope here?
-                if pipeline_db_module.functions:
-                    high_id = max(function.db_id
-                                  for function in pipeline_db_module.functions)
-                else:
-                    high_id = 0
-
-                # adding function and parameter to module in pipeline
-                # TODO: 'pos' should not be always 0 here
-                id_scope = IdScope(beginId=long(high_id+1))
-                for elementValue, inputPort in izip(element, nameInput):
-
-                    p_spec = pipeline_db_module.get_port_spec(inputPort, 'input')
-                    descrs = p_spec.descriptors()
-                    if len(descrs) != 1:
-                        raise ModuleError(
-                                self,
-                                "Tuple input ports are not supported")
-                    if not issubclass(descrs[0].module, Constant):
-                        raise ModuleError(
-                                self,
-                                "Module inputs should be Constant types")
-                    type = p_spec.sigstring[1:-1]
-
-                    mod_function = ModuleFunction(id=id_scope.getNewId(ModuleFunction.vtType),
-                                                  pos=0,
-                                                  name=inputPort)
-                    mod_param = ModuleParam(id=0L,
-                                            pos=0,
-                                            type=type,
-                                            val=elementValue)
-
-                    mod_function.add_parameter(mod_param)
-                    pipeline_db_module.add_function(mod_function)
-
-                # serializing module
-                wf = self.serialize_module(pipeline_db_module)
-                workflows.append(wf)
+                elements.append(self.element_functions(pipeline_db_module,
+                                                       nameInput, element))
 
             # getting first connector, ignoring the rest
             break
 
-        # IPython stuff
-        try:
-            rc = get_client()
-        except Exception, error:
-            raise ModuleError(self, "Exception while loading IPython: "
-                              "%s" % error)
-        if rc is None:
-            raise ModuleError(self, "Couldn't get an IPython connection")
-        engines = rc.ids
-        if not engines:
-            raise ModuleError(
-                    self,
-                    "Exception while loading IPython: No IPython engines "
-                    "detected!")
-
-        # initializes each engine
-        # importing modules and initializing the VisTrails application
-        # in the engines *only* in the first execution on this engine
-        uninitialized = []
-        for eng in engines:
+        # use IPython if a cluster is already running, else local workers
+        rc = None
+        if engine == 'auto':
             try:
-                rc[eng]['init']
+                rc = get_client(ask=False)
             except Exception:
-                uninitialized.append(eng)
-        if uninitialized:
-            init_view = rc[uninitialized]
-            with init_view.sync_imports():
-                import tempfile
-                import inspect
+                pass
+            if rc is None:
+                engine = 'local'
 
-                # VisTrails API
-                import vistrails
-                import vistrails.core
-                import vistrails.core.db.action
-                import vistrails.core.application
-                import vistrails.core.modules.module_registry
-                from vistrails.core.db.io import serialize
-                from vistrails.core.vistrail.vistrail import Vistrail
-                from vistrails.core.vistrail.pipeline import Pipeline
-                from vistrails.core.db.locator import XMLFileLocator
-                from vistrails.core.vistrail.controller import VistrailController
-                from vistrails.core.interpreter.default import get_default_interpreter
+        if engine == 'local':
+            # setting computing color
+            module.logging.set_computing(module)
 
-            # initializing a VisTrails application
-            try:
-                init_view.execute(
-                        'app = vistrails.core.application.init('
-                        '        {"spawned": True},'
-                        '        args=[])',
-                        block=True)
-            except CompositeError, e:
-                self.print_compositeerror(e)
-                raise ModuleError(self, "Error initializing application on "
-                                  "IPython engines:\n"
-                                  "%s" % self.list_exceptions(e))
-
-            init_view['init'] = True
-
-        # setting computing color
-        module.logging.set_computing(module)
-
-        # executing function in engines
-        # each map returns a dictionary
-        try:
-            ldview = rc.load_balanced_view()
-            map_result = ldview.map_sync(execute_wf, workflows, [nameOutput]*len(workflows))
-        except CompositeError, e:
-            self.print_compositeerror(e)
-            raise ModuleError(self, "Error from IPython engines:\n"
-                              "%s" % self.list_exceptions(e))
+            map_result = self.execute_local(pipeline_db_module, elements,
+                                            nameOutput)
+        else:
+            map_result = self.execute_ipython(rc, module, pipeline_db_module,
+                                              elements, nameOutput)
 
         # verifying errors
         errors = []
@@ -405,7 +352,9 @@ class Map(Module):
                 output = module_klass().deserialize(map_execution['output'])
             self.result.append(output)
 
-        # including execution logs
+        # including execution logs, unless this execution isn't logged
+        if self.logging.log is DummyLogController:
+            return
         for engine in range(len(map_result)):
             log = map_result[engine]['xml_log']
             exec_ = None
@@ -446,6 +395,131 @@ class Map(Module):
             self.logging.add_exec(exec_)
 
 
+    def element_functions(self, pipeline_db_module, nameInput, element):
+        """
+        Returns the functions setting the values of an element on the
+        module, as expected by add_element_functions().
+        """
+        functions = []
+        for elementValue, inputPort in izip(element, nameInput):
+
+            p_spec = pipeline_db_module.get_port_spec(inputPort, 'input')
+            descrs = p_spec.descriptors()
+            if len(descrs) != 1:
+                raise ModuleError(
+                        self,
+                        "Tuple input ports are not supported")
+            if not issubclass(descrs[0].module, Constant):
+                raise ModuleError(
+                        self,
+                        "Module inputs should be Constant types")
+            type = p_spec.sigstring[1:-1]
+            # parameters hold strings, as they would once serialized
+            functions.append((inputPort, type, str(elementValue)))
+        return functions
+
+    def execute_local(self, pipeline_db_module, elements, nameOutput):
+        """
+        Executes the module for each element on the local worker processes.
+        The module is serialized and sent to the workers once; each task
+        only carries its key and the values of an element.
+        """
+        processes = self.force_get_input('Processes', None)
+        if processes is not None and processes < 1:
+            raise ModuleError(self, "Processes should be at least 1")
+
+        wf = self.serialize_module(pipeline_db_module)
+        key = sha1_hash(wf).hexdigest()
+        try:
+            return LocalEngine.map(key, wf, elements, nameOutput, processes)
+        except Exception, e:
+            raise ModuleError(self, "Error from local workers: %s" % e)
+
+    def execute_ipython(self, rc, module, pipeline_db_module, elements,
+                        nameOutput):
+        """
+        Executes the module for each element on the IPython engines.
+        """
+        workflows = []
+        for functions in elements:
+            element_module = pipeline_db_module.do_copy()
+            add_element_functions(element_module, functions)
+
+            # serializing module
+            workflows.append(self.serialize_module(element_module))
+
+        # IPython stuff
+        if rc is None:
+            try:
+                rc = get_client()
+            except Exception, error:
+                raise ModuleError(self, "Exception while loading IPython: "
+                                  "%s" % error)
+        if rc is None:
+            raise ModuleError(self, "Couldn't get an IPython connection")
+        engines = rc.ids
+        if not engines:
+            raise ModuleError(
+                    self,
+                    "Exception while loading IPython: No IPython engines "
+                    "detected!")
+
+        # initializes each engine
+        # importing modules and initializing the VisTrails application
+        # in the engines *only* in the first execution on this engine
+        uninitialized = []
+        for eng in engines:
+            try:
+                rc[eng]['init']
+            except Exception:
+                uninitialized.append(eng)
+        if uninitialized:
+            init_view = rc[uninitialized]
+            with init_view.sync_imports():
+                import inspect
+
+                # VisTrails API
+                import vistrails
+                import vistrails.core
+                import vistrails.core.db.action
+                import vistrails.core.application
+                import vistrails.core.modules.module_registry
+                from vistrails.core.db.io import serialize, unserialize
+                from vistrails.core.vistrail.vistrail import Vistrail
+                from vistrails.core.vistrail.pipeline import Pipeline
+                from vistrails.core.vistrail.controller import VistrailController
+                from vistrails.core.interpreter.default import get_default_interpreter
+                from vistrails.packages.parallelflow.map import execute_pipeline
+
+            # initializing a VisTrails application
+            try:
+                init_view.execute(
+                        'app = vistrails.core.application.init('
+                        '        {"spawned": True},'
+                        '        args=[])',
+                        block=True)
+            except CompositeError, e:
+                self.print_compositeerror(e)
+                raise ModuleError(self, "Error initializing application on "
+                                  "IPython engines:\n"
+                                  "%s" % self.list_exceptions(e))
+
+            init_view['init'] = True
+
+        # setting computing color
+        module.logging.set_computing(module)
+
+        # executing function in engines
+        # each map returns a dictionary
+        try:
+            ldview = rc.load_balanced_view()
+            return ldview.map_sync(execute_wf, workflows,
+                                   [nameOutput]*len(workflows))
+        except CompositeError, e:
+            self.print_compositeerror(e)
+            raise ModuleError(self, "Error from IPython engines:\n"
+                              "%s" % self.list_exceptions(e))
+
     def serialize_module(self, module):
         """
         Serializes a module to be executed in parallel.
@@ -522,3 +596,50 @@ def get_module(value, signature):
         debug.warning("Could not identify the type of the list element.")
         debug.warning("Type checking is not going to be done inside Map module.")
         return None
+
+###############################################################################
+
+import unittest
+import urllib2
+
+from vistrails.tests.utils import intercept_result, execute
+
+
+class TestLocalMap(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        from vistrails.core.packagemanager import get_package_manager
+        pm = get_package_manager()
+        if not pm.has_package('edu.poly.vistrails.parallel_flow'):
+            pm.late_enable_package('parallelflow')
+
+    @classmethod
+    def tearDownClass(cls):
+        LocalEngine.cleanup()
+
+    def test_local(self):
+        src = urllib2.quote('o = i * 2')
+        for i in xrange(2): # second run reuses the warm workers
+            with intercept_result(Map, 'Result') as results:
+                self.assertFalse(execute([
+                        ('PythonSource', 'org.vistrails.vistrails.basic', [
+                            ('source', [('String', src)]),
+                        ]),
+                        ('Map', 'edu.poly.vistrails.parallel_flow', [
+                            ('InputPort', [('List', "['i']")]),
+                            ('OutputPort', [('String', 'o')]),
+                            ('InputList', [('List', '[1, 2, 3, 4]')]),
+                            ('Engine', [('String', 'local')]),
+                            ('Processes', [('Integer', '2')]),
+                        ]),
+                    ],
+                    [
+                        (0, 'self', 1, 'FunctionPort'),
+                    ],
+                    add_port_specs=[
+                        (0, 'input', 'i',
+                         'org.vistrails.vistrails.basic:Integer'),
+                        (0, 'output', 'o',
+                         'org.vistrails.vistrails.basic:Integer'),
+                    ]))
+            self.assertEqual(results, [[2, 4, 6, 8]])
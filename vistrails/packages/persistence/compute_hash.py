@@ -41,7 +41,16 @@ except ImportError:
     import sha
     sha_hash = sha.new
 
+from vistrails.core.cache.file_signature import get_file_signatures
+
 def compute_hash(persistent_path, is_dir=None):
+    """compute_hash(persistent_path: str, is_dir: bool) -> str
+
+    Returns the content digest of a file or directory. The digests of files
+    are kept in the shared file signature index, so only the files modified
+    since they were last hashed are read again. Directories are hashed as
+    before, as these digests are compared with the ones stored in logs.
+    """
     def hash_file(filename, hasher):
         f = open(filename, 'rb')
         while True:
@@ -50,31 +59,30 @@ def compute_hash(persistent_path, is_dir=None):
                 break
             hasher.update(block)
 
-    sha_hasher = sha_hash()
     if is_dir is None:
         is_dir = os.path.isdir(persistent_path)
-    if is_dir:
-        # get all of the files we need to hash
-        fnames = []
-        base_dir = persistent_path
-        dir_stack = ['.']
-        while dir_stack:
-            dir = dir_stack.pop()
-            for base in sorted(os.listdir(os.path.join(base_dir, dir))):
-                name = os.path.join(dir, base)
-                if os.path.isdir(os.path.join(base_dir, name)):
-                    dir_stack.append(name)
-                else:
-                    fnames.append(name)
+    if not is_dir:
+        return get_file_signatures().signature(persistent_path, content=True)
+
+    sha_hasher = sha_hash()
+    # get all of the files we need to hash
+    fnames = []
+    base_dir = persistent_path
+    dir_stack = ['.']
+    while dir_stack:
+        dir = dir_stack.pop()
+        for base in sorted(os.listdir(os.path.join(base_dir, dir))):
+            name = os.path.join(dir, base)
+            if os.path.isdir(os.path.join(base_dir, name)):
+                dir_stack.append(name)
+            else:
+                fnames.append(name)
 
-        # hash filenames and files to ensure directory structure
-        # is accounted for
-        for fname in fnames:
-            # print fname
-            sha_hasher.update(fname)
-            hash_file(os.path.join(base_dir, fname), sha_hasher)
-    else:
-        hash_file(persistent_path, sha_hasher)
+    # hash filenames and files to ensure directory structure
+    # is accounted for
+    for fname in fnames:
+        sha_hasher.update(fname)
+        hash_file(os.path.join(base_dir, fname), sha_hasher)
     return sha_hasher.hexdigest()
 
 if __name__ == '__main__':
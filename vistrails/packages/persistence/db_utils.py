@@ -33,6 +33,7 @@
 ##
 ###############################################################################
 
+from contextlib import contextmanager
 import os
 import sqlite3
 
@@ -60,7 +61,10 @@ class DatabaseAccess(object):
             self.run_sql_file(cur, os.path.join(os.path.dirname(
                         os.path.abspath(__file__)), 'schema.sql'))
         self.ensure_deleted_column_exist()
+        self.ensure_indexes_exist()
+        self.ensure_hash_table_exist()
         self.model = None
+        self._transaction_depth = 0
 
     def ensure_deleted_column_exist(self):
         """ Add a "deleted" column if not already exist
@@ -73,6 +77,47 @@ class DatabaseAccess(object):
                         "deleted bool NOT NULL DEFAULT False;")
             self.conn.commit()
 
+    def ensure_indexes_exist(self):
+        """ Add the index used to look up references by id and version
+        """
+        cur = self.conn.cursor()
+        cur.execute("CREATE INDEX IF NOT EXISTS id_version_idx "
+                    "ON file(id, version);")
+        self.conn.commit()
+
+    def ensure_hash_table_exist(self):
+        """ Add the table of the content hashes of the files the repository
+            hashed, keyed by path and stat metadata
+        """
+        cur = self.conn.cursor()
+        cur.execute("CREATE TABLE IF NOT EXISTS file_hash "
+                    "(path text PRIMARY KEY, inode integer, size integer, "
+                    "mtime integer, hash text);")
+        self.conn.commit()
+
+    @contextmanager
+    def transaction(self):
+        """ Groups the writes made in this block in a single transaction
+
+        Transactions can be nested; the changes are committed when the
+        outermost block exits, and rolled back if it raises.
+        """
+        self._transaction_depth += 1
+        try:
+            yield
+        except:
+            self._transaction_depth -= 1
+            if self._transaction_depth == 0:
+                self.conn.rollback()
+            raise
+        else:
+            self._transaction_depth -= 1
+            self._commit()
+
+    def _commit(self):
+        if self._transaction_depth == 0:
+            self.conn.commit()
+
     def set_model(self, model):
         self.model = model
 
@@ -88,22 +133,31 @@ class DatabaseAccess(object):
         self.conn.close()
 
     def write_database(self, value_dict):
-#         db_file = '/vistrails/managed/files.db'
-#         self.conn = sqlite3.connect(db_file)
+        self.write_many([value_dict])
+
+    def write_many(self, value_dicts, table='file'):
+        """ Inserts several rows in one transaction
 
+        Rows with the same columns are inserted with a single statement.
+        Rows replace those with the same primary key, if the table has one.
+        """
         cur = self.conn.cursor()
-        cols, vals = zip(*value_dict.iteritems())
-        col_str = ', '.join(cols)
-        # print "executing sql:", "INSERT INTO file(%s) VALUES (%s);" % \
-        #                 (col_str, ','.join(['?'] * len(vals)))
-        # print "  ", vals
-        cur.execute("INSERT INTO file(%s) VALUES (%s);" % \
-                        (col_str, ','.join(['?'] * len(vals))),
-                    vals)
-        self.conn.commit()
+        groups = {}
+        for value_dict in value_dicts:
+            cols = tuple(sorted(value_dict))
+            groups.setdefault(cols, []).append(
+                    [value_dict[col] for col in cols])
+        with self.transaction():
+            for cols, rows in groups.iteritems():
+                cur.executemany("INSERT OR REPLACE INTO %s(%s) "
+                                "VALUES (%s);" % \
+                                    (table, ', '.join(cols),
+                                     ','.join(['?'] * len(cols))),
+                                rows)
 
-        if self.model:
-            self.model.add_data(value_dict)
+        if self.model and table == 'file':
+            for value_dict in value_dicts:
+                self.model.add_data(value_dict)
 
     #         cur.execute("SELECT id, name, tags, user, date_created, "
     #                     "date_modified, content_hash, version, signature "
@@ -164,8 +218,86 @@ class DatabaseAccess(object):
             where_str = '=? AND '.join(where_cols) + '=?'
             cur.execute("UPDATE file SET deleted='True' WHERE %s;" %
                            where_str, where_vals)
-        self.conn.commit()
+        self._commit()
         if self.model:
             self.model.remove_data(where_dict)
         # return cur.fetchall()
                      
+
+    def read_hashes(self):
+        """ Returns the (path, inode, size, mtime, hash) rows of file_hash
+        """
+        cur = self.conn.cursor()
+        cur.execute("SELECT path, inode, size, mtime, hash FROM file_hash;")
+        return cur.fetchall()
+
+    def delete_hashes(self, paths):
+        """ Removes the content hashes of the given paths
+        """
+        cur = self.conn.cursor()
+        with self.transaction():
+            cur.executemany("DELETE FROM file_hash WHERE path=?;",
+                            [(path,) for path in paths])
+
+##############################################################################
+
+import shutil
+import tempfile
+import unittest
+
+
+class TestDatabaseAccess(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='vt_persist_db_')
+        self.db = DatabaseAccess(os.path.join(self.directory, 'files.db'))
+
+    def tearDown(self):
+        self.db.finalize()
+        shutil.rmtree(self.directory)
+
+    def row(self, id, version):
+        return {'id': id, 'name': 'file %s' % id, 'tags': '', 'user': 'test',
+                'date_created': '', 'date_modified': '',
+                'content_hash': 'h%s' % id, 'version': version,
+                'signature': 's%s' % id, 'type': 'blob'}
+
+    def test_write_many(self):
+        self.db.write_many([self.row('a', '1'), self.row('b', '1'),
+                            {'id': 'c', 'version': '2'}])
+        self.assertEqual(sorted(self.db.read_database(['id', 'version'])),
+                         [('a', '1'), ('b', '1'), ('c', '2')])
+        self.assertTrue(self.db.ref_exists('b', '1'))
+        self.assertEqual(self.db.get_signature('a', '1'), 'sa')
+
+    def test_transaction(self):
+        with self.db.transaction():
+            self.db.write_database(self.row('a', '1'))
+            with self.db.transaction():
+                self.db.write_database(self.row('b', '1'))
+            # nested blocks are only committed with the outermost one
+            other = DatabaseAccess(self.db.db_file)
+            self.assertEqual(other.read_database(['id']), [])
+            other.finalize()
+        self.assertEqual(len(self.db.read_database(['id'])), 2)
+
+        try:
+            with self.db.transaction():
+                self.db.delete_from_database({'id': 'a'})
+                self.db.write_database(self.row('c', '1'))
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(sorted(self.db.read_database(['id'])),
+                         [('a',), ('b',)])
+
+    def test_hashes(self):
+        self.db.write_many([{'path': '/a', 'inode': 1, 'size': 2,
+                             'mtime': 1400000000000000000, 'hash': 'x'},
+                            {'path': '/b', 'inode': 3, 'size': 4,
+                             'mtime': 5, 'hash': 'y'}],
+                           table='file_hash')
+        self.db.write_many([{'path': '/a', 'inode': 1, 'size': 6,
+                             'mtime': 7, 'hash': 'z'}],
+                           table='file_hash')
+        self.db.delete_hashes(['/b', '/c'])
+        self.assertEqual(self.db.read_hashes(), [('/a', 1, 6, 7, 'z')])
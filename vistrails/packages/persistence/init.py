@@ -584,13 +584,13 @@ def initialize():
             except OSError:
                 raise RuntimeError('local_db "%s" does not exist' % local_db)
 
-    local_repo = repo.get_repo(local_db)
-    repo.set_current_repo(local_repo)
-
     debug_print('creating DatabaseAccess')
     db_path = os.path.join(local_db, '.files.db')
     db_access = DatabaseAccessSingleton(db_path)
     debug_print('done', db_access)
+
+    local_repo = repo.get_repo(local_db, db_access)
+    repo.set_current_repo(local_repo)
     
     search_dbs = [local_db,]
     if configuration.check('search_dbs'):
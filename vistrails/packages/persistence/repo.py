@@ -40,6 +40,7 @@ py_import('dulwich', {
         'linux-ubuntu': 'python-dulwich',
         'linux-fedora': 'python-dulwich'})
 from vistrails.core import debug
+from vistrails.core.cache.file_signature import FileSignatureIndex, stat_key
 
 from dulwich.errors import NotCommitError, NotGitRepository
 from dulwich.repo import Repo
@@ -52,8 +53,56 @@ import shutil
 import stat
 import tempfile
 
+class RepoHashIndex(FileSignatureIndex):
+    """Blob hashes of the files a repository hashed.
+
+    The hashes are kept in the file_hash table of the persistence database,
+    if one is given; only the rows that changed are written on save().
+    """
+    def __init__(self, db_access=None, **kwargs):
+        FileSignatureIndex.__init__(self, content=True,
+                                    hash_function=GitRepo.compute_blob_hash,
+                                    **kwargs)
+        self.db_access = db_access
+        if db_access is not None:
+            for path, inode, size, mtime, bhash in db_access.read_hashes():
+                self._entries[path] = ((inode, size, mtime), bhash)
+        self._saved = dict(self._entries)
+        self.clean()
+
+    def prune(self, dirname, seen):
+        """prune(dirname: str, seen: set) -> None
+
+        Forgets the files in dirname that are not in seen, which were
+        removed since that directory was last hashed.
+        """
+        prefix = os.path.join(os.path.abspath(dirname), '')
+        with self._lock:
+            for path in self._entries.keys():
+                if path.startswith(prefix) and path not in seen:
+                    del self._entries[path]
+                    self._dirty = True
+
+    def save(self):
+        if self.db_access is None or not self._dirty:
+            return
+        with self._lock:
+            entries = dict(self._entries)
+            self._dirty = False
+        changed = [{'path': path, 'inode': key[0], 'size': key[1],
+                    'mtime': key[2], 'hash': bhash}
+                   for path, (key, bhash) in entries.iteritems()
+                   if self._saved.get(path) != (key, bhash)]
+        removed = [path for path in self._saved if path not in entries]
+        with self.db_access.transaction():
+            if changed:
+                self.db_access.write_many(changed, table='file_hash')
+            if removed:
+                self.db_access.delete_hashes(removed)
+        self._saved = entries
+
 class GitRepo(object):
-    def __init__(self, path):
+    def __init__(self, path, db_access=None):
         if os.path.exists(path):
             if not os.path.isdir(path):
                 raise IOError('Git repository "%s" must be a directory.' %
@@ -65,6 +114,8 @@ class GitRepo(object):
             self.repo = Repo.init(path, not os.path.exists(path))
     
         self.temp_persist_files = []
+        # blob hashes of the files we hashed, keyed by their stat metadata
+        self.hashes = RepoHashIndex(db_access)
 
     def _get_commit(self, version="HEAD"):
         commit = self.repo[version]
@@ -151,7 +202,7 @@ class GitRepo(object):
         return tree[name][1]
 
     @staticmethod
-    def compute_blob_hash(fname, chunk_size=1<<16):
+    def compute_blob_hash(fname, chunk_size=1<<20):
         obj_len = os.path.getsize(fname)
         head = object_header(Blob.type_num, obj_len)
         with open(fname, "rb") as f:
@@ -160,27 +211,52 @@ class GitRepo(object):
             my_iter = chain([head], iter(read_chunk,''))
             return iter_sha1(my_iter)
 
-    @staticmethod
-    def compute_tree_hash(dirname):
-        tree = Tree()
-        for entry in sorted(os.listdir(dirname)):
-            fname = os.path.join(dirname, entry)
-            if os.path.isdir(fname):
-                thash = GitRepo.compute_tree_hash(fname)
-                mode = stat.S_IFDIR # os.stat(fname)[stat.ST_MODE]
-                tree.add(entry, mode, thash)
-            elif os.path.isfile(fname):
-                bhash = GitRepo.compute_blob_hash(fname)
-                mode = os.stat(fname)[stat.ST_MODE]
-                tree.add(entry, mode, bhash)
-        return tree.id
+    def compute_tree_hash(self, dirname):
+        # list the whole tree first, so that the files that changed since
+        # they were last hashed can be hashed together
+        files = []
+        def scan(dirname):
+            entries = []
+            for entry in sorted(os.listdir(dirname)):
+                fname = os.path.join(dirname, entry)
+                try:
+                    st = os.stat(fname)
+                except OSError:
+                    continue # dangling link
+                if stat.S_ISDIR(st.st_mode):
+                    mode = stat.S_IFDIR
+                    entries.append((entry, mode, scan(fname)))
+                elif stat.S_ISREG(st.st_mode):
+                    entries.append((entry, st.st_mode, len(files)))
+                    files.append((os.path.abspath(fname), stat_key(st)))
+            return entries
 
-    @staticmethod
-    def compute_hash(path):
+        def build(entries):
+            tree = Tree()
+            for entry, mode, value in entries:
+                if isinstance(value, list):
+                    tree.add(entry, mode, build(value))
+                else:
+                    tree.add(entry, mode, bhashes[value])
+            return tree.id
+
+        entries = scan(dirname)
+        bhashes = self.hashes.digests(files)
+        self.hashes.prune(dirname, set(path for path, key in files))
+        self.hashes.save()
+        return build(entries)
+
+    def compute_file_hash(self, fname):
+        fname = os.path.abspath(fname)
+        bhash, = self.hashes.digests([(fname, stat_key(os.stat(fname)))])
+        self.hashes.save()
+        return bhash
+
+    def compute_hash(self, path):
         if os.path.isdir(path):
-            return GitRepo.compute_tree_hash(path)
+            return self.compute_tree_hash(path)
         elif os.path.isfile(path):
-            return GitRepo.compute_blob_hash(path)
+            return self.compute_file_hash(path)
         raise TypeError("Do not support this type of path")
 
     def get_latest_version(self, path):
@@ -189,21 +265,24 @@ class GitRepo(object):
                         paths=[path])
         return iter(walker).next().commit.id
 
-    def _stage(self, filename):
+    def _stage(self, filename, paths):
         fullpath = os.path.join(self.repo.path, filename)
         if os.path.islink(fullpath):
             debug.warning("Warning: not staging symbolic link %s" % os.path.basename(filename))
         elif os.path.isdir(fullpath):
             for f in os.listdir(fullpath):
-                self._stage(os.path.join(filename, f))
+                self._stage(os.path.join(filename, f), paths)
         else:
             if os.path.sep != '/':
                 filename = filename.replace(os.path.sep, '/')
-            self.repo.stage(filename)
+            paths.append(filename)
 
     def add_commit(self, filename):
         self.setup_git()
-        self._stage(filename)
+        # the index is written once for all the files
+        paths = []
+        self._stage(filename, paths)
+        self.repo.stage(paths)
         commit_id = self.repo.do_commit('Updated %s' % filename)
         return commit_id
 
@@ -230,8 +309,8 @@ def set_current_repo(repo):
     global current_repo
     current_repo = repo
 
-def get_repo(path):
-    return GitRepo(path)
+def get_repo(path, db_access=None):
+    return GitRepo(path, db_access)
 
 def run_get_file_test():
     r = GitRepo("/vistrails/src/git")
@@ -36,6 +36,9 @@
 from sqlalchemy.engine import create_engine
 from sqlalchemy.engine.url import URL
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.pool import QueuePool
+from collections import OrderedDict
+import threading
 import urllib
 
 from vistrails.core.db.action import create_action
@@ -50,6 +53,104 @@ from vistrails.core.utils import versions_increasing
 from vistrails.packages.tabledata.common import TableObject
 
 
+# Engines are kept for the whole session, keyed by URL, so that connections
+# are taken from their pools
+_engines = {}
+_engines_lock = threading.Lock()
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+class QueryCache(object):
+    """Results of queries, keyed by database URL, query and parameters.
+
+    The least recently used results are dropped once there are more than
+    'size' of them. Statements that don't return rows are assumed to modify
+    the database, and discard the results cached for it.
+    """
+    def __init__(self, size=32):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(connection, query, parameters):
+        """Returns the key for a query, or None if it can't be cached.
+        """
+        key = (str(connection.engine.url), query,
+               tuple(sorted(parameters.iteritems())))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                return None
+            self._entries[key] = value
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, connection):
+        url = str(connection.engine.url)
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == url]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+query_cache = QueryCache()
+
+
+def returns_rows(results):
+    # We don't only use 'returns_rows' because this attribute didn't use to
+    # exist
+    try:
+        return results.returns_rows
+    except AttributeError:
+        return bool(results.keys())
+
+
+def fetch_table(results, batch_size=DEFAULT_BATCH_SIZE):
+    """Reads the rows of a result in batches, straight into table columns.
+    """
+    names = list(results.keys())
+    columns = [[] for name in names]
+    count = 0
+    while True:
+        rows = results.fetchmany(batch_size)
+        if not rows:
+            break
+        for column, values in zip(columns, zip(*rows)):
+            column.extend(values)
+        count += len(rows)
+    return TableObject(columns, count, names)
+
+
+def iter_tables(results, batch_size=DEFAULT_BATCH_SIZE):
+    """Reads the rows of a result in batches, yielding a table for each.
+    """
+    names = list(results.keys())
+    while True:
+        rows = results.fetchmany(batch_size)
+        if not rows:
+            break
+        yield TableObject([list(values) for values in zip(*rows)],
+                          len(rows), names)
+
+
 class DBConnection(Module):
     """Connects to a database.
 
@@ -76,6 +177,16 @@ class DBConnection(Module):
                   port=self.force_get_input('port', None),
                   database=self.get_input('db_name'))
 
+        with _engines_lock:
+            engine = _engines.get(str(url))
+        if engine is None:
+            engine = self.create_engine(url)
+            with _engines_lock:
+                engine = _engines.setdefault(str(url), engine)
+
+        self.set_output('connection', engine.connect())
+
+    def create_engine(self, url):
         try:
             engine = create_engine(url)
         except ImportError, e:
@@ -131,18 +242,40 @@ class DBConnection(Module):
                     self,
                     "SQLAlchemy has no support for protocol %r -- are you "
                     "sure you spelled that correctly?" % url.drivername)
-
-        self.set_output('connection', engine.connect())
+        if isinstance(engine.pool, QueuePool):
+            # Each cached DBConnection module keeps one connection checked
+            # out, so their number can't be bounded by the pool
+            engine.dispose()
+            engine = create_engine(url, max_overflow=-1)
+        return engine
 
 
 class SQLSource(Module):
+    """Runs a SQL query, with the values of the other input ports as its
+    parameters.
+
+    If batchSize is set, rows are read in batches of that size straight into
+    the columns of the result table, and resultSet is not set. If streaming
+    is set, the rows are only available from the batches port, as a stream
+    of tables of batchSize rows (1000 by default) that downstream modules
+    iterate on; result and resultSet are not set. Otherwise, batches holds
+    the result as a single table. If cacheResults is set, results are also
+    reused by other modules running the same query with the same
+    parameters.
+    """
     _settings = ModuleSettings(configure_widget=
             'vistrails.packages.sql.widgets:SQLSourceConfigurationWidget')
     _input_ports = [('connection', '(DBConnection)'),
                     ('cacheResults', '(basic:Boolean)'),
+                    ('batchSize', '(basic:Integer)',
+                     {'optional': True}),
+                    ('streaming', '(basic:Boolean)',
+                     {'optional': True, 'defaults': "['False']"}),
                     ('source', '(basic:String)')]
     _output_ports = [('result', '(org.vistrails.vistrails.tabledata:Table)'),
-                     ('resultSet', '(basic:List)')]
+                     ('resultSet', '(basic:List)'),
+                     ('batches', '(org.vistrails.vistrails.tabledata:Table)',
+                      {'depth': 1, 'optional': True})]
 
     def is_cacheable(self):
         return False
@@ -154,24 +287,65 @@ class SQLSource(Module):
             self.is_cacheable = lambda: cached
         connection = self.get_input('connection')
         inputs = dict((k, self.get_input(k)) for k in self.inputPorts.iterkeys()
-                  if k not in ('source', 'connection', 'cacheResults'))
+                  if k not in ('source', 'connection', 'cacheResults',
+                               'batchSize', 'streaming'))
         s = urllib.unquote(str(self.get_input('source')))
+        batch_size = self.force_get_input('batchSize', None)
+        if batch_size is not None and batch_size <= 0:
+            raise ModuleError(self, "batchSize should be positive")
+        streaming = self.get_input('streaming')
+
+        key = None
+        if cached and not streaming:
+            key = query_cache.key(connection, s, inputs)
+        if key is not None:
+            result = query_cache.get(key)
+            if result is not None:
+                self.set_output('result', result[0])
+                self.set_output('resultSet', result[1])
+                self.set_output('batches', [result[0]])
+                return
 
         try:
             transaction = connection.begin()
             results = connection.execute(s, inputs)
-            try:
-                rows = results.fetchall()
-            except Exception:
+            if not returns_rows(results):
+                results.close()
+                transaction.commit()
+                query_cache.invalidate(connection)
+                self.set_output('result', None)
+                self.set_output('resultSet', None)
+                self.set_output('batches', [])
+                return
+            if streaming:
+                # The stream can't be computed again
+                self.is_cacheable = lambda: False
                 self.set_output('result', None)
                 self.set_output('resultSet', None)
+                self.set_streaming_output(
+                        'batches',
+                        self.stream(transaction, results,
+                                    batch_size or DEFAULT_BATCH_SIZE))
+                return
+            if batch_size is not None:
+                table = fetch_table(results, batch_size)
+                rows = None
             else:
-                # results.returns_rows is True
-                # We don't use 'if return_rows' because this attribute didn't
-                # use to exist
+                rows = results.fetchall()
                 table = TableObject.from_dicts(rows, results.keys())
-                self.set_output('result', table)
-                self.set_output('resultSet', rows)
+            transaction.commit()
+        except SQLAlchemyError, e:
+            raise ModuleError(self, debug.format_exception(e))
+        if key is not None:
+            query_cache.put(key, (table, rows))
+        self.set_output('result', table)
+        self.set_output('resultSet', rows)
+        self.set_output('batches', [table])
+
+    def stream(self, transaction, results, batch_size):
+        try:
+            for table in iter_tables(results, batch_size):
+                yield table
             transaction.commit()
         except SQLAlchemyError, e:
             raise ModuleError(self, debug.format_exception(e))
@@ -180,6 +354,15 @@ class SQLSource(Module):
 _modules = [DBConnection, SQLSource]
 
 
+def finalize():
+    with _engines_lock:
+        engines = _engines.values()
+        _engines.clear()
+    for engine in engines:
+        engine.dispose()
+    query_cache.clear()
+
+
 def handle_module_upgrade_request(controller, module_id, pipeline):
     # Before 0.0.3, SQLSource's resultSet output was type ListOfElements (which
     #   doesn't exist anymore)
@@ -330,3 +513,143 @@ class TestSQL(unittest.TestCase):
                 os.remove(test_db)
             except OSError:
                 pass # Oops, we are leaking the file here...
+
+    def test_batches_sqlite3(self):
+        """Reads results in batches, and caches them.
+        """
+        import os
+        import tempfile
+        import urllib2
+        from vistrails.tests.utils import execute, intercept_results
+        identifier = 'org.vistrails.vistrails.sql'
+
+        test_db_fd, test_db = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(test_db_fd)
+        try:
+            engine = create_engine('sqlite:///%s' % test_db)
+            engine.execute('CREATE TABLE test(id INTEGER, name VARCHAR(8))')
+            engine.execute('INSERT INTO test(id, name) VALUES (?, ?)',
+                           [(i, 'n%d' % i) for i in xrange(25)])
+            engine.dispose()
+
+            def run(source, batch_size=None, cache=False):
+                functions = [('source', [('String', urllib2.quote(source))]),
+                             ('cacheResults', [('Boolean', str(cache))])]
+                if batch_size is not None:
+                    functions.append(('batchSize',
+                                      [('Integer', str(batch_size))]))
+                with intercept_results(DBConnection, 'connection',
+                                       SQLSource, 'result',
+                                       SQLSource, 'resultSet') as (
+                        connection, table, rows):
+                    self.assertFalse(execute([
+                            ('DBConnection', identifier, [
+                                ('protocol', [('String', 'sqlite')]),
+                                ('db_name', [('String', test_db)]),
+                            ]),
+                            ('SQLSource', identifier, functions),
+                        ],
+                        [
+                            (0, 'connection', 1, 'connection'),
+                        ]))
+                connection[0].close()
+                return table[0], rows[0]
+
+            query = "SELECT id, name FROM test WHERE id >= 10"
+            table, rows = run(query, batch_size=4)
+            self.assertIsNone(rows)
+            self.assertEqual((table.rows, table.columns), (15, 2))
+            self.assertEqual(table.get_column(0), range(10, 25))
+            self.assertEqual(table.get_column_by_name('name')[-1], 'n24')
+            self.assertEqual(len(_engines), 1)
+
+            table, rows = run(query, cache=True)
+            self.assertEqual(len(rows), 15)
+            self.assertIs(run(query, cache=True)[0], table)
+            # Statements that don't return rows invalidate the cache
+            run("DELETE FROM test WHERE id >= 20", cache=True)
+            table2, rows = run(query, cache=True)
+            self.assertEqual(table2.rows, 10)
+            self.assertEqual(len(_engines), 1)
+        finally:
+            finalize()
+            try:
+                os.remove(test_db)
+            except OSError:
+                pass
+
+    def test_streaming_sqlite3(self):
+        """Streams batches of rows into a downstream table operation.
+        """
+        import os
+        import tempfile
+        import urllib2
+        from vistrails.tests.utils import execute
+        identifier = 'org.vistrails.vistrails.sql'
+
+        test_db_fd, test_db = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(test_db_fd)
+        try:
+            engine = create_engine('sqlite:///%s' % test_db)
+            engine.execute('CREATE TABLE test(id INTEGER, name VARCHAR(8))')
+            engine.execute('INSERT INTO test(id, name) VALUES (?, ?)',
+                           [(i, 'n%d' % i) for i in xrange(10)])
+            engine.dispose()
+
+            reg = get_module_registry()
+            project = reg.get_descriptor_by_name(
+                    'org.vistrails.vistrails.tabledata',
+                    'ProjectTable').module
+            source = "SELECT id, name FROM test ORDER BY id"
+            # The same module object computes every batch, so collect the
+            # values as they are set
+            tables = []
+            actual_set_output = project.set_output
+            def set_output(module, port, value):
+                if port == 'value' and value is not None:
+                    tables.append(value)
+                actual_set_output(module, port, value)
+            project.set_output = set_output
+            try:
+                self.assertFalse(execute([
+                        ('DBConnection', identifier, [
+                            ('protocol', [('String', 'sqlite')]),
+                            ('db_name', [('String', test_db)]),
+                        ]),
+                        ('SQLSource', identifier, [
+                            ('source', [('String', urllib2.quote(source))]),
+                            ('batchSize', [('Integer', '4')]),
+                            ('streaming', [('Boolean', 'True')]),
+                        ]),
+                        ('ProjectTable', 'org.vistrails.vistrails.tabledata', [
+                            ('column_names', [('List', "['name']")]),
+                        ]),
+                    ],
+                    [
+                        (0, 'connection', 1, 'connection'),
+                        (1, 'batches', 2, 'table'),
+                    ]))
+            finally:
+                del project.set_output
+            self.assertEqual([t.rows for t in tables], [4, 4, 2])
+            self.assertEqual(tables[2].names, ['name'])
+            self.assertEqual(tables[2].get_column(0), ['n8', 'n9'])
+        finally:
+            finalize()
+            try:
+                os.remove(test_db)
+            except OSError:
+                pass
+
+    def test_iter_tables(self):
+        engine = create_engine('sqlite://')
+        engine.execute('CREATE TABLE test(a INTEGER, b INTEGER)')
+        engine.execute('INSERT INTO test(a, b) VALUES (?, ?)',
+                       [(i, i * i) for i in xrange(10)])
+        tables = list(iter_tables(engine.execute('SELECT a, b FROM test'), 4))
+        self.assertEqual([t.rows for t in tables], [4, 4, 2])
+        self.assertEqual(tables[1].names, ['a', 'b'])
+        self.assertEqual(tables[2].get_column(1), [64, 81])
+        table = fetch_table(engine.execute('SELECT a FROM test WHERE a < 0'))
+        self.assertEqual((table.rows, table.columns), (0, 1))
+        self.assertEqual(table.get_column(0), [])
@@ -2,6 +2,8 @@ try:
     import numpy
 except ImportError: # pragma: no cover
     numpy = None
+import itertools
+import operator
 import re
 
 from vistrails.core.modules.vistrails_module import ModuleError
@@ -20,6 +22,51 @@ def utf8(obj):
         return bytes(obj)
 
 
+def take(column, rows):
+    """Gets the elements of a column at the given row indexes.
+
+    NumPy arrays are indexed in one go and give an array; other sequences
+    give a list.
+    """
+    if numpy is not None:
+        if isinstance(column, numpy.ndarray):
+            return column[rows]
+        if isinstance(rows, numpy.ndarray):
+            rows = rows.tolist()
+    if len(rows) == 0:
+        return []
+    elif len(rows) == 1:
+        return [column[rows[0]]]
+    else:
+        return list(operator.itemgetter(*rows)(column))
+
+
+def group_rows(column):
+    """Numbers the distinct values of a column, in order of appearance.
+
+    Returns an array with the group number of each row, and an array with
+    the first row of each group. Requires NumPy.
+    """
+    if isinstance(column, numpy.ndarray) and column.dtype != object:
+        values, first, codes = numpy.unique(column, return_index=True,
+                                            return_inverse=True)
+        # numpy.unique() sorts the values, renumber the groups
+        order = numpy.argsort(first)
+        renumber = numpy.empty_like(order)
+        renumber[order] = numpy.arange(len(order))
+        return renumber[codes], first[order]
+    else:
+        # maps each value to the first row where it appears
+        count = len(column)
+        first_row = dict(itertools.izip(reversed(column),
+                                        xrange(count - 1, -1, -1)))
+        first_rows = numpy.fromiter(itertools.imap(first_row.__getitem__,
+                                                   column),
+                                    dtype=numpy.intp, count=count)
+        first, codes = numpy.unique(first_rows, return_inverse=True)
+        return codes, first
+
+
 class JoinedTables(TableObject):
     def __init__(self, left_t, right_t, left_key_col, right_key_col,
                  case_sensitive=False, always_prefix=False):
@@ -33,7 +80,7 @@ class JoinedTables(TableObject):
         self.build_column_names()
         self.compute_row_map()
         self.column_cache = {}
-        self.rows = len(self.row_map)
+        self.rows = len(self.left_rows)
 
     def build_column_names(self):
         left_name = self.left_t.name
@@ -67,46 +114,78 @@ class JoinedTables(TableObject):
         if (index, numeric) in self.column_cache:
             return self.column_cache[(index, numeric)]
 
-        result = []
         if index < self.left_t.columns:
             column = self.left_t.get_column(index, numeric)
-            for i in xrange(self.left_t.rows):
-                if i in self.row_map:
-                    result.append(column[i])
+            result = take(column, self.left_rows)
         else:
             column = self.right_t.get_column(index - self.left_t.columns,
                                              numeric)
-            for i in xrange(self.left_t.rows):
-                if i in self.row_map:
-                    j = self.row_map[i]
-                    result.append(column[j])
+            result = take(column, self.right_rows)
 
         if numeric and numpy is not None:
-            result = numpy.array(result, dtype=numpy.float32)
+            result = numpy.asarray(result, dtype=numpy.float32)
         self.column_cache[(index, numeric)] = result
         return result
 
+    def normalize_key(self, key):
+        key = utf8(key).strip()
+        if not self.case_sensitive:
+            key = key.upper()
+        return key
+
+    def key_groups(self, table, key_col):
+        """Groups the rows of a table by normalized key.
+
+        Returns the sorted array of distinct keys, and for each row the
+        index of its key in that array. Only the distinct values of the
+        column are normalized.
+        """
+        column = table.get_column(key_col)
+        codes, first = group_rows(column)
+        keys = numpy.array([utf8(val) for val in take(column, first)],
+                           dtype=numpy.bytes_)
+        keys = numpy.char.strip(keys)
+        if not self.case_sensitive:
+            keys = numpy.char.upper(keys)
+        keys, key_idx = numpy.unique(keys, return_inverse=True)
+        return keys, key_idx[codes]
+
     def compute_row_map(self):
-        def build_key_dict(table, key_col):
-            column = table.get_column(key_col)
-            if self.case_sensitive:
-                key_dict = dict((utf8(val).strip(), i)
-                                for i, val in enumerate(column))
-            else:
-                key_dict = dict((utf8(val).strip().upper(), i)
-                                for i, val in enumerate(column))
-            return key_dict
-
-        right_keys = build_key_dict(self.right_t, self.right_key_col)
-
-        self.row_map = {}
-        for left_row_idx, key in enumerate(
-                self.left_t.get_column(self.left_key_col)):
-            key = utf8(key).strip()
-            if not self.case_sensitive:
-                key = key.upper()
-            if key in right_keys:
-                self.row_map[left_row_idx] = right_keys[key]
+        """Finds the pairs of rows with matching keys.
+
+        Sets left_rows and right_rows, the indexes of the matched rows in
+        each table, in the order of the left table. If a key appears more
+        than once in the right table, the last row is used.
+        """
+        if numpy is None:
+            right_keys = dict((self.normalize_key(val), i)
+                              for i, val in enumerate(
+                                  self.right_t.get_column(self.right_key_col)))
+            self.left_rows = []
+            self.right_rows = []
+            for left_row_idx, key in enumerate(
+                    self.left_t.get_column(self.left_key_col)):
+                key = self.normalize_key(key)
+                if key in right_keys:
+                    self.left_rows.append(left_row_idx)
+                    self.right_rows.append(right_keys[key])
+            return
+
+        keys, right = self.key_groups(self.right_t, self.right_key_col)
+        # last row of each key in the right table
+        last = len(right) - 1 - numpy.unique(right[::-1],
+                                             return_index=True)[1]
+        left_keys, left = self.key_groups(self.left_t, self.left_key_col)
+        # match the distinct keys, then expand to the rows
+        if len(keys):
+            pos = numpy.minimum(numpy.searchsorted(keys, left_keys),
+                                len(keys) - 1)
+            found = keys[pos] == left_keys
+        else:
+            pos = numpy.zeros(len(left_keys), dtype=numpy.intp)
+            found = numpy.zeros(len(left_keys), dtype=bool)
+        self.left_rows = numpy.nonzero(found[left])[0]
+        self.right_rows = last[pos[left[self.left_rows]]]
 
 
 class JoinTables(Table):
@@ -160,6 +239,9 @@ class JoinTables(Table):
 
 class ProjectedTable(TableObject):
     def __init__(self, table, col_idxs, col_names):
+        if isinstance(table, ProjectedTable):
+            col_idxs = [table.col_map[i] for i in col_idxs]
+            table = table.table
         self.table = table
         self.col_map = dict(enumerate(col_idxs))
         self.columns = len(self.col_map)
@@ -220,6 +302,33 @@ class ProjectTable(Table):
         self.set_output("value", projected_table)
 
 
+class SelectedTable(TableObject):
+    """The rows of another table, given by their indexes.
+
+    Columns are only extracted from the original table when requested.
+    """
+    def __init__(self, table, row_idxs):
+        if isinstance(table, SelectedTable):
+            row_idxs = take(table.row_idxs, row_idxs)
+            table = table.table
+        self.table = table
+        self.row_idxs = row_idxs
+        self.columns = table.columns
+        self.names = table.names
+        self.rows = len(row_idxs)
+        self.column_cache = {}
+
+    def get_column(self, index, numeric=False):
+        if (index, numeric) in self.column_cache:
+            return self.column_cache[(index, numeric)]
+
+        result = take(self.table.get_column(index, numeric), self.row_idxs)
+        if numeric and numpy is not None:
+            result = numpy.asarray(result, dtype=numpy.float32)
+        self.column_cache[(index, numeric)] = result
+        return result
+
+
 class SelectFromTable(Table):
     """Builds a table from the rows of another table.
 
@@ -259,6 +368,31 @@ class SelectFromTable(Table):
         else:
             raise ValueError("Invalid comparison operator %r" % comparer)
 
+    @staticmethod
+    def make_mask(column, comparand, comparer):
+        """Evaluates a condition on a whole column, giving a boolean array.
+
+        This is the NumPy equivalent of applying make_condition() to every
+        element.
+        """
+        if comparer == '=~':
+            regex = re.compile(comparand)
+            return numpy.fromiter((regex.search(v) is not None
+                                   for v in column),
+                                  dtype=bool, count=len(column))
+        try:
+            op = {'==': operator.eq, '!=': operator.ne,
+                  '<': operator.lt, '>': operator.gt,
+                  '<=': operator.le, '>=': operator.ge}[comparer]
+        except KeyError:
+            raise ValueError("Invalid comparison operator %r" % comparer)
+        if isinstance(comparand, float):
+            values = numpy.asarray(column, dtype=numpy.float64)
+        else:
+            values = numpy.empty(len(column), dtype=object)
+            values[:] = column
+        return numpy.asarray(op(values, comparand), dtype=bool)
+
     def compute(self):
         table = self.get_input('table')
 
@@ -282,18 +416,17 @@ class SelectFromTable(Table):
                                   "No column %d, table only has %d columns" % (
                                   idx, table.columns))
 
-        condition = self.make_condition(comparand, comparer)
         numeric = isinstance(comparand, float)
         column = table.get_column(idx, numeric)
-        matched_rows = [i
-                        for i, col_val in enumerate(column)
-                        if condition(col_val)]
-        columns = []
-        for col in xrange(table.columns):
-            column = table.get_column(col)
-            columns.append([column[row] for row in matched_rows])
-        selected_table = TableObject(columns, len(matched_rows), table.names)
-        self.set_output('value', selected_table)
+        if numpy is not None:
+            matched_rows = numpy.nonzero(
+                    self.make_mask(column, comparand, comparer))[0]
+        else:
+            condition = self.make_condition(comparand, comparer)
+            matched_rows = [i
+                            for i, col_val in enumerate(column)
+                            if condition(col_val)]
+        self.set_output('value', SelectedTable(table, matched_rows))
 
 
 class AggregatedTable(TableObject):
@@ -306,21 +439,58 @@ class AggregatedTable(TableObject):
         self.build_map()
 
     def build_map(self):
-        agg_map = {}
-        for i, val in enumerate(self.table.get_column(self.group_col)):
-            if val in agg_map:
-                agg_map[val].append(i)
-            else:
-                agg_map[val] = [i]
-        self.agg_rows = [(min(rows), rows) for rows in agg_map.itervalues()]
-        self.agg_rows.sort()
-        self.rows = len(self.agg_rows)
+        column = self.table.get_column(self.group_col)
+        if numpy is not None:
+            self.codes, self.first_rows = group_rows(column)
+            self.rows = len(self.first_rows)
+        else:
+            agg_map = {}
+            for i, val in enumerate(column):
+                if val in agg_map:
+                    agg_map[val].append(i)
+                else:
+                    agg_map[val] = [i]
+            self.agg_rows = [(min(rows), rows)
+                             for rows in agg_map.itervalues()]
+            self.agg_rows.sort()
+            self.first_rows = [x[0] for x in self.agg_rows]
+            self.rows = len(self.agg_rows)
         self.columns = 2
         if self.table.names is not None:
             self.names = [self.table.names[self.group_col],
                           self.table.names[self.col]]
 
     def get_column(self, index, numeric=False):
+        if index == 0:
+            col = self.table.get_column(self.group_col, numeric)
+            return take(col, self.first_rows)
+        elif self.op not in ('count', 'sum', 'average', 'min', 'max'):
+            raise ValueError('Unknown operation: "%s"' % self.op)
+        elif numpy is None:
+            return self.aggregate_lists()
+
+        counts = numpy.bincount(self.codes, minlength=self.rows)
+        if self.op == 'count':
+            return counts.tolist()
+        values = numpy.asarray(self.table.get_column(self.col, True),
+                               dtype=numpy.float64)
+        if self.op == 'sum':
+            result = numpy.bincount(self.codes, weights=values,
+                                    minlength=self.rows)
+        elif self.op == 'average':
+            result = numpy.bincount(self.codes, weights=values,
+                                    minlength=self.rows) / counts
+        elif self.rows == 0:
+            return []
+        else:
+            # sort the values by group and reduce each run
+            order = numpy.argsort(self.codes, kind='mergesort')
+            starts = numpy.concatenate(([0], numpy.cumsum(counts)[:-1]))
+            ufunc = numpy.minimum if self.op == 'min' else numpy.maximum
+            result = ufunc.reduceat(values[order], starts)
+        return result.tolist()
+
+    def aggregate_lists(self):
         def average(value_iter):
             # value_iter can only be used once
             sum = 0
@@ -332,18 +502,12 @@ class AggregatedTable(TableObject):
                   'average': average,
                   'min': min,
                   'max': max}
-        if index == 0:
-            col = self.table.get_column(self.group_col, numeric)
-            return [col[x[0]] for x in self.agg_rows]
+        if self.op == 'count':
+            return [len(x[1]) for x in self.agg_rows]
         else:
-            if self.op == 'count':
-                return [len(x[1]) for x in self.agg_rows]
-            elif self.op in op_map:
-                col = self.table.get_column(self.col, True)
-                return [op_map[self.op](col[idx] for idx in x[1])
-                        for x in self.agg_rows]
-            else:
-                raise ValueError('Unknown operation: "%s"' % self.op)
+            col = self.table.get_column(self.col, True)
+            return [op_map[self.op](col[idx] for idx in x[1])
+                    for x in self.agg_rows]
 
 
 class AggregateColumn(Table):
@@ -695,3 +859,71 @@ class TestAggregate(unittest.TestCase):
                                    ('group_by_index', [('Integer', '2')])])
         self.assertEqual(table.get_column(0, False), ['T', 'F'])
         self.assertEqual(table.get_column(1, True), [-7, 21])
+
+    def test_aggregate_max_count(self):
+        table = self.do_aggregate([('op', [('String', 'max')]),
+                                   ('column_index', [('Integer', '3')]),
+                                   ('group_by_index', [('Integer', '1')])])
+        self.assertEqual(table.get_column(1, True), [100, 23, 41, 21])
+        table.op = 'count'
+        self.assertEqual(table.get_column(1, True), [3, 2, 1, 1])
+
+
+class TestVectorized(unittest.TestCase):
+    """Checks that the NumPy code gives the same results as plain Python.
+    """
+    def make_table(self):
+        rows = 200
+        keys = ['k%d' % (i % 7) for i in xrange(rows)]
+        values = [str((i * 37) % 101 - 50) for i in xrange(rows)]
+        mixed = [i if i % 3 else ' K%d ' % (i % 5) for i in xrange(rows)]
+        return TableObject([keys, values, mixed], rows,
+                           ['key', 'value', 'mixed'])
+
+    def run_operations(self):
+        table = self.make_table()
+        results = []
+        for comparer in ['==', '!=', '<', '>', '<=', '>=']:
+            results.append(
+                    SelectFromTable.make_mask(table.get_column(1, True),
+                                              12.0, comparer).tolist()
+                    if numpy is not None else
+                    [SelectFromTable.make_condition(12.0, comparer)(v)
+                     for v in table.get_column(1, True)])
+        selected = SelectedTable(table, [i for i in xrange(table.rows)
+                                         if i % 4])
+        selected = SelectedTable(selected, [0, 5, 7, 30, 31])
+        projected = ProjectedTable(ProjectedTable(selected, [2, 0, 1],
+                                                  ['m', 'k', 'v']),
+                                   [1, 2], ['k', 'v'])
+        results.append(projected.get_column(0))
+        results.append(list(projected.get_column(1, True)))
+        for op in ['count', 'sum', 'average', 'min', 'max']:
+            aggregated = AggregatedTable(table, op, 1, 0)
+            results.append(list(aggregated.get_column(0)))
+            results.append(aggregated.get_column(1, True))
+        right = TableObject([['k1', 'K3', 'k3', 'x', 'k1 '], range(5)], 5,
+                            ['key', 'id'])
+        for case_sensitive in (False, True):
+            joined = JoinedTables(table, right, 0, 0, case_sensitive)
+            results.append(joined.rows)
+            results.append(list(joined.get_column(1)))
+            results.append(list(joined.get_column(4)))
+        joined = JoinedTables(right, table, 0, 2)
+        results.append(list(joined.get_column(1)))
+        results.append(list(joined.get_column(3)))
+        return results
+
+    def test_same_results(self):
+        global numpy
+        if numpy is None: # pragma: no cover
+            self.skipTest("NumPy is not available")
+        vectorized = self.run_operations()
+        saved, numpy = numpy, None
+        try:
+            plain = self.run_operations()
+        finally:
+            numpy = saved
+        self.assertEqual(len(vectorized), len(plain))
+        for v, p in zip(vectorized, plain):
+            self.assertEqual(v, p)
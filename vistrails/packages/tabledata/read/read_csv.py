@@ -1,4 +1,7 @@
 import csv
+import mmap
+import os
+import threading
 try:
     import numpy
 except ImportError: # pragma: no cover
@@ -14,17 +17,135 @@ def count_lines(fp):
     return lines
 
 
-# FIXME : test coverage for CSVTable
+class CSVColumns(object):
+    """Column-oriented storage for the fields of a CSV file.
+
+    Rows are appended in chunks as the file is parsed. Every column is kept
+    as text; if numpy is available, the columns in which every field is a
+    number are also kept as float32 arrays.
+
+    If a directory is given (this requires numpy), the columns are written
+    to files there as they are appended and memory-mapped when read, so that
+    only one chunk of rows is ever held in memory. The files of a column are
+    only open while a chunk is written to them:
+      col<n>.txt -- the fields of column n, back to back
+      col<n>.idx -- the end offset of each field in col<n>.txt, as int64
+      col<n>.f32 -- the values of column n as float32, if it is numeric
+    """
+    def __init__(self, count, directory=None):
+        self.count = count
+        self.rows = 0
+        self.directory = directory
+        self.numeric = [numpy is not None] * count
+        if directory is None:
+            self._text = [[] for i in xrange(count)]
+            self._values = [[] for i in xrange(count)]
+        else:
+            self._sizes = [0] * count
+
+    def _path(self, index, ext):
+        return os.path.join(self.directory, 'col%d.%s' % (index, ext))
+
+    def append(self, rows):
+        """Adds a chunk of rows, each of them a list of fields.
+        """
+        for i in xrange(self.count):
+            fields = [row[i] for row in rows]
+            values = None
+            if self.numeric[i]:
+                try:
+                    values = numpy.array(fields, dtype=numpy.float32)
+                except ValueError:
+                    self.numeric[i] = False
+                    if self.directory is None:
+                        self._values[i] = None
+                    elif os.path.exists(self._path(i, 'f32')):
+                        os.remove(self._path(i, 'f32'))
+            if self.directory is None:
+                self._text[i].extend(fields)
+                if values is not None:
+                    self._values[i].append(values)
+            else:
+                mode = 'ab' if self.rows else 'wb'
+                with open(self._path(i, 'txt'), mode) as fp:
+                    fp.write(''.join(fields))
+                ends = numpy.cumsum([len(f) for f in fields],
+                                    dtype=numpy.int64)
+                ends += self._sizes[i]
+                with open(self._path(i, 'idx'), mode) as fp:
+                    ends.tofile(fp)
+                if len(ends):
+                    self._sizes[i] = int(ends[-1])
+                if values is not None:
+                    with open(self._path(i, 'f32'), mode) as fp:
+                        values.tofile(fp)
+        self.rows += len(rows)
+
+    def finish(self):
+        """Ends the parsing; no rows can be appended after this.
+        """
+        if self.directory is None:
+            for i in xrange(self.count):
+                if self.numeric[i]:
+                    if self._values[i]:
+                        self._values[i] = numpy.concatenate(self._values[i])
+                    else:
+                        self._values[i] = numpy.zeros(0, numpy.float32)
+
+    def _map(self, index, ext, dtype):
+        if self.rows == 0:
+            return numpy.zeros(0, dtype)
+        return numpy.memmap(self._path(index, ext), dtype=dtype, mode='r',
+                            shape=(self.rows,))
+
+    def get_text(self, index):
+        """Returns a column as a list of str.
+        """
+        if self.directory is None:
+            return list(self._text[index])
+        ends = self._map(index, 'idx', numpy.int64).tolist()
+        starts = [0] + ends[:-1]
+        if self._sizes[index] == 0:
+            return [''] * self.rows
+        with open(self._path(index, 'txt'), 'rb') as fp:
+            data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return [data[start:end] for start, end in zip(starts, ends)]
+            finally:
+                data.close()
+
+    def get_numeric(self, index):
+        """Returns a column as a float32 array, or None if not numeric.
+        """
+        if not self.numeric[index]:
+            return None
+        elif self.directory is None:
+            return self._values[index]
+        else:
+            return self._map(index, 'f32', numpy.float32)
+
+
 class CSVTable(TableObject):
+    """A table read from a CSV file.
+
+    The file is only parsed once, the first time it is needed, into a
+    CSVColumns object. If cache_dir is given, the columns are stored in
+    memory-mapped files in that directory instead of in memory.
+    """
+    chunk_rows = 65536
+
     def __init__(self, csv_file, header_present, delimiter,
-                 skip_lines=0, dialect=None, use_sniffer=True):
-        self._rows = None
+                 skip_lines=0, dialect=None, use_sniffer=True,
+                 cache_dir=None):
+        self._store = None
+        self._lock = threading.Lock()
 
         self.header_present = header_present
         self.delimiter = delimiter
         self.filename = csv_file
         self.skip_lines = skip_lines
         self.dialect = dialect
+        self.cache_dir = cache_dir
 
         (self.columns, self.names, self.delimiter,
          self.header_present, self.dialect) = \
@@ -87,45 +208,67 @@ class CSVTable(TableObject):
 
         return column_count, column_names, delimiter, header_present, dialect
 
+    @property
+    def store(self):
+        """The CSVColumns holding the content of the file.
+        """
+        with self._lock:
+            if self._store is None:
+                self._store = self.parse()
+            return self._store
+
+    def parse(self):
+        if self.cache_dir is not None and numpy is not None:
+            store = CSVColumns(self.columns, self.cache_dir)
+        else:
+            store = CSVColumns(self.columns)
+        with open(self.filename, 'rb') as fp:
+            for i in xrange(self.skip_lines):
+                line = fp.readline()
+                if not line:
+                    raise InternalModuleError("skip_lines greater than "
+                                              "the number of lines in the "
+                                              "file")
+            if self.dialect is not None:
+                reader = csv.reader(fp, dialect=self.dialect)
+            else:
+                reader = csv.reader(fp, delimiter=self.delimiter)
+
+            chunk = []
+            for row in reader:
+                if not row:
+                    continue
+                if len(row) < self.columns:
+                    raise InternalModuleError(
+                            "Line %d has %d fields, expected %d" % (
+                            reader.line_num + self.skip_lines, len(row),
+                            self.columns))
+                chunk.append(row)
+                if len(chunk) >= self.chunk_rows:
+                    store.append(chunk)
+                    chunk = []
+            if chunk:
+                store.append(chunk)
+        store.finish()
+        return store
+
     def get_column(self, index, numeric=False):
         if (index, numeric) in self.column_cache:
             return self.column_cache[(index, numeric)]
 
-        if numeric and numpy is not None:
-            result = numpy.loadtxt(
-                    self.filename,
-                    dtype=numpy.float32,
-                    delimiter=self.delimiter,
-                    skiprows=self.skip_lines,
-                    usecols=[index])
+        if numeric:
+            result = self.store.get_numeric(index)
+            if result is None:
+                result = [float(e) for e in self.store.get_text(index)]
         else:
-            with open(self.filename, 'rb') as fp:
-                for i in xrange(self.skip_lines):
-                    line = fp.readline()
-                    if not line:
-                        raise InternalModuleError("skip_lines greater than "
-                                                  "the number of lines in the "
-                                                  "file")
-                if self.dialect is not None:
-                    reader = csv.reader(fp, dialect=self.dialect)
-                else:
-                    reader = csv.reader(fp, delimiter=self.delimiter)
-
-                result = [row[index] for row in reader]
-            if numeric:
-                result = [float(e) for e in result]
+            result = self.store.get_text(index)
 
         self.column_cache[(index, numeric)] = result
         return result
 
     @property
     def rows(self):
-        if self._rows is not None:
-            return self._rows
-        with open(self.filename, 'rb') as fp:
-            self._rows = count_lines(fp)
-        self._rows -= self.skip_lines
-        return self._rows
+        return self.store.rows
 
 
 class CSVFile(Table):
@@ -161,9 +304,12 @@ class CSVFile(Table):
         dialect = self.force_get_input('dialect', None)
         sniff_header = self.get_input('sniff_header')
 
+        cache_dir = self.interpreter.filePool.create_directory(
+                prefix='vt_csv_').name
+
         try:
             table = CSVTable(csv_file, header_present, delimiter, skip_lines,
-                             dialect, sniff_header)
+                             dialect, sniff_header, cache_dir)
         except InternalModuleError, e:
             e.raise_module_error(self)
 
@@ -295,3 +441,94 @@ class TestCountlines(unittest.TestCase):
         # Single newline
         fp = StringIO("\n")
         self.assertEqual(count_lines(fp), 1)
+
+
+class TestCSVTable(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        import tempfile
+        cls._dir = tempfile.mkdtemp(prefix='vt_test_csv_')
+        cls._filename = os.path.join(cls._dir, 'table.csv')
+        with open(cls._filename, 'wb') as fp:
+            fp.write('a,b,c\n')
+            for i in xrange(10):
+                fp.write('%d,"line %d\nx",%s\n' % (i, i, i * 0.5 if i != 7
+                                                     else ''))
+
+    @classmethod
+    def tearDownClass(cls):
+        import shutil
+        shutil.rmtree(cls._dir)
+
+    def check_table(self, table):
+        self.assertEqual(table.names, ['a', 'b', 'c'])
+        self.assertEqual(table.rows, 10)
+        self.assertEqual(table.get_column(0), [str(i) for i in xrange(10)])
+        self.assertEqual(table.get_column(1)[3], 'line 3\nx')
+        self.assertEqual(list(table.get_column(0, True)), range(10))
+        self.assertEqual(table.get_column(2)[6:8], ['3.0', ''])
+        self.assertRaises(ValueError, table.get_column, 2, True)
+
+    def test_memory(self):
+        table = CSVTable(self._filename, True, ',', use_sniffer=False)
+        table.chunk_rows = 3
+        self.check_table(table)
+        self.assertIsNone(table.cache_dir)
+
+    def test_mapped(self):
+        import tempfile
+        cache_dir = tempfile.mkdtemp(dir=self._dir)
+        table = CSVTable(self._filename, True, ',', use_sniffer=False,
+                         cache_dir=cache_dir)
+        table.chunk_rows = 4
+        self.check_table(table)
+        if numpy is not None:
+            self.assertIsInstance(table.get_column(0, True), numpy.memmap)
+            self.assertTrue(os.path.exists(os.path.join(cache_dir,
+                                                        'col1.idx')))
+            # column 2 turned out not to be numeric after the first chunk
+            self.assertTrue(os.path.exists(os.path.join(cache_dir,
+                                                        'col0.f32')))
+            self.assertFalse(os.path.exists(os.path.join(cache_dir,
+                                                         'col2.f32')))
+
+    def test_many_columns(self):
+        """Reads more columns than the process can have files open.
+        """
+        try:
+            import resource
+        except ImportError: # pragma: no cover
+            self.skipTest("resource module not available")
+        import tempfile
+        filename = os.path.join(self._dir, 'wide.csv')
+        with open(filename, 'wb') as fp:
+            for i in xrange(5):
+                fp.write(','.join(str(i * j) for j in xrange(400)))
+                fp.write('\n')
+        cache_dir = tempfile.mkdtemp(dir=self._dir)
+        table = CSVTable(filename, False, ',', use_sniffer=False,
+                         cache_dir=cache_dir)
+        table.chunk_rows = 2
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (256, hard))
+        try:
+            self.assertEqual(table.rows, 5)
+        finally:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+        self.assertEqual(list(table.get_column(399, True)),
+                         [i * 399 for i in xrange(5)])
+
+    def test_parsed_once(self):
+        table = CSVTable(self._filename, True, ',', use_sniffer=False)
+        store = table.store
+        for i in xrange(table.columns):
+            table.get_column(i)
+        self.assertIs(table.store, store)
+
+    def test_short_line(self):
+        filename = os.path.join(self._dir, 'short.csv')
+        with open(filename, 'wb') as fp:
+            fp.write('1,2\n3\n')
+        table = CSVTable(filename, False, ',', use_sniffer=False)
+        with self.assertRaises(InternalModuleError):
+            table.get_column(0)
@@ -11,7 +11,7 @@ from vistrails.core.modules.vistrails_module import Module
 
 
 def execute(modules, connections=[], add_port_specs=[],
-            enable_pkg=True, full_results=False):
+            enable_pkg=True, full_results=False, interpreter=None, **kwargs):
     """Build a pipeline and execute it.
 
     This is useful to simply build a pipeline in a test case, and run it. When
@@ -27,6 +27,8 @@ def execute(modules, connections=[], add_port_specs=[],
                 ('Signature', 'value-as-string'),
             ]),
         ])]
+    A fourth item can be added to a module tuple, listing control parameters
+    as ('name', 'value') pairs.
 
     connections is a list of tuples describing the connections to make, with
     the following format:
@@ -44,6 +46,10 @@ def execute(modules, connections=[], add_port_specs=[],
     It is useful to test modules that can have custom ports through a
     configuration widget.
 
+    The pipeline is run by the non-cached interpreter, unless another
+    interpreter is given. Additional keyword arguments are passed to its
+    execute() method.
+
     The function returns the 'errors' dict it gets from the interpreter, so you
     should use a construct like self.assertFalse(execute(...)) if the execution
     is not supposed to fail.
@@ -73,6 +79,8 @@ def execute(modules, connections=[], add_port_specs=[],
     from vistrails.core.utils import DummyView
     from vistrails.core.vistrail.connection import Connection
     from vistrails.core.vistrail.module import Module
+    from vistrails.core.vistrail.module_control_param import \
+        ModuleControlParam
     from vistrails.core.vistrail.module_function import ModuleFunction
     from vistrails.core.vistrail.module_param import ModuleParam
     from vistrails.core.vistrail.pipeline import Pipeline
@@ -98,7 +106,9 @@ def execute(modules, connections=[], add_port_specs=[],
 
     pipeline = Pipeline()
     module_list = []
-    for i, (name, identifier, functions) in enumerate(modules):
+    for i, module_tuple in enumerate(modules):
+        name, identifier, functions = module_tuple[:3]
+        control_params = module_tuple[3] if len(module_tuple) > 3 else []
         function_list = []
         try:
             pkg = pm.get_package(identifier)
@@ -132,7 +142,12 @@ def execute(modules, connections=[], add_port_specs=[],
                         package=identifier,
                         version=pkg.version,
                         id=i,
-                        functions=function_list)
+                        functions=function_list,
+                        controlParameters=[
+                                ModuleControlParam(id=j, name=cp_name,
+                                                   value=cp_value)
+                                for j, (cp_name, cp_value)
+                                in enumerate(control_params)])
         for port_spec in port_spec_per_module.get(i, []):
             module.add_port_spec(port_spec)
         pipeline.add_module(module)
@@ -156,12 +171,14 @@ def execute(modules, connections=[], add_port_specs=[],
                          signature=d_sig),
                 ]))
 
-    interpreter = Interpreter.get()
+    if interpreter is None:
+        interpreter = Interpreter.get()
     result = interpreter.execute(
             pipeline,
             locator=XMLFileLocator('foo.xml'),
             current_version=1,
-            view=DummyView())
+            view=DummyView(),
+            **kwargs)
     if full_results:
         return result
     else: